@@ -11,5 +11,6 @@ URLS = [
   ('/', stats.MainPage),
   ('/stats', stats.MainPage),
   ('/upload_command_stats', stats.PostPage),
+  ('/upload_command_stats_batch', stats.BatchPostPage),
 ]
 app = webapp2.WSGIApplication(URLS, debug=True)
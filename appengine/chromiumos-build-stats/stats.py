@@ -208,50 +208,97 @@ class MainPage(webapp2.RequestHandler):
     return stats_dict
 
 
+NO_VALUE = '__NO_VALUE_AT_ALL__'
+
+
+def _CreateStat(get, **kwargs):
+  """Create a new Statistics entity from the properties |get| returns.
+
+  Args:
+    get: Function taking a property name and a default value, returning the
+      value of that property.
+    kwargs: Extra properties to initialize the entity with.
+
+  Returns:
+    A new (unsaved) model.Statistics instance.
+  """
+  new_stat = model.Statistics(parent=DATASTORE_KEY, **kwargs)
+
+  # Check each supported DB property to see if it has a value set.
+  for prop in model.Statistics.properties():
+    # Skip properties with auto_now or auto_now_add enabled.
+    model_prop = getattr(model.Statistics, prop)
+    if ((hasattr(model_prop, 'auto_now_add') and model_prop.auto_now_add) or
+        (hasattr(model_prop, 'auto_now') and model_prop.auto_now)):
+      continue
+
+    value = get(prop, NO_VALUE)
+
+    if value is not NO_VALUE:
+      # String properties must be 500 characters or less (GQL requirement).
+      if isinstance(model_prop, db.StringProperty) and len(value) > 500:
+        logging.debug('  String property %r too long.  Cutting off at 500'
+                      ' characters.', prop)
+        value = value[:500]
+
+      # Integer properties require casting
+      if isinstance(model_prop, db.IntegerProperty):
+        value = int(value)
+
+      logging.debug('  Stats POST property %r ==> %r', prop, value)
+      setattr(new_stat, prop, value)
+
+  # Use automatically set end_datetime prop to set end_date and end_time.
+  new_stat.end_time = new_stat.end_datetime.time()
+  new_stat.end_date = new_stat.end_datetime.date()
+
+  return new_stat
+
+
 class PostPage(webapp2.RequestHandler):
   """Provides interface for uploading command stats to database."""
 
-  NO_VALUE = '__NO_VALUE_AT_ALL__'
-
   def post(self):
     """Support POST of command stats."""
     logging.info('Stats POST received at %r', self.request.uri)
 
-    new_stat = model.Statistics(parent=DATASTORE_KEY)
-
-    # Check each supported DB property to see if it has a value set
-    # in the POST request.
-    for prop in model.Statistics.properties():
-      # Skip properties with auto_now or auto_now_add enabled.
-      model_prop = getattr(model.Statistics, prop)
-      if ((hasattr(model_prop, 'auto_now_add') and model_prop.auto_now_add) or
-          (hasattr(model_prop, 'auto_now') and model_prop.auto_now)):
-        continue
-
-      # Note that using hasattr with self.request does not work at all.
-      # It (almost) always says the attribute is not present, when getattr
-      # does actually return a value.  Also note that self.request.get is
-      # not returning None as the default value if no explicit default value
-      # is provided, contrary to the spec for dict.get.
-      value = self.request.get(prop, self.NO_VALUE)
-
-      if value is not self.NO_VALUE:
-        # String properties must be 500 characters or less (GQL requirement).
-        if isinstance(model_prop, db.StringProperty) and len(value) > 500:
-          logging.debug('  String property %r too long.  Cutting off at 500'
-                        ' characters.', prop)
-          value = value[:500]
-
-        # Integer properties require casting
-        if isinstance(model_prop, db.IntegerProperty):
-          value = int(value)
-
-        logging.debug('  Stats POST property %r ==> %r', prop, value)
-        setattr(new_stat, prop, value)
-
-    # Use automatically set end_datetime prop to set end_date and end_time.
-    new_stat.end_time = new_stat.end_datetime.time()
-    new_stat.end_date = new_stat.end_datetime.date()
+    # Note that using hasattr with self.request does not work at all.
+    # It (almost) always says the attribute is not present, when getattr
+    # does actually return a value.  Also note that self.request.get is
+    # not returning None as the default value if no explicit default value
+    # is provided, contrary to the spec for dict.get.
+    new_stat = _CreateStat(self.request.get)
 
     # Save to model.
     new_stat.put()
+
+
+class BatchPostPage(webapp2.RequestHandler):
+  """Provides interface for uploading many command stats at once.
+
+  The body of the request is a json dictionary with a list of 'records', each
+  a dictionary of the properties that PostPage takes.  Records may also set
+  'end_datetime' to when the command finished (in seconds since the epoch);
+  it defaults to now.
+  """
+
+  def post(self):
+    """Support POST of a batch of command stats."""
+    logging.info('Stats batch POST received at %r', self.request.uri)
+
+    try:
+      records = json.loads(self.request.body)['records']
+    except (ValueError, KeyError, TypeError):
+      self.abort(400, 'Expected a json dictionary of records')
+
+    new_stats = []
+    for record in records:
+      kwargs = {}
+      end_datetime = record.pop('end_datetime', None)
+      if end_datetime is not None:
+        kwargs['end_datetime'] = datetime.datetime.utcfromtimestamp(
+            end_datetime)
+      new_stats.append(_CreateStat(record.get, **kwargs))
+
+    # Save them all to the model in one go.
+    db.put(new_stats)
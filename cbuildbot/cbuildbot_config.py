@@ -14,6 +14,9 @@ import json
 
 GS_PATH_DEFAULT = 'default' # Means gs://chromeos-image-archive/ + bot_id
 
+# Config values of these types are immutable, so derive() need not copy them.
+_IMMUTABLE_TYPES = (basestring, bool, int, long, float, type(None))
+
 # Contains the valid build config suffixes in the order that they are dumped.
 CONFIG_TYPE_PALADIN = 'paladin'
 CONFIG_TYPE_RELEASE = 'release'
@@ -793,8 +796,16 @@ class _config(dict):
   Each dictionary entry is in turn a dictionary of config_param->value.
 
   See _settings for details on known configurations, and their documentation.
+
+  Deriving configs is copy-on-read: mutable values that a derived config
+  takes over unchanged are shared with the config they came from, and are
+  only copied the first time they are handed out.  Values that have been
+  handed out are private to their config; deriving from it copies them.
   """
 
+  # Keys whose values may be shared with other configs.
+  _shared = frozenset()
+
   def __getattr__(self, name):
     """Support attribute-like access to each dict entry."""
     if name in self:
@@ -803,6 +814,74 @@ class _config(dict):
     # Super class (dict) has no __getattr__ method, so use __getattribute__.
     return super(_config, self).__getattribute__(name)
 
+  def __getitem__(self, key):
+    value = dict.__getitem__(self, key)
+    if key in self._shared:
+      self._shared.discard(key)
+      if not isinstance(value, _IMMUTABLE_TYPES):
+        value = copy.deepcopy(value)
+        dict.__setitem__(self, key, value)
+    return value
+
+  def __setitem__(self, key, value):
+    self._Unshare((key,))
+    dict.__setitem__(self, key, value)
+
+  def _Unshare(self, keys):
+    """Mark |keys| as no longer holding shared values."""
+    if self._shared:
+      self._shared.difference_update(keys)
+
+  def get(self, key, default=None):
+    return self[key] if key in self else default
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self[key] = default
+    return self[key]
+
+  def pop(self, key, *args):
+    if key in self:
+      value = self[key]
+      del self[key]
+      return value
+    return dict.pop(self, key, *args)
+
+  def popitem(self):
+    for key in self:
+      return key, self.pop(key)
+    return dict.popitem(self)
+
+  def update(self, *args, **kwargs):
+    for mapping in args + (kwargs,):
+      for key, value in dict(mapping).iteritems():
+        self[key] = value
+
+  def copy(self):
+    return _config(self.iteritems())
+
+  def iteritems(self):
+    for key in self:
+      yield key, self[key]
+
+  def itervalues(self):
+    for key in self:
+      yield self[key]
+
+  def items(self):
+    return list(self.iteritems())
+
+  def values(self):
+    return list(self.itervalues())
+
+  def __deepcopy__(self, memo):
+    # Values still shared can stay that way; derive() copies the others.
+    new_config = memo[id(self)] = self.derive()
+    return new_config
+
+  def __reduce__(self):
+    return (_config, (dict.items(self),))
+
   def GetBotId(self, remote_trybot=False):
     """Get the 'bot id' of a particular bot.
 
@@ -825,14 +904,26 @@ class _config(dict):
     Returns:
       A new _config instance.
     """
+    # pylint: disable=W0212
     inherits, overrides = args, kwargs
-    new_config = copy.deepcopy(self)
-    for update_config in inherits:
-      new_config.update(update_config)
-
-    new_config.update(overrides)
-
-    return copy.deepcopy(new_config)
+    values = {}
+    for update_config in (self,) + inherits + (overrides,):
+      shared = (update_config._shared if isinstance(update_config, _config)
+                else ())
+      for key, value in dict.iteritems(update_config):
+        values[key] = (value, key in shared)
+
+    # Values that are not shared may be held by whoever passed them in, so
+    # take a copy of those.  Everything the new config ends up with is then
+    # only shared between configs, and gets copied when first read.
+    memo = {}
+    new_config = _config()
+    for key, (value, shared) in values.iteritems():
+      if not shared and not isinstance(value, _IMMUTABLE_TYPES):
+        value = copy.deepcopy(value, memo)
+      dict.__setitem__(new_config, key, value)
+    new_config._shared = set(values)
+    return new_config
 
   def add_config(self, name, *args, **kwargs):
     """Derive and add the config to cbuildbot's usable config targets
@@ -6,6 +6,7 @@
 
 """Unittests for config.  Needs to be run inside of chroot for mox."""
 
+import copy
 import mock
 import os
 import cPickle
@@ -62,6 +63,78 @@ class ConfigClassTest(cros_test_lib.TestCase):
 
     self.assertRaises(AttributeError, getattr, cfg, 'foobar')
 
+  def testDeriveIsolation(self):
+    """Changes to values of a derived config should not leak into others."""
+    # pylint: disable=W0212
+    boards = ['x86-generic']
+    base = cbuildbot_config._config(boards=boards, vm_tests=[])
+    base_tests = base.vm_tests
+    derived = base.derive(name='foo')
+    other = derived.derive(name='bar')
+
+    derived.boards.append('amd64-generic')
+    derived['vm_tests'].append('smoke')
+    other.get('vm_tests').append('full')
+    base_tests.append('simple')
+
+    self.assertEqual(boards, ['x86-generic'])
+    self.assertEqual(base.boards, ['x86-generic'])
+    self.assertEqual(derived.boards, ['x86-generic', 'amd64-generic'])
+    self.assertEqual(other.boards, ['x86-generic'])
+    self.assertEqual(base.vm_tests, ['simple'])
+    self.assertEqual(derived.vm_tests, ['smoke'])
+    self.assertEqual(other.vm_tests, ['full'])
+
+  def testDeriveParentValues(self):
+    """Values held by the parent config should not leak into derived ones."""
+    # pylint: disable=W0212
+    base = cbuildbot_config._config(hw_tests=[])
+    tests = base.hw_tests
+    derived = base.derive(name='derived')
+    tests.append('leak')
+    self.assertEqual(base.hw_tests, ['leak'])
+    self.assertEqual(derived.hw_tests, [])
+
+  def testDeriveInherits(self):
+    """Mappings mixed into a config should not be shared with it."""
+    # pylint: disable=W0212
+    mixin = {'vm_tests': ['smoke']}
+    derived = cbuildbot_config._config().derive(mixin)
+    mixin['vm_tests'].append('leak')
+    derived.vm_tests.append('full')
+    self.assertEqual(mixin['vm_tests'], ['smoke', 'leak'])
+    self.assertEqual(derived.vm_tests, ['smoke', 'full'])
+
+  def testDeriveShares(self):
+    """Unchanged values should be shared until they are read."""
+    # pylint: disable=W0212
+    base = cbuildbot_config._config(boards=['x86-generic']).derive()
+    derived = base.derive(name='foo')
+    copied = copy.deepcopy(derived)
+    self.assertIs(dict.__getitem__(derived, 'boards'),
+                  dict.__getitem__(base, 'boards'))
+    self.assertIs(dict.__getitem__(copied, 'boards'),
+                  dict.__getitem__(base, 'boards'))
+
+    derived.boards.append('amd64-generic')
+    self.assertIsNot(dict.__getitem__(derived, 'boards'),
+                     dict.__getitem__(base, 'boards'))
+    self.assertEqual(base.boards, ['x86-generic'])
+    self.assertEqual(copied.boards, ['x86-generic'])
+
+    # Once handed out, a value is no longer shared with new configs.
+    other = base.derive()
+    base.boards.append('leak')
+    self.assertEqual(other.boards, ['x86-generic'])
+
+  def testDeriveCopies(self):
+    """Copies of configs should not share values with the original."""
+    cfg = cbuildbot_config.config['x86-mario-paladin']
+    for new_cfg in (copy.deepcopy(cfg), cPickle.loads(cPickle.dumps(cfg))):
+      self.assertEqual(new_cfg, cfg)
+      new_cfg.boards.append('foo')
+      self.assertNotIn('foo', cfg.boards)
+
 
 class CBuildBotTest(cros_test_lib.MoxTestCase):
   """General tests of cbuildbot_config with respect to cbuildbot."""
@@ -18,6 +18,7 @@ from chromite.cbuildbot import archive_lib
 from chromite.cbuildbot import cbuildbot_config
 from chromite.cbuildbot import results_lib
 from chromite.cbuildbot import constants
+from chromite.lib import cidb
 from chromite.lib import cros_build_lib
 from chromite.lib import gs
 from chromite.lib import parallel
@@ -182,9 +183,16 @@ class CBuildbotMetadata(object):
     """Return a JSON string representation of metadata."""
     return json.dumps(self.GetDict())
 
+  def GetValue(self, key, default=None):
+    """Return the metadata value of |key|, or |default| if there is none."""
+    return self._metadata_dict.get(key, default)
+
   def RecordCLAction(self, change, action, timestamp=None, reason=''):
     """Record an action that was taken on a CL, to the metadata.
 
+    If this build is in CIDB (see ReportBuildStartStage), the action is
+    queued up to be written there too.
+
     Args:
       change: A GerritPatch object for the change acted on.
       action: The action taken, should be one of constants.CL_ACTIONS
@@ -201,6 +209,12 @@ class CBuildbotMetadata(object):
                  reason or '')
 
     self._cl_action_list.append(cl_action)
+
+    writer = cidb.GetWriter()
+    build_id = self.GetValue('build_id')
+    if writer is not None and build_id is not None:
+      writer.AddCLAction(build_id, cl_action)
+
     return self
 
   @staticmethod
@@ -14,6 +14,7 @@ sys.path.insert(0, os.path.abspath('%s/../..' % os.path.dirname(__file__)))
 from chromite.cbuildbot import metadata_lib
 from chromite.cbuildbot import results_lib
 from chromite.cbuildbot import constants
+from chromite.lib import cidb
 from chromite.lib import cros_test_lib
 from chromite.lib import parallel
 
@@ -127,5 +128,24 @@ class MetadataTest(cros_test_lib.TestCase):
                      len(ending_dict['cl_actions']))
 
 
+class MetadataCIDBTest(cros_test_lib.MockTestCase):
+  """Tests that metadata gets written along to CIDB."""
+
+  def testRecordCLAction(self):
+    writer = self.PatchObject(cidb, '_WRITER')
+    metadata = metadata_lib.CBuildbotMetadata()
+    fake_change = metadata_lib.GerritPatchTuple(12345, 1, False)
+
+    # Nothing should be written until the build is in CIDB.
+    metadata.RecordCLAction(fake_change, constants.CL_ACTION_PICKED_UP, 1000)
+    self.assertFalse(writer.AddCLAction.called)
+
+    metadata.UpdateWithDict({'build_id': 7})
+    metadata.RecordCLAction(fake_change, constants.CL_ACTION_SUBMITTED, 2000)
+    writer.AddCLAction.assert_called_once_with(
+        7, ({'gerrit_number': 12345, 'patch_number': 1, 'internal': False},
+            constants.CL_ACTION_SUBMITTED, 2000, ''))
+
+
 if __name__ == '__main__':
   cros_test_lib.main(level=logging.DEBUG)
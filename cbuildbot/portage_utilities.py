@@ -8,11 +8,13 @@ import collections
 import filecmp
 import fileinput
 import glob
+import json
 import logging
 import multiprocessing
 import os
 import re
 import shutil
+import socket
 import sys
 
 from chromite.cbuildbot import constants
@@ -934,6 +936,168 @@ def ListInstalledPackages(sysroot):
   return packages
 
 
+# Where portageq_server listens for queries about a sysroot (in the chroot).
+_PORTAGEQ_SOCKET = '/tmp/portageq-%s.sock'
+
+
+def GetPortageqSocketPath(board=None):
+  """Return the (chroot) path portageq_server listens on for |board|."""
+  return _PORTAGEQ_SOCKET % (board or 'host')
+
+
+def _GetPathFromChroot(path, buildroot):
+  """Return where the chroot |path| of |buildroot| is from where we run."""
+  if cros_build_lib.IsInsideChroot():
+    return path
+  return os.path.join(buildroot, constants.DEFAULT_CHROOT_DIR,
+                      path.lstrip(os.path.sep))
+
+
+class Portageq(object):
+  """Query the portage database of a sysroot.
+
+  Running portageq means loading portage and its databases every time, which
+  often takes seconds.  So queries go to a portageq_server kept running in the
+  chroot for the sysroot (we start it on first use).  If the server can't be
+  used, or it can't answer a query, we fall back to running portageq.
+  """
+
+  # How long to wait on the server (the first query has to load portage).
+  SERVER_TIMEOUT = 120
+
+  def __init__(self, board=None, buildroot=constants.SOURCE_ROOT):
+    """Initialize.
+
+    Args:
+      board: Board to look at.  By default, look in chroot.
+      buildroot: Source root the chroot belongs to.
+    """
+    self.board = board
+    self.buildroot = buildroot
+    self.sysroot = cros_build_lib.GetSysroot(board=board)
+    self._use_server = True
+
+  def _GetSocketPath(self):
+    """Return the path to the server socket usable from where we run."""
+    return _GetPathFromChroot(GetPortageqSocketPath(self.board),
+                              self.buildroot)
+
+  def _Connect(self, start=True):
+    """Connect to the server, starting it if need be."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(self.SERVER_TIMEOUT)
+    try:
+      sock.connect(self._GetSocketPath())
+    except socket.error:
+      sock.close()
+      if not start:
+        raise
+      cmd = [os.path.join(constants.CHROOT_SOURCE_ROOT, 'chromite', 'bin',
+                          'portageq_server'), '--daemon']
+      if self.board:
+        cmd += ['--board', self.board]
+      cros_build_lib.RunCommand(
+          cmd, cwd=self.buildroot, enter_chroot=True,
+          debug_level=logging.DEBUG, capture_output=True)
+      return self._Connect(start=False)
+    return sock
+
+  def _QueryServer(self, cmd, args):
+    """Send the query |cmd| to the server & return its answer."""
+    sock = self._Connect()
+    try:
+      sock.sendall(json.dumps({'cmd': cmd, 'args': args}) + '\n')
+      f = sock.makefile('r')
+      reply = json.loads(f.readline())
+      f.close()
+    finally:
+      sock.close()
+    if 'error' in reply:
+      raise ValueError(reply['error'])
+    return reply['result']
+
+  def _RunPortageq(self, cmd, args, **kwargs):
+    """Run portageq |cmd| & return its output."""
+    portageq = 'portageq' if self.board is None else 'portageq-%s' % self.board
+    result = cros_build_lib.RunCommand(
+        [portageq, cmd] + args, cwd=self.buildroot, enter_chroot=True,
+        debug_level=logging.DEBUG, capture_output=True, **kwargs)
+    return result.output
+
+  def _Query(self, cmd, server_args, portageq_args, **kwargs):
+    """Run query |cmd| on the server if we can, else via portageq.
+
+    Returns:
+      A tuple of the answer from the server and the output of portageq; only
+      one of them is set (the other is None).
+    """
+    if self._use_server:
+      try:
+        return self._QueryServer(cmd, server_args), None
+      except ValueError as e:
+        # Let portageq deal with (and report) the bad query.
+        logging.debug('portageq_server could not answer %s %s: %s',
+                      cmd, server_args, e)
+      except (socket.error, cros_build_lib.RunCommandError) as e:
+        cros_build_lib.Warning('portageq_server unusable; falling back to '
+                               'portageq: %s', e)
+        self._use_server = False
+    return None, self._RunPortageq(cmd, portageq_args, **kwargs)
+
+  def BestVisible(self, atom, pkg_type='ebuild'):
+    """Return the best visible CPV (a string) for |atom| (or '')."""
+    result, output = self._Query('best_visible', [pkg_type, atom],
+                                 [self.sysroot, pkg_type, atom])
+    return output.strip() if result is None else result
+
+  def EnvVar(self, envvar, **kwargs):
+    """Return the value of the portage config variable |envvar|."""
+    result, output = self._Query('envvar', [envvar], [envvar], **kwargs)
+    return output.rstrip('\n') if result is None else result[0]
+
+  def Match(self, atom):
+    """Return the list of installed CPVs matching |atom|."""
+    result, output = self._Query('match', [atom], [self.sysroot, atom],
+                                 error_code_ok=True)
+    return output.split() if result is None else result
+
+  def Contents(self, cpv):
+    """Return the list of files installed by |cpv|."""
+    result, output = self._Query('contents', [cpv], [self.sysroot, cpv])
+    return output.splitlines() if result is None else result
+
+
+_PORTAGEQ_INSTANCES = {}
+
+
+def GetPortageq(board=None, buildroot=constants.SOURCE_ROOT):
+  """Return the (shared) Portageq instance for |board|."""
+  key = (board, buildroot)
+  if key not in _PORTAGEQ_INSTANCES:
+    _PORTAGEQ_INSTANCES[key] = Portageq(board=board, buildroot=buildroot)
+  return _PORTAGEQ_INSTANCES[key]
+
+
+def ShutdownPortageqServers(buildroot=constants.SOURCE_ROOT):
+  """Ask all the portageq_servers in the chroot of |buildroot| to exit.
+
+  They exit on their own once idle, but until then they keep the chroot busy
+  (e.g. so it can't be unmounted).
+  """
+  pattern = _GetPathFromChroot(GetPortageqSocketPath('*'), buildroot)
+  for path in glob.glob(pattern):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(Portageq.SERVER_TIMEOUT)
+    try:
+      sock.connect(path)
+      sock.sendall(json.dumps({'cmd': 'shutdown', 'args': []}) + '\n')
+      sock.makefile('r').readline()
+    except socket.error as e:
+      logging.debug('could not shut down portageq_server on %s: %s', path, e)
+    finally:
+      sock.close()
+
+
 def BestVisible(atom, board=None, pkg_type='ebuild',
                 buildroot=constants.SOURCE_ROOT):
   """Get the best visible ebuild CPV for the given atom.
@@ -947,13 +1111,8 @@ def BestVisible(atom, board=None, pkg_type='ebuild',
   Returns:
     A CPV object.
   """
-  portageq = 'portageq' if board is None else 'portageq-%s' % board
-  root = cros_build_lib.GetSysroot(board=board)
-  cmd = [portageq, 'best_visible', root, pkg_type, atom]
-  result = cros_build_lib.RunCommand(
-      cmd, cwd=buildroot, enter_chroot=True, debug_level=logging.DEBUG,
-      capture_output=True)
-  return SplitCPV(result.output.strip())
+  portageq = GetPortageq(board=board, buildroot=buildroot)
+  return SplitCPV(portageq.BestVisible(atom, pkg_type=pkg_type))
 
 
 def IsPackageInstalled(package, sysroot='/'):
@@ -9,6 +9,7 @@ import logging
 import os
 import re
 import shutil
+from xml import sax
 
 from chromite.lib import cros_build_lib
 from chromite.lib import git
@@ -142,6 +143,17 @@ class RepoRepository(object):
   # If a repo hasn't been used in the last 5 runs, wipe it.
   LRU_THRESHOLD = 5
 
+  # Where incremental syncs record the revision locked manifest they synced
+  # to, relative to the .repo directory.
+  SYNCED_MANIFEST = 'synced_manifest.xml'
+
+  # The default --jobs for checking out the changed projects of an incremental
+  # sync.
+  INCREMENTAL_CHECKOUT_JOBS = 8
+
+  # The project attributes that, if changed, require the project to be synced.
+  _PROJECT_SYNC_KEYS = ('name', 'remote', 'revision')
+
   def __init__(self, repo_url, directory, branch=None, referenced_repo=None,
                manifest=constants.DEFAULT_MANIFEST, depth=None):
     self.repo_url = repo_url
@@ -290,7 +302,7 @@ class RepoRepository(object):
                               cwd=self.directory)
 
   def Sync(self, local_manifest=None, jobs=None, all_branches=True,
-           network_only=False):
+           network_only=False, incremental=False):
     """Sync/update the source.  Changes manifest if specified.
 
     Args:
@@ -307,6 +319,11 @@ class RepoRepository(object):
         if the manifest has bad copyfile statements, via skipping checkout
         the broken copyfile tag won't be spotted), or of use when the
         invoking code is fine w/ operating on bare repos, ie .repo/projects/*.
+      incremental: If true, only fetch and check out the projects that changed
+        since the last incremental sync.  See _GetChangedProjects for when
+        this falls back to a full sync.  Recording what was synced for next
+        time costs an ExportManifest (a git call per project), so that is only
+        done when the manifest is revision locked.
     """
     try:
       # Always re-initialize to the current branch.
@@ -319,61 +336,191 @@ class RepoRepository(object):
         cmd += ['--jobs', str(jobs)]
       if not all_branches:
         cmd.append('-c')
-      # Do the network half of the sync; retry as necessary to get the content.
-      retry_util.RunCommandWithRetries(constants.SYNC_RETRIES, cmd + ['-n'],
-                                       cwd=self.directory)
 
-      if network_only:
-        return
-
-      # Do the local sync; note that there is a couple of corner cases where
-      # the new manifest cannot transition from the old checkout cleanly-
-      # primarily involving git submodules.  Thus we intercept, and do
-      # a forced wipe, then a retry.
-      try:
-        cros_build_lib.RunCommand(cmd + ['-l'], cwd=self.directory)
-      except cros_build_lib.RunCommandError:
-        manifest = git.ManifestCheckout.Cached(self.directory)
-        targets = set(project['path'].split('/', 1)[0]
-                      for project in manifest.ListCheckouts())
-        if not targets:
-          # No directories to wipe, thus nothing we can fix.
-          raise
-
-        cros_build_lib.SudoRunCommand(['rm', '-rf'] + sorted(targets),
-                                      cwd=self.directory)
-
-        # Retry the sync now; if it fails, let the exception propagate.
-        cros_build_lib.RunCommand(cmd + ['-l'], cwd=self.directory)
+      synced_manifest = self.GetRelativePath(
+          os.path.join('.repo', self.SYNCED_MANIFEST))
+      projects = None
+      if incremental and not network_only:
+        projects = self._GetChangedProjects(synced_manifest)
+      # Whatever happens next, the record of the last sync is out of date.
+      osutils.SafeUnlink(synced_manifest)
+
+      if projects is not None:
+        try:
+          self._SyncProjects(cmd, projects, jobs=jobs)
+        except cros_build_lib.RunCommandError as e:
+          cros_build_lib.Warning('Incremental sync failed; falling back to a '
+                                 'full sync: %s', e)
+          projects = None
+
+      if projects is None:
+        # Do the network half of the sync; retry as necessary to get the
+        # content.
+        retry_util.RunCommandWithRetries(constants.SYNC_RETRIES, cmd + ['-n'],
+                                         cwd=self.directory)
+
+        if network_only:
+          return
+
+        # Do the local sync; note that there is a couple of corner cases where
+        # the new manifest cannot transition from the old checkout cleanly-
+        # primarily involving git submodules.  Thus we intercept, and do
+        # a forced wipe, then a retry.
+        try:
+          cros_build_lib.RunCommand(cmd + ['-l'], cwd=self.directory)
+        except cros_build_lib.RunCommandError:
+          manifest = git.ManifestCheckout.Cached(self.directory)
+          targets = set(project['path'].split('/', 1)[0]
+                        for project in manifest.ListCheckouts())
+          if not targets:
+            # No directories to wipe, thus nothing we can fix.
+            raise
+
+          cros_build_lib.SudoRunCommand(['rm', '-rf'] + sorted(targets),
+                                        cwd=self.directory)
+
+          # Retry the sync now; if it fails, let the exception propagate.
+          cros_build_lib.RunCommand(cmd + ['-l'], cwd=self.directory)
 
       # We do a second run to fix any new repositories created by repo to
       # use relative object pathways.  Note that cros_sdk also triggers the
       # same cleanup- we however kick it erring on the side of caution.
       self._EnsureMirroring(True)
-      self._DoCleanup()
+      self._DoCleanup(incremental=projects is not None)
+
+      # Incremental syncs only work from revision locked manifests, so don't
+      # bother recording anything for the others.
+      if incremental and self._IsRevisionLocked():
+        osutils.WriteFile(synced_manifest, self.ExportManifest())
 
     except cros_build_lib.RunCommandError as e:
       err_msg = e.Stringify(error=False, output=False)
       logging.error(err_msg)
       raise SrcCheckOutException(err_msg)
 
-  def _DoCleanup(self):
-    """Wipe unused repositories."""
+  def _GetCheckoutHead(self, path):
+    """Return what the checkout of the project at |path| has checked out.
 
-    # Find all projects, even if they're not in the manifest.  Note the find
-    # trickery this is done to keep it as fast as possible.
-    repo_path = os.path.join(self.directory, '.repo', 'projects')
-    current = set(cros_build_lib.RunCommand(
-        ['find', repo_path, '-type', 'd', '-name', '*.git', '-printf', '%P\n',
-         '-a', '!', '-wholename',  '*.git/*', '-prune'],
-        print_cmd=False, capture_output=True).output.splitlines())
-    data = {}.fromkeys(current, 0)
+    This is a sha1 for a detached checkout, as left by `repo sync`.  It is
+    read straight from disk, as running git for every project is slow.
+    """
+    try:
+      return osutils.ReadFile(
+          os.path.join(self.directory, path, '.git', 'HEAD')).strip()
+    except EnvironmentError:
+      return None
+
+  def _GetChangedProjects(self, synced_manifest):
+    """Work out which projects need syncing for an incremental sync.
+
+    Args:
+      synced_manifest: The revision locked manifest of the last sync.
+
+    Returns:
+      A list of the paths of the projects that changed between
+      |synced_manifest| and the new manifest, or whose checkouts have moved
+      off their revision since (e.g. because patches were applied).  None if
+      a full sync is needed instead: |synced_manifest| is missing, the new
+      manifest is not revision locked, or projects or remotes changed.
+    """
+    if not os.path.exists(synced_manifest):
+      logging.info('No record of the last sync; doing a full sync.')
+      return None
+
+    try:
+      old = git.Manifest(synced_manifest)
+      new = self._GetManifest()
+    except (EnvironmentError, sax.SAXException) as e:
+      cros_build_lib.Warning('Failed to parse manifests; doing a full sync: '
+                             '%s', e)
+      return None
+
+    fetch_urls = lambda m: dict((k, v.get('fetch'))
+                                for k, v in m.remotes.iteritems())
+    if (set(old.checkouts_by_path) != set(new.checkouts_by_path) or
+        fetch_urls(old) != fetch_urls(new)):
+      logging.info('Projects were added or removed; doing a full sync.')
+      return None
+
+    changed = []
+    for path, attrs in sorted(new.checkouts_by_path.iteritems()):
+      if not git.IsSHA1(attrs['revision']):
+        logging.info('Manifest is not revision locked; doing a full sync.')
+        return None
+      old_attrs = old.checkouts_by_path[path]
+      # Checking out a project also redoes its <copyfile> & <linkfile> tags.
+      if (any(old_attrs[k] != attrs[k] for k in self._PROJECT_SYNC_KEYS) or
+          old.copies_by_path.get(path) != new.copies_by_path.get(path) or
+          self._GetCheckoutHead(path) != attrs['revision']):
+        changed.append(path)
+    return changed
+
+  def _GetManifest(self):
+    """Parse the manifest we're syncing to."""
+    return git.Manifest(
+        self.GetRelativePath('.repo/manifest.xml'),
+        manifest_include_dir=self.GetRelativePath('.repo/manifests'))
+
+  def _IsRevisionLocked(self):
+    """Whether every project in the manifest is pinned to a sha1."""
+    try:
+      manifest = self._GetManifest()
+    except (EnvironmentError, sax.SAXException):
+      return False
+    return all(git.IsSHA1(attrs['revision'])
+               for attrs in manifest.checkouts_by_path.itervalues())
+
+  def _SyncProjects(self, cmd, projects, jobs=None):
+    """Fetch and check out just |projects|.
+
+    Args:
+      cmd: The `repo sync` command to use.
+      projects: The paths of the projects to sync.
+      jobs: The --jobs the caller asked for, if any (|cmd| already has it).
+    """
+    if not projects:
+      logging.info('No projects changed since the last sync.')
+      return
+
+    logging.info('Incrementally syncing %i projects: %s', len(projects),
+                 ' '.join(projects))
+    retry_util.RunCommandWithRetries(constants.SYNC_RETRIES,
+                                     cmd + ['-n'] + projects,
+                                     cwd=self.directory)
+
+    # repo does not support running more than once at a time in the same
+    # checkout, so leave checking out the projects in parallel up to it.
+    checkout_cmd = cmd + ['-l']
+    if not jobs:
+      checkout_cmd += ['--jobs', str(self.INCREMENTAL_CHECKOUT_JOBS)]
+    cros_build_lib.RunCommand(checkout_cmd + projects, cwd=self.directory)
 
+  def _DoCleanup(self, incremental=False):
+    """Wipe unused repositories.
+
+    Args:
+      incremental: Whether the sync was incremental.  Incremental syncs never
+        add or remove projects, so the projects on disk are just the ones
+        recorded by the last cleanup, and we can skip searching for them.
+    """
     path = os.path.join(self.directory, '.repo', 'project.lru')
+    existing = []
     if os.path.exists(path):
       existing = [x.strip().split(None, 1)
                   for x in osutils.ReadFile(path).splitlines()]
-      data.update((k, int(v)) for k, v in existing if k in current)
+
+    repo_path = os.path.join(self.directory, '.repo', 'projects')
+    if incremental and existing:
+      current = set(k for k, _ in existing)
+    else:
+      # Find all projects, even if they're not in the manifest.  Note the find
+      # trickery this is done to keep it as fast as possible.
+      current = set(cros_build_lib.RunCommand(
+          ['find', repo_path, '-type', 'd', '-name', '*.git', '-printf',
+           '%P\n', '-a', '!', '-wholename',  '*.git/*', '-prune'],
+          print_cmd=False, capture_output=True).output.splitlines())
+    data = {}.fromkeys(current, 0)
+    data.update((k, int(v)) for k, v in existing if k in current)
 
     # Increment it all...
     data.update((k, v + 1) for k, v in data.iteritems())
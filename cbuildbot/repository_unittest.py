@@ -15,6 +15,9 @@ sys.path.insert(0, constants.SOURCE_ROOT)
 from chromite.cbuildbot import repository
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
+from chromite.lib import git
+from chromite.lib import osutils
+from chromite.lib import retry_util
 
 # pylint: disable=W0212,R0904,E1101,W0613
 class RepositoryTests(cros_test_lib.MoxTestCase):
@@ -84,5 +87,128 @@ class RepoInitChromeBotTests(RepoInitTests):
     os.putenv('GIT_AUTHOR_EMAIL', 'chrome-bot@chromium.org')
 
 
+
+class IncrementalSyncTests(cros_test_lib.MockTempDirTestCase):
+  """Test cases for working out what an incremental sync needs to do."""
+
+  MANIFEST = """<?xml version="1.0" encoding="UTF-8"?>
+<manifest>
+  <remote name="cros" fetch="https://chromium.googlesource.com" />
+  <default remote="cros" revision="refs/heads/master" />
+%s
+</manifest>
+"""
+
+  SHA1_A = 'a' * 40
+  SHA1_B = 'b' * 40
+
+  def setUp(self):
+    self.repo = repository.RepoRepository(constants.MANIFEST_URL, self.tempdir)
+    self.synced_manifest = os.path.join(
+        self.tempdir, '.repo', repository.RepoRepository.SYNCED_MANIFEST)
+    self.projects = {'src/foo': self.SHA1_A, 'src/bar': self.SHA1_A}
+    self._WriteManifest(self.synced_manifest, self.projects)
+    self._WriteManifest(os.path.join(self.tempdir, '.repo', 'manifest.xml'),
+                        self.projects)
+    for path, revision in self.projects.iteritems():
+      self._WriteHead(path, revision)
+
+  def _WriteManifest(self, path, projects, copies=None):
+    copies = copies or {}
+    lines = []
+    for p, rev in sorted(projects.iteritems()):
+      lines.append('  <project name="%s" path="%s" revision="%s">' %
+                   (p, p, rev))
+      lines.extend('    <%s src="%s" dest="%s" />' % x
+                   for x in copies.get(p, ()))
+      lines.append('  </project>')
+    osutils.WriteFile(path, self.MANIFEST % '\n'.join(lines), makedirs=True)
+
+  def _WriteHead(self, path, revision):
+    osutils.WriteFile(os.path.join(self.tempdir, path, '.git', 'HEAD'),
+                      revision + '\n', makedirs=True)
+
+  def _ChangeProjects(self, copies=None, **kwargs):
+    projects = dict(self.projects, **kwargs)
+    self._WriteManifest(os.path.join(self.tempdir, '.repo', 'manifest.xml'),
+                        projects, copies=copies)
+
+  def _GetChangedProjects(self):
+    return self.repo._GetChangedProjects(self.synced_manifest)
+
+  def testNothingChanged(self):
+    """Nothing needs syncing if nothing changed."""
+    self.assertEqual(self._GetChangedProjects(), [])
+
+  def testRevisionChanged(self):
+    """Projects with new revisions need syncing."""
+    self.projects['src/foo'] = self.SHA1_B
+    self._ChangeProjects()
+    self.assertEqual(self._GetChangedProjects(), ['src/foo'])
+
+  def testCheckoutMoved(self):
+    """Projects whose checkouts moved since the last sync need syncing."""
+    self._WriteHead('src/bar', self.SHA1_B)
+    self.assertEqual(self._GetChangedProjects(), ['src/bar'])
+
+  def testCopiesChanged(self):
+    """Projects with new <copyfile> or <linkfile> tags need syncing."""
+    self._ChangeProjects(copies={'src/bar': [('linkfile', 'a', 'b')]})
+    self.assertEqual(self._GetChangedProjects(), ['src/bar'])
+    self._ChangeProjects(copies={'src/bar': [('copyfile', 'a', 'b')]})
+    self.assertEqual(self._GetChangedProjects(), ['src/bar'])
+
+  def testSyncProjects(self):
+    """All the changed projects are checked out by a single repo command."""
+    run = self.PatchObject(cros_build_lib, 'RunCommand')
+    self.PatchObject(retry_util, 'RunCommandWithRetries')
+    cmd = ['repo', 'sync']
+    self.repo._SyncProjects(cmd, ['src/foo', 'src/bar'])
+    run.assert_called_once_with(
+        ['repo', 'sync', '-l', '--jobs',
+         str(self.repo.INCREMENTAL_CHECKOUT_JOBS), 'src/foo', 'src/bar'],
+        cwd=self.tempdir)
+    self.assertEqual(cmd, ['repo', 'sync'])
+
+  def testRevisionLocked(self):
+    """The last sync is only worth recording for revision locked manifests."""
+    self.assertTrue(self.repo._IsRevisionLocked())
+    self.projects['src/foo'] = 'refs/heads/master'
+    self._ChangeProjects()
+    self.assertFalse(self.repo._IsRevisionLocked())
+
+  def testFullSync(self):
+    """Fall back to a full sync when an incremental one won't do."""
+    self.projects['src/new'] = self.SHA1_A
+    self._ChangeProjects()
+    self.assertEqual(self._GetChangedProjects(), None)
+
+    self.projects.pop('src/new')
+    self.projects['src/foo'] = 'refs/heads/master'
+    self._ChangeProjects()
+    self.assertEqual(self._GetChangedProjects(), None)
+
+    self.projects['src/foo'] = self.SHA1_A
+    self._ChangeProjects()
+    os.unlink(self.synced_manifest)
+    self.assertEqual(self._GetChangedProjects(), None)
+
+  def testIncrementalCleanup(self):
+    """Incremental cleanups use the LRU file rather than searching the disk."""
+    lru = os.path.join(self.tempdir, '.repo', 'project.lru')
+    osutils.WriteFile(lru, 'src/foo.git 3\nsrc/bar.git 0\nsrc/old.git 5')
+    self.PatchObject(cros_build_lib, 'RunCommand',
+                     side_effect=AssertionError('should not search'))
+    sudo = self.PatchObject(cros_build_lib, 'SudoRunCommand')
+    manifest = self.PatchObject(git.ManifestCheckout, 'Cached')
+    manifest.return_value.ListCheckouts.return_value = [
+        {'path': 'src/foo'}, {'path': 'src/bar'}]
+    self.repo._DoCleanup(incremental=True)
+    sudo.assert_called_once_with(
+        ['rm', '-rf', os.path.join(self.tempdir, '.repo', 'projects',
+                                   'src/old.git')])
+    self.assertEqual(sorted(osutils.ReadFile(lru).splitlines()),
+                     ['src/bar.git 0', 'src/foo.git 0'])
+
 if __name__ == '__main__':
   cros_test_lib.main()
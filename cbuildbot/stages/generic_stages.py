@@ -28,6 +28,7 @@ from chromite.cbuildbot import results_lib
 from chromite.cbuildbot import constants
 from chromite.cbuildbot import portage_utilities
 from chromite.cbuildbot import repository
+from chromite.lib import cidb
 from chromite.lib import cros_build_lib
 from chromite.lib import gs
 from chromite.lib import osutils
@@ -207,15 +208,9 @@ class BuilderStage(object):
       The value of the environment variable, as a string. If no such variable
       can be found, return the empty string.
     """
-    cwd = os.path.join(self._build_root, 'src', 'scripts')
-    if board:
-      portageq = 'portageq-%s' % board
-    else:
-      portageq = 'portageq'
-    binhost = cros_build_lib.RunCommand(
-        [portageq, 'envvar', envvar], cwd=cwd, redirect_stdout=True,
-        enter_chroot=True, error_code_ok=True)
-    return binhost.output.rstrip('\n')
+    portageq = portage_utilities.GetPortageq(board=board,
+                                             buildroot=self._build_root)
+    return portageq.EnvVar(envvar, error_code_ok=True)
 
   def _GetSlaveConfigs(self):
     """Get the slave configs for the current build config.
@@ -342,6 +337,28 @@ class BuilderStage(object):
     """Record a successful or failed result."""
     results_lib.Results.Record(*args, **kwargs)
 
+  def _RecordStageInCIDB(self, result, start_time, board=''):
+    """Queue up the result of this stage to be written to CIDB, if in use."""
+    writer = cidb.GetWriter()
+    if writer is None:
+      return
+    build_id = self._run.attrs.metadata.GetValue('build_id')
+    if build_id is None:
+      return
+    if result in results_lib.Results.NON_FAILURE_TYPES:
+      status = constants.FINAL_STATUS_PASSED
+    else:
+      status = constants.FINAL_STATUS_FAILED
+    writer.AddBuildStage(build_id, {
+        'name': self.name,
+        'board': board,
+        'status': status,
+        'start_time': start_time,
+        'finish_time': time.time(),
+        # The result might be a custom exception.
+        'summary': str(result)[:1024],
+    })
+
   def Run(self):
     """Have the builder execute the stage."""
     # See if this stage should be skipped.
@@ -400,6 +417,7 @@ class BuilderStage(object):
       elapsed_time = time.time() - start_time
       self._RecordResult(self.name, result, description, prefix=self._prefix,
                          time=elapsed_time)
+      self._RecordStageInCIDB(result, start_time)
       self._Finish()
       sys.stdout.flush()
       sys.stderr.flush()
@@ -533,6 +551,11 @@ class BoardSpecificBuilderStage(BuilderStage):
     kwargs.setdefault('board', self._current_board)
     super(BoardSpecificBuilderStage, self)._RecordResult(*args, **kwargs)
 
+  def _RecordStageInCIDB(self, *args, **kwargs):
+    """Queue up the result of this stage to be written to CIDB, if in use."""
+    kwargs.setdefault('board', self._current_board)
+    super(BoardSpecificBuilderStage, self)._RecordStageInCIDB(*args, **kwargs)
+
   def GetParallel(self, board_attr, timeout=None, pretty_name=None):
     """Wait for given |board_attr| to show up.
 
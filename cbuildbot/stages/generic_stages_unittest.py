@@ -7,7 +7,6 @@
 
 import contextlib
 import copy
-import mox
 import os
 import sys
 import unittest
@@ -238,13 +237,13 @@ class BuilderStageTest(AbstractStageTest):
 
   def testGetPortageEnvVar(self):
     """Basic test case for _GetPortageEnvVar function."""
-    self.mox.StubOutWithMock(cros_build_lib, 'RunCommand')
+    self.mox.StubOutWithMock(portage_utilities, 'GetPortageq')
     envvar = 'EXAMPLE'
-    obj = cros_test_lib.EasyAttr(output='RESULT\n')
-    cros_build_lib.RunCommand(mox.And(mox.IsA(list), mox.In(envvar)),
-                              cwd='%s/src/scripts' % self.build_root,
-                              redirect_stdout=True, enter_chroot=True,
-                              error_code_ok=True).AndReturn(obj)
+    portageq = self.mox.CreateMock(portage_utilities.Portageq)
+    portage_utilities.GetPortageq(
+        board=self._current_board,
+        buildroot=os.path.abspath(self.build_root)).AndReturn(portageq)
+    portageq.EnvVar(envvar, error_code_ok=True).AndReturn('RESULT')
     self.mox.ReplayAll()
 
     stage = self.ConstructStage()
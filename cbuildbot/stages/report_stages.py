@@ -7,6 +7,7 @@
 import logging
 import os
 import sys
+import time
 
 from chromite.cbuildbot import commands
 from chromite.cbuildbot import failures_lib
@@ -17,6 +18,7 @@ from chromite.cbuildbot.stages import completion_stages
 from chromite.cbuildbot.stages import generic_stages
 from chromite.cbuildbot.stages import sync_stages
 from chromite.lib import alerts
+from chromite.lib import cidb
 from chromite.lib import cros_build_lib
 from chromite.lib import gs
 from chromite.lib import osutils
@@ -124,6 +126,31 @@ class ReportBuildStartStage(generic_stages.BuilderStage,
     self._run.attrs.metadata.UpdateKeyDictWithDict('version', version)
     self.UploadMetadata(filename=constants.PARTIAL_METADATA_JSON)
 
+    self._InsertBuildInCIDB(version['full'])
+
+  def _InsertBuildInCIDB(self, full_version):
+    """Record this build in CIDB (if in use), and its build_id in metadata."""
+    db = cidb.GetCIDB()
+    metadata = self._run.attrs.metadata
+    if db is None or metadata.GetValue('build_id') is not None:
+      return
+    # Results.start_time is a local datetime; CIDB wants seconds since the
+    # epoch.
+    start_time = time.mktime(results_lib.Results.start_time.timetuple())
+    try:
+      build_id = db.InsertBuild(
+          builder_name=metadata.GetValue('builder-name', ''),
+          waterfall=os.environ.get('BUILDBOT_MASTERNAME', ''),
+          build_number=metadata.GetValue('build-number'),
+          build_config=self._run.config.name,
+          bot_hostname=metadata.GetValue('bot-hostname', ''),
+          full_version=full_version,
+          start_time=start_time)
+    except cidb.DB_ERRORS as e:
+      logging.warning('Not recording this build in CIDB: %s', e)
+      return
+    metadata.UpdateWithDict({'build_id': build_id})
+
 
 class ReportStage(generic_stages.BuilderStage,
                   generic_stages.ArchivingStageMixin):
@@ -216,6 +243,23 @@ class ReportStage(generic_stages.BuilderStage,
     return 'The builder named %s has failed %i consecutive times. See %s' % (
         self._run.config['name'], fail_count, self.ConstructDashboardURL())
 
+  def _FinishBuildInCIDB(self, final_status):
+    """Write out what is queued up for CIDB, and mark the build finished.
+
+    Args:
+      final_status: Final status string for this run.
+    """
+    db = cidb.GetCIDB()
+    build_id = self._run.attrs.metadata.GetValue('build_id')
+    if db is None or build_id is None:
+      return
+    cidb.GetWriter().Flush()
+    try:
+      db.FinishBuild(build_id, final_status)
+    except cidb.DB_ERRORS as e:
+      logging.warning('Failed to mark build %s finished in CIDB: %s',
+                      build_id, e)
+
   def _UploadMetadataForRun(self, final_status):
     """Upload metadata.json for this entire run.
 
@@ -343,6 +387,7 @@ class ReportStage(generic_stages.BuilderStage,
     # run only. These aren't needed for the child builder runs.
     self._UploadMetadataForRun(final_status)
     self._UpdateRunStreak(self._run, final_status)
+    self._FinishBuildInCIDB(final_status)
 
     # Iterate through each builder run, whether there is just the main one
     # or multiple child builder runs.
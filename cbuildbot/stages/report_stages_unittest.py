@@ -5,17 +5,22 @@
 
 """Unittests for report stages."""
 
+import datetime
 import os
 import sys
+import time
+import unittest
 
 sys.path.insert(0, os.path.abspath('%s/../../..' % os.path.dirname(__file__)))
 from chromite.cbuildbot import commands
 from chromite.cbuildbot import constants
+from chromite.cbuildbot import results_lib
 from chromite.cbuildbot import validation_pool
 from chromite.cbuildbot.stages import sync_stages
 from chromite.cbuildbot.stages import sync_stages_unittest
 from chromite.cbuildbot.stages import report_stages
 from chromite.cbuildbot.stages import generic_stages_unittest
+from chromite.lib import cidb
 from chromite.lib import cros_test_lib
 from chromite.lib import alerts
 from chromite.lib import osutils
@@ -117,5 +122,73 @@ class ReportStageTest(generic_stages_unittest.AbstractStageTest):
     self.assertTrue(metadata_dict.has_key('bot-hostname'))
 
 
+class CIDBTest(generic_stages_unittest.AbstractStageTest):
+  """Test recording the build in CIDB."""
+
+  def setUp(self):
+    self.StartPatcher(BuilderRunMock())
+    self.db = mock.Mock()
+    self.PatchObject(cidb, 'GetCIDB', return_value=self.db)
+    self.writer = mock.Mock()
+    self.PatchObject(cidb, 'GetWriter', return_value=self.writer)
+    self._Prepare()
+
+  def ConstructStage(self):
+    return report_stages.ReportBuildStartStage(self._run)
+
+  def testInsertBuild(self):
+    """The build_id CIDB gives the build should be kept in the metadata."""
+    self.db.InsertBuild.return_value = 42
+    self.ConstructStage()._InsertBuildInCIDB('R40-1.0.0')
+    self.assertEqual(self._run.attrs.metadata.GetValue('build_id'), 42)
+
+  def testInsertBuildError(self):
+    """Failing to insert the build should not fail the stage."""
+    for e in (cidb.DBException(), cidb.UnsupportedMethodException()):
+      self.db.InsertBuild.side_effect = e
+      self.ConstructStage()._InsertBuildInCIDB('R40-1.0.0')
+      self.assertEqual(self._run.attrs.metadata.GetValue('build_id'), None)
+
+  def testFinishBuildError(self):
+    """Failing to mark the build finished should not fail the stage."""
+    self._run.attrs.metadata.UpdateWithDict({'build_id': 42})
+    self.db.FinishBuild.side_effect = cidb.DBException()
+    stage = report_stages.ReportStage(self._run, None, None)
+    stage._FinishBuildInCIDB(constants.FINAL_STATUS_PASSED)
+    self.assertEqual(self.writer.Flush.call_count, 1)
+    self.db.FinishBuild.assert_called_once_with(
+        42, constants.FINAL_STATUS_PASSED)
+
+
+@unittest.skipIf(cidb.sqlalchemy is None, 'sqlalchemy is not installed')
+class CIDBSQLiteTest(generic_stages_unittest.AbstractStageTest):
+  """Test recording the build in a real (in-memory SQLite) CIDB."""
+
+  def setUp(self):
+    self.StartPatcher(BuilderRunMock())
+    self.db = cidb.CIDBConnection(connect_url='sqlite://')
+    self.db.ApplySchemaMigrations()
+    self.PatchObject(cidb, 'GetCIDB', return_value=self.db)
+    self._Prepare()
+
+  def ConstructStage(self):
+    return report_stages.ReportBuildStartStage(self._run)
+
+  def testInsertBuild(self):
+    """The build should be inserted with its start time in UTC."""
+    start_time = datetime.datetime(2014, 7, 1, 12, 30, 15)
+    self.PatchObject(results_lib.Results, 'start_time', new=start_time)
+    self._run.attrs.metadata.UpdateWithDict({'builder-name': 'x86-generic',
+                                             'build-number': 1234})
+    self.ConstructStage()._InsertBuildInCIDB('R40-1.0.0')
+
+    build_id = self._run.attrs.metadata.GetValue('build_id')
+    self.assertNotEqual(build_id, None)
+    build = self.db.GetBuildStatus(build_id)
+    self.assertEqual(build['full_version'], 'R40-1.0.0')
+    self.assertEqual(build['start_time'], datetime.datetime.utcfromtimestamp(
+        time.mktime(start_time.timetuple())))
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
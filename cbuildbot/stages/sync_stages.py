@@ -309,7 +309,10 @@ class SyncStage(generic_stages.BuilderStage):
                            'NEXT MANIFEST: %s' % next_manifest]))
 
     if not self.skip_sync:
-      self.repo.Sync(next_manifest)
+      # Only the projects that changed since the last build need syncing when
+      # building a revision locked manifest; Sync falls back to a full sync
+      # otherwise.
+      self.repo.Sync(next_manifest, incremental=True)
 
     print >> sys.stderr, self.repo.ExportManifest(
         mark_revision=self.output_manifest_sha1)
@@ -146,6 +146,8 @@ class BaseCQTest(generic_stages_unittest.StageTest):
     # If a test is still contacting GoB, something is busted.
     self.PatchObject(gob_util, 'CreateHttpConn',
                      side_effect=AssertionError('Test should not contact GoB'))
+    self.PatchObject(gob_util.HttpConnectionPool, 'Request',
+                     side_effect=AssertionError('Test should not contact GoB'))
 
     # Create a fake repo / manifest on disk that is used by subclasses.
     for subdir in ('repo', 'manifests'):
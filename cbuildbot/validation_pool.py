@@ -13,6 +13,7 @@ import contextlib
 import cPickle
 import functools
 import httplib
+import itertools
 import logging
 import os
 import sys
@@ -362,7 +363,8 @@ class PatchSeries(object):
   """Class representing a set of patches applied to a single git repository."""
 
   def __init__(self, path, helper_pool=None, forced_manifest=None,
-               deps_filter_fn=None, is_submitting=False):
+               deps_filter_fn=None, is_submitting=False, prefetch_deps=False,
+               parallel_apply=False):
     """Constructor.
 
     Args:
@@ -376,6 +378,10 @@ class PatchSeries(object):
         True or False.
       is_submitting: Whether we are currently submitting patchsets. This is
         used to print better error messages.
+      prefetch_deps: Whether to look up the dependencies of all the changes
+        in bulk before creating transactions.  See PrefetchDependencies.
+      parallel_apply: Whether to apply transactions that touch disjoint git
+        repositories in parallel.  See _ApplyTransactionsInParallel.
     """
     self.manifest = forced_manifest
 
@@ -387,6 +393,8 @@ class PatchSeries(object):
       deps_filter_fn = lambda x: True
     self.deps_filter_fn = deps_filter_fn
     self._is_submitting = is_submitting
+    self._prefetch_deps = prefetch_deps
+    self._parallel_apply = parallel_apply
 
     self.applied = []
     self.failed = []
@@ -479,6 +487,18 @@ class PatchSeries(object):
     if not change:
       return
 
+    return self._InjectGerritPatch(query_text, change)
+
+  def _InjectGerritPatch(self, query_text, change):
+    """Record a change we looked up in gerrit in our caches.
+
+    Args:
+      query_text: The text used to query gerrit for |change|.
+      change: The GerritPatch that was found.
+
+    Returns:
+      The GerritPatch to use for |change|.
+    """
     # If the query was a gerrit number based query, check the projects/change-id
     # to see if we already have it locally, but couldn't map it since we didn't
     # know the gerrit number at the time of the initial injection.
@@ -493,6 +513,47 @@ class PatchSeries(object):
       self.InjectCommittedPatches([change])
     return change
 
+  def PrefetchDependencies(self, changes):
+    """Look up the dependencies of |changes| in bulk.
+
+    Rather than asking gerrit about each dependency one at a time as we run
+    into it while creating transactions, ask each gerrit instance about all of
+    them at once, and seed our lookup caches with the results.  Anything that
+    can't be resolved this way is left for _GetGerritPatch to look up (and
+    complain about) later, so failures here are not fatal.
+
+    Args:
+      changes: A list of cros_patch.GitRepoPatch instances that we will be
+        creating transactions for.
+    """
+    self.InjectLookupCache(changes)
+
+    queries = {}
+    for change in changes:
+      try:
+        gerrit_deps, cq_deps = self.GetDepsForChange(change)
+      except cros_patch.PatchException:
+        continue
+      for dep in gerrit_deps + cq_deps:
+        if dep in self._committed_cache or self._lookup_cache[dep] is not None:
+          continue
+        try:
+          helper = self._LookupHelper(dep)
+          query_text = dep.ToGerritQueryText()
+        except (GerritHelperNotAvailable, ValueError):
+          continue
+        queries.setdefault(helper, set()).add(query_text)
+
+    for helper, query_texts in queries.iteritems():
+      try:
+        results = helper.QueryMultiple(list(query_texts), must_match=False)
+      except (gerrit.GerritException, gob_util.GOBError) as e:
+        logging.warning('Bulk lookup of dependencies failed: %s', e)
+        continue
+      for query_text, change in results.iteritems():
+        if change is not None:
+          self._InjectGerritPatch(query_text, change)
+
   def _LookupUncommittedChanges(self, deps, limit_to=None):
     """Given a set of deps (changes), return unsatisfied dependencies.
 
@@ -600,31 +661,35 @@ class PatchSeries(object):
       transactions. Each change in the pool will included in exactly one of the
       transactions, unless the patch does not apply for some reason.
     """
-    # Gather the dependency graph for the specified changes.
-    deps, edges, failed = {}, {}, []
-    for change, plan, ex in self.CreateTransactions(changes, limit_to=changes):
-      if ex is not None:
-        logging.info('Failed creating transaction for %s: %s', change, ex)
-        failed.append(ex)
-      else:
-        # Save off the ordered dependencies of this change.
-        deps[change] = plan
+    if self._prefetch_deps:
+      self.PrefetchDependencies(changes)
+
+    # Gather the dependency graph for the whole pool in one pass, rather than
+    # re-walking shared dependency chains once for every change.
+    graph, failed = self._GetDependencyGraph(
+        changes, limit_to=cros_patch.PatchCache(changes))
 
-        # Mark every change in the transaction as bidirectionally connected.
-        for change_dep in plan:
-          edges.setdefault(change_dep, set()).update(plan)
+    # Mark every change as bidirectionally connected to its dependencies, so
+    # that each strongly connected component is a disjoint transaction.
+    vertices = [change for change in changes if change in graph]
+    edges = dict((change, set()) for change in vertices)
+    for change in vertices:
+      for dep in itertools.chain(*graph[change]):
+        edges[change].add(dep)
+        edges[dep].add(change)
 
     # Calculate an unordered group of strongly connected components.
-    unordered_plans = digraph.StronglyConnectedComponents(list(edges), edges)
+    unordered_plans = digraph.StronglyConnectedComponents(vertices, edges)
 
     # Sort the groups according to our ordered dependency graph.
     ordered_plans = []
     for unordered_plan in unordered_plans:
       ordered_plan, seen = [], set()
-      for change in unordered_plan:
-        # Iterate over the required CLs, adding them to our plan in order.
-        new_changes = list(dep_change for dep_change in deps[change]
-                           if dep_change not in seen)
+      for change in vertices:
+        if change not in unordered_plan or change in seen:
+          continue
+        # Add the required CLs to our plan in order, if they fit.
+        new_changes = self._GetPlanFromGraph(change, graph, seen)
         new_plan_size = len(ordered_plan) + len(new_changes)
         if not max_txn_length or new_plan_size <= max_txn_length:
           seen.update(new_changes)
@@ -645,6 +710,135 @@ class PatchSeries(object):
 
     return ordered_plans, failed
 
+  @_PatchWrapException
+  def _GetUncommittedDeps(self, change, limit_to=None):
+    """Look up the uncommitted Gerrit and CQ dependencies of |change|.
+
+    Returns:
+      A (gerrit_deps, cq_deps) tuple of lists of cros_patch.GitRepoPatch
+      instances (or derivatives).
+
+    Raises:
+      DependencyError: If we could not resolve a dependency.
+      GerritException or GOBError: If there is a failure in querying gerrit.
+    """
+    gerrit_deps, cq_deps = self.GetDepsForChange(change)
+    return (self._LookupUncommittedChanges(gerrit_deps, limit_to=limit_to),
+            self._LookupUncommittedChanges(cq_deps, limit_to=limit_to))
+
+  def _GetDependencyGraph(self, changes, limit_to=None):
+    """Build the dependency graph of |changes| and everything they need.
+
+    Each change has its dependencies looked up exactly once. A change whose
+    dependencies cannot be resolved is left out of the graph, as is every
+    change that (transitively) depends on it.
+
+    Args:
+      changes: A list of cros_patch.GitRepoPatch instances.
+      limit_to: See CreateTransaction docs.
+
+    Returns:
+      A (graph, failed) tuple. |graph| maps each change to a tuple of its
+      uncommitted (gerrit_deps, cq_deps). |failed| is a list of the
+      cros_patch.PatchException errors for the changes left out of |graph|.
+
+    Raises:
+      GOBError: If there is a failure in querying gerrit.
+    """
+    graph, errors, rdeps = {}, {}, {}
+    todo = [change for change in changes if change not in self._committed_cache]
+    queued = set(todo)
+    while todo:
+      change = todo.pop()
+      try:
+        graph[change] = deps = self._GetUncommittedDeps(
+            change, limit_to=limit_to)
+      except cros_patch.PatchException as e:
+        errors[change] = e
+        continue
+      for dep in itertools.chain(*deps):
+        rdeps.setdefault(dep, []).append(change)
+        if dep not in queued:
+          queued.add(dep)
+          todo.append(dep)
+
+    # Anything that depends on a broken change is broken too.
+    todo = list(errors)
+    while todo:
+      dep = todo.pop()
+      for change in rdeps.get(dep, ()):
+        if change not in errors:
+          errors[change] = cros_patch.DependencyError(change, errors[dep])
+          del graph[change]
+          todo.append(change)
+
+    failed = []
+    for change in changes:
+      if change in errors:
+        logging.info('Failed creating transaction for %s: %s', change,
+                     errors[change])
+        failed.append(errors[change])
+    return graph, failed
+
+  @staticmethod
+  def _GetPlanFromGraph(change, graph, exclude=()):
+    """Resolve |change| into a transaction using a prebuilt dependency graph.
+
+    This orders the changes the same way as _AddChangeToPlanWithDeps, but
+    without recursing, so that long stacks of changes are handled cheaply.
+
+    Args:
+      change: The change to resolve.
+      graph: A dependency graph, as returned by _GetDependencyGraph.
+      exclude: Changes to leave out of the plan, e.g. because they have
+        already been planned. Their dependencies must also be in |exclude|.
+
+    Returns:
+      The list of changes in |change|'s transaction, in the order they should
+      be applied, less anything in |exclude|.
+    """
+    plan, planned = [], set()
+    gerrit_deps_seen, cq_deps_seen = set(exclude), set(exclude)
+
+    def _Visit(change, include_cq_deps):
+      # Each frame is [change, include_cq_deps, plan length on entry,
+      # iterator over the deps left to visit, whether we're on the CQ deps].
+      if change not in gerrit_deps_seen:
+        gerrit_deps_seen.add(change)
+        deps = iter(graph[change][0])
+      else:
+        deps = iter(())
+      return [change, include_cq_deps, len(plan), deps, False]
+
+    stack = [_Visit(change, True)]
+    while stack:
+      frame = stack[-1]
+      change, include_cq_deps, old_plan_len, deps, on_cq_deps = frame
+      if not on_cq_deps:
+        # Gerrit dependencies come first, as they are needed to apply.
+        for dep in deps:
+          stack.append(_Visit(dep, False))
+          break
+        else:
+          if change not in planned and change not in exclude:
+            planned.add(change)
+            plan.append(change)
+          if include_cq_deps and change not in cq_deps_seen:
+            cq_deps_seen.add(change)
+            frame[3] = iter(plan[old_plan_len:] + graph[change][1])
+            frame[4] = True
+          else:
+            stack.pop()
+      else:
+        for dep in deps:
+          if dep not in cq_deps_seen:
+            stack.append(_Visit(dep, True))
+            break
+        else:
+          stack.pop()
+
+    return plan
+
   @_PatchWrapException
   def _AddChangeToPlanWithDeps(self, change, plan, gerrit_deps_seen,
                                cq_deps_seen, limit_to=None,
@@ -777,9 +971,13 @@ class PatchSeries(object):
 
     If we're an external builder, internal changes are filtered out.
 
+    The changes are fetched with one `git fetch` per repository and remote,
+    and different repositories are fetched in parallel.
+
     Returns:
-      An iterator over a list of the filtered changes.
+      A list of the filtered changes.
     """
+    filtered, changes_by_repo = [], {}
     for change in changes:
       try:
         self._helper_pool.ForChange(change)
@@ -787,8 +985,19 @@ class PatchSeries(object):
         # Internal patches are irrelevant to external builders.
         logging.info("Skipping internal patch: %s", change)
         continue
-      change.Fetch(self.GetGitRepoForChange(change, strict=True))
-      yield change
+      git_repo = self.GetGitRepoForChange(change, strict=True)
+      changes_by_repo.setdefault(git_repo, []).append(change)
+      filtered.append(change)
+
+    if len(changes_by_repo) > 1:
+      # The fetched objects land in the git repositories themselves, so the
+      # FetchPatches calls below just have to read the commit messages back.
+      parallel.RunTasksInProcessPool(cros_patch.PrefetchPatches,
+                                     changes_by_repo.items())
+    for git_repo, repo_changes in changes_by_repo.iteritems():
+      cros_patch.FetchPatches(git_repo, repo_changes)
+
+    return filtered
 
   @_ManifestDecorator
   def Apply(self, changes, frozen=True, honor_ordering=False,
@@ -833,13 +1042,15 @@ class PatchSeries(object):
     """
     # Prefetch the changes; we need accurate change_id/id's, which is
     # guaranteed via Fetch.
-    changes = list(self.FetchChanges(changes))
+    changes = self.FetchChanges(changes)
     if changes_filter:
       changes = changes_filter(self, changes)
 
     self.InjectLookupCache(changes)
+    if self._prefetch_deps:
+      self.PrefetchDependencies(changes)
     limit_to = cros_patch.PatchCache(changes) if frozen else None
-    resolved, applied, failed = [], [], []
+    resolved, failed = [], []
     for change, plan, ex in self.CreateTransactions(changes, limit_to=limit_to):
       if ex is not None:
         logging.info("Failed creating transaction for %s: %s", change, ex)
@@ -864,7 +1075,41 @@ class PatchSeries(object):
         return -len(ids), position[data[0]]
       resolved.sort(key=mk_key)
 
+    if self._parallel_apply:
+      applied, apply_failed = self._ApplyTransactionsInParallel(resolved)
+    else:
+      applied, apply_failed = self._ApplyTransactions(resolved)
+    failed.extend(apply_failed)
+
+    # Uniquify while maintaining order.
+    def _uniq(l):
+      s = set()
+      for x in l:
+        if x not in s:
+          yield x
+          s.add(x)
+
+    applied = list(_uniq(applied))
+    self._is_submitting = True
+
+    failed = [x for x in failed if x.patch not in applied]
+    failed_tot = [x for x in failed if not x.inflight]
+    failed_inflight = [x for x in failed if x.inflight]
+    return applied, failed_tot, failed_inflight
+
+  def _ApplyTransactions(self, resolved):
+    """Apply the given transactions, in order.
+
+    Args:
+      resolved: A list of (inducing_change, transaction_changes) tuples.
+
+    Returns:
+      A tuple of the changes that were applied, and the
+      cros_patch.PatchException instances for the transactions that failed.
+    """
+    applied, failed = [], []
     for inducing_change, transaction_changes in resolved:
+      start = time.time()
       try:
         with self._Transaction(transaction_changes):
           logging.debug("Attempting transaction for %s: changes: %s",
@@ -878,22 +1123,119 @@ class PatchSeries(object):
       else:
         applied.extend(transaction_changes)
         self.InjectCommittedPatches(transaction_changes)
+      logging.info("Transaction for %s took %.1f seconds.",
+                   inducing_change, time.time() - start)
+    return applied, failed
 
-    # Uniquify while maintaining order.
-    def _uniq(l):
-      s = set()
-      for x in l:
-        if x not in s:
-          yield x
-          s.add(x)
+  def _GroupTransactionsByRepo(self, resolved):
+    """Split transactions into groups that touch disjoint git repositories.
 
-    applied = list(_uniq(applied))
-    self._is_submitting = True
+    Args:
+      resolved: A list of (inducing_change, transaction_changes) tuples.
 
-    failed = [x for x in failed if x.patch not in applied]
-    failed_tot = [x for x in failed if not x.inflight]
-    failed_inflight = [x for x in failed if x.inflight]
-    return applied, failed_tot, failed_inflight
+    Returns:
+      A list of lists of transactions. Transactions that share a git
+      repository, directly or via other transactions, end up in the same
+      group, in the same order as in |resolved|.
+    """
+    groups = []
+    for idx, (_, transaction_changes) in enumerate(resolved):
+      repos = set(self.GetGitRepoForChange(change, strict=True)
+                  for change in transaction_changes)
+      indices = [idx]
+      for group in groups[:]:
+        group_repos, group_indices = group
+        if repos & group_repos:
+          repos |= group_repos
+          indices += group_indices
+          groups.remove(group)
+      groups.append((repos, indices))
+
+    groups.sort(key=lambda group: min(group[1]))
+    return [[resolved[idx] for idx in sorted(indices)]
+            for _, indices in groups]
+
+  def _ApplyTransactionsInParallel(self, resolved):
+    """Apply transactions that touch disjoint git repositories in parallel.
+
+    Each group of transactions from _GroupTransactionsByRepo is applied in
+    order in a background process.  Every transaction still lives in a
+    single process, so it is applied or rolled back as a whole.
+
+    Args:
+      resolved: See _ApplyTransactions.
+
+    Returns:
+      See _ApplyTransactions.
+    """
+    groups = self._GroupTransactionsByRepo(resolved)
+    if len(groups) <= 1:
+      return self._ApplyTransactions(resolved)
+
+    logging.info("Applying %i transactions in %i independent groups.",
+                 len(resolved), len(groups))
+
+    with parallel.Manager() as manager:
+      results = manager.dict()
+
+      def _ApplyGroup(idx):
+        try:
+          applied, failed = self._ApplyTransactions(groups[idx])
+        except Exception as e:
+          # Hand the error back as is (rather than as a BackgroundFailure) so
+          # callers see the same exceptions as when applying serially.
+          logging.warning('Applying transactions failed', exc_info=True)
+          results[idx] = e
+        else:
+          results[idx] = (applied, failed, self.failed_tot)
+
+      parallel.RunTasksInProcessPool(_ApplyGroup,
+                                     [[idx] for idx in xrange(len(groups))])
+      results = dict(results)
+
+    for idx in xrange(len(groups)):
+      if isinstance(results[idx], Exception):
+        raise results[idx]
+
+    # The background processes hand back copies of the changes; map them back
+    # to the objects we were given.
+    originals = dict((change, change) for inducing_change, transaction_changes
+                     in resolved for change in [inducing_change] +
+                     list(transaction_changes))
+    applied, failed = [], []
+    for idx in xrange(len(groups)):
+      group_applied, group_failed, failed_tot = results[idx]
+      group_applied = [originals[change] for change in group_applied]
+      applied.extend(group_applied)
+      for ex in group_failed:
+        failed.append(self._RestorePatches(ex, originals))
+      for change_id, ex in failed_tot.iteritems():
+        self.failed_tot[change_id] = self._RestorePatches(ex, originals)
+      self.InjectCommittedPatches(group_applied)
+    return applied, failed
+
+  @classmethod
+  def _RestorePatches(cls, ex, originals):
+    """Point the patches referenced by |ex| back at the |originals|.
+
+    Args:
+      ex: A cros_patch.PatchException that came from a background process.
+      originals: A dict mapping patches to the objects they should be.
+
+    Returns:
+      |ex| after updating it in place.
+    """
+    def _Restore(value):
+      if isinstance(value, cros_patch.GitRepoPatch):
+        return originals.get(value, value)
+      elif isinstance(value, cros_patch.PatchException):
+        return cls._RestorePatches(value, originals)
+      return value
+
+    for attr, value in vars(ex).items():
+      setattr(ex, attr, _Restore(value))
+    ex.args = tuple(_Restore(x) for x in ex.args)
+    return ex
 
   @contextlib.contextmanager
   def _Transaction(self, commits):
@@ -1844,7 +2186,8 @@ class ValidationPool(object):
     """
     applied = []
     failed_tot = failed_inflight = {}
-    patch_series = PatchSeries(self.build_root, helper_pool=self._helper_pool)
+    patch_series = PatchSeries(self.build_root, helper_pool=self._helper_pool,
+                               prefetch_deps=True, parallel_apply=True)
     if self.is_master:
       try:
         # pylint: disable=E1123
@@ -2733,7 +3076,8 @@ class ValidationPool(object):
       Each change in the pool will included in exactly one of transactions,
       unless the patch does not apply for some reason.
     """
-    patches = PatchSeries(self.build_root, forced_manifest=manifest)
+    patches = PatchSeries(self.build_root, forced_manifest=manifest,
+                          prefetch_deps=True)
     plans, failed = patches.CreateDisjointTransactions(
         self.changes, max_txn_length=max_txn_length)
     failed = self._FilterDependencyErrors(failed)
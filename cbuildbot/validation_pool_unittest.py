@@ -35,6 +35,7 @@ from chromite.lib import gerrit
 from chromite.lib import gob_util
 from chromite.lib import gs
 from chromite.lib import osutils
+from chromite.lib import parallel
 from chromite.lib import parallel_unittest
 from chromite.lib import partial_mock
 from chromite.lib import patch as cros_patch
@@ -81,6 +82,8 @@ class Base(cros_test_lib.MockTestCase):
     self.build_root = 'fakebuildroot'
     self.PatchObject(gob_util, 'CreateHttpConn',
                      side_effect=AssertionError('Test should not contact GoB'))
+    self.PatchObject(gob_util.HttpConnectionPool, 'Request',
+                     side_effect=AssertionError('Test should not contact GoB'))
     self.PatchObject(tree_status, 'IsTreeOpen', return_value=True)
     self.PatchObject(tree_status, 'WaitForTreeStatus',
                      return_value=constants.TREE_OPEN)
@@ -215,6 +218,12 @@ class TestPatchSeries(MoxBase):
     series.GetGitRepoForChange = \
         lambda change, **kwargs: os.path.join(self.build_root, change.project)
 
+    # Fetch the patches one at a time, so the stubbed out Fetch() is used.
+    self.PatchObject(parallel, 'RunTasksInProcessPool')
+    self.PatchObject(cros_patch, 'FetchPatches',
+                     side_effect=lambda repo, patches: [p.Fetch(repo)
+                                                        for p in patches])
+
     return series
 
   def assertPath(self, _patch, return_value, path):
@@ -1507,6 +1516,108 @@ class TestCreateDisjointTransactions(Base):
       call_count = self.runUnresolvedPlan(patches, max_txn_length=3)
     self.assertEqual(5, call_count)
 
+  def testLargePool(self):
+    """Verify that big pools with long stacks are planned efficiently."""
+    def _Stack(how_many):
+      patches = [self.MockPatch() for _ in xrange(how_many)]
+      for parent, child in zip(patches, patches[1:]):
+        self.patch_mock.SetGerritDependencies(child, [parent])
+      return patches
+
+    # A 300 CL stack, five pairs of 10 CL stacks that CQ-DEPEND on each other,
+    # and 100 independent CLs.
+    stacks = [_Stack(300)]
+    for _ in xrange(5):
+      first, second = _Stack(10), _Stack(10)
+      self.patch_mock.SetCQDependencies(first[-1], [second[-1]])
+      self.patch_mock.SetCQDependencies(second[-1], [first[-1]])
+      stacks.append(first + second)
+    stacks += [_Stack(1) for _ in xrange(100)]
+    patches = list(itertools.chain.from_iterable(stacks))
+    self.assertEqual(len(patches), 500)
+
+    series = validation_pool.PatchSeries(self.build_root)
+    plans, failed = series.CreateDisjointTransactions(patches)
+    self.assertEqual(failed, [])
+    self.assertEqual(sorted(map(sorted, plans)), sorted(map(sorted, stacks)))
+    for plan in plans:
+      for i, patch in enumerate(plan):
+        for dep in self.patch_mock.deps.get(patch, []):
+          self.assertTrue(plan.index(dep) < i)
+
+    # The dependencies of each change should only be looked up once.
+    get_deps = self.patch_mock.patched['GetDepsForChange']
+    self.assertEqual(get_deps.call_count, 500)
+
+
+class TestParallelApply(Base):
+  """Test applying transactions to disjoint repositories in parallel."""
+
+  def setUp(self):
+    self.series = validation_pool.PatchSeries(self.build_root,
+                                              parallel_apply=True)
+    self.series.GetGitRepoForChange = \
+        lambda change, **kwargs: os.path.join(self.build_root, change.project)
+
+  def _GetTransactions(self):
+    """Return transactions over projects a, b, c, with a and c linked."""
+    p1, p2, p3, p4, p5 = patches = [
+        self.MockPatch(project=project) for project in 'abcca']
+    resolved = [(p1, [p1]), (p2, [p2]), (p3, [p3]), (p4, [p1, p4]),
+                (p5, [p5])]
+    return patches, resolved
+
+  def testGroupTransactions(self):
+    """Transactions that share repositories should be grouped together."""
+    _, resolved = self._GetTransactions()
+    groups = self.series._GroupTransactionsByRepo(resolved)
+    self.assertEqual(groups, [[resolved[0], resolved[2], resolved[3],
+                               resolved[4]],
+                              [resolved[1]]])
+
+  def testApplyInParallel(self):
+    """The results of each group should be merged back together."""
+    patches, resolved = self._GetTransactions()
+    error = cros_patch.DependencyError(
+        patches[1], cros_patch.ApplyPatchException(patches[1]))
+
+    def _ApplyTransactions(inst, transactions):
+      if transactions[0][0] == patches[1]:
+        inst.failed_tot[patches[1].id] = error
+        return [], [error]
+      return list(itertools.chain(*[x[1] for x in transactions])), []
+
+    self.PatchObject(validation_pool.PatchSeries, '_ApplyTransactions',
+                     side_effect=_ApplyTransactions, autospec=True)
+    applied, failed = self.series._ApplyTransactionsInParallel(resolved)
+    self.assertEqual(applied, [patches[0], patches[2], patches[0], patches[3],
+                               patches[4]])
+    # The changes should be the original objects, not copies.
+    for change in applied:
+      self.assertTrue(any(change is x for x in patches))
+    self.assertEqual([str(x) for x in failed], [str(error)])
+    self.assertTrue(patches[3] in self.series._committed_cache)
+    # So should the changes in the failures.
+    failures = [failed[0], self.series.failed_tot[patches[1].id]]
+    for ex in failures:
+      self.assertTrue(ex.patch is patches[1])
+      self.assertTrue(ex.args[0] is patches[1])
+      self.assertTrue(ex.error.patch is patches[1])
+
+  def testApplyInParallelError(self):
+    """Unexpected errors should be passed up as is."""
+    patches, resolved = self._GetTransactions()
+
+    def _ApplyTransactions(_inst, transactions):
+      if transactions[0][0] == patches[1]:
+        raise cros_build_lib.RunCommandError('git failed', None)
+      return list(itertools.chain(*[x[1] for x in transactions])), []
+
+    self.PatchObject(validation_pool.PatchSeries, '_ApplyTransactions',
+                     side_effect=_ApplyTransactions, autospec=True)
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      self.series._ApplyTransactionsInParallel, resolved)
+
 
 class MockValidationPool(partial_mock.PartialMock):
   """Mock out a ValidationPool instance."""
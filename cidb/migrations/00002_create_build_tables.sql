@@ -0,0 +1,47 @@
+CREATE TABLE buildTable (
+  id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+  master_build_id INT,
+  builder_name VARCHAR(80) NOT NULL,
+  waterfall VARCHAR(80) NOT NULL,
+  build_number INT NOT NULL,
+  build_config VARCHAR(80) NOT NULL,
+  bot_hostname VARCHAR(80) NOT NULL,
+  full_version VARCHAR(80),
+  start_time TIMESTAMP NULL,
+  finish_time TIMESTAMP NULL,
+  status VARCHAR(80) NOT NULL,
+  FOREIGN KEY (master_build_id) REFERENCES buildTable(id)
+);
+
+CREATE INDEX buildTable_master_build_id ON buildTable (master_build_id);
+
+CREATE TABLE buildStageTable (
+  id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+  build_id INT NOT NULL,
+  name VARCHAR(80) NOT NULL,
+  board VARCHAR(80),
+  status VARCHAR(80) NOT NULL,
+  start_time TIMESTAMP NULL,
+  finish_time TIMESTAMP NULL,
+  summary VARCHAR(1024),
+  FOREIGN KEY (build_id) REFERENCES buildTable(id)
+);
+
+CREATE INDEX buildStageTable_build_id ON buildStageTable (build_id);
+
+CREATE TABLE clActionTable (
+  id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+  build_id INT NOT NULL,
+  change_number INT NOT NULL,
+  patch_number INT NOT NULL,
+  change_source VARCHAR(80) NOT NULL,
+  action VARCHAR(80) NOT NULL,
+  reason VARCHAR(1024),
+  timestamp TIMESTAMP NULL,
+  FOREIGN KEY (build_id) REFERENCES buildTable(id)
+);
+
+CREATE INDEX clActionTable_build_id ON clActionTable (build_id);
+
+INSERT INTO schemaVersionTable (schemaVersion, scriptName) VALUES
+  (2, '00002_create_build_tables.sql');
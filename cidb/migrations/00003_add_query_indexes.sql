@@ -0,0 +1,15 @@
+CREATE INDEX buildTable_start_time ON buildTable (start_time);
+
+CREATE INDEX buildTable_build_config ON buildTable (build_config, start_time);
+
+CREATE INDEX buildTable_builder_name ON buildTable (builder_name, start_time);
+
+CREATE INDEX buildStageTable_name ON buildStageTable (name, status);
+
+CREATE INDEX clActionTable_change ON clActionTable
+  (change_number, change_source, patch_number);
+
+CREATE INDEX clActionTable_timestamp ON clActionTable (timestamp);
+
+INSERT INTO schemaVersionTable (schemaVersion, scriptName) VALUES
+  (3, '00003_add_query_indexes.sql');
@@ -5,15 +5,31 @@
 """This package contains all valid cros commands and their unittests.
 
 All commands can be either imported directly or looked up using this module.
-This modules contains a dictionary called commands mapping
-command names -> command classes e.g. image->cros_image.ImageCommand.
+Importing every command module is slow (they pull in most of chromite), so
+the names & help of the commands are read out of their source instead and
+kept in a small index; GetCommand only imports the module of the command
+that is actually asked for.  ListCommands still imports everything and
+returns a dictionary mapping command names -> command classes
+e.g. image->cros_image.ImageCommand.
 """
 
+import ast
 import glob
+import hashlib
 import imp
+import json
 import os
+import sys
 
 from chromite import cros
+from chromite.lib import commandline
+
+
+# Where to keep the index of commands in the cache dir (see GetCommandIndex).
+INDEX_DIR = 'cros-commands'
+
+# Bump this whenever the layout of the index changes.
+_INDEX_VERSION = 1
 
 
 def _FindModules(subdir_path):
@@ -27,6 +43,19 @@ def _FindModules(subdir_path):
   return modules
 
 
+def _LoadModule(subdir_path, mod_name):
+  """Import the command module |mod_name| (unless it already was)."""
+  # The modules have always been loaded under their bare names.
+  if mod_name in sys.modules:
+    return sys.modules[mod_name]
+  mod_info = imp.find_module(mod_name, [subdir_path])
+  try:
+    return imp.load_module(mod_name, *mod_info)
+  finally:
+    if mod_info[0]:
+      mod_info[0].close()
+
+
 def _ImportCommands():
   """Directly imports all cros_[!unittest] python modules.
 
@@ -38,14 +67,128 @@ def _ImportCommands():
   for file_path in _FindModules(subdir_path):
     file_name = os.path.basename(file_path)
     mod_name = os.path.splitext(file_name)[0]
+    if mod_name in sys.modules:
+      continue
     imp.load_module(mod_name, *imp.find_module(mod_name, [subdir_path]))
 
 
+def _ScanModule(file_path):
+  """Find the commands declared in |file_path| without importing it.
+
+  Returns:
+    A dictionary mapping command names to the first line of their help.
+  """
+  with open(file_path) as f:
+    tree = ast.parse(f.read(), file_path)
+
+  # Command names are usually literals, but sometimes module constants.
+  strings = {}
+  for node in tree.body:
+    if isinstance(node, ast.Assign) and isinstance(node.value, ast.Str):
+      for target in node.targets:
+        if isinstance(target, ast.Name):
+          strings[target.id] = node.value.s
+
+  found = {}
+  for node in tree.body:
+    if not isinstance(node, ast.ClassDef):
+      continue
+    for decorator in node.decorator_list:
+      if not (isinstance(decorator, ast.Call) and decorator.args and
+              getattr(decorator.func, 'attr',
+                      getattr(decorator.func, 'id', None)) ==
+              'CommandDecorator'):
+        continue
+      name = decorator.args[0]
+      if isinstance(name, ast.Str):
+        name = name.s
+      elif isinstance(name, ast.Name) and name.id in strings:
+        name = strings[name.id]
+      else:
+        continue
+      doc = (ast.get_docstring(node) or '').strip()
+      found[name] = doc.splitlines()[0] if doc else ''
+  return found
+
+
+def _GetIndexDir():
+  """Return the directory to keep command indexes in."""
+  return os.path.join(commandline.GetCacheDir(), INDEX_DIR)
+
+
+def _GetIndexPath(subdir_path):
+  """Return the path to the cached index for the commands in |subdir_path|"""
+  key = hashlib.md5(os.path.realpath(subdir_path)).hexdigest()
+  return os.path.join(_GetIndexDir(), '%s.json' % key)
+
+
+def GetCommandIndex(subdir_path=None):
+  """Return the commands available, without importing any of them.
+
+  The index is cached on disk, and rebuilt whenever a command module changes.
+
+  Args:
+    subdir_path: The directory to look for commands in.
+
+  Returns:
+    A dictionary mapping command names to dictionaries with the 'module'
+    the command lives in and its one line 'help'.
+  """
+  if subdir_path is None:
+    subdir_path = os.path.dirname(os.path.abspath(__file__))
+
+  stamps = {}
+  for file_path in _FindModules(subdir_path):
+    st = os.stat(file_path)
+    stamps[os.path.basename(file_path)] = [st.st_mtime, st.st_size]
+
+  index_path = _GetIndexPath(subdir_path)
+  try:
+    with open(index_path) as f:
+      cached = json.load(f)
+    if cached['version'] == _INDEX_VERSION and cached['stamps'] == stamps:
+      return cached['commands']
+  except (IOError, ValueError, KeyError, TypeError):
+    pass
+
+  commands = {}
+  for file_name in stamps:
+    mod_name = os.path.splitext(file_name)[0]
+    found = _ScanModule(os.path.join(subdir_path, file_name))
+    for name, help_text in found.iteritems():
+      commands[name] = {'module': mod_name, 'help': help_text}
+
+  # Failing to write out the cache only costs us speed.
+  try:
+    index_dir = os.path.dirname(index_path)
+    if not os.path.isdir(index_dir):
+      os.makedirs(index_dir)
+    tmp_path = '%s.%i' % (index_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+      json.dump({'version': _INDEX_VERSION, 'stamps': stamps,
+                 'commands': commands}, f)
+    os.rename(tmp_path, index_path)
+  except (IOError, OSError):
+    pass
+
+  return commands
+
+
+def GetCommand(name):
+  """Return the class of command |name|, importing only its module.
+
+  Raises:
+    KeyError if there is no such command.
+  """
+  # pylint: disable=W0212
+  if name not in cros._commands:
+    subdir_path = os.path.dirname(os.path.abspath(__file__))
+    _LoadModule(subdir_path, GetCommandIndex(subdir_path)[name]['module'])
+  return cros._commands[name]
+
+
 def ListCommands():
   """Return a dictionary mapping command names to classes."""
   # pylint: disable=W0212
+  _ImportCommands()
   return cros._commands.copy()
-
-
-_ImportCommands()
-
@@ -17,9 +17,15 @@ sys.path.insert(0, os.path.abspath('%s/../../..' % os.path.dirname(__file__)))
 from chromite.lib import commandline
 from chromite.lib import cros_build_lib_unittest
 from chromite.lib import cros_test_lib
+from chromite.lib import osutils
 from chromite.lib import partial_mock
+from chromite import cros
 from chromite.cros import commands
 
+# TODO(build): Finish test wrapper (http://crosbug.com/37517).
+# Until then, this has to be after the chromite imports.
+import mock
+
 
 class MockCommand(partial_mock.PartialMock):
   """Mock class for a generic cros command."""
@@ -82,5 +88,82 @@ class CommandTest(cros_test_lib.MoxTestCase):
     self.mox.VerifyAll()
 
 
+class CommandIndexTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for finding commands without importing them."""
+
+  def setUp(self):
+    self.PatchObject(commandline, 'GetCacheDir', return_value=self.tempdir)
+    self.cmd_dir = os.path.join(self.tempdir, 'cmds')
+    osutils.WriteFile(os.path.join(self.cmd_dir, 'cros_foo.py'),
+                      _FAKE_COMMAND_MODULE, makedirs=True)
+    osutils.WriteFile(os.path.join(self.cmd_dir, 'cros_foo_unittest.py'),
+                      _FAKE_COMMAND_MODULE.replace('foo', 'unittest'))
+
+  def testRealCommands(self):
+    """The index should match what the command modules register."""
+    index = commands.GetCommandIndex()
+    cmds = commands.ListCommands()
+    self.assertEqual(sorted(index), sorted(cmds))
+    for name, info in index.iteritems():
+      self.assertEqual(info['module'], cmds[name].__module__)
+      self.assertTrue(cmds[name].__doc__.strip().startswith(info['help']))
+
+  def testScan(self):
+    """Commands named by literals & module constants should be found."""
+    self.assertEqual(commands.GetCommandIndex(self.cmd_dir), {
+        'foo': {'module': 'cros_foo', 'help': 'Do foo things.'},
+        'bar': {'module': 'cros_foo', 'help': 'Do bar things.'},
+    })
+
+  def testCache(self):
+    """The index should be cached until a command module changes."""
+    scan = self.PatchObject(commands, '_ScanModule',
+                            side_effect=commands._ScanModule)
+    index = commands.GetCommandIndex(self.cmd_dir)
+    self.assertExists(commands._GetIndexPath(self.cmd_dir))
+    self.assertTrue(commands._GetIndexPath(self.cmd_dir).startswith(
+        os.path.join(self.tempdir, commands.INDEX_DIR)))
+    self.assertEqual(commands.GetCommandIndex(self.cmd_dir), index)
+    self.assertEqual(scan.call_count, 1)
+
+    osutils.WriteFile(os.path.join(self.cmd_dir, 'cros_foo.py'),
+                      _FAKE_COMMAND_MODULE.replace('bar', 'baz'))
+    self.assertIn('baz', commands.GetCommandIndex(self.cmd_dir))
+    self.assertEqual(scan.call_count, 2)
+
+  def testGetCommand(self):
+    """Only the module of the requested command should be imported."""
+    load = self.PatchObject(imp, 'load_module', side_effect=imp.load_module)
+    self.StartPatcher(mock.patch.dict(sys.modules))
+    self.StartPatcher(mock.patch.dict(cros._commands, clear=True))
+    for mod_name in ('cros_lint', 'cros_flash'):
+      sys.modules.pop(mod_name, None)
+    lint = commands.GetCommand('lint')
+    self.assertEqual(lint.command_name, 'lint')
+    self.assertEqual([x[0][0] for x in load.call_args_list], ['cros_lint'])
+    self.assertNotIn('cros_flash', sys.modules)
+
+
+_FAKE_COMMAND_MODULE = """
+from chromite import cros
+
+BAR = 'bar'
+
+@cros.CommandDecorator('foo')
+class FooCommand(cros.CrosCommand):
+  \"\"\"Do foo things.
+
+  More about foo.
+  \"\"\"
+
+@cros.CommandDecorator(BAR)
+class BarCommand(cros.CrosCommand):
+  \"\"\"Do bar things.\"\"\"
+
+class NotACommand(object):
+  \"\"\"Do nothing.\"\"\"
+"""
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
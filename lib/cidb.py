@@ -4,11 +4,24 @@
 
 """Continuous Integration Database Library."""
 
+import collections
+import datetime
+import functools
 import glob
 import logging
+import multiprocessing.util
 import os
 import re
-import sqlalchemy
+import threading
+
+try:
+  import sqlalchemy
+  import sqlalchemy.exc
+  import sqlalchemy.pool
+except ImportError:
+  # Only builders that actually write to the database need sqlalchemy;
+  # everyone else still gets to import this module.
+  sqlalchemy = None
 
 from chromite.cbuildbot import constants
 
@@ -19,6 +32,25 @@ TEST_DB_CREDENTIALS_DIR = os.path.join(constants.SOURCE_ROOT,
 CIDB_MIGRATIONS_DIR = os.path.join(constants.CHROMITE_DIR, 'cidb',
                                    'migrations')
 
+# Number of connections each process keeps open to the database, and how
+# many more it may open when they are all busy.
+POOL_SIZE = 2
+POOL_MAX_OVERFLOW = 5
+# MySQL closes connections that sit idle for longer than its wait_timeout;
+# replace ours well before that happens.
+POOL_RECYCLE = 60 * 60
+
+# Max number of rows a CIDBWriter holds on to before inserting them.
+BATCH_SIZE = 100
+
+# Values of clActionTable.change_source.
+CHANGE_SOURCE_INTERNAL = 'internal'
+CHANGE_SOURCE_EXTERNAL = 'external'
+
+# Value of buildTable.status until a build finishes.
+BUILD_STATUS_INFLIGHT = 'inflight'
+
+
 class DBException(Exception):
   """General exception class for this module."""
 
@@ -27,6 +59,12 @@ class UnsupportedMethodException(DBException):
   """Raised when a call is made that the database does not support."""
 
 
+# What talking to the database can raise.  Builds catch these around their
+# writes to CIDB, so that database problems never fail the build.
+DB_ERRORS = ((DBException, sqlalchemy.exc.SQLAlchemyError)
+             if sqlalchemy is not None else (DBException,))
+
+
 def minimum_schema(min_version):
   """Generate a decorator to specify a minimum schema version for a method.
 
@@ -35,21 +73,30 @@ def minimum_schema(min_version):
   """
 
   def decorator(f):
-    def wrapper(self, *args):
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
       if self.schema_version < min_version:
         raise UnsupportedMethodException()
-      return f(self, *args)
+      return f(self, *args, **kwargs)
     return wrapper
   return decorator
 
 
+def _ToDatetime(timestamp):
+  """Convert |timestamp| (seconds since the epoch) to a UTC datetime."""
+  if timestamp is None:
+    return None
+  return datetime.datetime.utcfromtimestamp(timestamp)
+
+
 class SchemaVersionedMySQLConnection(object):
   """Connection to a database that is aware of its schema version."""
 
   SCHEMA_VERSION_TABLE_NAME = 'schemaVersionTable'
   SCHEMA_VERSION_COL = 'schemaVersion'
 
-  def __init__(self, db_name, db_migrations_dir, db_credentials_dir):
+  def __init__(self, db_name, db_migrations_dir, db_credentials_dir,
+               connect_url=None):
     """SchemaVersionedMySQLConnection constructor.
 
     Args:
@@ -61,11 +108,29 @@ class SchemaVersionedMySQLConnection(object):
                           directory should contain files names user.txt,
                           password.txt, host.txt, client-cert.pem,
                           client-key.pem, and server-ca.pem
+      connect_url: If given, connect to this sqlalchemy database URL rather
+                   than the MySQL instance in |db_credentials_dir|, e.g.
+                   'sqlite://' for a throwaway in-memory database.
     """
+    if sqlalchemy is None:
+      raise DBException('sqlalchemy is needed to connect to %s' % db_name)
+
     self.db_migrations_dir = db_migrations_dir
     self.db_credentials_dir = db_credentials_dir
     self.db_name = db_name
 
+    self._engine = None
+    self._engine_pid = None
+    # Engines we inherited from our parent process; see the engine property.
+    self._parent_engines = []
+    self._metadata = sqlalchemy.MetaData()
+
+    if connect_url is not None:
+      self._connect_url = connect_url
+      self._connect_args = {}
+      self.schema_version = self.QuerySchemaVersion()
+      return
+
     with open(os.path.join(db_credentials_dir, 'password.txt')) as f:
       password = f.read().strip()
     with open(os.path.join(db_credentials_dir, 'host.txt')) as f:
@@ -94,13 +159,95 @@ class SchemaVersionedMySQLConnection(object):
     # Now create the persistent connection to the database named |db_name|.
     # If there is a schema version table, read the current schema version
     # from it. Otherwise, assume schema_version 0.
-    connect_string = '%s/%s' % (connect_string, db_name)
-
-    self.engine = sqlalchemy.create_engine(connect_string,
-                                           connect_args=ssl_args)
+    self._connect_url = '%s/%s' % (connect_string, db_name)
+    self._connect_args = ssl_args
 
     self.schema_version = self.QuerySchemaVersion()
 
+  def _IsSQLite(self):
+    return self._connect_url.startswith('sqlite')
+
+  def _CreateEngine(self):
+    """Create the engine (and its pool of connections) for this process."""
+    if self._IsSQLite():
+      # An in-memory database only lives as long as its connection, so
+      # everyone has to share the one connection.
+      return sqlalchemy.create_engine(
+          self._connect_url, poolclass=sqlalchemy.pool.StaticPool,
+          connect_args={'check_same_thread': False})
+    return sqlalchemy.create_engine(
+        self._connect_url, connect_args=self._connect_args,
+        pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW,
+        pool_recycle=POOL_RECYCLE)
+
+  @property
+  def engine(self):
+    """The sqlalchemy engine to use from this process.
+
+    Connections are pooled, but a pooled connection can't be shared with
+    the processes we fork (e.g. stages running in parallel), so children
+    get an engine of their own the first time they use it.
+    """
+    pid = os.getpid()
+    if self._engine is None:
+      self._engine = self._CreateEngine()
+    elif self._engine_pid != pid and not self._IsSQLite():
+      # Hold on to our parent's engine rather than letting it get collected:
+      # closing its connections from here would close them for the parent.
+      self._parent_engines.append(self._engine)
+      self._engine = self._CreateEngine()
+    self._engine_pid = pid
+    return self._engine
+
+  def _GetTable(self, name):
+    """Return the sqlalchemy Table |name|, as it is in the database."""
+    table = self._metadata.tables.get(name)
+    if table is None:
+      table = sqlalchemy.Table(name, self._metadata, autoload=True,
+                               autoload_with=self.engine)
+    return table
+
+  def _Insert(self, table_name, values):
+    """Insert a row of |values| into |table_name|.
+
+    Returns:
+      The primary key of the new row.
+    """
+    table = self._GetTable(table_name)
+    r = self.engine.execute(table.insert().values(values))
+    return r.inserted_primary_key[0]
+
+  def _InsertMany(self, table_name, rows):
+    """Insert all of |rows| (dictionaries) into |table_name| at once.
+
+    The rows go out in one transaction and, where the driver supports it, one
+    round trip to the database.
+    """
+    if not rows:
+      return
+    table = self._GetTable(table_name)
+    with self.engine.begin() as conn:
+      conn.execute(table.insert(), rows)
+
+  def _Update(self, table_name, row_id, values):
+    """Update the row with id |row_id| in |table_name| with |values|."""
+    table = self._GetTable(table_name)
+    self.engine.execute(table.update().where(table.c.id == row_id)
+                        .values(values))
+
+  def _Select(self, table_name, *args):
+    """Return the rows of |table_name| matching all the clauses as dicts.
+
+    Args:
+      table_name: The table to select from.
+      args: Functions taking the Table and returning a clause to filter by.
+    """
+    table = self._GetTable(table_name)
+    query = table.select()
+    for make_clause in args:
+      query = query.where(make_clause(table))
+    return [dict(r) for r in self.engine.execute(query.order_by(table.c.id))]
+
   def DropDatabase(self):
     """Delete all data and tables from database, and drop database.
 
@@ -117,8 +264,7 @@ class SchemaVersionedMySQLConnection(object):
       The current schema version from the database's schema version table,
       as an integer, or 0 if the table is empty or nonexistent.
     """
-    tables = self.engine.execute('SHOW TABLES').fetchall()
-    if (self.SCHEMA_VERSION_TABLE_NAME,) in tables:
+    if self.engine.has_table(self.SCHEMA_VERSION_TABLE_NAME):
       r = self.engine.execute('SELECT MAX(%s) from %s' %
           (self.SCHEMA_VERSION_COL, self.SCHEMA_VERSION_TABLE_NAME))
       return r.fetchone()[0] or 0
@@ -158,20 +304,31 @@ class SchemaVersionedMySQLConnection(object):
                             'schema version to %s as expected. ' % (number,
                                                                     script))
 
+    # Tables may have changed underneath whatever we had looked up.
+    self._metadata.clear()
+
   def RunQueryScript(self, script_path):
     """Run a .sql script file located at |script_path| on the database."""
     with open(script_path, 'r') as f:
       script = f.read()
     queries = [q.strip() for q in script.split(';') if q.strip()]
     for q in queries:
+      if self._IsSQLite():
+        # The scripts are written for MySQL, which spells auto incrementing
+        # keys differently.
+        q = q.replace('INT NOT NULL AUTO_INCREMENT PRIMARY KEY',
+                      'INTEGER PRIMARY KEY AUTOINCREMENT')
       self.engine.execute(q)
 
 
 class CIDBConnection(SchemaVersionedMySQLConnection):
   """Connection to a Continuous Integration database."""
-  def __init__(self):
+
+  def __init__(self, db_credentials_dir=TEST_DB_CREDENTIALS_DIR,
+               connect_url=None):
     super(CIDBConnection, self).__init__('cidb', CIDB_MIGRATIONS_DIR,
-                                         TEST_DB_CREDENTIALS_DIR)
+                                         db_credentials_dir,
+                                         connect_url=connect_url)
 
   @minimum_schema(1)
   def TestMethodSchemaTooLow(self):
@@ -181,3 +338,511 @@ class CIDBConnection(SchemaVersionedMySQLConnection):
   def TestMethodSchemaOK(self):
     """This method is a temporary one to test the minimum_schema decorator."""
 
+  @minimum_schema(2)
+  def InsertBuild(self, builder_name, waterfall, build_number, build_config,
+                  bot_hostname, master_build_id=None, full_version=None,
+                  start_time=None):
+    """Insert a build row into the database.
+
+    Args:
+      builder_name: The buildbot builder name, e.g. 'x86-generic paladin'.
+      waterfall: The waterfall the builder is on, e.g. 'chromeos'.
+      build_number: The buildbot build number.
+      build_config: The cbuildbot config of the build.
+      bot_hostname: The hostname of the bot running the build.
+      master_build_id: The build id of this build's master, if it is a slave.
+      full_version: The full version string of the build, if known.
+      start_time: When the build started (seconds since the epoch); defaults
+                  to now.
+
+    Returns:
+      The build id of the new build.
+    """
+    return self._Insert('buildTable', {
+        'builder_name': builder_name,
+        'waterfall': waterfall,
+        'build_number': build_number,
+        'build_config': build_config,
+        'bot_hostname': bot_hostname,
+        'master_build_id': master_build_id,
+        'full_version': full_version,
+        'start_time': _ToDatetime(start_time) or datetime.datetime.utcnow(),
+        'status': BUILD_STATUS_INFLIGHT,
+    })
+
+  @minimum_schema(2)
+  def FinishBuild(self, build_id, status, finish_time=None):
+    """Record that build |build_id| finished with |status|.
+
+    Args:
+      build_id: The build to update.
+      status: The final status of the build, e.g.
+              constants.FINAL_STATUS_PASSED.
+      finish_time: When the build finished (seconds since the epoch);
+                   defaults to now.
+    """
+    self._Update('buildTable', build_id, {
+        'status': status,
+        'finish_time': _ToDatetime(finish_time) or datetime.datetime.utcnow(),
+    })
+
+  @minimum_schema(2)
+  def InsertBuildStages(self, build_id, stages):
+    """Insert the results of a number of stages of build |build_id|.
+
+    Args:
+      build_id: The build the stages are part of.
+      stages: A list of dictionaries with the 'name', 'board', 'status',
+              'start_time', 'finish_time' (seconds since the epoch) and
+              'summary' of each stage.
+    """
+    self._InsertMany('buildStageTable', [{
+        'build_id': build_id,
+        'name': stage['name'],
+        'board': stage.get('board'),
+        'status': stage['status'],
+        'start_time': _ToDatetime(stage.get('start_time')),
+        'finish_time': _ToDatetime(stage.get('finish_time')),
+        'summary': stage.get('summary'),
+    } for stage in stages])
+
+  @minimum_schema(2)
+  def InsertCLActions(self, build_id, cl_actions):
+    """Insert a number of CL actions taken by build |build_id|.
+
+    Args:
+      build_id: The build that took the actions.
+      cl_actions: A list of (change, action, timestamp, reason) tuples, as
+                  recorded by CBuildbotMetadata.RecordCLAction.
+    """
+    rows = []
+    for change, action, timestamp, reason in cl_actions:
+      rows.append({
+          'build_id': build_id,
+          'change_number': int(change['gerrit_number']),
+          'patch_number': int(change['patch_number']),
+          'change_source': (CHANGE_SOURCE_INTERNAL if change['internal']
+                            else CHANGE_SOURCE_EXTERNAL),
+          'action': action,
+          'reason': reason,
+          'timestamp': _ToDatetime(timestamp),
+      })
+    self._InsertMany('clActionTable', rows)
+
+  @minimum_schema(2)
+  def GetBuildStatus(self, build_id):
+    """Return the buildTable row of |build_id| as a dict, or None."""
+    rows = self._Select('buildTable', lambda t: t.c.id == build_id)
+    return rows[0] if rows else None
+
+  @minimum_schema(2)
+  def GetSlaveStatuses(self, master_build_id):
+    """Return the buildTable rows of the slaves of |master_build_id|.
+
+    Only builds inserted with a master_build_id are found; cbuildbot does
+    not pass its master's build id on to slaves (yet).
+    """
+    return self._Select('buildTable',
+                        lambda t: t.c.master_build_id == master_build_id)
+
+  @staticmethod
+  def _TimeClauses(column, start_time, end_time):
+    """Return the clauses limiting |column| to [start_time, end_time)."""
+    clauses = []
+    if start_time is not None:
+      clauses.append(column >= start_time)
+    if end_time is not None:
+      clauses.append(column < end_time)
+    return clauses
+
+  @classmethod
+  def _BuildClauses(cls, build_table, build_configs=None, builder_name=None):
+    """Return the clauses limiting |build_table| to the given builders."""
+    clauses = []
+    if build_configs is not None:
+      clauses.append(build_table.c.build_config.in_(build_configs))
+    if builder_name is not None:
+      clauses.append(build_table.c.builder_name == builder_name)
+    return clauses
+
+  def _CLActionsFrom(self):
+    """Return clActionTable joined with the builds that took the actions."""
+    a = self._GetTable('clActionTable')
+    b = self._GetTable('buildTable')
+    return a, b, a.join(b, a.c.build_id == b.c.id)
+
+  @staticmethod
+  def _Where(query, clauses):
+    for clause in clauses:
+      query = query.where(clause)
+    return query
+
+  @minimum_schema(3)
+  def GetBuilds(self, build_configs=None, builder_name=None, start_time=None,
+                end_time=None):
+    """Return the builds matching all of the given filters.
+
+    Args:
+      build_configs: Only return builds of these configs.
+      builder_name: Only return builds by this buildbot builder.
+      start_time: Only return builds that started at or after this (UTC)
+                  datetime.
+      end_time: Only return builds that started before this (UTC) datetime.
+
+    Returns:
+      A list of buildTable rows (as dicts), oldest first.
+    """
+    b = self._GetTable('buildTable')
+    query = self._Where(
+        b.select(),
+        self._BuildClauses(b, build_configs, builder_name) +
+        self._TimeClauses(b.c.start_time, start_time, end_time))
+    query = query.order_by(b.c.start_time, b.c.id)
+    return [dict(r) for r in self.engine.execute(query)]
+
+  @minimum_schema(3)
+  def GetBuildStatusCounts(self, build_configs=None, start_time=None,
+                           end_time=None):
+    """Count the builds that started in a time range, by config and status.
+
+    Returns:
+      A dict mapping (build_config, status) to the number of such builds.
+    """
+    b = self._GetTable('buildTable')
+    query = self._Where(
+        sqlalchemy.select([b.c.build_config, b.c.status,
+                           sqlalchemy.func.count()]),
+        self._BuildClauses(b, build_configs) +
+        self._TimeClauses(b.c.start_time, start_time, end_time))
+    query = query.group_by(b.c.build_config, b.c.status)
+    return dict(((config, status), count)
+                for config, status, count in self.engine.execute(query))
+
+  @minimum_schema(3)
+  def GetStageFailureCounts(self, build_configs=None, start_time=None,
+                            end_time=None):
+    """Count the failures of each stage in builds that started in a range.
+
+    Returns:
+      A dict mapping (build_config, stage name) to the number of failures.
+    """
+    st = self._GetTable('buildStageTable')
+    b = self._GetTable('buildTable')
+    query = self._Where(
+        sqlalchemy.select([b.c.build_config, st.c.name,
+                           sqlalchemy.func.count()])
+        .select_from(st.join(b, st.c.build_id == b.c.id))
+        .where(st.c.status == constants.FINAL_STATUS_FAILED),
+        self._BuildClauses(b, build_configs) +
+        self._TimeClauses(b.c.start_time, start_time, end_time))
+    query = query.group_by(b.c.build_config, st.c.name)
+    return dict(((config, name), count)
+                for config, name, count in self.engine.execute(query))
+
+  @minimum_schema(3)
+  def GetCLActions(self, build_configs=None, change_number=None,
+                   change_source=None, patch_number=None, start_time=None,
+                   end_time=None):
+    """Return the CL actions matching all of the given filters.
+
+    Args:
+      build_configs: Only return actions taken by builds of these configs.
+      change_number: Only return actions on this gerrit change number.
+      change_source: Only return actions on CLs from this source (one of
+                     CHANGE_SOURCE_INTERNAL or CHANGE_SOURCE_EXTERNAL).
+      patch_number: Only return actions on this patch number.
+      start_time: Only return actions taken at or after this (UTC) datetime.
+      end_time: Only return actions taken before this (UTC) datetime.
+
+    Returns:
+      A list of clActionTable rows (as dicts, along with the build_config
+      of the build that took the action), oldest first.
+    """
+    a, b, actions = self._CLActionsFrom()
+    clauses = (self._BuildClauses(b, build_configs) +
+               self._TimeClauses(a.c.timestamp, start_time, end_time))
+    for column, value in ((a.c.change_number, change_number),
+                          (a.c.change_source, change_source),
+                          (a.c.patch_number, patch_number)):
+      if value is not None:
+        clauses.append(column == value)
+    query = self._Where(
+        sqlalchemy.select([a, b.c.build_config]).select_from(actions),
+        clauses)
+    query = query.order_by(a.c.timestamp, a.c.id)
+    return [dict(r) for r in self.engine.execute(query)]
+
+  @minimum_schema(3)
+  def GetCLActionCounts(self, build_configs=None, start_time=None,
+                        end_time=None):
+    """Count the CL actions taken in a time range, by config and action.
+
+    Returns:
+      A dict mapping (build_config, action) to the number of such actions.
+    """
+    a, b, actions = self._CLActionsFrom()
+    query = self._Where(
+        sqlalchemy.select([b.c.build_config, a.c.action,
+                           sqlalchemy.func.count()]).select_from(actions),
+        self._BuildClauses(b, build_configs) +
+        self._TimeClauses(a.c.timestamp, start_time, end_time))
+    query = query.group_by(b.c.build_config, a.c.action)
+    return dict(((config, action), count)
+                for config, action, count in self.engine.execute(query))
+
+  @minimum_schema(3)
+  def GetUniqueChangeCounts(self, build_configs=None, start_time=None,
+                            end_time=None):
+    """Count the distinct CLs and patches acted on in a time range.
+
+    Returns:
+      A (number of CLs, number of patches) tuple.
+    """
+    a, b, actions = self._CLActionsFrom()
+    clauses = (self._BuildClauses(b, build_configs) +
+               self._TimeClauses(a.c.timestamp, start_time, end_time))
+    counts = []
+    for columns in ([a.c.change_number, a.c.change_source],
+                    [a.c.change_number, a.c.change_source, a.c.patch_number]):
+      distinct = self._Where(
+          sqlalchemy.select(columns).select_from(actions), clauses)
+      query = sqlalchemy.select([sqlalchemy.func.count()]).select_from(
+          distinct.distinct().alias())
+      counts.append(self.engine.execute(query).scalar())
+    return tuple(counts)
+
+  def _RejectionsQuery(self, build_configs, start_time, end_time,
+                       falsely_rejected):
+    """Return a query for the rejections of CLs that were later submitted.
+
+    A rejection only counts if the build had actually picked up the patch
+    (i.e. it didn't just fail to apply).  A rejection is considered false if
+    the very same patch went on to be submitted; if a later patch of the CL
+    was submitted instead, the rejected patch was probably bad.
+    """
+    b = self._GetTable('buildTable')
+    a = self._GetTable('clActionTable')
+    rejected = a.alias('rejected')
+    submitted = a.alias('submitted')
+    picked_up = a.alias('picked_up')
+
+    def _SameChange(other):
+      return sqlalchemy.and_(
+          other.c.change_number == rejected.c.change_number,
+          other.c.change_source == rejected.c.change_source)
+
+    if falsely_rejected:
+      same_patch = submitted.c.patch_number == rejected.c.patch_number
+    else:
+      same_patch = submitted.c.patch_number != rejected.c.patch_number
+    was_submitted = sqlalchemy.exists().where(sqlalchemy.and_(
+        _SameChange(submitted), same_patch,
+        submitted.c.action == constants.CL_ACTION_SUBMITTED,
+        *self._TimeClauses(submitted.c.timestamp, start_time, end_time)))
+    was_picked_up = sqlalchemy.exists().where(sqlalchemy.and_(
+        _SameChange(picked_up),
+        picked_up.c.patch_number == rejected.c.patch_number,
+        picked_up.c.build_id == rejected.c.build_id,
+        picked_up.c.action == constants.CL_ACTION_PICKED_UP))
+
+    query = sqlalchemy.select([
+        rejected.c.id, rejected.c.build_id, b.c.build_config,
+        rejected.c.change_number, rejected.c.change_source,
+        rejected.c.patch_number, rejected.c.timestamp,
+    ]).select_from(rejected.join(b, rejected.c.build_id == b.c.id))
+    return self._Where(
+        query,
+        [rejected.c.action == constants.CL_ACTION_KICKED_OUT,
+         was_submitted, was_picked_up] +
+        self._BuildClauses(b, build_configs) +
+        self._TimeClauses(rejected.c.timestamp, start_time, end_time))
+
+  @minimum_schema(3)
+  def GetRejections(self, build_configs=None, start_time=None, end_time=None,
+                    falsely_rejected=True):
+    """Return the rejections of CLs that were submitted in a time range.
+
+    Args:
+      build_configs: Only return rejections by builds of these configs.
+      start_time: Only consider actions at or after this (UTC) datetime.
+      end_time: Only consider actions before this (UTC) datetime.
+      falsely_rejected: If True, return the rejections of patches that were
+                        later submitted unmodified (i.e. good patches).  If
+                        False, return the rejections of patches that were
+                        replaced by the patch that got submitted.
+
+    Returns:
+      A list of dicts with the 'id', 'build_id', 'build_config',
+      'change_number', 'change_source', 'patch_number' and 'timestamp' of
+      each rejection, oldest first.
+    """
+    query = self._RejectionsQuery(build_configs, start_time, end_time,
+                                  falsely_rejected).alias('rejections')
+    query = sqlalchemy.select([query]).order_by(query.c.timestamp,
+                                                query.c.id)
+    return [dict(r) for r in self.engine.execute(query)]
+
+  @minimum_schema(3)
+  def GetRejectionStageFailureCounts(self, build_configs=None,
+                                     start_time=None, end_time=None,
+                                     falsely_rejected=True):
+    """Count the stage failures behind rejections (see GetRejections).
+
+    Returns:
+      A dict mapping (build_config, stage name) to the number of rejections
+      the stage failing in that config was (partly) responsible for.
+    """
+    rejections = self._RejectionsQuery(build_configs, start_time, end_time,
+                                       falsely_rejected).alias('rejections')
+    st = self._GetTable('buildStageTable')
+    query = sqlalchemy.select([
+        rejections.c.build_config, st.c.name, sqlalchemy.func.count(),
+    ]).select_from(rejections.join(st, st.c.build_id == rejections.c.build_id))
+    query = query.where(st.c.status == constants.FINAL_STATUS_FAILED)
+    query = query.group_by(rejections.c.build_config, st.c.name)
+    return dict(((config, name), count)
+                for config, name, count in self.engine.execute(query))
+
+  @minimum_schema(3)
+  def GetPatchHandlingTimes(self, build_configs=None, start_time=None,
+                            end_time=None):
+    """Return how long each patch submitted in a time range took to land.
+
+    Returns:
+      A list of the seconds between the first and last action on each
+      submitted patch.
+    """
+    a, b, actions = self._CLActionsFrom()
+    submitted = sqlalchemy.func.sum(sqlalchemy.case(
+        [(a.c.action == constants.CL_ACTION_SUBMITTED, 1)], else_=0))
+    query = self._Where(
+        sqlalchemy.select([sqlalchemy.func.min(a.c.timestamp),
+                           sqlalchemy.func.max(a.c.timestamp)])
+        .select_from(actions),
+        self._BuildClauses(b, build_configs) +
+        self._TimeClauses(a.c.timestamp, start_time, end_time))
+    query = query.group_by(a.c.change_number, a.c.change_source,
+                           a.c.patch_number).having(submitted > 0)
+    return [(last - first).total_seconds()
+            for first, last in self.engine.execute(query)]
+
+
+class CIDBWriter(object):
+  """Queue up rows for CIDB and insert them in batches.
+
+  Builds take actions on CLs one at a time, from a number of processes;
+  rather than making a round trip to the database for each of them, rows
+  are held here and inserted |batch_size| at a time (and whatever is left
+  when the process exits).  Forked children start out with nothing queued,
+  so nothing gets written twice.
+
+  Failing to write to the database never fails the caller; the rows are
+  logged and dropped instead.
+  """
+
+  # The per-process state is set up by _Reset() rather than __init__, as a
+  # forked child has to start over with its own copy of it.
+  # pylint: disable=W0201
+
+  def __init__(self, db, batch_size=BATCH_SIZE):
+    """Initialize.
+
+    Args:
+      db: The CIDBConnection to write to.
+      batch_size: Max number of rows to queue up before inserting them.
+    """
+    self.db = db
+    self.batch_size = batch_size
+    self._pid = None
+    self._Reset()
+
+  def _Reset(self):
+    """Set up (or throw away, after a fork) the per-process state."""
+    self._pid = os.getpid()
+    self._lock = threading.Lock()
+    # Maps (CIDBConnection method, build id) -> rows to pass to it.
+    self._pending = collections.OrderedDict()
+    self._count = 0
+    # Unlike atexit handlers, this also runs in multiprocessing children.
+    multiprocessing.util.Finalize(self, self.Flush, exitpriority=10)
+
+  def _Add(self, method, build_id, row):
+    if self._pid != os.getpid():
+      self._Reset()
+    with self._lock:
+      self._pending.setdefault((method, build_id), []).append(row)
+      self._count += 1
+      full = self._count >= self.batch_size
+    if full:
+      self.Flush()
+
+  def AddCLAction(self, build_id, cl_action):
+    """Queue up a CL action (see CIDBConnection.InsertCLActions)."""
+    self._Add('InsertCLActions', build_id, cl_action)
+
+  def AddBuildStage(self, build_id, stage):
+    """Queue up a stage result (see CIDBConnection.InsertBuildStages)."""
+    self._Add('InsertBuildStages', build_id, stage)
+
+  def Flush(self):
+    """Insert everything queued so far."""
+    if self._pid != os.getpid():
+      return
+    with self._lock:
+      pending, self._pending = self._pending, collections.OrderedDict()
+      self._count = 0
+    for (method, build_id), rows in pending.iteritems():
+      try:
+        getattr(self.db, method)(build_id, rows)
+      except DB_ERRORS as e:
+        logging.warning('Dropping %d rows for build %s in CIDB (%s): %s',
+                        len(rows), build_id, method, e)
+
+
+_CIDB = None
+_WRITER = None
+
+
+def SetupCIDB(db):
+  """Make |db| the CIDBConnection this process (and its children) use.
+
+  Args:
+    db: A CIDBConnection, or None to stop writing to CIDB.
+  """
+  # pylint: disable=W0603
+  global _CIDB, _WRITER
+  if _WRITER is not None:
+    _WRITER.Flush()
+  _CIDB = db
+  _WRITER = CIDBWriter(db) if db is not None else None
+
+
+def ConnectCIDB(db_credentials_dir):
+  """Connect to the CIDB instance in |db_credentials_dir| & set it up.
+
+  Failing to connect does not fail the caller; nothing gets written to CIDB
+  instead.
+
+  Args:
+    db_credentials_dir: See CIDBConnection.
+
+  Returns:
+    Whether CIDB was set up (see SetupCIDB).
+  """
+  try:
+    db = CIDBConnection(db_credentials_dir)
+  except DB_ERRORS + (EnvironmentError,) as e:
+    logging.warning('Not writing to CIDB; failed to connect: %s', e)
+    return False
+  SetupCIDB(db)
+  return True
+
+
+def GetCIDB():
+  """Return the CIDBConnection set up by SetupCIDB, if any."""
+  return _CIDB
+
+
+def GetWriter():
+  """Return the CIDBWriter for the CIDB set up by SetupCIDB, if any."""
+  return _WRITER
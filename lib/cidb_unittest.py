@@ -0,0 +1,323 @@
+#!/usr/bin/python
+# Copyright 2014 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for cidb.py, using an in-memory SQLite database."""
+
+import datetime
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from chromite.cbuildbot import constants
+from chromite.lib import cidb
+from chromite.lib import cros_test_lib
+
+import mock
+
+
+def _GetCLAction(number, action, timestamp, internal=False, reason=''):
+  """Return a CL action the way CBuildbotMetadata.RecordCLAction does."""
+  change = {'gerrit_number': str(number), 'patch_number': '1',
+            'internal': internal}
+  return (change, action, timestamp, reason)
+
+
+class CIDBTestCase(cros_test_lib.MockTestCase):
+  """Base class for tests that need a fresh database."""
+
+  def _PrepareFreshDatabase(self, max_schema_version=None):
+    db = cidb.CIDBConnection(connect_url='sqlite://')
+    db.ApplySchemaMigrations(max_schema_version)
+    return db
+
+  def _InsertBuild(self, db, **kwargs):
+    kwargs.setdefault('builder_name', 'x86-generic paladin')
+    kwargs.setdefault('waterfall', 'chromeos')
+    kwargs.setdefault('build_number', 1)
+    kwargs.setdefault('build_config', 'x86-generic-paladin')
+    kwargs.setdefault('bot_hostname', 'build1.example.com')
+    return db.InsertBuild(**kwargs)
+
+
+class CIDBMigrationsTest(CIDBTestCase):
+  """Test that all migrations apply correctly."""
+
+  def testMigrations(self):
+    """Test that all migrations apply correctly."""
+    db = self._PrepareFreshDatabase()
+    self.assertEqual(db.schema_version, db.QuerySchemaVersion())
+    self.assertTrue(db.schema_version >= 2)
+
+  def testSchemaVersionTooLow(self):
+    """Methods needing a newer schema should refuse to run."""
+    db = self._PrepareFreshDatabase(1)
+    self.assertRaises(cidb.UnsupportedMethodException, self._InsertBuild, db)
+
+
+class CIDBAPITest(CIDBTestCase):
+  """Tests of the CIDB API."""
+
+  def setUp(self):
+    self.db = self._PrepareFreshDatabase()
+
+  def testInsertBuild(self):
+    """Builds should start out inflight, and finish with their status."""
+    build_id = self._InsertBuild(self.db, start_time=1000)
+    build = self.db.GetBuildStatus(build_id)
+    self.assertEqual(build['status'], cidb.BUILD_STATUS_INFLIGHT)
+    self.assertEqual(build['build_config'], 'x86-generic-paladin')
+    self.assertEqual(build['finish_time'], None)
+
+    self.db.FinishBuild(build_id, constants.FINAL_STATUS_PASSED,
+                        finish_time=2000)
+    build = self.db.GetBuildStatus(build_id)
+    self.assertEqual(build['status'], constants.FINAL_STATUS_PASSED)
+    self.assertNotEqual(build['finish_time'], None)
+    self.assertEqual(self.db.GetBuildStatus(build_id + 1), None)
+
+  def testSlaves(self):
+    """Slaves should be found through their master."""
+    master_id = self._InsertBuild(self.db, build_config='master-paladin')
+    slave_ids = [self._InsertBuild(self.db, build_config=x,
+                                   master_build_id=master_id)
+                 for x in ('x86-generic-paladin', 'arm-generic-paladin')]
+    self._InsertBuild(self.db, build_config='unrelated-paladin')
+    slaves = self.db.GetSlaveStatuses(master_id)
+    self.assertEqual([x['id'] for x in slaves], slave_ids)
+    self.assertEqual([x['build_config'] for x in slaves],
+                     ['x86-generic-paladin', 'arm-generic-paladin'])
+
+  def testInsertCLActions(self):
+    """CL actions should be inserted in one go."""
+    build_id = self._InsertBuild(self.db)
+    actions = [
+        _GetCLAction(1, constants.CL_ACTION_PICKED_UP, 1000),
+        _GetCLAction(2, constants.CL_ACTION_PICKED_UP, 1000, internal=True),
+        _GetCLAction(1, constants.CL_ACTION_KICKED_OUT, 1100, reason='flaky'),
+    ]
+    self.db.InsertCLActions(build_id, actions)
+    rows = self.db.engine.execute(
+        'SELECT change_number, change_source, action, reason '
+        'FROM clActionTable ORDER BY id').fetchall()
+    self.assertEqual([tuple(x) for x in rows], [
+        (1, cidb.CHANGE_SOURCE_EXTERNAL, constants.CL_ACTION_PICKED_UP, ''),
+        (2, cidb.CHANGE_SOURCE_INTERNAL, constants.CL_ACTION_PICKED_UP, ''),
+        (1, cidb.CHANGE_SOURCE_EXTERNAL, constants.CL_ACTION_KICKED_OUT,
+         'flaky'),
+    ])
+
+  def testInsertBuildStages(self):
+    """Stage results should be kept along with their build."""
+    build_id = self._InsertBuild(self.db)
+    self.db.InsertBuildStages(build_id, [
+        {'name': 'BuildPackages', 'board': 'x86-generic',
+         'status': constants.FINAL_STATUS_PASSED, 'start_time': 1000,
+         'finish_time': 2000, 'summary': 'Stage was successful'},
+        {'name': 'HWTest', 'status': constants.FINAL_STATUS_FAILED},
+    ])
+    rows = self.db.engine.execute(
+        'SELECT build_id, name, board, status FROM buildStageTable '
+        'ORDER BY id').fetchall()
+    self.assertEqual([tuple(x) for x in rows], [
+        (build_id, 'BuildPackages', 'x86-generic',
+         constants.FINAL_STATUS_PASSED),
+        (build_id, 'HWTest', None, constants.FINAL_STATUS_FAILED),
+    ])
+
+
+class CIDBQueryTest(CIDBTestCase):
+  """Tests of the CIDB query functions."""
+
+  def setUp(self):
+    self.db = self._PrepareFreshDatabase()
+
+    # Two CQ runs: the first rejects patch 1 of CL 1 and patch 1 of CL 2, the
+    # second submits patch 1 of CL 1 and patch 2 of CL 2.  Then a Pre-CQ run.
+    self.cq1 = self._InsertBuild(self.db, build_number=1, start_time=1000)
+    self.cq2 = self._InsertBuild(self.db, build_number=2, start_time=5000)
+    self.precq = self._InsertBuild(self.db, build_config='pre-cq',
+                                   builder_name='pre-cq', start_time=9000)
+    self.db.FinishBuild(self.cq1, constants.FINAL_STATUS_FAILED)
+    self.db.FinishBuild(self.cq2, constants.FINAL_STATUS_PASSED)
+
+    self.db.InsertCLActions(self.cq1, [
+        _GetCLAction(1, constants.CL_ACTION_PICKED_UP, 1000),
+        _GetCLAction(2, constants.CL_ACTION_PICKED_UP, 1000),
+        _GetCLAction(1, constants.CL_ACTION_KICKED_OUT, 2000),
+        _GetCLAction(2, constants.CL_ACTION_KICKED_OUT, 2000),
+    ])
+    c2p2 = _GetCLAction(2, constants.CL_ACTION_PICKED_UP, 5000)
+    c2p2[0]['patch_number'] = '2'
+    c2p2_submit = _GetCLAction(2, constants.CL_ACTION_SUBMITTED, 6000)
+    c2p2_submit[0]['patch_number'] = '2'
+    self.db.InsertCLActions(self.cq2, [
+        _GetCLAction(1, constants.CL_ACTION_PICKED_UP, 5000),
+        c2p2,
+        _GetCLAction(1, constants.CL_ACTION_SUBMITTED, 6000),
+        c2p2_submit,
+    ])
+    self.db.InsertBuildStages(self.cq1, [
+        {'name': 'HWTest', 'status': constants.FINAL_STATUS_FAILED},
+        {'name': 'VMTest', 'status': constants.FINAL_STATUS_FAILED},
+        {'name': 'BuildPackages', 'status': constants.FINAL_STATUS_PASSED},
+    ])
+    self.db.InsertBuildStages(self.precq, [
+        {'name': 'VMTest', 'status': constants.FINAL_STATUS_FAILED},
+    ])
+
+  @staticmethod
+  def _Time(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+  def testGetBuilds(self):
+    """Builds should be found by config, builder and time range."""
+    builds = self.db.GetBuilds(build_configs=['x86-generic-paladin'])
+    self.assertEqual([x['id'] for x in builds], [self.cq1, self.cq2])
+    builds = self.db.GetBuilds(builder_name='pre-cq')
+    self.assertEqual([x['id'] for x in builds], [self.precq])
+    builds = self.db.GetBuilds(start_time=self._Time(1000),
+                               end_time=self._Time(9000))
+    self.assertEqual([x['id'] for x in builds], [self.cq1, self.cq2])
+    self.assertEqual(self.db.GetBuildStatusCounts(), {
+        ('x86-generic-paladin', constants.FINAL_STATUS_FAILED): 1,
+        ('x86-generic-paladin', constants.FINAL_STATUS_PASSED): 1,
+        ('pre-cq', cidb.BUILD_STATUS_INFLIGHT): 1,
+    })
+
+  def testGetCLActions(self):
+    """The history of a CL should be found by its number."""
+    actions = self.db.GetCLActions(change_number=1,
+                                   change_source=cidb.CHANGE_SOURCE_EXTERNAL)
+    self.assertEqual([(x['build_id'], x['action']) for x in actions], [
+        (self.cq1, constants.CL_ACTION_PICKED_UP),
+        (self.cq1, constants.CL_ACTION_KICKED_OUT),
+        (self.cq2, constants.CL_ACTION_PICKED_UP),
+        (self.cq2, constants.CL_ACTION_SUBMITTED),
+    ])
+    self.assertEqual(actions[0]['build_config'], 'x86-generic-paladin')
+    self.assertEqual(len(self.db.GetCLActions(start_time=self._Time(5000))),
+                     4)
+    self.assertEqual(self.db.GetCLActionCounts(), {
+        ('x86-generic-paladin', constants.CL_ACTION_PICKED_UP): 4,
+        ('x86-generic-paladin', constants.CL_ACTION_KICKED_OUT): 2,
+        ('x86-generic-paladin', constants.CL_ACTION_SUBMITTED): 2,
+    })
+    self.assertEqual(self.db.GetUniqueChangeCounts(), (2, 3))
+
+  def testGetStageFailureCounts(self):
+    """Stage failures should be counted by config and stage."""
+    self.assertEqual(self.db.GetStageFailureCounts(), {
+        ('x86-generic-paladin', 'HWTest'): 1,
+        ('x86-generic-paladin', 'VMTest'): 1,
+        ('pre-cq', 'VMTest'): 1,
+    })
+    self.assertEqual(
+        self.db.GetStageFailureCounts(end_time=self._Time(9000)),
+        {('x86-generic-paladin', 'HWTest'): 1,
+         ('x86-generic-paladin', 'VMTest'): 1})
+
+  def testGetRejections(self):
+    """Good and bad patches should be told apart by what got submitted."""
+    good = self.db.GetRejections()
+    self.assertEqual([(x['build_id'], x['change_number'], x['patch_number'])
+                      for x in good], [(self.cq1, 1, 1)])
+    bad = self.db.GetRejections(falsely_rejected=False)
+    self.assertEqual([(x['build_id'], x['change_number'], x['patch_number'])
+                      for x in bad], [(self.cq1, 2, 1)])
+    # Nothing was submitted in this range.
+    self.assertEqual(self.db.GetRejections(end_time=self._Time(5000)), [])
+
+    self.assertEqual(self.db.GetRejectionStageFailureCounts(), {
+        ('x86-generic-paladin', 'HWTest'): 1,
+        ('x86-generic-paladin', 'VMTest'): 1,
+    })
+
+  def testGetPatchHandlingTimes(self):
+    """Patches should take from their first to their last action to land."""
+    self.assertEqual(sorted(self.db.GetPatchHandlingTimes()), [1000, 5000])
+
+
+class CIDBWriterTest(CIDBTestCase):
+  """Tests for the batching CIDBWriter."""
+
+  def setUp(self):
+    self.db = self._PrepareFreshDatabase()
+    self.build_id = self._InsertBuild(self.db)
+
+  def _CountCLActions(self):
+    return self.db.engine.execute(
+        'SELECT COUNT(*) FROM clActionTable').fetchone()[0]
+
+  def testBatching(self):
+    """Rows should be inserted a batch at a time."""
+    insert = self.PatchObject(self.db, 'InsertCLActions',
+                              wraps=self.db.InsertCLActions)
+    writer = cidb.CIDBWriter(self.db, batch_size=3)
+    for i in xrange(7):
+      writer.AddCLAction(self.build_id,
+                         _GetCLAction(i, constants.CL_ACTION_PICKED_UP, 1000))
+    self.assertEqual(insert.call_count, 2)
+    self.assertEqual(self._CountCLActions(), 6)
+
+    writer.Flush()
+    self.assertEqual(insert.call_count, 3)
+    self.assertEqual(self._CountCLActions(), 7)
+
+    # Nothing should get written twice.
+    writer.Flush()
+    self.assertEqual(insert.call_count, 3)
+
+  def testErrors(self):
+    """Failing to write to the database should not fail the caller."""
+    self.PatchObject(self.db, 'InsertBuildStages',
+                     side_effect=cidb.UnsupportedMethodException())
+    writer = cidb.CIDBWriter(self.db)
+    writer.AddBuildStage(self.build_id, {'name': 'Foo', 'status': 'passed'})
+    writer.Flush()
+
+  def testSetupCIDB(self):
+    """The shared writer should write to the CIDB that was set up."""
+    self.PatchObject(cidb, '_CIDB', None)
+    self.PatchObject(cidb, '_WRITER', None)
+    self.assertEqual(cidb.GetWriter(), None)
+
+    cidb.SetupCIDB(self.db)
+    self.assertEqual(cidb.GetCIDB(), self.db)
+    cidb.GetWriter().AddCLAction(
+        self.build_id, _GetCLAction(1, constants.CL_ACTION_SUBMITTED, 1000))
+
+    # Switching away from a CIDB should write out what was queued for it.
+    with mock.patch.object(cidb.CIDBWriter, 'Flush') as flush:
+      cidb.SetupCIDB(None)
+    self.assertEqual(flush.call_count, 1)
+    self.assertEqual(cidb.GetWriter(), None)
+
+
+class ConnectCIDBTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for ConnectCIDB."""
+
+  def setUp(self):
+    self.PatchObject(cidb, '_CIDB', None)
+    self.PatchObject(cidb, '_WRITER', None)
+
+  def testConnect(self):
+    """Connecting should set up the CIDB for this process."""
+    db = mock.Mock()
+    self.PatchObject(cidb, 'CIDBConnection', return_value=db)
+    self.assertTrue(cidb.ConnectCIDB(self.tempdir))
+    self.assertEqual(cidb.GetCIDB(), db)
+
+  def testErrors(self):
+    """Failing to connect should not fail the caller."""
+    for e in (cidb.DBException(), IOError(), OSError()):
+      self.PatchObject(cidb, 'CIDBConnection', side_effect=e)
+      self.assertFalse(cidb.ConnectCIDB(self.tempdir))
+      self.assertEqual(cidb.GetCIDB(), None)
+      self.assertEqual(cidb.GetWriter(), None)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -434,8 +434,15 @@ class SpreadsheetComm(object):
   # Spreadsheet column numbers start at 1.
   COLUMN_NUMBER_OFFSET = 1
 
+  # Max number of cells to write in one batch request.
+  CELL_BATCH_SIZE = 500
+  # Max number of cells to read back (including ones that are not being
+  # written) when looking up the cells for one batch request.
+  CELL_FETCH_SIZE = 4 * CELL_BATCH_SIZE
+
   __slots__ = (
     '_columns',    # Tuple of translated column names, filled in as needed
+    '_pending',    # Dict of (rowIx, colIx) to cell values waiting to be written
     '_rows',       # Tuple of Row dicts in order, filled in as needed
     'gd_client',   # Google Data client
     'ss_key',      # Spreadsheet key
@@ -489,6 +496,7 @@ class SpreadsheetComm(object):
   def __init__(self):
     for slot in self.__slots__:
       setattr(self, slot, None)
+    self._pending = {}
 
   def Connect(self, creds, ss_key, ws_name, source='chromiumos'):
     """Login to spreadsheet service and set current worksheet.
@@ -606,12 +614,97 @@ class SpreadsheetComm(object):
   @ReadWriteDecorator
   def UpdateRowCellByCell(self, rowIx, row):
     """Replace cell values in row at |rowIx| with those in |row| dict."""
+    self.QueueRowUpdate(rowIx, row)
+    self.FlushCellUpdates()
+
+  def QueueCellValue(self, rowIx, colIx, val):
+    """Queue up |val| to be written to the cell at |rowIx| and |colIx|.
+
+    Nothing is written until FlushCellUpdates is called, which must be
+    done before switching worksheets or deleting rows.
+    """
+    self._pending[(rowIx, colIx)] = val
+
+  @ReadWriteDecorator
+  def QueueRowUpdate(self, rowIx, row):
+    """Queue up replacing cell values in row at |rowIx| with |row| dict."""
     for colName in row:
       colIx = self.GetColumnIndex(colName)
       if colIx is not None:
-        self.ReplaceCellValue(rowIx, colIx, row[colName])
+        self.QueueCellValue(rowIx, colIx, row[colName])
+
+  @ReadWriteDecorator
+  def FlushCellUpdates(self):
+    """Write all queued cell values, using as few batch requests as possible."""
+    cells = sorted(self._pending.iteritems())
+    self._pending = {}
+    if not cells:
+      return
+
+    for batch in self._GenCellBatches(cells):
+      self._UpdateCellBatch(batch)
     self._ClearCache(keep_columns=True)
 
+  def _GenCellBatches(self, cells):
+    """Split sorted list of ((rowIx, colIx), val) |cells| into batches.
+
+    Each batch has at most CELL_BATCH_SIZE cells, in a range of rows and
+    columns that covers at most CELL_FETCH_SIZE cells.
+    """
+    batch = []
+    min_col = max_col = None
+    for cell in cells:
+      (rowIx, colIx), _ = cell
+      if batch:
+        first_row = batch[0][0][0]
+        cols = max(max_col, colIx) - min(min_col, colIx) + 1
+        if (len(batch) >= self.CELL_BATCH_SIZE or
+            (rowIx - first_row + 1) * cols > self.CELL_FETCH_SIZE):
+          yield batch
+          batch = []
+      if batch:
+        min_col, max_col = min(min_col, colIx), max(max_col, colIx)
+      else:
+        min_col = max_col = colIx
+      batch.append(cell)
+    if batch:
+      yield batch
+
+  def _UpdateCellBatch(self, cells):
+    """Write list of ((rowIx, colIx), val) |cells| in one batch request."""
+    rows = [rowIx for (rowIx, _), _ in cells]
+    cols = [colIx for (_, colIx), _ in cells]
+
+    query = gdata.spreadsheet.service.CellQuery()
+    query.min_row = str(min(rows))
+    query.max_row = str(max(rows))
+    query.min_col = str(min(cols))
+    query.max_col = str(max(cols))
+    query.return_empty = 'true'
+
+    feed = self.gd_client.GetCellsFeed(self.ss_key, wksht_id=self.ws_key,
+                                       query=query)
+    entries = dict(((int(entry.cell.row), int(entry.cell.col)), entry)
+                   for entry in feed.entry)
+    batchRequest = gdata.spreadsheet.SpreadsheetsCellsFeed()
+
+    for (rowIx, colIx), val in cells:
+      entry = entries.get((rowIx, colIx))
+      if entry is None:
+        raise SpreadsheetError('Unable to find cell at row %d, column %d' %
+                               (rowIx, colIx))
+      entry.cell.inputValue = val
+      batchRequest.AddUpdate(entry)
+
+    result = self.gd_client.ExecuteBatch(batchRequest,
+                                         feed.GetBatchLink().href)
+    failed = [entry for entry in result.entry
+              if entry.batch_status and entry.batch_status.code != '200']
+    if failed:
+      raise SpreadsheetError('Failed to write %d of %d cells: %s' %
+                             (len(failed), len(cells),
+                              failed[0].batch_status.reason))
+
   @ReadWriteDecorator
   def DeleteRow(self, ss_row):
     """Delete the given |ss_row| (must be original spreadsheet row object."""
@@ -12,8 +12,11 @@ import re
 import sys
 
 # pylint: disable=F0401
+import atom
 import atom.service
+import gdata
 import gdata.projecthosting.client as gd_ph_client
+import gdata.spreadsheet
 import gdata.spreadsheet.service
 # pylint: enable=F0401
 
@@ -653,6 +656,21 @@ class SpreadsheetCommTest(cros_test_lib.MoxOutputTestCase):
   def testUpdateRowCellByCell(self):
     mocked_scomm = self.MockScomm()
 
+    rowIx = 5
+    row = {'a': 123, 'b': 234, 'c': 345}
+
+    # Replay script
+    mocked_scomm.QueueRowUpdate(rowIx, row)
+    mocked_scomm.FlushCellUpdates()
+    self.mox.ReplayAll()
+
+    # This is the test verification.
+    gdata_lib.SpreadsheetComm.UpdateRowCellByCell(mocked_scomm, rowIx, row)
+    self.mox.VerifyAll()
+
+  def testQueueRowUpdate(self):
+    mocked_scomm = self.MockScomm()
+
     rowIx = 5
     row = {'a': 123, 'b': 234, 'c': 345}
     colIndices = {'a': 1, 'b': None, 'c': 4}
@@ -662,12 +680,11 @@ class SpreadsheetCommTest(cros_test_lib.MoxOutputTestCase):
       colIx = colIndices[colName]
       mocked_scomm.GetColumnIndex(colName).AndReturn(colIx)
       if colIx is not None:
-        mocked_scomm.ReplaceCellValue(rowIx, colIx, row[colName])
-    mocked_scomm._ClearCache(keep_columns=True)
+        mocked_scomm.QueueCellValue(rowIx, colIx, row[colName])
     self.mox.ReplayAll()
 
     # This is the test verification.
-    gdata_lib.SpreadsheetComm.UpdateRowCellByCell(mocked_scomm, rowIx, row)
+    gdata_lib.SpreadsheetComm.QueueRowUpdate(mocked_scomm, rowIx, row)
     self.mox.VerifyAll()
 
   def testDeleteRow(self):
@@ -716,6 +733,142 @@ class SpreadsheetCommTest(cros_test_lib.MoxOutputTestCase):
     self.mox.VerifyAll()
 
 
+class FakeSpreadsheetsService(object):
+  """In-memory stand-in for the cells feed of gdata's SpreadsheetsService.
+
+  The worksheet is held in |cells|, a dict of (row, col) to cell value, with
+  column names in row 1.  Every request made is recorded in |requests|.
+  """
+
+  BATCH_URL = 'https://spreadsheets.example.com/batch'
+  BATCH_REL = 'http://schemas.google.com/g/2005#batch'
+
+  def __init__(self, cells=None, fail_cells=()):
+    self.cells = dict(cells or {})
+    self.fail_cells = set(fail_cells)
+    self.requests = []
+
+  def _NewCell(self, row, col):
+    val = self.cells.get((row, col))
+    return gdata.spreadsheet.SpreadsheetsCell(
+        content=atom.Content(text=val),
+        cell=gdata.spreadsheet.Cell(row=str(row), col=str(col),
+                                    inputValue=val, text=val))
+
+  def GetCellsFeed(self, _key, wksht_id='default', query=None):
+    self.requests.append(('GetCellsFeed', wksht_id))
+
+    def Bound(name, default):
+      return int(query.get(name, default)) if query else default
+
+    max_row = max([1] + [row for row, _ in self.cells])
+    max_col = max([1] + [col for _, col in self.cells])
+    rows = xrange(Bound('min-row', 1), Bound('max-row', max_row) + 1)
+    cols = xrange(Bound('min-col', 1), Bound('max-col', max_col) + 1)
+    return_empty = query and query.get('return-empty') == 'true'
+
+    entries = [self._NewCell(row, col) for row in rows for col in cols
+               if return_empty or self.cells.get((row, col)) is not None]
+    return gdata.spreadsheet.SpreadsheetsCellsFeed(
+        entry=entries, link=[atom.Link(rel=self.BATCH_REL,
+                                       href=self.BATCH_URL)])
+
+  def ExecuteBatch(self, batch_feed, url):
+    self.requests.append(('ExecuteBatch', len(batch_feed.entry)))
+    assert url == self.BATCH_URL
+
+    results = []
+    for entry in batch_feed.entry:
+      cell = (int(entry.cell.row), int(entry.cell.col))
+      if cell in self.fail_cells:
+        status = gdata.BatchStatus(code='409', reason='Conflict')
+      else:
+        self.cells[cell] = entry.cell.inputValue
+        status = gdata.BatchStatus(code='200', reason='Success')
+      result = self._NewCell(*cell)
+      result.batch_status = status
+      results.append(result)
+    return gdata.spreadsheet.SpreadsheetsCellsFeed(entry=results)
+
+  def UpdateCell(self, row, col, inputValue, _key, wksht_id='default'):
+    self.requests.append(('UpdateCell', wksht_id))
+    self.cells[(int(row), int(col))] = inputValue
+
+
+class SpreadsheetCommBatchTest(cros_test_lib.MockTestCase):
+  """Test batched cell updates against a fake spreadsheet service."""
+
+  COLUMNS = ('Package', 'Version', 'State')
+
+  def setUp(self):
+    cells = {}
+    for colIx, col in enumerate(self.COLUMNS, start=1):
+      cells[(1, colIx)] = col
+    for rowIx in xrange(2, 102):
+      cells[(rowIx, 1)] = 'pkg%d' % rowIx
+      cells[(rowIx, 2)] = '1.0'
+    self.service = FakeSpreadsheetsService(cells)
+
+    self.scomm = gdata_lib.SpreadsheetComm()
+    self.scomm.gd_client = self.service
+    self.scomm.ss_key = 'TheSSKey'
+    self.scomm.ws_key = 'TheWSKey'
+    self.scomm.GetColumns()
+    self.service.requests = []
+
+  def testQueueAndFlush(self):
+    """Queued rows should be written in one batch, and not before a flush."""
+    for rowIx in xrange(2, 102, 3):
+      self.scomm.QueueRowUpdate(rowIx, {'version': '2.0', 'state': 'current',
+                                        'unknown': 'ignored'})
+    self.assertEquals([], self.service.requests)
+
+    self.scomm._rows = 'SomeRows'
+    self.scomm.FlushCellUpdates()
+    self.assertEquals([('GetCellsFeed', 'TheWSKey'), ('ExecuteBatch', 68)],
+                      self.service.requests)
+    self.assertEquals('2.0', self.service.cells[(5, 2)])
+    self.assertEquals('current', self.service.cells[(5, 3)])
+    self.assertEquals('1.0', self.service.cells[(6, 2)])
+    self.assertEquals(None, self.service.cells.get((6, 3)))
+    self.assertTrue(self.scomm._rows is None)
+
+    # Nothing left to write.
+    self.service.requests = []
+    self.scomm.FlushCellUpdates()
+    self.assertEquals([], self.service.requests)
+
+  def testBatchSize(self):
+    """Big or spread out updates should be split into bounded batches."""
+    self.PatchObject(gdata_lib.SpreadsheetComm, 'CELL_BATCH_SIZE', 10)
+    self.PatchObject(gdata_lib.SpreadsheetComm, 'CELL_FETCH_SIZE', 40)
+    for rowIx in xrange(2, 32):
+      self.scomm.QueueCellValue(rowIx, 3, 'x')
+    # These two are too far apart to fetch together.
+    self.scomm.QueueCellValue(60, 1, 'y')
+    self.scomm.QueueCellValue(90, 3, 'z')
+    self.scomm.FlushCellUpdates()
+
+    batches = [n for req, n in self.service.requests if req == 'ExecuteBatch']
+    self.assertEquals([10, 10, 10, 1, 1], batches)
+    self.assertEquals('x', self.service.cells[(31, 3)])
+    self.assertEquals('y', self.service.cells[(60, 1)])
+    self.assertEquals('z', self.service.cells[(90, 3)])
+
+  def testUpdateRowCellByCell(self):
+    """Updating a single row should take one batch, not a request per cell."""
+    self.scomm.UpdateRowCellByCell(10, {'version': '3.0', 'state': 'old'})
+    self.assertEquals([('GetCellsFeed', 'TheWSKey'), ('ExecuteBatch', 2)],
+                      self.service.requests)
+    self.assertEquals('3.0', self.service.cells[(10, 2)])
+
+  def testFailedCells(self):
+    """Cells the server refuses to write should raise SpreadsheetError."""
+    self.service.fail_cells.add((10, 2))
+    self.scomm.QueueRowUpdate(10, {'version': '3.0', 'state': 'old'})
+    self.assertRaises(gdata_lib.SpreadsheetError, self.scomm.FlushCellUpdates)
+
+
 class IssueCommentTest(cros_test_lib.TestCase):
   """Test creating comments."""
 
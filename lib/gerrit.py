@@ -37,6 +37,10 @@ class GerritHelper(object):
   # Maximum number of results to return per query.
   _GERRIT_MAX_QUERY_RETURN = 500
 
+  # Maximum number of changes to look up in a single OR-ed query.  This keeps
+  # the request URLs at a reasonable length.
+  _GERRIT_MAX_MULTI_QUERY = 50
+
   # Fields that appear in gerrit change query results.
   MORE_CHANGES = '_more_changes'
 
@@ -271,26 +275,135 @@ class GerritHelper(object):
       return result
     return [cros_patch.GerritPatch(x, self.remote, url_prefix) for x in result]
 
-  def QueryMultipleCurrentPatchset(self, changes):
+  def _GetChangeDetails(self, change_nums):
+    """Fetch GetChangeDetail() for many changes at once."""
+    return gob_util.RunConcurrently(
+        self.GetChangeDetail, [((x,), {}) for x in change_nums])
+
+  @staticmethod
+  def _ParseMultiQueryTerm(change):
+    """Turn a change identifier into a (search term, match function) tuple.
+
+    The match function takes a raw query result and returns whether it is the
+    change that was asked for.
+    """
+    change = str(change)
+    if cros_patch.ParseGerritNumber(change):
+      return change, lambda x: str(x['_number']) == change
+    elif cros_patch.ParseChangeID(change):
+      change_id = change.lower()
+      return change, lambda x: x['change_id'].lower() == change_id
+    elif cros_patch.ParseSHA1(change):
+      return ('commit:%s' % change,
+              lambda x: change in x.get('revisions', {}) or
+                        x.get('current_revision') == change)
+    elif cros_patch.ParseFullChangeID(change):
+      project, branch, change_id = cros_patch.ParseFullChangeID(change)
+      change_id = change_id.lower()
+      return change_id, lambda x: (x['change_id'].lower() == change_id and
+                                   x['project'] == project and
+                                   x['branch'] == branch)
+    raise GerritException('Cannot query for change %s' % (change,))
+
+  def QueryMultiple(self, changes, must_match=True, bypass_cache=True):
+    """Look up many changes using a handful of requests.
+
+    The changes are chunked into OR-ed queries which are sent concurrently,
+    rather than querying for each change one at a time.
+
+    Args:
+      changes: A sequence of gerrit change numbers, Change-Ids, full Change-Ids
+          or commit sha1s.
+      must_match: Raise an exception if a change is not found.  If this is
+          False, missing changes will map to None.
+      bypass_cache: Re-request the changes that were found directly, as query
+          results are served from the gerrit cache which may be stale.  See
+          Query() for details.  Merged changes are not re-requested as they
+          cannot go stale.
+
+    Returns:
+      A dict mapping each of |changes| to a cros_patch.GerritPatch.
+
+    Raises:
+      QueryHasNoResults if |must_match| and a change was not found.
+      QueryNotSpecific if a change matched multiple changes.
+    """
+    if not changes:
+      return {}
+
+    matchers = {}
+    for change in changes:
+      matchers[change] = self._ParseMultiQueryTerm(change)
+    terms = sorted(set(term for term, _ in matchers.itervalues()))
+
+    o_params = ['DETAILED_ACCOUNTS', 'ALL_REVISIONS', 'DETAILED_LABELS',
+                'CURRENT_COMMIT', 'CURRENT_REVISION']
+    chunk_size = self._GERRIT_MAX_MULTI_QUERY
+    calls = [((self.host, {}, terms[i:i + chunk_size]),
+              {'limit': self._GERRIT_MAX_QUERY_RETURN, 'o_params': o_params})
+             for i in xrange(0, len(terms), chunk_size)]
+    results = []
+    for chunk in gob_util.RunConcurrently(gob_util.MultiQueryChanges, calls):
+      if chunk and self.MORE_CHANGES in chunk[-1]:
+        raise GerritException('Query for %s returned too many results'
+                              % (changes,))
+      results.extend(chunk)
+
+    matches = {}
+    for change, (_, match) in matchers.iteritems():
+      found = [x for x in results if match(x)]
+      if len(found) > 1:
+        raise QueryNotSpecific('Query %s returned too many results: %s'
+                               % (change, [x['_number'] for x in found]))
+      elif found:
+        matches[change] = found[0]
+      elif must_match:
+        raise QueryHasNoResults('Change %s not found on server %s.'
+                                % (change, self.host))
+      else:
+        matches[change] = None
+
+    if bypass_cache:
+      numbers = sorted(set(x['_number'] for x in matches.itervalues()
+                           if x and x['status'] != 'MERGED'))
+      details = dict(zip(numbers, self._GetChangeDetails(numbers)))
+      for change, result in matches.items():
+        if result and result['_number'] in details:
+          matches[change] = details[result['_number']]
+          if not matches[change] and must_match:
+            raise QueryHasNoResults('Change %s not found on server %s.'
+                                    % (change, self.host))
+
+    url_prefix = gob_util.GetGerritFetchUrl(self.host)
+    patches = {}
+    for change, result in matches.iteritems():
+      if result:
+        patch_dict = cros_patch.GerritPatch.ConvertQueryResults(
+            result, self.host)
+        patches[change] = cros_patch.GerritPatch(
+            patch_dict, self.remote, url_prefix)
+      else:
+        patches[change] = None
+    return patches
+
+  def QueryMultipleCurrentPatchset(self, changes, bypass_cache=True):
     """Query the gerrit server for multiple changes.
 
+    The search index can lag behind gerrit, so by default any change that is
+    not merged is re-read with GetChangeDetail(), concurrently.
+
     Args:
       changes: A sequence of gerrit change numbers.
+      bypass_cache: See QueryMultiple().
 
     Returns:
       A list of cros_patch.GerritPatch.
     """
     if not changes:
       return
-    url_prefix = gob_util.GetGerritFetchUrl(self.host)
+    patches = self.QueryMultiple(changes, bypass_cache=bypass_cache)
     for change in changes:
-      change_detail = self.GetChangeDetail(change)
-      if not change_detail:
-        raise GerritException('Change %s not found on server %s.'
-                              % (change, self.host))
-      patch_dict = cros_patch.GerritPatch.ConvertQueryResults(
-          change_detail, self.host)
-      yield change, cros_patch.GerritPatch(patch_dict, self.remote, url_prefix)
+      yield change, patches[change]
 
   @staticmethod
   def _to_changenum(change):
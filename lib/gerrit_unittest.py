@@ -268,5 +268,93 @@ class GerritHelperTest(cros_test_lib.GerritTestCase):
     self.assertTrue(helper.IsChangeCommitted(gpatch2.gerrit_number))
 
 
+class QueryMultipleTest(cros_test_lib.MockTestCase):
+  """Unittests for GerritHelper.QueryMultiple that don't hit the network."""
+
+  def setUp(self):
+    self.helper = gerrit.GerritHelper('gerrit.example.com',
+                                      constants.EXTERNAL_REMOTE)
+    self.changes = {}
+    for num in xrange(1, 121):
+      self.changes[num] = self._MakeChange(num)
+    self.query_mock = self.PatchObject(
+        gob_util, 'MultiQueryChanges', side_effect=self._MultiQuery)
+    self.detail_mock = self.PatchObject(
+        gerrit.GerritHelper, 'GetChangeDetail',
+        side_effect=lambda num: self.changes.get(num))
+
+  @staticmethod
+  def _MakeChange(num, status='NEW'):
+    """Return a fake gerrit query result for change |num|."""
+    return {
+        'change_id': 'I%040x' % num,
+        'project': 'chromiumos/chromite',
+        'branch': 'master',
+        'created': '2014-01-01 00:00:00.000000000',
+        'updated': '2014-01-01 00:00:00.000000000',
+        'owner': {'name': 'foo', 'email': 'foo@chromium.org'},
+        '_number': num,
+        'status': status,
+        'subject': 'change %i' % num,
+    }
+
+  def _MultiQuery(self, _host, _params, change_list, **_kwargs):
+    """Fake out gob_util.MultiQueryChanges using self.changes."""
+    return [x for x in self.changes.itervalues()
+            if str(x['_number']) in change_list or
+            x['change_id'] in change_list]
+
+  def testChunks(self):
+    """Many changes are looked up in a few concurrent requests."""
+    nums = range(1, 121)
+    patches = self.helper.QueryMultiple(nums, bypass_cache=False)
+    self.assertEqual(sorted(patches), nums)
+    for num, patch in patches.iteritems():
+      self.assertEqual(patch.gerrit_number, str(num))
+    self.assertEqual(self.query_mock.call_count, 3)
+    for call in self.query_mock.call_args_list:
+      self.assertTrue(len(call[0][2]) <= self.helper._GERRIT_MAX_MULTI_QUERY)
+    self.assertFalse(self.detail_mock.called)
+
+  def testChangeIds(self):
+    """Changes can be looked up by Change-Id too."""
+    change_id = self.changes[5]['change_id']
+    patches = self.helper.QueryMultiple([change_id, 6], bypass_cache=False)
+    self.assertEqual(patches[change_id].gerrit_number, '5')
+    self.assertEqual(patches[6].gerrit_number, '6')
+
+  def testMissing(self):
+    """Missing changes raise unless must_match is False."""
+    self.assertRaises(gerrit.QueryHasNoResults, self.helper.QueryMultiple,
+                      [1, 1000])
+    patches = self.helper.QueryMultiple([1, 1000], must_match=False)
+    self.assertEqual(patches[1].gerrit_number, '1')
+    self.assertEqual(patches[1000], None)
+
+  def testNotSpecific(self):
+    """A Change-Id that matches multiple changes should raise."""
+    self.changes[2]['change_id'] = self.changes[1]['change_id']
+    self.assertRaises(gerrit.QueryNotSpecific, self.helper.QueryMultiple,
+                      [self.changes[1]['change_id']])
+
+  def testBypassCache(self):
+    """Only changes that are not merged are re-fetched."""
+    self.changes[2] = self._MakeChange(2, status='MERGED')
+    patches = self.helper.QueryMultiple([1, 2, 3])
+    self.assertEqual(sorted(x[0][0] for x in self.detail_mock.call_args_list),
+                     [1, 3])
+    self.assertEqual(patches[2].status, 'MERGED')
+
+  def testCurrentPatchset(self):
+    """QueryMultipleCurrentPatchset yields changes in the order given."""
+    ret = list(self.helper.QueryMultipleCurrentPatchset([3, 1, 2]))
+    self.assertEqual([(c, p.gerrit_number) for c, p in ret],
+                     [(3, '3'), (1, '1'), (2, '2')])
+    # The changes are read fresh, not just from the search index.
+    self.assertEqual(self.query_mock.call_count, 1)
+    self.assertEqual(sorted(x[0][0] for x in self.detail_mock.call_args_list),
+                     [1, 2, 3])
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
@@ -338,6 +338,8 @@ class Manifest(object):
       list of ProjectCheckout objects.
     checkouts_by_path: A dictionary mapping paths for <project> tags to a single
       ProjectCheckout object.
+    copies_by_path: A dictionary mapping paths for <project> tags to a list of
+      the (tag, src, dest) tuples of their <copyfile> & <linkfile> tags.
     default: The attributes of the <default> tag.
     includes: A list of XML files that should be pulled in to the manifest.
       These includes are represented as a list of (name, path) tuples.
@@ -365,8 +367,10 @@ class Manifest(object):
     self.default = {}
     self.checkouts_by_path = {}
     self.checkouts_by_name = {}
+    self.copies_by_path = {}
     self.remotes = {}
     self.includes = []
+    self._project_path = None
     self.revision = None
     self.manifest_include_dir = manifest_include_dir
     self._RunParser(source)
@@ -390,8 +394,14 @@ class Manifest(object):
       attrs.setdefault('alias', attrs['name'])
       self.remotes[attrs['name']] = attrs
     elif name == 'project':
-      self.checkouts_by_path[attrs.get('path', attrs['name'])] = attrs
+      self._project_path = attrs.get('path', attrs['name'])
+      self.checkouts_by_path[self._project_path] = attrs
       self.checkouts_by_name.setdefault(attrs['name'], []).append(attrs)
+    elif name in ('copyfile', 'linkfile'):
+      # These are only valid inside of the <project> tag just seen.
+      path = os.path.normpath(self._project_path)
+      self.copies_by_path.setdefault(path, []).append(
+          (name, attrs['src'], attrs['dest']))
     elif name == 'manifest':
       self.revision = attrs.get('revision')
     elif name == 'include':
@@ -8,12 +8,16 @@ https://gerrit-review.googlesource.com/Documentation/rest-api.html
 """
 
 import base64
+import errno
 import httplib
 import json
 import logging
 import netrc
 import os
+import Queue
 import socket
+import sys
+import threading
 import urllib
 from cStringIO import StringIO
 
@@ -28,6 +32,14 @@ LOGGER = logging.getLogger()
 TRY_LIMIT = 10
 SLEEP = 0.5
 
+# The most requests we'll have in flight to a single host at once.  Idle
+# connections beyond this are closed rather than kept around.
+MAX_CONNECTIONS_PER_HOST = 8
+
+# Requests that are safe to send again if a kept-alive connection turns out to
+# have been closed by the server.  Anything else gets a new connection.
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
 # Controls the transport protocol used to communicate with Gerrit servers using
 # git. This is parameterized primarily to enable cros_test_lib.GerritTestCase.
 GIT_PROTOCOL = 'https'
@@ -72,14 +84,29 @@ def GetCookies(_host, _path):
   return {}
 
 
-def CreateHttpConn(host, path, reqtype='GET', headers=None, body=None):
-  """Opens an https connection to a gerrit service, and sends a request."""
-  headers = headers or {}
+# Cache of the netrc derived Authorization header for each host.
+_AUTH_HEADERS = {}
+
+
+def _GetAuthHeader(host):
+  """Returns the Authorization header to use for |host| (or None)."""
   bare_host = host.partition(':')[0]
-  auth = NETRC.authenticators(bare_host)
+  if bare_host not in _AUTH_HEADERS:
+    auth = NETRC.authenticators(bare_host)
+    if auth:
+      _AUTH_HEADERS[bare_host] = 'Basic %s' % (
+          base64.b64encode('%s:%s' % (auth[0], auth[2])))
+    else:
+      _AUTH_HEADERS[bare_host] = None
+  return _AUTH_HEADERS[bare_host]
+
+
+def _GetRequestParams(host, path, reqtype='GET', headers=None, body=None):
+  """Returns the httplib request() arguments for a gerrit service request."""
+  headers = headers or {}
+  auth = _GetAuthHeader(host)
   if auth:
-    headers.setdefault('Authorization', 'Basic %s' % (
-        base64.b64encode('%s:%s' % (auth[0], auth[2]))))
+    headers.setdefault('Authorization', auth)
   else:
     LOGGER.debug('No authorization found')
 
@@ -92,25 +119,165 @@ def CreateHttpConn(host, path, reqtype='GET', headers=None, body=None):
     body = json.JSONEncoder().encode(body)
     headers.setdefault('Content-Type', 'application/json')
   if LOGGER.isEnabledFor(logging.DEBUG):
-    LOGGER.debug('%s https://%s/a/%s' % (reqtype, host, path))
+    LOGGER.debug('%s https://%s/a/%s', reqtype, host, path)
     for key, val in headers.iteritems():
       if key.lower() in ('authorization', 'cookie'):
         val = 'HIDDEN'
-      LOGGER.debug('%s: %s' % (key, val))
+      LOGGER.debug('%s: %s', key, val)
     if body:
       LOGGER.debug(body)
-  conn = httplib.HTTPSConnection(host)
-  conn.req_host = host
-  conn.req_params = {
+  return {
       'url': '/a/%s' % path,
       'method': reqtype,
       'headers': headers,
       'body': body,
   }
+
+
+def CreateHttpConn(host, path, reqtype='GET', headers=None, body=None):
+  """Opens an https connection to a gerrit service, and sends a request."""
+  conn = httplib.HTTPSConnection(host)
+  conn.req_host = host
+  conn.req_params = _GetRequestParams(host, path, reqtype=reqtype,
+                                      headers=headers, body=body)
   conn.request(**conn.req_params)
   return conn
 
 
+def _WasHungUpOn(ex, sent):
+  """Whether |ex| means the server closed the connection before our request.
+
+  Args:
+    ex: The exception raised while sending the request or reading the response.
+    sent: Whether the request was sent.
+  """
+  if sent:
+    # The connection was closed without any response at all.
+    return isinstance(ex, httplib.BadStatusLine)
+  return (isinstance(ex, socket.error) and
+          ex.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
+class HttpConnectionPool(object):
+  """Persistent (keep-alive) https connections to gerrit services.
+
+  GET and HEAD requests to a host reuse idle connections rather than doing a
+  new TCP/SSL handshake each time, and at most |max_connections| requests to a
+  host are in flight at once.  This is thread safe, and forked children start
+  with an empty pool (they can't share the parent's sockets).
+  """
+
+  def __init__(self, max_connections=MAX_CONNECTIONS_PER_HOST, context=None):
+    """Initialize.
+
+    Args:
+      max_connections: The most concurrent connections to a single host.
+      context: An ssl.SSLContext to use for new connections.
+    """
+    self.max_connections = max_connections
+    self.context = context
+    self._lock = threading.Lock()
+    self._pid = None
+    self._idle = {}
+    self._slots = {}
+
+  def _CheckPid(self):
+    """Forget connections we inherited via fork.  Must hold self._lock."""
+    if self._pid != os.getpid():
+      self._pid = os.getpid()
+      self._idle = {}
+      self._slots = {}
+
+  def _GetSlot(self, host):
+    """Returns the semaphore bounding the connections to |host|."""
+    with self._lock:
+      self._CheckPid()
+      if host not in self._slots:
+        self._slots[host] = threading.BoundedSemaphore(self.max_connections)
+      return self._slots[host]
+
+  def _GetIdle(self, host):
+    """Returns an idle connection to |host|, or None if there are none."""
+    with self._lock:
+      self._CheckPid()
+      idle = self._idle.get(host)
+      return idle.pop() if idle else None
+
+  def _PutIdle(self, host, conn):
+    """Keep |conn| around for the next request to |host|."""
+    with self._lock:
+      self._CheckPid()
+      self._idle.setdefault(host, []).append(conn)
+
+  def _NewConnection(self, host):
+    """Returns a new (unconnected) connection to |host|."""
+    if self.context is None:
+      return httplib.HTTPSConnection(host)
+    return httplib.HTTPSConnection(host, context=self.context)
+
+  def Request(self, host, req_params):
+    """Sends a request to |host| and reads the full response.
+
+    Args:
+      host: The hostname of the Gerrit service.
+      req_params: The arguments for httplib.HTTPConnection.request().
+
+    Returns:
+      A tuple of the httplib.HTTPResponse and the response body.  The
+      response also has a |peername| member for logging.
+    """
+    with self._GetSlot(host):
+      conn = None
+      if req_params['method'] in IDEMPOTENT_METHODS:
+        # The server may have hung up on an idle connection, and then we have
+        # to send the request again; only do that with requests that are safe
+        # to repeat.
+        conn = self._GetIdle(host)
+      reused = conn is not None
+      if not reused:
+        conn = self._NewConnection(host)
+      keep = False
+      try:
+        sent = False
+        try:
+          conn.request(**req_params)
+          sent = True
+          response = conn.getresponse()
+        except (httplib.HTTPException, socket.error) as ex:
+          if not reused or not _WasHungUpOn(ex, sent):
+            raise
+          LOGGER.debug('Reconnecting to %s: %r', host, ex)
+          conn.close()
+          conn = self._NewConnection(host)
+          conn.request(**req_params)
+          response = conn.getresponse()
+
+        data = response.read()
+        try:
+          response.peername = conn.sock.getpeername()
+        except (AttributeError, socket.error):
+          response.peername = None
+        keep = not response.will_close
+      finally:
+        if keep:
+          self._PutIdle(host, conn)
+        else:
+          conn.close()
+      return response, data
+
+  def Close(self):
+    """Close all the idle connections."""
+    with self._lock:
+      self._CheckPid()
+      for conns in self._idle.itervalues():
+        for conn in conns:
+          conn.close()
+      self._idle = {}
+
+
+_POOL = HttpConnectionPool()
+
+
 def FetchUrl(host, path, reqtype='GET', headers=None, body=None,
              ignore_404=True):
   """Fetches the http response from the specified URL into a string buffer.
@@ -131,10 +298,11 @@ def FetchUrl(host, path, reqtype='GET', headers=None, body=None,
   """
   def _FetchUrlHelper():
     err_prefix = 'A transient error occured while querying %s:\n' % (host,)
+    req_params = _GetRequestParams(host, path, reqtype=reqtype,
+                                   headers=headers and headers.copy(),
+                                   body=body)
     try:
-      conn = CreateHttpConn(host, path, reqtype=reqtype, headers=headers,
-                            body=body)
-      response = conn.getresponse()
+      response, data = _POOL.Request(host, req_params)
     except socket.error as ex:
       LOGGER.warn('%s%s', err_prefix, str(ex))
       raise
@@ -143,13 +311,13 @@ def FetchUrl(host, path, reqtype='GET', headers=None, body=None,
     if response.status == 404 and ignore_404:
       return StringIO()
     elif response.status == 200:
-      return StringIO(response.read())
+      return StringIO(data)
 
     # Bad responses.
     LOGGER.debug('response msg:\n%s', response.msg)
     http_version = 'HTTP/%s' % ('1.1' if response.version == 11 else '1.0')
     msg = ('%s %s %s\n%s %d %s' %
-           (reqtype, conn.req_params['url'], http_version,
+           (reqtype, req_params['url'], http_version,
             http_version, response.status, response.reason))
 
     # Ones we can retry.
@@ -170,7 +338,7 @@ def FetchUrl(host, path, reqtype='GET', headers=None, body=None,
       err_prefix = ('Authorization error; missing/bad %s/.netrc credentials?\n'
                     ' See %s' % (home, url))
     elif response.status in (422,):
-      err_prefix = ('Bad request body?  Response body: "%s"' % response.read())
+      err_prefix = ('Bad request body?  Response body: "%s"' % data)
 
     if response.status >= 400:
       # The 'X-ErrorId' header is set only on >= 400 response code.
@@ -179,9 +347,9 @@ def FetchUrl(host, path, reqtype='GET', headers=None, body=None,
     else:
       LOGGER.warn('%s\n%s', err_prefix, msg)
 
-    try:
-      LOGGER.warn('conn.sock.getpeername(): %s', conn.sock.getpeername())
-    except AttributeError:
+    if response.peername:
+      LOGGER.warn('conn.sock.getpeername(): %s', response.peername)
+    else:
       LOGGER.warn('peer name unavailable')
     raise GOBError(response.status, response.reason)
 
@@ -205,6 +373,61 @@ def FetchUrlJson(*args, **kwargs):
   return json.loads(s)
 
 
+def RunConcurrently(functor, calls, max_threads=MAX_CONNECTIONS_PER_HOST):
+  """Run many gerrit requests at once over the shared connection pool.
+
+  Args:
+    functor: The function to call, e.g. FetchUrlJson or MultiQueryChanges.
+    calls: A list of (args, kwargs) tuples to pass to |functor|.
+    max_threads: The most requests to run at once.  Requests to a single host
+                 are further bounded by MAX_CONNECTIONS_PER_HOST.
+
+  Returns:
+    A list of the results, in the same order as |calls|.
+
+  Raises:
+    The exception of the first call (in order) that failed, if any.
+  """
+  results = [None] * len(calls)
+  errors = [None] * len(calls)
+  todo = Queue.Queue()
+  for i in xrange(len(calls)):
+    todo.put(i)
+
+  def _Worker():
+    while True:
+      try:
+        i = todo.get_nowait()
+      except Queue.Empty:
+        return
+      args, kwargs = calls[i]
+      try:
+        results[i] = functor(*args, **kwargs)
+      except Exception:
+        errors[i] = sys.exc_info()
+
+  threads = [threading.Thread(target=_Worker)
+             for _ in xrange(min(max_threads, len(calls)))]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  for t in threads:
+    t.join()
+
+  for exc_info in errors:
+    if exc_info is not None:
+      raise exc_info[0], exc_info[1], exc_info[2]
+  return results
+
+
+def FetchUrlJsonMulti(requests, max_threads=MAX_CONNECTIONS_PER_HOST):
+  """Run many FetchUrlJson calls at once over the shared connection pool.
+
+  See RunConcurrently for arguments.
+  """
+  return RunConcurrently(FetchUrlJson, requests, max_threads=max_threads)
+
+
 def QueryChanges(host, param_dict, first_param=None, limit=None, o_params=None,
                  start=None):
   """Queries a gerrit-on-borg server for changes matching query terms.
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# Copyright (c) 2014 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for gob_util.py"""
+
+import BaseHTTPServer
+import errno
+import httplib
+import json
+import os
+import socket
+import SocketServer
+import ssl
+import sys
+import threading
+import time
+import traceback
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import gob_util
+
+import mock
+
+
+class _FakeGerritHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answer every request with a json dump of what was requested."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    with self.server.lock:
+      self.server.connections += 1
+
+  def _Reply(self):
+    server = self.server
+    with server.lock:
+      server.active += 1
+      server.max_active = max(server.max_active, server.active)
+      server.requests.append((self.command, self.path, dict(self.headers)))
+    try:
+      time.sleep(server.delay)
+      status = server.status
+      body = json.dumps({'method': self.command, 'path': self.path})
+      body = ")]}'\n%s" % body
+      self.send_response(status)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      if server.drop_connections:
+        # Hang up without telling the client (like an idle timeout would).
+        self.close_connection = 1
+    finally:
+      with server.lock:
+        server.active -= 1
+
+  do_GET = do_POST = do_PUT = do_DELETE = _Reply
+
+  def log_message(self, *_args):
+    pass
+
+
+class _FakeGerritServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """A local https stand-in for a gerrit server."""
+
+  daemon_threads = True
+
+  def __init__(self, certfile, keyfile):
+    BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                       _FakeGerritHandler)
+    self.socket = ssl.wrap_socket(self.socket, certfile=certfile,
+                                  keyfile=keyfile, server_side=True)
+    self.lock = threading.Lock()
+    self.connections = 0
+    self.active = 0
+    self.max_active = 0
+    self.requests = []
+    self.delay = 0
+    self.status = 200
+    self.drop_connections = False
+
+  def handle_error(self, request, client_address):
+    # Clients hanging up on idle connections is expected; don't spew.
+    pass
+
+  @property
+  def host(self):
+    return 'localhost:%i' % self.server_address[1]
+
+
+# pylint: disable=W0212
+class ConnectionPoolTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for the gob_util connection pool."""
+
+  def setUp(self):
+    certfile = os.path.join(self.tempdir, 'cert.pem')
+    keyfile = os.path.join(self.tempdir, 'key.pem')
+    cros_build_lib.RunCommand(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-days', '1', '-subj', '/CN=localhost',
+         '-keyout', keyfile, '-out', certfile],
+        quiet=True)
+
+    self.server = _FakeGerritServer(certfile, keyfile)
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+
+    self.pool = gob_util.HttpConnectionPool(
+        max_connections=2, context=ssl._create_unverified_context())
+    self.PatchObject(gob_util, '_POOL', self.pool)
+    self.PatchObject(gob_util, 'SLEEP', 0)
+
+  def tearDown(self):
+    self.pool.Close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testKeepAlive(self):
+    """Serial requests should all share one connection."""
+    for i in xrange(5):
+      ret = gob_util.FetchUrlJson(self.server.host, 'changes/%i' % i)
+      self.assertEqual(ret, {'method': 'GET', 'path': '/a/changes/%i' % i})
+    self.assertEqual(self.server.connections, 1)
+
+  def testReconnect(self):
+    """Idle connections the server hung up on should be replaced."""
+    self.server.drop_connections = True
+    for _ in xrange(3):
+      gob_util.FetchUrlJson(self.server.host, 'changes/')
+    self.assertEqual(len(self.server.requests), 3)
+    self.assertEqual(self.server.connections, 3)
+
+  def testPostNewConnection(self):
+    """Requests that aren't safe to repeat should not reuse connections."""
+    gob_util.FetchUrlJson(self.server.host, 'changes/')
+    gob_util.FetchUrlJson(self.server.host, 'changes/', reqtype='POST',
+                          body={'a': 'b'})
+    self.assertEqual(len(self.server.requests), 2)
+    self.assertEqual(self.server.connections, 2)
+
+  def testNoRetryAfterSend(self):
+    """Errors after the server may have seen the request are not retried."""
+    idle_conn = mock.Mock()
+    idle_conn.getresponse.side_effect = socket.timeout('timed out')
+    self.PatchObject(self.pool, '_GetIdle', return_value=idle_conn)
+    new_mock = self.PatchObject(self.pool, '_NewConnection')
+    req_params = gob_util._GetRequestParams(self.server.host, 'changes/')
+    self.assertRaises(socket.timeout, self.pool.Request, self.server.host,
+                      req_params)
+    self.assertFalse(new_mock.called)
+    idle_conn.close.assert_called_once_with()
+
+  def testRetryHungUp(self):
+    """Idle connections closed before the request got through are retried."""
+    for ex in (socket.error(errno.EPIPE, 'Broken pipe'),
+               httplib.BadStatusLine('')):
+      idle_conn = mock.Mock()
+      if isinstance(ex, socket.error):
+        idle_conn.request.side_effect = ex
+      else:
+        idle_conn.getresponse.side_effect = ex
+      self.PatchObject(self.pool, '_GetIdle', return_value=idle_conn)
+      response, data = self.pool.Request(
+          self.server.host,
+          gob_util._GetRequestParams(self.server.host, 'changes/'))
+      self.assertEqual(response.status, 200)
+      self.assertTrue(data)
+      idle_conn.close.assert_called_once_with()
+
+  def testAuthHeader(self):
+    """The netrc credentials should be looked up once and sent every time."""
+    netrc_mock = mock.MagicMock()
+    netrc_mock.authenticators.return_value = ('user', None, 'pass')
+    self.PatchObject(gob_util, 'NETRC', netrc_mock)
+    self.PatchObject(gob_util, '_AUTH_HEADERS', {})
+    for _ in xrange(2):
+      gob_util.FetchUrl(self.server.host, 'changes/')
+    netrc_mock.authenticators.assert_called_once_with('localhost')
+    for _, _, headers in self.server.requests:
+      self.assertEqual(headers['authorization'], 'Basic dXNlcjpwYXNz')
+
+  def testErrors(self):
+    """HTTP errors should still raise, and not break the connection."""
+    self.server.status = 404
+    self.assertEqual(gob_util.FetchUrlJson(self.server.host, 'changes/'), None)
+    self.server.status = 400
+    self.assertRaises(gob_util.GOBError, gob_util.FetchUrlJson,
+                      self.server.host, 'changes/')
+    self.server.status = 200
+    self.assertTrue(gob_util.FetchUrlJson(self.server.host, 'changes/'))
+    self.assertEqual(self.server.connections, 1)
+
+  def testMulti(self):
+    """Concurrent requests are bounded by the per-host connection limit."""
+    self.server.delay = 0.05
+    requests = [((self.server.host, 'changes/%i' % i), {})
+                for i in xrange(10)]
+    ret = gob_util.FetchUrlJsonMulti(requests, max_threads=5)
+    self.assertEqual([x['path'] for x in ret],
+                     ['/a/changes/%i' % i for i in xrange(10)])
+    self.assertEqual(self.server.max_active, 2)
+    self.assertEqual(self.server.connections, 2)
+
+  def testMultiError(self):
+    """Errors from concurrent requests are passed back up."""
+    self.server.status = 400
+    requests = [((self.server.host, 'changes/'), {})] * 3
+    self.assertRaises(gob_util.GOBError, gob_util.FetchUrlJsonMulti, requests)
+
+  def testMultiErrorTraceback(self):
+    """Errors from concurrent requests keep the worker's traceback."""
+    def _Fail():
+      raise ValueError('failed')
+    try:
+      gob_util.RunConcurrently(_Fail, [((), {})])
+    except ValueError:
+      tb = traceback.extract_tb(sys.exc_info()[2])
+    self.assertEqual(tb[-1][2], '_Fail')
+
+  def testFork(self):
+    """Connections should not be shared with forked children."""
+    gob_util.FetchUrlJson(self.server.host, 'changes/')
+    with mock.patch.object(os, 'getpid', return_value=-1):
+      gob_util.FetchUrlJson(self.server.host, 'changes/')
+    self.assertEqual(self.server.connections, 2)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -2,43 +2,392 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-"""Interface for sending data to Graphite."""
+"""Interface for sending data to Graphite.
 
+Metrics are buffered in memory and sent to carbon from a background thread
+using its pickle protocol, so callers (e.g. cbuildbot stages reporting how
+long they took) never wait on the network.  Whatever can't be delivered is
+spooled to disk & sent along the next time carbon is reachable.
+"""
+
+import cPickle
+import errno
+import multiprocessing.util
+import os
 import socket
+import struct
+import threading
+import time
 
+from chromite.lib import commandline
 from chromite.lib import cros_build_lib
+from chromite.lib import osutils
 
 CARBON_SERVER = 'chromeos-stats.corp.google.com'
 CARBON_PORT = 2003
+CARBON_PICKLE_PORT = 2004
+
+# Where (in the cache dir) metrics that couldn't be sent are kept until
+# they can be.
+SPOOL_DIR = 'graphite-spool'
+
+# How often (in seconds) to send what has been buffered.
+FLUSH_INTERVAL = 10
+# Max number of metrics to send to carbon in one go.
+BATCH_SIZE = 500
+# Max number of metrics to hold in memory before spooling them to disk.
+MAX_BUFFER = 10000
+# How long (in seconds) to wait on carbon before giving up on a batch.
+SOCKET_TIMEOUT = 10
+# How long (in seconds) to wait before reconnecting after a failure; this
+# doubles on each consecutive failure, up to MAX_BACKOFF.
+INITIAL_BACKOFF = 1
+MAX_BACKOFF = 5 * 60
+# How long (in seconds) to spend sending what's left when exiting; whatever
+# isn't sent by then is spooled.
+EXIT_TIMEOUT = 5
+
+
+def _GetSpoolDir():
+  """Return the directory to spool metrics in."""
+  return os.path.join(commandline.GetCacheDir(), SPOOL_DIR)
+
+
+class CarbonClient(object):
+  """Send metrics to carbon in the background.
+
+  Metrics are queued up by Send, and a background thread sends them every
+  |flush_interval| seconds (or once |batch_size| of them are waiting).  When
+  carbon can't be reached, batches are written to |spool_dir| & the client
+  backs off before trying again; spooled batches are resent once carbon is
+  back.  The client is safe to use across forks: children start out with an
+  empty buffer and their own thread.
+  """
+
+  # The per-process state is set up by _Reset() rather than __init__, as a
+  # forked child has to start over with its own copy of it.
+  # pylint: disable=W0201
+
+  def __init__(self, server=CARBON_SERVER, port=CARBON_PICKLE_PORT,
+               spool_dir=None, flush_interval=FLUSH_INTERVAL,
+               batch_size=BATCH_SIZE, max_buffer=MAX_BUFFER, dryrun=False):
+    """Initialize.
+
+    Args:
+      server: The carbon server to send metrics to.
+      port: The port carbon's pickle receiver listens on.
+      spool_dir: Where to keep metrics that could not be sent.  If None,
+        they get dropped instead.
+      flush_interval: How often (in seconds) to send buffered metrics.
+      batch_size: Max number of metrics to send at once.
+      max_buffer: Max number of metrics to keep in memory; once there are
+        more than this, the oldest ones get spooled.
+      dryrun: Log what would be sent rather than sending it.
+    """
+    self.server = server
+    self.port = port
+    self.spool_dir = spool_dir
+    self.flush_interval = flush_interval
+    self.batch_size = batch_size
+    self.max_buffer = max_buffer
+    self.dryrun = dryrun
+    self._pid = None
+    self._Reset()
+
+  def _Reset(self):
+    """Set up (or throw away, after a fork) the per-process state."""
+    self._pid = os.getpid()
+    self._cond = threading.Condition()
+    self._buffer = []
+    # The batch the thread has taken out of the buffer but not yet either
+    # sent or spooled.
+    self._in_flight = []
+    self._flush = False
+    self._closing = False
+    self._thread = None
+    self._sock = None
+    self._failures = 0
+    self._retry_at = 0
+    # Send what's left when the process exits; this is also run by the
+    # children multiprocessing forks off (unlike atexit handlers).
+    multiprocessing.util.Finalize(self, self.Close, exitpriority=10)
+
+  def _CheckPid(self):
+    if self._pid != os.getpid():
+      self._Reset()
+
+  def Send(self, path, value, timestamp=None):
+    """Queue up a metric.
+
+    Args:
+      path: The metric, e.g. "buildbot.stages.BuildPackages.duration".
+      value: The (numeric) value of the metric.
+      timestamp: When the value was recorded (seconds since the epoch);
+        defaults to now.
+    """
+    if timestamp is None:
+      timestamp = time.time()
+    self.SendMany([(path, (int(timestamp), float(value)))])
+
+  def SendMany(self, metrics):
+    """Queue up a list of (path, (timestamp, value)) metrics."""
+    self._CheckPid()
+    with self._cond:
+      if self._closing:
+        self._Spool(metrics)
+        return
+      was_empty = not self._buffer
+      self._buffer.extend(metrics)
+      if len(self._buffer) > self.max_buffer:
+        overflow = len(self._buffer) - self.max_buffer
+        self._Spool(self._buffer[:overflow])
+        del self._buffer[:overflow]
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._Run,
+                                        name='graphite-sender')
+        self._thread.daemon = True
+        self._thread.start()
+      if was_empty or len(self._buffer) >= self.batch_size:
+        self._cond.notify_all()
+
+  def Flush(self, timeout=None):
+    """Send everything queued so far.
+
+    Args:
+      timeout: Max time (in seconds) to wait.
+
+    Returns:
+      True if everything was sent or spooled, False if we timed out.
+    """
+    self._CheckPid()
+    deadline = None if timeout is None else time.time() + timeout
+    with self._cond:
+      while self._buffer or self._in_flight:
+        if self._thread is None or not self._thread.is_alive():
+          break
+        self._flush = True
+        self._cond.notify_all()
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+          return False
+        # Wake up periodically; Condition.wait can't be interrupted.
+        self._cond.wait(0.1 if remaining is None else min(remaining, 0.1))
+      return True
+
+  def Close(self, timeout=EXIT_TIMEOUT):
+    """Send (or spool) everything queued, and stop the background thread.
+
+    Args:
+      timeout: Max time (in seconds) to spend on all of this; whatever
+        isn't sent by then is spooled.
+    """
+    if self._pid != os.getpid():
+      return
+    deadline = time.time() + timeout
+    self.Flush(timeout)
+    with self._cond:
+      self._closing = True
+      # Anything we didn't get to in time goes to disk.
+      self._Spool(self._buffer)
+      self._buffer = []
+      self._cond.notify_all()
+    if self._thread is not None:
+      self._thread.join(max(deadline - time.time(), 0))
+    with self._cond:
+      if self._thread is not None and self._thread.is_alive():
+        # The thread is stuck on carbon & will die with the process, so
+        # keep the batch it was sending.
+        self._Spool(self._in_flight)
+        self._in_flight = []
+        return
+    self._Disconnect()
+
+  def _Run(self):
+    """Main loop of the background thread."""
+    while True:
+      with self._cond:
+        deadline = time.time() + self.flush_interval
+        while not self._closing:
+          now = time.time()
+          if not self._buffer:
+            self._cond.wait()
+            deadline = time.time() + self.flush_interval
+            continue
+          if now < self._retry_at:
+            if self._flush:
+              # Carbon is down; don't keep whoever is flushing waiting.
+              self._Spool(self._buffer)
+              self._buffer = []
+              self._flush = False
+              self._cond.notify_all()
+              continue
+            wake = self._retry_at
+          elif (self._flush or now >= deadline or
+                len(self._buffer) >= self.batch_size):
+            break
+          else:
+            wake = deadline
+          self._cond.wait(max(wake - now, 0.01))
+        if self._closing:
+          return
+
+        batch = self._in_flight = self._buffer[:self.batch_size]
+        del self._buffer[:self.batch_size]
 
-def SendToCarbon(lines, dryrun=False, process_queue=20):
+      sent = self._SendBatch(batch)
+      if sent:
+        self._SendSpool()
+
+      with self._cond:
+        if not sent:
+          # Close() spools the batch itself if it gives up on us.
+          self._Spool(self._in_flight)
+          # Don't hold up flushes while carbon is down; it's on disk now.
+          self._Spool(self._buffer)
+          self._buffer = []
+        self._in_flight = []
+        if not self._buffer:
+          self._flush = False
+        self._cond.notify_all()
+
+  def _Connect(self):
+    if self._sock is None:
+      self._sock = socket.create_connection((self.server, self.port),
+                                            SOCKET_TIMEOUT)
+    return self._sock
+
+  def _Disconnect(self):
+    if self._sock is not None:
+      self._sock.close()
+      self._sock = None
+
+  def _SendBatch(self, batch):
+    """Send |batch| of metrics to carbon.
+
+    Returns:
+      Whether carbon got them; if not, we back off before trying again.
+    """
+    if self.dryrun:
+      cros_build_lib.Info('Not sending to Graphite via Carbon:\n%s',
+                          '\n'.join('%s %s %s' % (path, value, ts)
+                                    for path, (ts, value) in batch))
+      return True
+
+    payload = cPickle.dumps(batch, cPickle.HIGHEST_PROTOCOL)
+    try:
+      cros_build_lib.Debug('Sending %d metrics to Graphite via Carbon',
+                           len(batch))
+      self._Connect().sendall(struct.pack('!L', len(payload)) + payload)
+    except (socket.error, EnvironmentError) as e:
+      self._Disconnect()
+      self._failures += 1
+      backoff = min(INITIAL_BACKOFF * 2 ** (self._failures - 1), MAX_BACKOFF)
+      self._retry_at = time.time() + backoff
+      cros_build_lib.Warning('Failed to send metrics to Carbon (%s); '
+                             'retrying in %ss', e, backoff)
+      return False
+
+    self._failures = 0
+    self._retry_at = 0
+    return True
+
+  def _Spool(self, metrics):
+    """Write |metrics| to the spool dir (if there is one)."""
+    if not metrics:
+      return
+    if not self.spool_dir:
+      cros_build_lib.Warning('Dropping %d metrics for Carbon', len(metrics))
+      return
+    # Names sort in the order the batches were spooled.
+    name = '%.6f.%i.%i' % (time.time(), os.getpid(), id(metrics))
+    path = os.path.join(self.spool_dir, name)
+    try:
+      osutils.SafeMakedirs(self.spool_dir)
+      osutils.WriteFile(path + '.tmp',
+                        cPickle.dumps(metrics, cPickle.HIGHEST_PROTOCOL))
+      os.rename(path + '.tmp', path + '.pickle')
+    except EnvironmentError as e:
+      cros_build_lib.Warning('Dropping %d metrics for Carbon: %s',
+                             len(metrics), e)
+
+  def _SendSpool(self):
+    """Send along whatever was spooled to disk earlier."""
+    if not self.spool_dir:
+      return
+    try:
+      names = sorted(x for x in os.listdir(self.spool_dir)
+                     if x.endswith('.pickle'))
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return
+
+    for name in names:
+      path = os.path.join(self.spool_dir, name)
+      # Claim the file first so other clients don't send it too.
+      claimed = '%s.%i.sending' % (path, os.getpid())
+      try:
+        os.rename(path, claimed)
+        metrics = cPickle.loads(osutils.ReadFile(claimed))
+      except (EnvironmentError, cPickle.UnpicklingError, EOFError):
+        continue
+
+      sent = True
+      for i in xrange(0, len(metrics), self.batch_size):
+        sent = self._SendBatch(metrics[i:i + self.batch_size])
+        if not sent:
+          self._Spool(metrics[i:])
+          break
+      osutils.SafeUnlink(claimed)
+      if not sent:
+        break
+
+
+_CLIENT = None
+
+
+def GetClient():
+  """Return the CarbonClient shared by this process."""
+  # pylint: disable=W0603
+  global _CLIENT
+  if _CLIENT is None:
+    _CLIENT = CarbonClient(spool_dir=_GetSpoolDir())
+  return _CLIENT
+
+
+def SendMetric(path, value, timestamp=None):
+  """Queue up a metric for carbon (see CarbonClient.Send)."""
+  GetClient().Send(path, value, timestamp=timestamp)
+
+
+def Flush(timeout=None):
+  """Wait for the metrics queued so far to be sent (or spooled)."""
+  return GetClient().Flush(timeout)
+
+
+def SendToCarbon(lines, dryrun=False):
   """Send data to the statsd/graphite server.
 
   Example of a line "autotest.scheduler.running_agents_5m 300"
   5m is the frequency we are sampling (It is not required but it adds clarity
   to the metric).
 
+  The lines are queued up and sent in the background; see Flush.
+
   Args:
-    lines: A list of lines of the format "category value"
+    lines: A list of lines of the format "category value [timestamp]"
     dryrun: Print out what you would send but do not send anything.
       [default: False]
-    process_queue: How many lines to send to the statsd server at a
-      time. [defualt: 20]
   """
-  sock = socket.socket()
-
-  try:
-    sock.connect((CARBON_SERVER, CARBON_PORT))
-  except Exception:
-    cros_build_lib.Error('Failed to connect to Carbon.')
-    raise
-
-  slices = [lines[i:i+process_queue]
-            for i in range(0, len(lines), process_queue)]
-  for lines in slices:
-    data = '\n'.join(lines) + '\n'
-    if dryrun:
-      cros_build_lib.Info('Not sending to Graphite via Carbon:\n%s', data)
-    else:
-      cros_build_lib.Debug('Sending to Graphite via Carbon:\n%s', data)
-      sock.sendall(data)
+  if dryrun:
+    cros_build_lib.Info('Not sending to Graphite via Carbon:\n%s',
+                        '\n'.join(lines))
+    return
+
+  now = int(time.time())
+  metrics = []
+  for line in lines:
+    fields = line.split()
+    timestamp = int(float(fields[2])) if len(fields) > 2 else now
+    metrics.append((fields[0], (timestamp, float(fields[1]))))
+  GetClient().SendMany(metrics)
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+# Copyright (c) 2014 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for graphite.py"""
+
+import cPickle
+import os
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from chromite.lib import cros_test_lib
+from chromite.lib import graphite
+
+import mock
+
+
+class _FakeCarbonHandler(SocketServer.StreamRequestHandler):
+  """Read pickled batches of metrics the way carbon does."""
+
+  def handle(self):
+    while True:
+      header = self.rfile.read(4)
+      if len(header) < 4:
+        break
+      length = struct.unpack('!L', header)[0]
+      batch = cPickle.loads(self.rfile.read(length))
+      with self.server.lock:
+        self.server.batches.append(batch)
+
+
+class _FakeCarbonServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """A local stand-in for carbon's pickle receiver."""
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, port=0):
+    SocketServer.TCPServer.__init__(self, ('localhost', port),
+                                    _FakeCarbonHandler)
+    self.lock = threading.Lock()
+    self.batches = []
+    self.thread = threading.Thread(target=self.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  @property
+  def port(self):
+    return self.server_address[1]
+
+  @property
+  def metrics(self):
+    with self.lock:
+      return [x for batch in self.batches for x in batch]
+
+  def WaitFor(self, count, timeout=10):
+    """Wait for |count| metrics to come in."""
+    deadline = time.time() + timeout
+    while len(self.metrics) < count and time.time() < deadline:
+      time.sleep(0.01)
+    return self.metrics
+
+  def Stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+def _GetFreePort():
+  """Return a port nothing is listening on."""
+  sock = socket.socket()
+  sock.bind(('localhost', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+class CarbonClientTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for the buffered carbon client."""
+
+  def setUp(self):
+    self.server = _FakeCarbonServer()
+    self.spool_dir = os.path.join(self.tempdir, 'spool')
+    self.clients = []
+    self.PatchObject(graphite, 'INITIAL_BACKOFF', 0.05)
+
+  def tearDown(self):
+    for client in self.clients:
+      client.Close(timeout=1)
+    self.server.Stop()
+
+  def _GetClient(self, port=None, **kwargs):
+    kwargs.setdefault('flush_interval', 60)
+    client = graphite.CarbonClient(
+        server='localhost', port=port or self.server.port,
+        spool_dir=self.spool_dir, **kwargs)
+    self.clients.append(client)
+    return client
+
+  def _Spooled(self):
+    if not os.path.isdir(self.spool_dir):
+      return []
+    return os.listdir(self.spool_dir)
+
+  def testSend(self):
+    """Metrics should be buffered up & sent together."""
+    client = self._GetClient()
+    client.Send('foo.bar', 1, timestamp=100)
+    client.Send('foo.baz', 2.5, timestamp=101)
+    self.assertEqual(self.server.metrics, [])
+    self.assertTrue(client.Flush(timeout=10))
+    self.assertEqual(self.server.WaitFor(2), [('foo.bar', (100, 1.0)),
+                                              ('foo.baz', (101, 2.5))])
+    self.assertEqual(len(self.server.batches), 1)
+
+  def testBatchSize(self):
+    """Big bursts of metrics should be split up into batches."""
+    client = self._GetClient(batch_size=10)
+    client.SendMany([('foo', (i, i)) for i in xrange(25)])
+    # Full batches go out without waiting for a flush.
+    self.assertEqual(len(self.server.WaitFor(20)), 20)
+    client.Flush(timeout=10)
+    self.server.WaitFor(25)
+    self.assertEqual([len(x) for x in self.server.batches], [10, 10, 5])
+
+  def testFlushInterval(self):
+    """Metrics should be sent periodically without being asked to."""
+    client = self._GetClient(flush_interval=0.05)
+    client.Send('foo', 1)
+    self.assertEqual(len(self.server.WaitFor(1)), 1)
+
+  def testSpool(self):
+    """Metrics carbon can't take should be kept & sent later."""
+    port = _GetFreePort()
+    client = self._GetClient(port=port)
+    client.Send('foo', 1, timestamp=100)
+    self.assertTrue(client.Flush(timeout=10))
+    self.assertEqual(len(self._Spooled()), 1)
+
+    # While backing off, flushing should spool rather than wait.
+    client.Send('foo', 2, timestamp=101)
+    self.assertTrue(client.Flush(timeout=10))
+    self.assertEqual(len(self._Spooled()), 2)
+
+    # Once carbon is back, everything spooled should be sent along.
+    self.server.Stop()
+    self.server = _FakeCarbonServer(port=port)
+    time.sleep(0.1)
+    client.Send('foo', 3, timestamp=102)
+    client.Flush(timeout=10)
+    self.assertEqual(sorted(self.server.WaitFor(3)), [
+        ('foo', (100, 1.0)), ('foo', (101, 2.0)), ('foo', (102, 3.0))])
+    self.assertEqual(self._Spooled(), [])
+
+  def testClose(self):
+    """Whatever can't be sent before exiting should be spooled."""
+    client = self._GetClient(port=_GetFreePort())
+    client.Send('foo', 1)
+    client.Close(timeout=10)
+    client.Send('foo', 2)
+    self.assertEqual(len(self._Spooled()), 2)
+
+  def testCloseBlackholed(self):
+    """Close should not wait on carbon past its timeout."""
+    # pylint: disable=W0212
+    client = self._GetClient()
+    sending = threading.Event()
+    release = threading.Event()
+    self.addCleanup(release.set)
+    def _SendBatch(_batch):
+      sending.set()
+      release.wait(10)
+      return False
+    self.PatchObject(client, '_SendBatch', side_effect=_SendBatch)
+    client.Send('foo', 1)
+    client.Flush(timeout=0)
+    self.assertTrue(sending.wait(10))
+    client.Send('foo', 2)
+
+    start = time.time()
+    client.Close(timeout=0.5)
+    self.assertLess(time.time() - start, 2)
+    # Both the queued metric & the one being sent should be kept.
+    self.assertEqual(len(self._Spooled()), 2)
+
+    # The batch should not be spooled a second time once the send fails.
+    release.set()
+    client._thread.join(10)
+    self.assertEqual(len(self._Spooled()), 2)
+
+  def testSpoolDir(self):
+    """The shared client should spool metrics in the cache dir."""
+    self.PatchObject(graphite, '_CLIENT', None)
+    self.PatchObject(graphite.commandline, 'GetCacheDir',
+                     return_value=self.tempdir)
+    client = graphite.GetClient()
+    self.clients.append(client)
+    self.assertEqual(client.spool_dir,
+                     os.path.join(self.tempdir, graphite.SPOOL_DIR))
+
+  def testMaxBuffer(self):
+    """The oldest metrics should be spooled once the buffer is full."""
+    client = self._GetClient(max_buffer=2, batch_size=100)
+    client.SendMany([('foo', (i, i)) for i in xrange(5)])
+    self.assertEqual(len(self._Spooled()), 1)
+    client.Flush(timeout=10)
+    self.assertEqual(len(self.server.WaitFor(5)), 5)
+
+  def testFork(self):
+    """Children should not send what their parent buffered."""
+    client = self._GetClient()
+    client.Send('parent', 1)
+    pid = os.fork()
+    if pid == 0:
+      try:
+        client.Send('child', 2)
+        client.Close(timeout=10)
+      finally:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    self.assertEqual([x[0] for x in self.server.WaitFor(1)], ['child'])
+    client.Flush(timeout=10)
+    self.assertEqual([x[0] for x in self.server.WaitFor(2)],
+                     ['child', 'parent'])
+
+
+class SendToCarbonTest(cros_test_lib.MockTestCase):
+  """Tests for SendToCarbon."""
+
+  def testLines(self):
+    """Lines should be parsed into metrics for the shared client."""
+    client = mock.MagicMock()
+    self.PatchObject(graphite, '_CLIENT', client)
+    self.PatchObject(time, 'time', return_value=1000.5)
+    graphite.SendToCarbon(['foo.bar 300', 'foo.baz 1.5 999'])
+    client.SendMany.assert_called_once_with([('foo.bar', (1000, 300.0)),
+                                             ('foo.baz', (999, 1.5))])
+
+  def testDryRun(self):
+    """Nothing should be sent in dryrun mode."""
+    client = mock.MagicMock()
+    self.PatchObject(graphite, '_CLIENT', client)
+    graphite.SendToCarbon(['foo.bar 300'], dryrun=True)
+    self.assertFalse(client.SendMany.called)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
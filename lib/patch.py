@@ -487,6 +487,100 @@ def GetPaladinDeps(commit_message):
   return dependencies
 
 
+def _GetCommitData(git_repo, revs):
+  """Read the commit data of many revisions with a single git call.
+
+  Args:
+    git_repo: The git repository to look in.
+    revs: A list of full commit sha1s.
+
+  Returns:
+    A dict mapping each sha1 that is available in |git_repo| to a
+    (sha1, subject, commit message) tuple.
+  """
+  if not revs:
+    return {}
+  ret = git.RunGit(
+      git_repo, ['log', '--no-walk', '--ignore-missing', '-z',
+                 '--pretty=format:%H%x00%s%x00%B'] + list(revs),
+      error_code_ok=True)
+  if ret.returncode != 0:
+    return {}
+  output = ret.output.split('\0')
+  data = {}
+  for i in xrange(0, len(output) - 2, 3):
+    commit = [unicode(x.strip(), 'ascii', 'ignore') for x in output[i:i + 3]]
+    data[commit[0]] = commit
+  return data
+
+
+def PrefetchPatches(git_repo, patches):
+  """Make sure the commits of |patches| are available in |git_repo|.
+
+  Whatever is missing is fetched with a single multi-refspec `git fetch` per
+  remote, rather than one fetch per patch.  Patches whose sha1 is not known
+  are left alone; GitRepoPatch.Fetch takes care of those.
+
+  Args:
+    git_repo: The git repository to fetch the patches into.
+    patches: A list of GitRepoPatch instances.
+
+  Returns:
+    The commit data of the patches, as returned by _GetCommitData.
+  """
+  # pylint: disable=W0212
+  git_repo = os.path.normpath(git_repo)
+  patches = [p for p in patches
+             if p.sha1 is not None and git_repo not in p._is_fetched]
+  data = _GetCommitData(git_repo, [p.sha1 for p in patches])
+
+  refs_by_url = {}
+  for patch in patches:
+    if patch.sha1 not in data:
+      refs = refs_by_url.setdefault(patch.project_url, [])
+      if patch.ref not in refs:
+        refs.append(patch.ref)
+
+  if refs_by_url:
+    for url, refs in sorted(refs_by_url.iteritems()):
+      ret = git.RunGit(git_repo, ['fetch', '-f', url] + refs,
+                       error_code_ok=True)
+      if ret.returncode != 0:
+        # One bad ref fails the whole fetch.  Let GitRepoPatch.Fetch sort out
+        # which patch is at fault.
+        cros_build_lib.Warning('Failed to fetch %i refs from %s; falling back '
+                               'to fetching them one at a time.', len(refs),
+                               url)
+    data.update(_GetCommitData(
+        git_repo, [p.sha1 for p in patches if p.sha1 not in data]))
+  return data
+
+
+def FetchPatches(git_repo, patches):
+  """Fetch many patches into |git_repo|, like GitRepoPatch.Fetch.
+
+  The commits are fetched by PrefetchPatches, and their commit messages are
+  read back with a single `git log` call.
+
+  Args:
+    git_repo: The git repository to fetch the patches into.
+    patches: A list of GitRepoPatch instances.
+
+  Returns:
+    A list of the sha1s of |patches|.
+  """
+  # pylint: disable=W0212
+  git_repo = os.path.normpath(git_repo)
+  data = PrefetchPatches(git_repo, patches)
+  sha1s = []
+  for patch in patches:
+    if git_repo in patch._is_fetched or patch.sha1 not in data:
+      sha1s.append(patch.Fetch(git_repo))
+    else:
+      sha1s.append(patch._SetFetchedData(git_repo, *data[patch.sha1]))
+  return sha1s
+
+
 class PatchQuery(object):
   """Store information about a patch.
 
@@ -712,6 +806,14 @@ class GitRepoPatch(PatchQuery):
       git.RunGit(git_repo, ['fetch', '-f', self.project_url, self.ref])
       sha1, subject, msg = _PullData(self.sha1 or 'FETCH_HEAD')
 
+    return self._SetFetchedData(git_repo, sha1, subject, msg)
+
+  def _SetFetchedData(self, git_repo, sha1, subject, msg):
+    """Record the commit data of this patch, as fetched into |git_repo|.
+
+    Returns:
+      The sha1 of the patch.
+    """
     sha1 = ParseSHA1(sha1, error_ok=False)
 
     if self.sha1 is not None and sha1 != self.sha1:
@@ -222,6 +222,30 @@ class TestGitRepoPatch(GitRepoPatchTestCase):
     patch2.Fetch(git2)
     self.assertEqual(sha1, patch2.sha1)
 
+  def testFetchPatches(self):
+    """Fetch several patches from several refs in one go."""
+    git1, git2, patch1 = self._CommonGitSetup()
+    patch2 = self.CommitFile(git1, 'monkeys2', 'foon2')
+    self._run(['git', 'checkout', '-b', 'other', 'HEAD~2'], git1)
+    patch3 = self.CommitFile(git1, 'monkeys3', 'foon3', ref='refs/heads/other')
+    patches = [patch1, patch2, patch3]
+    self.assertEqual(cros_patch.FetchPatches(git2, patches),
+                     [x.sha1 for x in patches])
+    for patch in patches:
+      self.assertEqual(patch.sha1, self._GetSha1(git2, patch.sha1))
+      self.assertTrue(patch.commit_message)
+    # Already fetched patches should be left alone.
+    patch1.project_url = '/dev/null'
+    cros_patch.FetchPatches(git2, [patch1])
+
+  def testFetchPatchesWithoutSha1(self):
+    """Patches with an unknown sha1 are fetched one by one."""
+    git1, git2, patch1 = self._CommonGitSetup()
+    patch2 = self.CommitFile(git1, 'monkeys2', 'foon2')
+    sha1, patch2.sha1 = patch2.sha1, None
+    cros_patch.FetchPatches(git2, [patch1, patch2])
+    self.assertEqual(sha1, patch2.sha1)
+
   def testAlreadyApplied(self):
     git1 = self._MakeRepo('git1', self.source)
     patch1 = self._MkPatch(git1, self._GetSha1(git1, 'HEAD'))
@@ -6,13 +6,15 @@
 """Library for uploading command stats to AppEngine."""
 
 import contextlib
+import json
 import logging
 import os
-import parallel
+import time
 import urllib
 import urllib2
 
 from chromite.cbuildbot import constants
+from chromite.lib import commandline
 from chromite.lib import cros_build_lib
 from chromite.lib import git
 from chromite.lib import osutils
@@ -98,9 +100,11 @@ class StatsUploader(object):
   # To test with an app engine instance on localhost, set envvar
   # export CROS_BUILD_STATS_SITE="http://localhost:8080"
   _PAGE = 'upload_command_stats'
+  _BATCH_PAGE = 'upload_command_stats_batch'
   _DEFAULT_SITE = 'https://chromiumos-build-stats.appspot.com'
   _SITE = os.environ.get('CROS_BUILD_STATS_SITE', _DEFAULT_SITE)
   URL = '%s/%s' % (_SITE, _PAGE)
+  BATCH_URL = '%s/%s' % (_SITE, _BATCH_PAGE)
   UPLOAD_TIMEOUT = 5
 
   _DISABLE_FILE = '~/.disable_build_stats_upload'
@@ -172,6 +176,39 @@ class StatsUploader(object):
       except EnvironmentError:
         logging.debug(cls.ENVIRONMENT_ERROR, exc_info=True)
 
+  @classmethod
+  def UploadBatch(cls, records, url=None, timeout=None):
+    """Upload a list of stats |records| to |url| in one request.
+
+    Unlike Upload, the upload conditions are not checked here; records only
+    get spooled (see StatsSpool) if they are met.
+
+    Args:
+      records: A list of dictionaries of stats data (see StatsSpool.Append).
+      url: The url to send the request to.
+      timeout: A timeout value to set, in seconds.
+
+    Returns:
+      True if the records were uploaded.
+    """
+    if url is None:
+      url = cls.BATCH_URL
+    if timeout is None:
+      timeout = cls.UPLOAD_TIMEOUT
+
+    with timeout_util.Timeout(timeout):
+      try:
+        cls._UploadBatch(records, url)
+        return True
+      # Stats upload errors are silenced, for the sake of user experience.
+      except timeout_util.TimeoutError:
+        logging.debug(cls.TIMEOUT_ERROR, timeout)
+      except urllib2.HTTPError as e:
+        logging.debug(cls.HTTPURL_ERROR, e.filename, exc_info=True)
+      except EnvironmentError:
+        logging.debug(cls.ENVIRONMENT_ERROR, exc_info=True)
+    return False
+
   @classmethod
   def _Upload(cls, stats, url):
     logging.debug('Uploading command stats to %r', url)
@@ -179,6 +216,145 @@ class StatsUploader(object):
     request = urllib2.Request(url)
     urllib2.urlopen(request, data)
 
+  @classmethod
+  def _UploadBatch(cls, records, url):
+    logging.debug('Uploading %d command stats to %r', len(records), url)
+    data = json.dumps({'records': records})
+    request = urllib2.Request(url, headers={'Content-Type': 'application/json'})
+    urllib2.urlopen(request, data)
+
+
+def _GetSpoolDir():
+  """Return the directory to spool stats records in."""
+  return os.path.join(commandline.GetCacheDir(), 'stats')
+
+
+class StatsSpool(object):
+  """Stats records waiting to be uploaded, kept in an append-only file.
+
+  Each line of the spool is the json encoded data of one record, plus the
+  time it was recorded.  Every UPLOAD_INTERVAL seconds, the spool is moved
+  out of the way (so that other commands can keep appending to a new one)
+  and uploaded in batches of up to BATCH_SIZE records.
+  """
+
+  SPOOL_NAME = 'command_stats.spool'
+  STAMP_NAME = 'command_stats.last_upload'
+  UPLOAD_INTERVAL = 10 * 60
+  BATCH_SIZE = 100
+  # Max number of records to hold on to while uploads keep failing.
+  MAX_RECORDS = 1000
+
+  def __init__(self, spool_dir=None):
+    if spool_dir is None:
+      spool_dir = _GetSpoolDir()
+    self.spool_dir = spool_dir
+    self.path = os.path.join(spool_dir, self.SPOOL_NAME)
+    self.stamp = os.path.join(spool_dir, self.STAMP_NAME)
+
+  def _Write(self, records):
+    """Append |records| to the spool."""
+    osutils.SafeMakedirs(self.spool_dir)
+    data = ''.join(json.dumps(x) + '\n' for x in records)
+    # A single O_APPEND write keeps concurrent writers from interleaving.
+    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      os.write(fd, data)
+    finally:
+      os.close(fd)
+
+  def Append(self, stats):
+    """Add |stats| to the spool, stamped with the current time."""
+    record = stats.data
+    record['end_datetime'] = int(time.time())
+    self._Write([record])
+
+  def UploadDue(self):
+    """Whether there is anything spooled that should be uploaded by now."""
+    if not os.path.exists(self.path):
+      return False
+    try:
+      last_upload = os.path.getmtime(self.stamp)
+    except OSError:
+      return True
+    return time.time() - last_upload >= self.UPLOAD_INTERVAL
+
+  def Upload(self, url=None, timeout=None):
+    """Upload everything spooled so far.
+
+    Records that fail to upload are put back in the spool for next time.
+    """
+    # Let other commands know an upload is under way.
+    osutils.Touch(self.stamp, makedirs=True)
+    claimed = '%s.%i' % (self.path, os.getpid())
+    try:
+      os.rename(self.path, claimed)
+    except OSError:
+      # Someone else got to it first.
+      return
+
+    records = []
+    for line in osutils.ReadFile(claimed).splitlines():
+      try:
+        records.append(json.loads(line))
+      except ValueError:
+        logging.debug('Skipping corrupt stats record %r', line)
+
+    for i in xrange(0, len(records), self.BATCH_SIZE):
+      if not StatsUploader.UploadBatch(records[i:i + self.BATCH_SIZE],
+                                       url=url, timeout=timeout):
+        self._Write(records[i:][-self.MAX_RECORDS:])
+        break
+    osutils.SafeUnlink(claimed)
+
+
+def _RunDetached(func, *args):
+  """Run |func| in a background process that we don't wait for."""
+  pid = os.fork()
+  if pid:
+    os.waitpid(pid, 0)
+    return
+
+  # Detach from the session & the terminal, so that whoever is waiting on our
+  # output does not end up waiting for |func| too.
+  try:
+    os.setsid()
+    if os.fork() == 0:
+      null = os.open(os.devnull, os.O_RDWR)
+      for fd in (0, 1, 2):
+        os.dup2(null, fd)
+      func(*args)
+  finally:
+    os._exit(0)
+
+
+class _SpoolQueue(object):
+  """Queue-like interface for adding stats to a StatsSpool.
+
+  Stats are put in the queue before the command runs, so they are only
+  spooled (and stamped with the time the command finished) by Close().
+  """
+
+  def __init__(self, spool):
+    self.spool = spool
+    self.pending = []
+
+  def put(self, args):
+    """Queue the stats in an arg-list of the format [stats, url, timeout]."""
+    stats = args[0]
+    try:
+      if StatsUploader._UploadConditionsMet(stats):  # pylint: disable=W0212
+        self.pending.append(stats)
+    except Exception:
+      # Display unexpected errors, but don't propagate the error.
+      logging.error(UNCAUGHT_UPLOAD_ERROR, exc_info=True)
+
+  def Close(self):
+    """Spool all the stats queued so far."""
+    pending, self.pending = self.pending, []
+    for stats in pending:
+      self.spool.Append(stats)
+
 
 UNCAUGHT_UPLOAD_ERROR = 'Uncaught command stats exception'
 
@@ -187,17 +363,24 @@ UNCAUGHT_UPLOAD_ERROR = 'Uncaught command stats exception'
 def UploadContext():
   """Provides a context where stats are uploaded in the background.
 
+  Stats are only appended to a local spool here, when the context exits (so
+  that they are stamped with the time the command finished).  Every so often,
+  the spool gets uploaded in one go by a background process that nothing
+  waits on, so that commands never wait on the network on their way out.
+
   Yields:
     A queue that accepts an arg-list of the format [stats, url, timeout].
+    The url & timeout are ignored; see StatsSpool.
   """
+  spool = StatsSpool()
+  queue = _SpoolQueue(spool)
   try:
-    # We need to use parallel.BackgroundTaskRunner, and not
-    # parallel.RunParallelTasks, because with RunParallelTasks, both the
-    # uploader and the subcommand are treated as background tasks, and the
-    # subcommand will lose responsiveness, since its output will be buffered.
-    with parallel.BackgroundTaskRunner(
-        StatsUploader.Upload, processes=1) as queue:
-      yield queue
-  except parallel.BackgroundFailure:
-    # Display unexpected errors, but don't propagate the error.
-    logging.error('Uncaught command stats exception', exc_info=True)
+    yield queue
+  finally:
+    try:
+      queue.Close()
+      if spool.UploadDue():
+        _RunDetached(spool.Upload)
+    except Exception:
+      # Display unexpected errors, but don't propagate the error.
+      logging.error(UNCAUGHT_UPLOAD_ERROR, exc_info=True)
@@ -13,12 +13,13 @@ import urllib2
 
 sys.path.insert(0, os.path.abspath('%s/../..' % os.path.dirname(__file__)))
 from chromite.lib import cros_test_lib
-from chromite.lib import parallel
 from chromite.lib import parallel_unittest
 from chromite.lib import partial_mock
 from chromite.lib import stats
 from chromite.lib import timeout_util
 
+import mock
+
 
 # pylint: disable=W0212
 
@@ -27,9 +28,10 @@ class StatsUploaderMock(partial_mock.PartialMock):
   """Mocks out stats.StatsUploader."""
 
   TARGET = 'chromite.lib.stats.StatsUploader'
-  ATTRS = ('URL', 'UPLOAD_TIMEOUT', '_Upload')
+  ATTRS = ('URL', 'BATCH_URL', 'UPLOAD_TIMEOUT', '_Upload', '_UploadBatch')
 
   URL = 'Invalid Url'
+  BATCH_URL = 'Invalid Batch Url'
   # Increased timeout so that we don't get errors when the machine is loaded.
   UPLOAD_TIMEOUT = 30
 
@@ -37,6 +39,10 @@ class StatsUploaderMock(partial_mock.PartialMock):
     """Disable actual uploading."""
     return
 
+  def _UploadBatch(self, _inst, *_args, **_kwargs):
+    """Disable actual uploading."""
+    return
+
 
 class StatsMock(partial_mock.PartialMock):
   """Mocks out stats.Stats."""
@@ -62,7 +68,7 @@ class StatsModuleMock(partial_mock.PartialMock):
   """Mock out everything needed to use this module."""
 
   def __init__(self):
-    partial_mock.PartialMock.__init__(self)
+    partial_mock.PartialMock.__init__(self, create_tempdir=True)
     self.uploader_mock = StatsUploaderMock()
     self.stats_mock = StatsMock()
     self.parallel_mock = parallel_unittest.ParallelMock()
@@ -71,6 +77,10 @@ class StatsModuleMock(partial_mock.PartialMock):
     self.StartPatcher(self.uploader_mock)
     self.StartPatcher(self.stats_mock)
     self.StartPatcher(self.parallel_mock)
+    # Spool stats in our tempdir, and upload them in the foreground.
+    self.PatchObject(stats, '_GetSpoolDir', return_value=self.tempdir)
+    self.PatchObject(stats, '_RunDetached',
+                     side_effect=lambda func, *args: func(*args))
 
 
 class StatsCreationTest(cros_test_lib.MockLoggingTestCase):
@@ -207,15 +217,41 @@ class UploadContextTest(cros_test_lib.MockLoggingTestCase):
       with stats.UploadContext() as queue:
         queue.put([stats.Stats()])
       self.AssertLogsContain(logs, stats.UNCAUGHT_UPLOAD_ERROR, inverted=True)
-      self.assertEquals(stats.StatsUploader._Upload.call_count, 1)
+      self.assertEquals(stats.StatsUploader._UploadBatch.call_count, 1)
 
   def testErrorSupression(self):
     """"Test exception supression."""
-    for e in [parallel.BackgroundFailure]:
-      with cros_test_lib.LoggingCapturer() as logs:
-        with stats.UploadContext():
-          raise e()
-        self.AssertLogsContain(logs, stats.UNCAUGHT_UPLOAD_ERROR)
+    for method in ('Append', 'UploadDue'):
+      with mock.patch.object(stats.StatsSpool, method,
+                             side_effect=EnvironmentError()):
+        with cros_test_lib.LoggingCapturer() as logs:
+          with stats.UploadContext() as queue:
+            queue.put([stats.Stats()])
+          self.AssertLogsContain(logs, stats.UNCAUGHT_UPLOAD_ERROR)
+
+  def testBatching(self):
+    """Stats should only be uploaded every so often, and in bulk."""
+    for _ in xrange(3):
+      with stats.UploadContext() as queue:
+        queue.put([stats.Stats(cmd_line='foo')])
+    # The first run uploads right away; the rest have to wait their turn.
+    self.assertEquals(stats.StatsUploader._UploadBatch.call_count, 1)
+
+    self.PatchObject(stats.StatsSpool, 'UPLOAD_INTERVAL', 0)
+    with stats.UploadContext() as queue:
+      queue.put([stats.Stats(cmd_line='bar')])
+    self.assertEquals(stats.StatsUploader._UploadBatch.call_count, 2)
+    records = stats.StatsUploader._UploadBatch.call_args[0][0]
+    self.assertEquals([x['cmd_line'] for x in records], ['foo', 'foo', 'bar'])
+
+  def testEndTime(self):
+    """Stats should be stamped with the time the context exits."""
+    time_mock = self.PatchObject(time, 'time', return_value=100)
+    with stats.UploadContext() as queue:
+      queue.put([stats.Stats(cmd_line='foo')])
+      time_mock.return_value = 200
+    records = stats.StatsUploader._UploadBatch.call_args[0][0]
+    self.assertEquals([x['end_datetime'] for x in records], [200])
 
   def testErrorPropagation(self):
     """Test we propagate some exceptions."""
@@ -228,5 +264,49 @@ class UploadContextTest(cros_test_lib.MockLoggingTestCase):
       self.assertRaises(e, RaiseContext, e)
 
 
+class StatsSpoolTest(cros_test_lib.MockTempDirTestCase):
+  """Test the spooling of stats records."""
+
+  def setUp(self):
+    self.StartPatcher(StatsUploaderMock())
+    self.spool = stats.StatsSpool(spool_dir=self.tempdir)
+    self.PatchObject(stats.StatsSpool, 'BATCH_SIZE', 2)
+
+  def _Spool(self, count):
+    for i in xrange(count):
+      self.spool.Append(stats.Stats(
+          run_time=i, host='test.golo.chromium.org',
+          username='chrome-bot@chromium.org'))
+
+  def testUpload(self):
+    """Spooled records should be uploaded in batches, then cleared."""
+    self.assertFalse(self.spool.UploadDue())
+    self._Spool(5)
+    self.assertTrue(self.spool.UploadDue())
+    self.spool.Upload()
+    calls = stats.StatsUploader._UploadBatch.call_args_list
+    self.assertEquals([[x['run_time'] for x in c[0][0]] for c in calls],
+                      [[0, 1], [2, 3], [4]])
+    self.assertEquals(calls[0][0][1], stats.StatsUploader.BATCH_URL)
+    self.assertFalse(self.spool.UploadDue())
+    self.assertEquals(os.listdir(self.tempdir), [self.spool.STAMP_NAME])
+
+  def testUploadFailure(self):
+    """Records that failed to upload should be kept for next time."""
+    self._Spool(5)
+    stats.StatsUploader._UploadBatch.side_effect = [None, EnvironmentError()]
+    self.spool.Upload()
+    # The stamp keeps us from retrying right away.
+    self.assertFalse(self.spool.UploadDue())
+    stats.StatsUploader._UploadBatch.side_effect = None
+    self.PatchObject(stats.StatsSpool, 'UPLOAD_INTERVAL', 0)
+    self.assertTrue(self.spool.UploadDue())
+    self.spool.Upload()
+    records = [x['run_time'] for c in
+               stats.StatsUploader._UploadBatch.call_args_list[2:]
+               for x in c[0][0]]
+    self.assertEquals(records, [2, 3, 4])
+
+
 if __name__ == '__main__':
   cros_test_lib.main(level=logging.DEBUG)
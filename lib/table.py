@@ -17,6 +17,7 @@ class Table(object):
 
   __slots__ = ['_column_set',  # Set of column headers (for faster lookup)
                '_columns',     # List of column headers in order
+               '_indices',     # Dict of lookup indices, see _GetIndex
                '_name',        # Name to associate with table
                '_rows',        # List of row dicts
                ]
@@ -115,6 +116,7 @@ class Table(object):
     self._column_set = set(columns)
     self._rows = []
     self._name = name
+    self._indices = {}
 
   def __str__(self):
     """Return a table-like string representation of this table."""
@@ -168,6 +170,7 @@ class Table(object):
   def Clear(self):
     """Remove all row data."""
     self._rows = []
+    self.InvalidateIndex()
 
   def GetNumRows(self):
     """Return the number of rows in the table."""
@@ -198,23 +201,65 @@ class Table(object):
       return True
     return Grep
 
+  def InvalidateIndex(self):
+    """Throw away the lookup indices, to be rebuilt when next needed.
+
+    The table keeps them up to date through its own methods, but callers
+    that change values in a row dict directly (e.g. a row they got from
+    iterating over the table) must call this afterwards.
+    """
+    self._indices = {}
+
+  def _GetIndex(self, columns):
+    """Return a dict mapping values in |columns| to indices of rows with them.
+
+    The |columns| argument is a tuple of column names.  Indices are built
+    the first time they are needed and kept until the rows change.
+    """
+    index = self._indices.get(columns)
+    if index is None:
+      index = {}
+      for ix, row in enumerate(self._rows):
+        key = tuple(row.get(col, None) for col in columns)
+        index.setdefault(key, []).append(ix)
+      self._indices[columns] = index
+    return index
+
+  def _IndexRow(self, ix):
+    """Add the row at |ix| to the existing lookup indices."""
+    row = self._rows[ix]
+    try:
+      for columns, index in self._indices.iteritems():
+        key = tuple(row.get(col, None) for col in columns)
+        index.setdefault(key, []).append(ix)
+    except TypeError:
+      # Values that cannot be hashed cannot be indexed either.
+      self.InvalidateIndex()
+
+  def _DropIndices(self, cols):
+    """Throw away the lookup indices that involve any of |cols|."""
+    for columns in self._indices.keys():
+      if not cols.isdisjoint(columns):
+        del self._indices[columns]
+
   def GetRowsByValue(self, id_values):
     """Return list of rows matching key/value pairs in |id_values|."""
-    # If row retrieval by value is heavily used for larger tables, then
-    # the implementation should change to be more efficient, at the
-    # expense of some pre-processing and extra storage.
-    grep = self._GenRowFilter(id_values)
-    return [r for r in self._rows if grep(r)]
+    return [self._rows[ix] for ix in self.GetRowIndicesByValue(id_values)]
 
   def GetRowIndicesByValue(self, id_values):
     """Return list of indices for rows matching k/v pairs in |id_values|."""
     grep = self._GenRowFilter(id_values)
-    indices = []
-    for ix, row in enumerate(self._rows):
-      if grep(row):
-        indices.append(ix)
-
-    return indices
+    columns = tuple(sorted(id_values))
+    try:
+      key = tuple(id_values[col] for col in columns)
+      indices = self._GetIndex(columns).get(key, [])
+    except TypeError:
+      # Values that cannot be hashed have to be looked for the slow way.
+      self._indices.pop(columns, None)
+      indices = xrange(len(self._rows))
+
+    # Double check the matches, in case a row was changed in place.
+    return [ix for ix in indices if grep(self._rows[ix])]
 
   def _PrepareValuesForAdd(self, values):
     """Prepare a |values| dict/list to be added as a row.
@@ -256,15 +301,19 @@ class Table(object):
     """
     row = self._PrepareValuesForAdd(values)
     self._rows.append(row)
+    if self._indices:
+      self._IndexRow(len(self._rows) - 1)
 
   def SetRowByIndex(self, index, values):
     """Replace the row at |index| with values from |values| dict."""
     row = self._PrepareValuesForAdd(values)
     self._rows[index] = row
+    self.InvalidateIndex()
 
   def RemoveRowByIndex(self, index):
     """Remove the row at |index|."""
     del self._rows[index]
+    self.InvalidateIndex()
 
   def HasColumn(self, name):
     """Return True if column |name| is in this table, False otherwise."""
@@ -295,6 +344,7 @@ class Table(object):
 
     for row in self._rows:
       row[name] = value if value is not None else self.EMPTY_CELL
+    self._DropIndices(set([name]))
 
   def AppendColumn(self, name, value=None):
     """Same as InsertColumn, but new column is appended after existing ones."""
@@ -304,6 +354,7 @@ class Table(object):
     """Invoke |row_processor| on each row in sequence."""
     for row in self._rows:
       row_processor(row)
+    self.InvalidateIndex()
 
   def MergeTable(self, other_table, id_columns, merge_rules=None,
                  allow_new_columns=False, key=None, reverse=False,
@@ -380,6 +431,7 @@ class Table(object):
     if row_indices:
       row_index = row_indices[0]
       row = self.GetRowByIndex(row_index)
+      changed_cols = set()
       for col in other_row:
         if col in row:
           # Find the merge rule that applies to this column, if there is one.
@@ -399,10 +451,13 @@ class Table(object):
 
           if val != row[col]:
             row[col] = val
+            changed_cols.add(col)
         else:
           # Cannot add new columns to row this way.
           raise LookupError("Tried merging data to unknown column '%s'" % col)
-      self.SetRowByIndex(row_index, row)
+      # The row was updated in place, so only the indices over the columns
+      # that changed (never the id columns) are out of date now.
+      self._DropIndices(changed_cols)
     else:
       self.AppendRow(other_row)
 
@@ -437,6 +492,7 @@ class Table(object):
   def Sort(self, key, reverse=False):
     """Sort the rows using the given |key| function."""
     self._rows.sort(key=key, reverse=reverse)
+    self.InvalidateIndex()
 
   def WriteCSV(self, filehandle, hiddencols=None):
     """Write this table out as comma-separated values to |filehandle|.
@@ -124,6 +124,82 @@ class TableTest(cros_test_lib.TestCase):
     indices = self._table.GetRowIndicesByValue({self.COL3: 'Foo'})
     self.assertEquals([1], indices)
 
+  def testGetByValueIndexed(self):
+    """Lookups should stay correct as the table changes under the index."""
+    self.assertEquals([1, 2], self._table.GetRowIndicesByValue(
+        {self.COL0: 'Abc'}))
+
+    self._table.AppendRow(dict(self.ROW1))
+    self.assertEquals([1, 2, 3], self._table.GetRowIndicesByValue(
+        {self.COL0: 'Abc'}))
+
+    self._table.RemoveRowByIndex(1)
+    self.assertEquals([1, 2], self._table.GetRowIndicesByValue(
+        {self.COL0: 'Abc'}))
+
+    self._table.SetRowByIndex(1, dict(self.ROW0))
+    self.assertEquals([0, 1], self._table.GetRowIndicesByValue(
+        {self.COL0: 'Xyz'}))
+
+    self._table.Sort(lambda row: row[self.COL0])
+    self.assertEquals([0], self._table.GetRowIndicesByValue(
+        {self.COL0: 'Abc'}))
+
+    self._table.AppendColumn(self.EXTRACOL, 'blah')
+    self.assertEquals([0, 1, 2], self._table.GetRowIndicesByValue(
+        {self.EXTRACOL: 'blah'}))
+
+  def testGetByValueChangedInPlace(self):
+    """Rows changed directly should be found again after InvalidateIndex."""
+    self.assertEquals([1, 2], self._table.GetRowIndicesByValue(
+        {self.COL0: 'Abc'}))
+    self._table[1][self.COL0] = 'Def'
+    # Stale matches are never returned.
+    self.assertEquals([2], self._table.GetRowIndicesByValue(
+        {self.COL0: 'Abc'}))
+    self._table.InvalidateIndex()
+    self.assertEquals([1], self._table.GetRowIndicesByValue(
+        {self.COL0: 'Def'}))
+
+  def testGetByUnhashableValue(self):
+    """Values that can't be indexed should still be found."""
+    self._table.AppendRow({self.COL0: ['a', 'list']})
+    self.assertEquals([3], self._table.GetRowIndicesByValue(
+        {self.COL0: ['a', 'list']}))
+    self.assertEquals([1, 2], self._table.GetRowIndicesByValue(
+        {self.COL0: 'Abc'}))
+
+  def testMergeTablesIndexed(self):
+    """Merging should look rows up in the index, not scan the table."""
+    calls = [0]
+    class CountingTable(table.Table):
+      """Table that counts the rows it checks against id values."""
+      def _GenRowFilter(self, id_values):
+        grep = table.Table._GenRowFilter(self, id_values)
+        def Grep(row):
+          calls[0] += 1
+          return grep(row)
+        return Grep
+
+    size = 1000
+    cols = [self.COL0, self.COL1, self.COL2]
+    table1 = CountingTable(list(cols))
+    for i in xrange(0, size * 2, 2):
+      table1.AppendRow({self.COL0: str(i), self.COL1: 'a', self.COL2: 'x'})
+    table2 = self._CreateTableWithRows(
+        cols, [{self.COL0: str(i), self.COL1: 'a', self.COL2: 'y'}
+               for i in xrange(size)])
+
+    table1.MergeTable(table2, [self.COL0, self.COL1],
+                      merge_rules={self.COL2: 'join_with: '})
+    self.assertEquals(size * 3 / 2, len(table1))
+    self.assertEquals(['x y'], [r[self.COL2] for r in table1.GetRowsByValue(
+        {self.COL0: '10', self.COL1: 'a'})])
+    self.assertEquals(['y'], [r[self.COL2] for r in table1.GetRowsByValue(
+        {self.COL0: '11', self.COL1: 'a'})])
+    # One check per matching row, rather than one per row in the table.
+    self.assertEquals(size / 2, calls[0] - 2)
+
   def testAppendRowDict(self):
     self._table.AppendRow(self.EXTRAROW)
     self.assertEquals(4, self._table.GetNumRows())
@@ -122,6 +122,7 @@ in http://crbug.com/271832 .
 
 import cgi
 import codecs
+import hashlib
 import logging
 import os
 import re
@@ -129,9 +130,11 @@ import tempfile
 
 from chromite.cbuildbot import constants
 from chromite.cbuildbot import portage_utilities
+from chromite.lib import cache
 from chromite.lib import commandline
 from chromite.lib import cros_build_lib
 from chromite.lib import osutils
+from chromite.lib import parallel
 
 # We are imported by src/repohooks/pre-upload.py in a non chroot environment
 # where yaml may not be there, so we don't error on that since it's not needed
@@ -267,28 +270,294 @@ LICENCES_IGNORE = [
     '||',
 ]
 
+# Bump this whenever the scanning logic changes in a way that would make
+# previously cached scan results stale.
+SCAN_CACHE_VERSION = '1'
+
+# Location of the scan result cache, relative to the common cache dir.
+SCAN_CACHE_DIR = 'licensing'
+
 TMPL = 'about_credits.tmpl'
 ENTRY_TMPL = 'about_credits_entry.tmpl'
 SHARED_LICENSE_TMPL = 'about_credits_shared_license_entry.tmpl'
 
 
-# This is called directly by src/repohooks/pre-upload.py
-def GetLicenseTypesFromEbuild(ebuild_path):
-  """Returns a list of license types from the ebuild file.
+def _EbuildOverlays():
+  """Overlays (in search order) that eclasses get inherited from."""
+  # TODO: the overlay_list hard-coded here should be changed to look
+  # at the current overlay, and then the master overlays. E.g. for an
+  # ebuild file in overlay-parrot, we will look at parrot overlay
+  # first, and then look at portage-stable and chromiumos, which are
+  # listed as masters in overlay-parrot/metadata/layout.conf.
+  return (
+      os.path.join(constants.SOURCE_ROOT, 'src/third_party/chromiumos-overlay'),
+      os.path.join(constants.SOURCE_ROOT, 'src/third_party/portage-stable'),
+  )
+
+
+class _UnsupportedEbuildSyntax(Exception):
+  """The ebuild (or an eclass) does something the fast parser can't follow."""
+
+
+# LICENSE="..." / LICENSE+="..." at the top level of an ebuild or eclass.
+_LICENSE_ASSIGN_RE = re.compile(r'^LICENSE(\+?)=(.*)$')
+# inherit foo bar at the top level of an ebuild or eclass.
+_INHERIT_RE = re.compile(r'^inherit((?:[ \t]+[\w.+-]+)+)[ \t]*(?:#.*)?$')
+# Start of a multi-line function definition; bash doesn't run these when
+# sourcing, so neither do we.
+_FUNCTION_START_RE = re.compile(
+    r'^(?:function[ \t]+[\w:.+-]+[ \t]*(?:\(\))?|[\w:.+-]+[ \t]*\(\))'
+    r'[ \t]*\{?[ \t]*$')
+# Anything that could touch LICENSE or inherit in a way we don't understand.
+_LICENSE_ANY_RE = re.compile(r'\bLICENSE\+?=|\bunset\b.*\bLICENSE\b')
+_INHERIT_ANY_RE = re.compile(r'(?:^|[\s;&|({])inherit(?:\s|$)')
+# Quoted strings, which can't open or close blocks.
+_QUOTED_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\'[^\']*\'')
+# Words opening and closing compound commands at the top level of a file.
+_BLOCK_OPEN_WORDS = frozenset(('if', 'case', 'for', 'while', 'until',
+                               'select', '{'))
+_BLOCK_CLOSE_WORDS = frozenset(('fi', 'esac', 'done', '}'))
+# A line ending like this makes the next one part of the same command.
+_CONTINUED_LINE_RE = re.compile(r'(?:&&|\|\||\||\\)\s*$')
+# The include-once guard wrapped around most eclasses, e.g.
+#   if [[ -z ${_EUTILS_ECLASS} ]]; then
+#   if [[ ${___ECLASS_ONCE_EUTILS} != "recur -_+^+_- spank" ]] ; then
+# followed by an assignment to the variable, and closed by a fi at the top
+# level.
+_ONCE_GUARD_RE = re.compile(
+    r'^if[ \t]+\[\[[ \t]+'
+    r'(?:-z[ \t]+"?\$\{(\w+)\}"?'
+    r'|"?\$\{(\w+)\}"?[ \t]+!=[ \t]+(?:"[^"]*"|\S+))'
+    r'[ \t]+\]\][ \t]*;[ \t]*then[ \t]*$')
+_FI_RE = re.compile(r'^fi[ \t]*(?:#.*)?$')
+
+# Parsed files: path -> ((mtime, size), list of operations or the
+# _UnsupportedEbuildSyntax raised while parsing).
+_EBUILD_OPS_CACHE = {}
+
+# Ebuilds sourced by bash: (path, overlays) -> ((mtime, size), LICENSE).
+_EBUILD_BASH_CACHE = {}
+
+
+def _FileStamp(path):
+  """Return what we use to tell whether |path| changed since we read it."""
+  st = os.stat(path)
+  return (st.st_mtime, st.st_size)
+
+
+def _ParseLicenseValue(value, lines):
+  """Parse the right hand side of a LICENSE assignment.
 
-  This function does not always return the correct list, but it is
-  faster than using portageq for not having to access chroot. It is
-  intended to be used for tasks such as presubmission checks.
+  Args:
+    value: text following the = sign.
+    lines: iterator over the following lines of the file, used to read the
+      rest of a quoted value spanning multiple lines.
+
+  Returns:
+    The value of the assignment.
+
+  Raises:
+    _UnsupportedEbuildSyntax: if the value needs expanding.
+  """
+  if value[:1] in ('"', "'"):
+    quote = value[0]
+    value = value[1:]
+    while quote not in value:
+      try:
+        value += '\n' + next(lines)
+      except StopIteration:
+        raise _UnsupportedEbuildSyntax('unterminated quote')
+    value, rest = value.split(quote, 1)
+    special_chars = r'[$`\\]'
+  else:
+    parts = value.split(None, 1)
+    value, rest = (parts[0], parts[1]) if len(parts) == 2 else (value, '')
+    special_chars = r'[$`\\()\'"]'
+
+  rest = rest.strip()
+  if rest and not rest.startswith('#'):
+    raise _UnsupportedEbuildSyntax('trailing text after LICENSE: %s' % rest)
+  if re.search(special_chars, value):
+    raise _UnsupportedEbuildSyntax('LICENSE needs expanding: %s' % value)
+  return value
+
+
+def _BlockDepthChange(line):
+  """Return the number of compound commands a line opens (or closes)."""
+  change = 0
+  for word in re.split(r'[\s;&|]+', _QUOTED_RE.sub('""', line)):
+    if word.startswith('#'):
+      break
+    if word in _BLOCK_OPEN_WORDS:
+      change += 1
+    elif word in _BLOCK_CLOSE_WORDS:
+      change -= 1
+  return change
+
+
+def _ParseLicenseOperations(path):
+  """Extract the LICENSE assignments and inherits of an ebuild or eclass.
+
+  Results are cached by path (and mtime/size), which in particular means each
+  eclass is only ever parsed once no matter how many ebuilds inherit it.
+
+  An include-once guard around the file is treated as if it wasn't there:
+  we only ever evaluate an eclass once per ebuild anyway.
+
+  Args:
+    path: ebuild or eclass to parse.
+
+  Returns:
+    List of ('inherit', [eclasses]), ('set', value) and ('append', value)
+    operations in the order they run when the file is sourced.
+
+  Raises:
+    _UnsupportedEbuildSyntax: the file needs to be sourced by bash.
+  """
+  stamp = _FileStamp(path)
+  cached = _EBUILD_OPS_CACHE.get(path)
+  if cached and cached[0] == stamp:
+    if isinstance(cached[1], _UnsupportedEbuildSyntax):
+      raise cached[1]
+    return cached[1]
+
+  ops = []
+  try:
+    lines = iter(osutils.ReadFile(path).splitlines())
+    in_function = False
+    # Number of if/case/loop/{ blocks we are in, and whether the previous
+    # line continues onto this one (e.g. "[[ ... ]] &&").  Assignments and
+    # inherits in either case are conditional, so are left to bash.
+    depth = 0
+    continued = False
+    # The variable of the include-once guard we are in, and whether we have
+    # seen it being set yet.
+    guard = None
+    guard_set = False
+    for line in lines:
+      if in_function:
+        if line.rstrip() == '}':
+          in_function = False
+        continue
+
+      stripped = line.strip()
+      if not stripped or stripped.startswith('#'):
+        continue
+
+      if guard is None and not depth and not continued:
+        m = _ONCE_GUARD_RE.match(line)
+        if m:
+          guard = m.group(1) or m.group(2)
+          guard_set = False
+          continue
+      if guard is not None and not guard_set:
+        if line.startswith('%s=' % guard):
+          guard_set = True
+          continue
+        # Not a guard after all, just a conditional.
+        guard = None
+        depth += 1
+      if guard is not None and not depth and not continued and (
+          _FI_RE.match(line)):
+        guard = None
+        continue
+
+      conditional = depth or continued
+      continued = bool(_CONTINUED_LINE_RE.search(line))
+      if conditional and (_LICENSE_ANY_RE.search(line) or
+                          _INHERIT_ANY_RE.search(line)):
+        raise _UnsupportedEbuildSyntax('%s: conditional: %s' % (path, line))
+
+      m = _LICENSE_ASSIGN_RE.match(line)
+      if m:
+        value = _ParseLicenseValue(m.group(2), lines)
+        ops.append(('append' if m.group(1) else 'set', value))
+        continue
+
+      m = _INHERIT_RE.match(line)
+      if m:
+        ops.append(('inherit', m.group(1).split()))
+        continue
+
+      if _FUNCTION_START_RE.match(line):
+        in_function = True
+        continue
+
+      # LICENSE/inherit hidden in a conditional, a one-liner, etc.
+      if _LICENSE_ANY_RE.search(line) or _INHERIT_ANY_RE.search(line):
+        raise _UnsupportedEbuildSyntax('%s: cannot parse: %s' % (path, line))
+
+      depth += _BlockDepthChange(line)
+      if depth < 0:
+        raise _UnsupportedEbuildSyntax('%s: unbalanced block: %s' %
+                                       (path, line))
+
+    if in_function:
+      raise _UnsupportedEbuildSyntax('%s: unterminated function' % path)
+    if guard is not None:
+      raise _UnsupportedEbuildSyntax('%s: unterminated guard' % path)
+  except _UnsupportedEbuildSyntax as e:
+    _EBUILD_OPS_CACHE[path] = (stamp, e)
+    raise
+
+  _EBUILD_OPS_CACHE[path] = (stamp, ops)
+  return ops
+
+
+def _EvaluateEbuildLicense(ebuild_path, overlays):
+  """Compute the LICENSE of an ebuild without running bash.
 
   Args:
     ebuild_path: ebuild to read.
+    overlays: overlays to look for eclasses in, in search order.
 
   Returns:
-    list of licenses read from ebuild.
+    The value of LICENSE once the ebuild is sourced, or None if unset.
 
   Raises:
-    ValueError: ebuild errors.
+    _UnsupportedEbuildSyntax: the ebuild needs to be sourced by bash.
   """
+  inherited = set()
+
+  def _Run(path, license_value):
+    for op, arg in _ParseLicenseOperations(path):
+      if op == 'set':
+        license_value = arg
+      elif op == 'append':
+        license_value = (license_value or '') + arg
+      else:
+        for eclass in arg:
+          if eclass in inherited:
+            continue
+          inherited.add(eclass)
+          for overlay in overlays:
+            eclass_path = os.path.join(overlay, 'eclass', '%s.eclass' % eclass)
+            if os.path.exists(eclass_path):
+              license_value = _Run(eclass_path, license_value)
+              break
+    return license_value
+
+  return _Run(ebuild_path, None)
+
+
+def _GetEbuildLicenseWithBash(ebuild_path, overlays):
+  """Compute the LICENSE of an ebuild by sourcing it in bash.
+
+  Args:
+    ebuild_path: ebuild to read.
+    overlays: overlays to look for eclasses in, in search order.
+
+  Results are cached by path (and mtime/size).
+
+  Returns:
+    The value of LICENSE once the ebuild is sourced, or None if unset.
+  """
+  key = (ebuild_path, tuple(overlays))
+  stamp = _FileStamp(ebuild_path)
+  cached = _EBUILD_BASH_CACHE.get(key)
+  if cached and cached[0] == stamp:
+    return cached[1]
+
   ebuild_env_tmpl = """
 has() { [[ " ${*:2} " == *" $1 "* ]]; }
 inherit() {
@@ -308,32 +577,131 @@ inherit() {
 }
 source %(ebuild)s"""
 
-  # TODO: the overlay_list hard-coded here should be changed to look
-  # at the current overlay, and then the master overlays. E.g. for an
-  # ebuild file in overlay-parrot, we will look at parrot overlay
-  # first, and then look at portage-stable and chromiumos, which are
-  # listed as masters in overlay-parrot/metadata/layout.conf.
   tmpl_env = {
       'ebuild': ebuild_path,
-      'overlay_list': '%s %s' % (
-          os.path.join(constants.SOURCE_ROOT,
-                       'src/third_party/chromiumos-overlay'),
-          os.path.join(constants.SOURCE_ROOT,
-                       'src/third_party/portage-stable'))
+      'overlay_list': ' '.join(overlays),
   }
 
   with tempfile.NamedTemporaryFile(bufsize=0) as f:
     osutils.WriteFile(f.name, ebuild_env_tmpl % tmpl_env)
     env = osutils.SourceEnvironment(
         f.name, whitelist=['LICENSE'], ifs=' ', multiline=True)
+  license_value = env.get('LICENSE')
+  _EBUILD_BASH_CACHE[key] = (stamp, license_value)
+  return license_value
+
+
+# This is called directly by src/repohooks/pre-upload.py
+def GetLicenseTypesFromEbuild(ebuild_path):
+  """Returns a list of license types from the ebuild file.
+
+  This function does not always return the correct list, but it is
+  faster than using portageq for not having to access chroot. It is
+  intended to be used for tasks such as presubmission checks.
+
+  Most ebuilds only use plain LICENSE assignments and inherits, which we
+  follow in python (caching every ebuild and eclass we parse); anything
+  fancier falls back to sourcing the ebuild with bash.
 
-  if not env.get('LICENSE'):
+  Args:
+    ebuild_path: ebuild to read.
+
+  Returns:
+    list of licenses read from ebuild.
+
+  Raises:
+    ValueError: ebuild errors.
+  """
+  overlays = _EbuildOverlays()
+  try:
+    license_value = _EvaluateEbuildLicense(ebuild_path, overlays)
+  except _UnsupportedEbuildSyntax as e:
+    logging.debug('Sourcing %s with bash: %s', ebuild_path, e)
+    license_value = _GetEbuildLicenseWithBash(ebuild_path, overlays)
+
+  if not license_value:
     raise ValueError('No LICENSE found in the ebuild.')
-  if re.search(r'[,;]', env['LICENSE']):
+  if re.search(r'[,;]', license_value):
     raise ValueError(
         'LICENSE field in the ebuild should be whitespace-limited.')
 
-  return env['LICENSE'].split()
+  return license_value.split()
+
+
+class LicenseStore(object):
+  """Index of the stock and custom shared license directories.
+
+  The license directories are listed once, on first use, instead of probing
+  each of them for every license reference, and license texts are read and
+  decoded only once no matter how many packages use them.
+  """
+
+  STOCK = 'Gentoo Package Stock'
+  CUSTOM = 'Custom'
+
+  def __init__(self, stock_dirs=None, custom_dirs=None):
+    """Initialize.
+
+    Args:
+      stock_dirs: list of stock license directories (STOCK_LICENSE_DIRS by
+        default, read when the index is first built).
+      custom_dirs: list of custom license directories (CUSTOM_LICENSE_DIRS by
+        default, read when the index is first built).
+    """
+    self._stock_dirs = stock_dirs
+    self._custom_dirs = custom_dirs
+    # license name -> (license type, path), built on demand.
+    self._index = None
+    # license name -> decoded license text.
+    self._text = {}
+
+  @property
+  def license_dirs(self):
+    """All the directories we look in, in order of precedence."""
+    stock_dirs = (STOCK_LICENSE_DIRS if self._stock_dirs is None
+                  else self._stock_dirs)
+    custom_dirs = (CUSTOM_LICENSE_DIRS if self._custom_dirs is None
+                   else self._custom_dirs)
+    return ([(self.STOCK, x) for x in stock_dirs] +
+            [(self.CUSTOM, x) for x in custom_dirs])
+
+  def _GetIndex(self):
+    if self._index is None:
+      index = {}
+      for license_type, directory in self.license_dirs:
+        try:
+          names = os.listdir(directory)
+        except OSError:
+          continue
+        for name in names:
+          # Earlier directories shadow later ones.
+          index.setdefault(name, (license_type, os.path.join(directory, name)))
+      self._index = index
+    return self._index
+
+  def Lookup(self, license_name):
+    """Return (license type, path) for |license_name|, or None if unknown."""
+    return self._GetIndex().get(license_name)
+
+  def ReadLicense(self, license_name):
+    """Return the decoded text of |license_name|, or None if unknown."""
+    if license_name not in self._text:
+      entry = self.Lookup(license_name)
+      if entry is None:
+        return None
+      self._text[license_name] = ReadUnknownEncodedFile(entry[1],
+                                                        "read license")
+    return self._text[license_name]
+
+  def GetDigest(self, license_name):
+    """Return a digest of the text of |license_name|, or None if unknown."""
+    text = self.ReadLicense(license_name)
+    if text is None:
+      return None
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+_LICENSE_STORE = LicenseStore()
 
 
 class PackageLicenseError(Exception):
@@ -454,14 +822,7 @@ class PackageInfo(object):
       False (no license found) or a multiline license string.
     """
     license_read = None
-    # dev-util/bsdiff-4.3-r5 -> bsdiff-4.3-r5
-    filename = os.path.basename(self.fullnamerev)
-    license_path = os.path.join(COPYRIGHT_ATTRIBUTION_DIR,
-                                os.path.dirname(self.fullnamerev))
-    pv = portage_utilities.SplitPV(filename)
-    pv_no_rev = '%s-%s' % (pv.package, pv.version_no_rev)
-    for filename in (pv.pv, pv_no_rev, pv.package):
-      file_path = os.path.join(license_path, filename)
+    for file_path in self._OverrideLicensePaths():
       logging.debug("Looking for override copyright attribution license in %s",
                     file_path)
       if os.path.exists(file_path):
@@ -477,6 +838,44 @@ class PackageInfo(object):
 
     return license_read
 
+  def _OverrideLicensePaths(self):
+    """Return the override license paths to probe, in order of preference."""
+    # dev-util/bsdiff-4.3-r5 -> bsdiff-4.3-r5
+    filename = os.path.basename(self.fullnamerev)
+    license_path = os.path.join(COPYRIGHT_ATTRIBUTION_DIR,
+                                os.path.dirname(self.fullnamerev))
+    pv = portage_utilities.SplitPV(filename)
+    pv_no_rev = '%s-%s' % (pv.package, pv.version_no_rev)
+    return [os.path.join(license_path, x)
+            for x in (pv.pv, pv_no_rev, pv.package)]
+
+  def GetScanDigest(self):
+    """Compute a digest of everything the license scan of this package uses.
+
+    This covers the ebuild itself, the Manifest next to it (which holds the
+    digests of the source tarballs that get unpacked), any override license
+    in COPYRIGHT_ATTRIBUTION_DIR and the static mappings in this file, so two
+    packages with the same digest are guaranteed to scan the same.
+
+    Returns:
+      A hex digest string, or None if the ebuild path is not known yet.
+    """
+    if not self.ebuild_path:
+      return None
+
+    digest = hashlib.sha1()
+    digest.update('%s\0%s\0%s\0' % (SCAN_CACHE_VERSION, self.board,
+                                     self.fullnamerev))
+    digest.update('%r\0%r\0' % (PACKAGE_LICENSES.get(self.fullname),
+                                PACKAGE_HOMEPAGES.get(self.fullname)))
+    manifest = os.path.join(os.path.dirname(self.ebuild_path), 'Manifest')
+    for path in [self.ebuild_path, manifest] + self._OverrideLicensePaths():
+      digest.update('%s\0' % path)
+      if os.path.exists(path):
+        digest.update(osutils.ReadFile(path))
+      digest.update('\0')
+    return digest.hexdigest()
+
   def _ExtractLicenses(self):
     """Scrounge for text licenses in the source of package we'll unpack.
 
@@ -525,10 +924,8 @@ class PackageInfo(object):
       for line in output:
         logging.info(line)
 
-      args = ['portageq-%s' % self.board, 'envvar', 'PORTAGE_TMPDIR']
-      result = cros_build_lib.RunCommand(args, print_cmd=debug,
-                                         redirect_stdout=True)
-      tmpdir = result.output.splitlines()[0]
+      portageq = portage_utilities.GetPortageq(board=self.board)
+      tmpdir = portageq.EnvVar('PORTAGE_TMPDIR')
       # tmpdir gets something like /build/daisy/tmp/
       workdir = os.path.join(tmpdir, 'portage', self.fullnamerev, 'work')
 
@@ -542,11 +939,12 @@ class PackageInfo(object):
     # In the case of libatomic_ops, it's actually required to look deep
     # to find the MIT license:
     # dev-libs/libatomic_ops-7.2d/work/gc-7.2/libatomic_ops/doc/LICENSING.txt
-    args = ['find', workdir, '-type', 'f']
-    result = cros_build_lib.RunCommand(args, print_cmd=debug,
-                                       redirect_stdout=True).output.splitlines()
-    # Truncate results to look like this: swig-2.0.4/COPYRIGHT
-    files = [x[len(workdir):].lstrip('/') for x in result]
+    files = []
+    for root, dirs, filenames in os.walk(workdir):
+      # Don't bother descending into git metadata, we skip it below anyway.
+      dirs[:] = [d for d in dirs if d != '.git']
+      reldir = root[len(workdir):].lstrip('/')
+      files.extend(os.path.join(reldir, x) for x in filenames)
     license_files = []
     for name in files:
       # When we scan a source tree managed by git, this can contain license
@@ -673,8 +1071,11 @@ being scraped currently).""",
       self.skip = True
       return
 
-  def _FindEbuildPath(self):
+  def FindEbuildPath(self):
     """Populate package info from an ebuild retrieved via equery."""
+    if self.ebuild_path:
+      return
+
     # By default, equery returns the latest version of the package. A
     # build may have used an older version than what is currently
     # available in the source tree (a build dependency can be pinned
@@ -753,7 +1154,7 @@ being scraped currently).""",
       self.homepages = self._BuildInfo("HOMEPAGE").split()
       self.ebuild_license_names = self._BuildInfo("LICENSE").split()
     else:
-      self._FindEbuildPath()
+      self.FindEbuildPath()
       self._ReadEbuildMetadata()
       self.skip = self.skip or not self._TestEbuildContents()
       if self.skip:
@@ -890,7 +1291,8 @@ being scraped currently).""",
 class Licensing(object):
   """Do the actual work of extracting licensing info and outputting html."""
 
-  def __init__(self, board, package_fullnames, gen_licenses):
+  def __init__(self, board, package_fullnames, gen_licenses, jobs=None,
+               scan_cache_dir=None):
     # eg x86-alex
     self.board = board
     # List of stock and custom licenses referenced in ebuilds. Used to
@@ -910,6 +1312,10 @@ class Licensing(object):
     self.package_text = {}
     self.entry_template = None
 
+    # Shared licenses whose text is identical to another one we already
+    # output: alias license name -> name of the license actually output.
+    self.license_aliases = {}
+
     # We need to have a dict for the list of packages objects, index by package
     # fullnamerev, so that when we scan our licenses at the end, and find out
     # some shared licenses are only used by one package, we can access that
@@ -917,6 +1323,15 @@ class Licensing(object):
     self.packages = {}
     self._package_fullnames = package_fullnames
 
+    # Number of packages to scan in parallel (None lets the pool decide).
+    self.jobs = jobs
+
+    # Packages whose ebuild, sources and license overrides have not changed
+    # since the last scan reuse the result stored here (None disables this).
+    self._scan_cache = None
+    if scan_cache_dir:
+      self._scan_cache = cache.DiskCache(scan_cache_dir)
+
   @property
   def sorted_licenses(self):
     return sorted(self.licenses.keys(), key=str.lower)
@@ -980,6 +1395,7 @@ class Licensing(object):
 
     Do not call this after adding virtual packages with AddExtraPkg.
     """
+    todo = []
     for package_name in self.packages:
       pkg = self.packages[package_name]
       if pkg.skip:
@@ -1002,13 +1418,14 @@ class Licensing(object):
         logging.warning(">>> License for %s is missing, creating now <<<",
                         package_name)
       if not os.path.exists(pkg.license_dump_path) or self.gen_licenses:
-        if not pkg.skip:
-          try:
-            pkg.GetLicenses()
-          except PackageLicenseError:
-            pkg.licensing_failed = True
-        # We dump packages where licensing failed too.
-        self._SaveLicenseDump(pkg)
+        todo.append([package_name])
+
+    # Scanning a package means unpacking its source and walking it, which is
+    # mostly I/O and subprocess bound, so spread packages over a pool. Each
+    # worker writes its own license dump which we read back below.
+    if todo:
+      parallel.RunTasksInProcessPool(self._ProcessPackage, todo,
+                                     processes=self.jobs)
 
     # To debug the code, we force the data to be re-read from the dumps
     # instead of reusing what we may have in memory.
@@ -1025,6 +1442,55 @@ class Licensing(object):
         logging.info("Package %s failed licensing", pkg.fullnamerev)
         self.incomplete_packages += [pkg.fullnamerev]
 
+  def _ProcessPackage(self, package_name):
+    """Gather the licenses for one package and save its license dump.
+
+    This runs in a worker process of ProcessPackageLicenses.
+
+    Args:
+      package_name: key of the package in self.packages.
+    """
+    pkg = self.packages[package_name]
+    if pkg.skip:
+      # We dump skipped packages too, with incomplete info.
+      self._SaveLicenseDump(pkg)
+      return
+
+    ref = None
+    # Live (cros-workon 9999) ebuilds build whatever is checked out locally,
+    # so their ebuild says nothing about the source and they can't be cached.
+    if self._scan_cache and pkg.version != '9999':
+      # The digest needs the ebuild path, which GetLicenses would look up
+      # anyway; getting it here is cheap next to unpacking the source.
+      pkg.FindEbuildPath()
+      digest = pkg.GetScanDigest()
+      ref = self._scan_cache.Lookup((digest,))
+      if ref.Exists():
+        logging.info("Reusing cached license scan of %s (%s)",
+                     pkg.fullnamerev, digest)
+        self._RestoreLicenseDump(pkg, ref.path)
+        return
+
+    try:
+      pkg.GetLicenses()
+    except PackageLicenseError:
+      pkg.licensing_failed = True
+
+    # We dump packages where licensing failed too.
+    self._SaveLicenseDump(pkg)
+
+    # Failed scans are not cached so they get retried on the next run.
+    if ref is not None and not pkg.licensing_failed:
+      ref.AssignText(osutils.ReadFile(pkg.license_dump_path))
+
+  def _RestoreLicenseDump(self, pkg, cached_dump):
+    """Install a cached license dump as the license dump of |pkg|."""
+    save_file = pkg.license_dump_path
+    save_dir = os.path.dirname(save_file)
+    if not os.path.isdir(save_dir):
+      os.makedirs(save_dir, 0755)
+    osutils.WriteFile(save_file, osutils.ReadFile(cached_dump), atomic=True)
+
   def AddExtraPkg(self, pkg_data):
     """Allow adding pre-created virtual packages.
 
@@ -1048,16 +1514,9 @@ class Licensing(object):
   @staticmethod
   def FindLicenseType(license_name):
     """Says if a license is stock Gentoo, custom, or doesn't exist."""
-
-    for directory in STOCK_LICENSE_DIRS:
-      path = '%s/%s' % (directory, license_name)
-      if os.path.exists(path):
-        return "Gentoo Package Stock"
-
-    for directory in CUSTOM_LICENSE_DIRS:
-      path = '%s/%s' % (directory, license_name)
-      if os.path.exists(path):
-        return "Custom"
+    entry = _LICENSE_STORE.Lookup(license_name)
+    if entry is not None:
+      return entry[0]
 
     raise AssertionError("""
 license %s could not be found in %s
@@ -1080,22 +1539,14 @@ after fixing the license.""" %
   @staticmethod
   def ReadSharedLicense(license_name):
     """Read and return stock or cust license file specified in an ebuild."""
-
-    license_path = None
-    for directory in STOCK_LICENSE_DIRS + CUSTOM_LICENSE_DIRS:
-      path = os.path.join(directory, license_name)
-      if os.path.exists(path):
-        license_path = path
-        break
-
-    if license_path:
-      return ReadUnknownEncodedFile(license_path, "read license")
-    else:
+    license_txt = _LICENSE_STORE.ReadLicense(license_name)
+    if license_txt is None:
       raise AssertionError("license %s could not be found in %s"
                            % (license_name,
                               '\n'.join(STOCK_LICENSE_DIRS +
                                         CUSTOM_LICENSE_DIRS))
                           )
+    return license_txt
 
   @staticmethod
   def EvaluateTemplate(template, env):
@@ -1123,13 +1574,19 @@ after fixing the license.""" %
       license_text.append('%s\n' % ('-=' * 40))
 
     license_pointers = []
+    seen = set()
     # sln: shared license name.
     for sln in pkg.license_names:
+      # Identical licenses are only output once, so point at that one.
+      target = self.license_aliases.get(sln, sln)
+      if target in seen:
+        continue
+      seen.add(target)
       # Says whether it's a stock gentoo or custom license.
       license_type = self.FindLicenseType(sln)
       license_pointers.append(
           "<li><a href='#%s'>%s License %s</a></li>" % (
-              sln, license_type, sln))
+              target, license_type, sln))
 
     # This should get caught earlier, but one extra check.
     if not license_text + license_pointers:
@@ -1143,6 +1600,28 @@ after fixing the license.""" %
     }
     self.package_text[pkg] = self.EvaluateTemplate(self.entry_template, env)
 
+  def _MergeIdenticalLicenses(self):
+    """Fold shared licenses with identical text into the first one by name.
+
+    Packages using a folded license get listed under the license we keep, and
+    self.license_aliases records where the folded names point to.
+    """
+    kept = {}
+    for sln in self.sorted_licenses:
+      digest = _LICENSE_STORE.GetDigest(sln)
+      if digest is None:
+        # Let the output code complain about the missing license.
+        continue
+      target = kept.setdefault(digest, sln)
+      if target == sln:
+        continue
+      logging.info("License %s has the same text as %s, merging them",
+                   sln, target)
+      self.license_aliases[sln] = target
+      for pkg_fullnamerev in self.licenses.pop(sln):
+        if pkg_fullnamerev not in self.licenses[target]:
+          self.licenses[target].append(pkg_fullnamerev)
+
   def GenerateHTMLLicenseOutput(self, output_file,
                                 output_template=TMPL,
                                 entry_template=ENTRY_TMPL,
@@ -1165,6 +1644,10 @@ after fixing the license.""" %
       for sln in pkg.license_names:
         self.licenses.setdefault(sln, []).append(pkg.fullnamerev)
 
+    # Different license names can have the very same text (e.g. a custom
+    # copy of a stock license); only output such text once.
+    self._MergeIdenticalLicenses()
+
     # Find licenses only used once, and roll them in the package that uses them.
     # We use keys() because licenses is modified in the loop, so we can't use
     # an iterator.
@@ -1179,7 +1662,10 @@ after fixing the license.""" %
                                                    license_txt)
         pkg = self.packages[pkg_fullnamerev]
         pkg.license_text_scanned.append(single_license)
-        pkg.license_names.remove(sln)
+        # The package may only reference an alias of this license.
+        for name in list(pkg.license_names):
+          if self.license_aliases.get(name, name) == sln:
+            pkg.license_names.remove(name)
         del self.licenses[sln]
 
     for pkg in sorted(self.packages.values(),
@@ -1369,7 +1855,12 @@ def NonHookMain(opts):
                          board)
   logging.debug("Initial Package list to work through:\n%s",
                 '\n'.join(sorted(packages)))
-  licensing = Licensing(board, packages, gen_licenses)
+  scan_cache_dir = None
+  if opts.scan_cache:
+    scan_cache_dir = os.path.join(commandline.GetCacheDir(),
+                                  constants.COMMON_CACHE, SCAN_CACHE_DIR)
+  licensing = Licensing(board, packages, gen_licenses, jobs=opts.jobs,
+                        scan_cache_dir=scan_cache_dir)
   licensing.LoadPackageInfo(board)
   logging.debug("Package list to skip:\n%s",
                 '\n'.join([p for p in sorted(packages)
@@ -1429,6 +1920,13 @@ def main(args):
                       "license on stdout. Give $PORTAGE_BUILDDIR as argument.")
   parser.add_argument("-o", "--output", type="path",
                       help="which html file to create with output")
+  parser.add_argument("-j", "--jobs", type=int, default=None,
+                      help="number of packages to scan in parallel "
+                      "(default: one per cpu, at least 16)")
+  parser.add_argument("--no-scan-cache", action="store_false",
+                      dest="scan_cache", default=True,
+                      help="do not reuse license scans of unchanged packages "
+                      "from previous runs")
   opts = parser.parse_args(args)
   debug = opts.debug
   debug = True
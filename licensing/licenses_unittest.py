@@ -0,0 +1,414 @@
+#!/usr/bin/python
+# Copyright (c) 2014 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for the licenses.py module."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+from chromite.cbuildbot import portage_utilities
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from chromite.licensing import licenses
+
+# TODO(build): Finish test wrapper (http://crosbug.com/37517).
+# Until then, this has to be after the chromite imports.
+import mock
+
+
+# pylint: disable=W0212
+class GetLicenseTypesFromEbuildTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for GetLicenseTypesFromEbuild."""
+
+  def setUp(self):
+    self.overlays = (os.path.join(self.tempdir, 'overlay-a'),
+                     os.path.join(self.tempdir, 'overlay-b'))
+    self.PatchObject(licenses, '_EbuildOverlays', return_value=self.overlays)
+    self.real_bash = licenses._GetEbuildLicenseWithBash
+    self.bash = self.PatchObject(licenses, '_GetEbuildLicenseWithBash',
+                                 side_effect=self.real_bash)
+    licenses._EBUILD_OPS_CACHE.clear()
+    licenses._EBUILD_BASH_CACHE.clear()
+
+  def _WriteEbuild(self, content, name='foo-1.ebuild'):
+    path = os.path.join(self.tempdir, name)
+    osutils.WriteFile(path, content)
+    return path
+
+  def _WriteEclass(self, overlay, eclass, content):
+    osutils.WriteFile(os.path.join(self.overlays[overlay], 'eclass',
+                                   '%s.eclass' % eclass),
+                      content, makedirs=True)
+
+  def _Check(self, ebuild, expected, bash=False, compare_bash=True):
+    """Check both the fast path and the bash path give |expected|."""
+    self.bash.reset_mock()
+    self.assertEqual(licenses.GetLicenseTypesFromEbuild(ebuild), expected)
+    self.assertEqual(self.bash.called, bash)
+    if compare_bash:
+      self.assertEqual(self.real_bash(ebuild, self.overlays).split(), expected)
+
+  def testSimple(self):
+    """Plain LICENSE assignment."""
+    ebuild = self._WriteEbuild('EAPI=4\nLICENSE="GPL-2 BSD"\nSLOT=0\n')
+    self._Check(ebuild, ['GPL-2', 'BSD'])
+
+  def testOrAndMultiline(self):
+    """OR syntax and values spanning several lines."""
+    ebuild = self._WriteEbuild(
+        'LICENSE="|| ( LGPL-2.1\n'
+        '\tMPL-1.1 )" # comment\n'
+        'src_install() {\n'
+        '\tLICENSE="ignored"\n'
+        '\tdodoc LICENSE\n'
+        '}\n')
+    # Values spanning lines confuse the bash path, so don't compare.
+    self._Check(ebuild, ['||', '(', 'LGPL-2.1', 'MPL-1.1', ')'],
+                compare_bash=False)
+
+  def testInherit(self):
+    """Eclasses are followed in overlay order and only inherited once."""
+    self._WriteEclass(0, 'first', 'inherit second\nLICENSE+=" MIT"\n')
+    self._WriteEclass(1, 'first', 'LICENSE="wrong"\n')
+    self._WriteEclass(1, 'second', 'LICENSE=BSD\n')
+    ebuild = self._WriteEbuild('inherit first second missing\n')
+    self._Check(ebuild, ['BSD', 'MIT'])
+
+    # The ebuild overrides whatever the eclasses set.
+    ebuild = self._WriteEbuild('inherit first\nLICENSE=Apache-2.0\n')
+    self._Check(ebuild, ['Apache-2.0'])
+
+  def testEclassParsedOnce(self):
+    """Eclasses shared by many ebuilds are only read once."""
+    self._WriteEclass(0, 'common', 'LICENSE="GPL-2"\n')
+    read_file = self.PatchObject(osutils, 'ReadFile',
+                                 side_effect=osutils.ReadFile)
+    for i in range(3):
+      ebuild = self._WriteEbuild('inherit common\n', name='foo-%i.ebuild' % i)
+      self.assertEqual(licenses.GetLicenseTypesFromEbuild(ebuild), ['GPL-2'])
+    eclass_reads = [x for x in read_file.call_args_list
+                    if x == mock.call(os.path.join(
+                        self.overlays[0], 'eclass', 'common.eclass'))]
+    self.assertEqual(len(eclass_reads), 1)
+    self.assertFalse(self.bash.called)
+
+  def testFallback(self):
+    """Things we can't evaluate ourselves are handed to bash."""
+    self._WriteEclass(0, 'git', 'LICENSE="git-license"\n')
+    for content, expected in (
+        ('MY_LICENSE=GPL-3\nLICENSE="${MY_LICENSE}"\n', ['GPL-3']),
+        ('[[ 1 == 1 ]] && inherit git\n', ['git-license']),
+        ('if true; then\n\tLICENSE=MIT\nfi\n', ['MIT']),
+    ):
+      self._Check(self._WriteEbuild(content), expected, bash=True)
+
+  def testConditionals(self):
+    """Statements at column 0 inside conditionals are left to bash."""
+    self._WriteEclass(0, 'git-2', 'LICENSE="git-lic"\n')
+    for content in (
+        'if [[ ${PV} == 9999 ]]; then\ninherit git-2\nfi\nLICENSE+=" BSD"\n',
+        'LICENSE=BSD\nif [[ ${PV} == 9999 ]]; then\nLICENSE+=" git-lic"\nfi\n',
+        'case ${PV} in\n9999)\ninherit git-2\n;;\nesac\nLICENSE+=" BSD"\n',
+        '[[ ${PV} == 9999 ]] &&\ninherit git-2\nLICENSE+=" BSD"\n',
+        '[[ ${PV} == 9999 ]] && {\ninherit git-2\n}\nLICENSE+=" BSD"\n',
+    ):
+      self._Check(self._WriteEbuild(content), ['BSD'], bash=True)
+
+  def testUnrelatedConditionals(self):
+    """Conditionals not touching LICENSE or inherit keep the fast path."""
+    self._WriteEclass(0, 'git-2', 'LICENSE="git-lic"\n')
+    ebuild = self._WriteEbuild(
+        'DESCRIPTION="Works if built; see fi.txt"\n'
+        'if [[ ${PV} == 9999 ]]; then\n'
+        'KEYWORDS="~*"\n'
+        'else\n'
+        'KEYWORDS="*"\n'
+        'fi\n'
+        'case ${ARCH} in\n'
+        'arm) IUSE="neon" ;;\n'
+        'esac\n'
+        'inherit git-2\n'
+        'LICENSE+=" BSD"\n')
+    self._Check(ebuild, ['git-lic', 'BSD'])
+
+  def testIncludeGuard(self):
+    """Eclasses wrapped in include-once guards keep the fast path."""
+    self._WriteEclass(0, 'eutils',
+                      'if [[ -z ${_EUTILS_ECLASS} ]]; then\n'
+                      '_EUTILS_ECLASS=1\n'
+                      '\n'
+                      'inherit multilib\n'
+                      'if [[ ${EAPI} == 2 ]]; then\n'
+                      'die "old EAPI"\n'
+                      'fi\n'
+                      'epatch() {\n'
+                      '\tLICENSE="ignored"\n'
+                      '}\n'
+                      '\n'
+                      'fi\n')
+    self._WriteEclass(0, 'multilib',
+                      'if [[ ${___ECLASS_ONCE_MULTILIB} != "recur -_+^+_- '
+                      'spank" ]] ; then\n'
+                      '___ECLASS_ONCE_MULTILIB="recur -_+^+_- spank"\n'
+                      'LICENSE+=" multilib-lic"\n'
+                      'fi # ___ECLASS_ONCE_MULTILIB\n')
+    ebuild = self._WriteEbuild('LICENSE=BSD\ninherit eutils multilib\n')
+    self._Check(ebuild, ['BSD', 'multilib-lic'])
+
+  def testIncludeGuardLookalike(self):
+    """Conditionals that look like guards but aren't are left to bash."""
+    self._WriteEclass(0, 'git-2', 'LICENSE="git-lic"\n')
+    ebuild = self._WriteEbuild('if [[ -z ${EGIT_COMMIT} ]]; then\n'
+                               'inherit git-2\n'
+                               'fi\n'
+                               'LICENSE+=" BSD"\n')
+    self._Check(ebuild, ['git-lic', 'BSD'], bash=True)
+
+  def testBashCached(self):
+    """Ebuilds are only sourced by bash again once they change."""
+    source = self.PatchObject(osutils, 'SourceEnvironment',
+                              side_effect=osutils.SourceEnvironment)
+    ebuild = self._WriteEbuild('MY_LICENSE=GPL-3\nLICENSE="${MY_LICENSE}"\n')
+    for _ in range(2):
+      self._Check(ebuild, ['GPL-3'], bash=True, compare_bash=False)
+    self.assertEqual(source.call_count, 1)
+
+    self._WriteEbuild('MY_LICENSE=MIT\nLICENSE="${MY_LICENSE}"\n')
+    self._Check(ebuild, ['MIT'], bash=True, compare_bash=False)
+    self.assertEqual(source.call_count, 2)
+
+  def testErrors(self):
+    """Missing or badly formatted LICENSE is rejected."""
+    ebuild = self._WriteEbuild('SLOT=0\n')
+    self.assertRaises(ValueError, licenses.GetLicenseTypesFromEbuild, ebuild)
+    ebuild = self._WriteEbuild('LICENSE="GPL-2,BSD"\n')
+    self.assertRaises(ValueError, licenses.GetLicenseTypesFromEbuild, ebuild)
+
+
+def _FakeGetLicenses(pkg, count_file):
+  """Stand-in for PackageInfo.GetLicenses that records each scan."""
+  osutils.WriteFile(count_file, '%s\n' % pkg.fullnamerev, mode='a')
+  pkg.ebuild_license_names = ['GPL-2']
+  pkg.license_names = set(['GPL-2'])
+  pkg.license_text_scanned = ['Copyright %s authors' % pkg.name]
+  if pkg.name == 'broken':
+    raise licenses.PackageLicenseError()
+
+
+class PackageTestBase(cros_test_lib.MockTempDirTestCase):
+  """Base class for tests working on a few fake packages."""
+
+  PACKAGES = ('dev-libs/foo-1', 'dev-libs/bar-2', 'sys-apps/baz-3-r1',
+              'sys-apps/broken-1', 'media-libs/qux-0.1', 'net-misc/quux-7')
+
+  def setUp(self):
+    self.overlay = os.path.join(self.tempdir, 'overlay')
+    self.sysroot = os.path.join(self.tempdir, 'sysroot')
+    self.count_file = os.path.join(self.tempdir, 'scans')
+    self.PatchObject(licenses, 'COPYRIGHT_ATTRIBUTION_DIR',
+                     os.path.join(self.tempdir, 'attribution'))
+    self.PatchObject(licenses.cros_build_lib, 'GetSysroot',
+                     side_effect=lambda board=None: self.sysroot)
+    # The scan cache won't create its dirs as root; we don't care here.
+    self.PatchObject(osutils, 'SafeMakedirsNonRoot',
+                     side_effect=osutils.SafeMakedirs)
+    count_file = self.count_file
+    self.PatchObject(licenses.PackageInfo, 'GetLicenses', autospec=True,
+                     side_effect=lambda pkg: _FakeGetLicenses(pkg, count_file))
+    for fullnamerev in self.PACKAGES:
+      osutils.WriteFile(self._EbuildPath(fullnamerev), 'LICENSE=GPL-2\n',
+                        makedirs=True)
+      osutils.WriteFile(self._ManifestPath(fullnamerev),
+                        'DIST %s.tar.gz 100\n' % fullnamerev)
+
+  def _EbuildPath(self, fullnamerev):
+    cpv = portage_utilities.SplitCPV(fullnamerev)
+    return os.path.join(self.overlay, cpv.category, cpv.package,
+                        '%s.ebuild' % cpv.pv)
+
+  def _ManifestPath(self, fullnamerev):
+    return os.path.join(os.path.dirname(self._EbuildPath(fullnamerev)),
+                        'Manifest')
+
+  def _GetPackage(self, fullnamerev):
+    cpv = portage_utilities.SplitCPV(fullnamerev)
+    pkg = licenses.PackageInfo()
+    pkg.board = 'board'
+    pkg.category = cpv.category
+    pkg.name = cpv.package
+    pkg.version = cpv.version_no_rev
+    pkg.revision = cpv.rev[1:] if cpv.rev else None
+    pkg.ebuild_path = self._EbuildPath(fullnamerev)
+    return pkg
+
+  def _Process(self, jobs, scan_cache_dir=None):
+    """Scan all PACKAGES; return {fullnamerev: dump} and the scanned pkgs."""
+    osutils.SafeUnlink(self.count_file)
+    licensing = licenses.Licensing('board', [], True, jobs=jobs,
+                                   scan_cache_dir=scan_cache_dir)
+    for fullnamerev in self.PACKAGES:
+      licensing.packages[fullnamerev] = self._GetPackage(fullnamerev)
+    licensing.ProcessPackageLicenses()
+    dumps = dict((name, pkg.__dict__)
+                 for name, pkg in licensing.packages.iteritems())
+    scanned = []
+    if os.path.exists(self.count_file):
+      scanned = osutils.ReadFile(self.count_file).split()
+    return dumps, sorted(scanned), licensing.incomplete_packages
+
+
+class ProcessPackageLicensesTest(PackageTestBase):
+  """Tests for scanning packages in parallel and the scan cache."""
+
+  def testParallelMatchesSerial(self):
+    """Scanning over a pool gives the same results as scanning serially."""
+    serial = self._Process(jobs=1)
+    parallel = self._Process(jobs=len(self.PACKAGES))
+    self.assertEqual(serial, parallel)
+    self.assertEqual(serial[1], sorted(self.PACKAGES))
+    self.assertEqual(serial[2], ['sys-apps/broken-1'])
+    self.assertEqual(serial[0]['dev-libs/foo-1']['license_text_scanned'],
+                     ['Copyright foo authors'])
+
+  def testScanCache(self):
+    """Unchanged packages reuse the last scan, changed ones are rescanned."""
+    cache_dir = os.path.join(self.tempdir, 'cache')
+    first = self._Process(jobs=2, scan_cache_dir=cache_dir)
+    self.assertEqual(first[1], sorted(self.PACKAGES))
+
+    # Only the package that failed licensing is scanned again.
+    second = self._Process(jobs=2, scan_cache_dir=cache_dir)
+    self.assertEqual(second[1], ['sys-apps/broken-1'])
+    self.assertEqual(first[0], second[0])
+
+    osutils.WriteFile(self._ManifestPath('dev-libs/foo-1'),
+                      'DIST foo-1.tar.gz 200\n')
+    third = self._Process(jobs=2, scan_cache_dir=cache_dir)
+    self.assertEqual(third[1], ['dev-libs/foo-1', 'sys-apps/broken-1'])
+    self.assertEqual(first[0], third[0])
+
+
+class GetScanDigestTest(PackageTestBase):
+  """Tests for PackageInfo.GetScanDigest."""
+
+  def testDigestChanges(self):
+    """The digest follows the ebuild, its Manifest and license overrides."""
+    pkg = self._GetPackage('sys-apps/baz-3-r1')
+    other = self._GetPackage('dev-libs/foo-1')
+    digests = [pkg.GetScanDigest()]
+    self.assertEqual(digests[0], pkg.GetScanDigest())
+    self.assertNotEqual(digests[0], other.GetScanDigest())
+
+    osutils.WriteFile(pkg.ebuild_path, 'LICENSE=BSD\n')
+    digests.append(pkg.GetScanDigest())
+    osutils.WriteFile(self._ManifestPath('sys-apps/baz-3-r1'),
+                      'DIST baz-3.tar.gz 200\n')
+    digests.append(pkg.GetScanDigest())
+    # Overrides are looked for from the most to the least specific name.
+    for name in ('baz', 'baz-3', 'baz-3-r1'):
+      osutils.WriteFile(os.path.join(licenses.COPYRIGHT_ATTRIBUTION_DIR,
+                                     'sys-apps', name),
+                        'Copyright baz', makedirs=True)
+      digests.append(pkg.GetScanDigest())
+    self.assertEqual(len(set(digests)), len(digests))
+
+    self.assertEqual(digests[-1], pkg.GetScanDigest())
+    pkg.ebuild_path = None
+    self.assertEqual(pkg.GetScanDigest(), None)
+
+
+class LicenseStoreTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for LicenseStore and the merging of identical licenses."""
+
+  def setUp(self):
+    self.stock_dir = os.path.join(self.tempdir, 'stock')
+    self.custom_dir = os.path.join(self.tempdir, 'custom')
+    for directory, name, text in (
+        (self.stock_dir, 'BSD', 'Redistribution is permitted.\n'),
+        (self.stock_dir, 'MIT', 'Permission is hereby granted.\n'),
+        (self.custom_dir, 'BSD', 'Shadowed by the stock license.\n'),
+        (self.custom_dir, 'BSD-Google', 'Redistribution is permitted.\n'),
+        (self.custom_dir, 'Google-TOS', 'Terms of service.\n')):
+      osutils.WriteFile(os.path.join(directory, name), text, makedirs=True)
+    self.store = licenses.LicenseStore(stock_dirs=[self.stock_dir],
+                                       custom_dirs=[self.custom_dir])
+    self.PatchObject(licenses, '_LICENSE_STORE', self.store)
+
+  def testLookup(self):
+    """Stock licenses shadow custom ones, unknown licenses give None."""
+    self.assertEqual(self.store.Lookup('BSD'),
+                     (licenses.LicenseStore.STOCK,
+                      os.path.join(self.stock_dir, 'BSD')))
+    self.assertEqual(self.store.Lookup('BSD-Google'),
+                     (licenses.LicenseStore.CUSTOM,
+                      os.path.join(self.custom_dir, 'BSD-Google')))
+    self.assertEqual(self.store.Lookup('GPL-2'), None)
+    self.assertEqual(self.store.ReadLicense('GPL-2'), None)
+    self.assertEqual(self.store.GetDigest('GPL-2'), None)
+
+  def testReadOnce(self):
+    """License texts are only read once."""
+    read = self.PatchObject(licenses, 'ReadUnknownEncodedFile',
+                            side_effect=licenses.ReadUnknownEncodedFile)
+    for _ in range(3):
+      self.assertEqual(self.store.ReadLicense('MIT'),
+                       'Permission is hereby granted.\n')
+    self.assertEqual(read.call_count, 1)
+
+  def testDigest(self):
+    """Only licenses with the same text have the same digest."""
+    self.assertEqual(self.store.GetDigest('BSD'),
+                     self.store.GetDigest('BSD-Google'))
+    self.assertNotEqual(self.store.GetDigest('BSD'),
+                        self.store.GetDigest('MIT'))
+
+  def _AddPackage(self, licensing, name, license_names):
+    pkg = licenses.PackageInfo()
+    pkg.category = 'dev-libs'
+    pkg.name = name
+    pkg.version = '1'
+    pkg.license_names = set(license_names)
+    licensing.packages[pkg.fullnamerev] = pkg
+    return pkg
+
+  def testMergeIdenticalLicenses(self):
+    """Identical licenses are output once, under the first name."""
+    licensing = licenses.Licensing('board', [], False)
+    self._AddPackage(licensing, 'a', ['BSD', 'MIT'])
+    self._AddPackage(licensing, 'b', ['BSD-Google', 'MIT'])
+    self._AddPackage(licensing, 'c', ['BSD', 'BSD-Google'])
+    self._AddPackage(licensing, 'd', ['Google-TOS'])
+    output = os.path.join(self.tempdir, 'credits.html')
+    tmpl_dir = os.path.dirname(os.path.abspath(licenses.__file__))
+    licensing.GenerateHTMLLicenseOutput(
+        output,
+        output_template=os.path.join(tmpl_dir, licenses.TMPL),
+        entry_template=os.path.join(tmpl_dir, licenses.ENTRY_TMPL),
+        license_template=os.path.join(tmpl_dir, licenses.SHARED_LICENSE_TMPL))
+
+    self.assertEqual(licensing.license_aliases, {'BSD-Google': 'BSD'})
+    self.assertEqual(sorted(licensing.licenses), ['BSD', 'MIT'])
+    self.assertEqual(sorted(licensing.licenses['BSD']),
+                     ['dev-libs/a-1', 'dev-libs/b-1', 'dev-libs/c-1'])
+
+    # Packages using the alias point at the license that is output, and a
+    # package using both names only points at it once.
+    text = licensing.package_text[licensing.packages['dev-libs/b-1']]
+    self.assertIn("<a href='#BSD'>Custom License BSD-Google</a>", text)
+    text = licensing.package_text[licensing.packages['dev-libs/c-1']]
+    self.assertEqual(text.count("href='#BSD'"), 1)
+
+    html = osutils.ReadFile(output)
+    self.assertEqual(html.count('Redistribution is permitted.'), 1)
+    self.assertNotIn('Shadowed by the stock license.', html)
+    # Licenses used by a single package are still rolled into the package.
+    self.assertNotIn("href='#Google-TOS'", html)
+    self.assertIn('Terms of service.', html)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -29,6 +29,7 @@ from chromite.cbuildbot import cbuildbot_run
 from chromite.cbuildbot import constants
 from chromite.cbuildbot import failures_lib
 from chromite.cbuildbot import manifest_version
+from chromite.cbuildbot import portage_utilities
 from chromite.cbuildbot import remote_try
 from chromite.cbuildbot import repository
 from chromite.cbuildbot import results_lib
@@ -49,6 +50,7 @@ from chromite.cbuildbot.stages import test_stages
 
 
 from chromite.lib import cgroups
+from chromite.lib import cidb
 from chromite.lib import cleanup
 from chromite.lib import commandline
 from chromite.lib import cros_build_lib
@@ -421,6 +423,9 @@ class Builder(object):
 Exception thrown, but all stages marked successful. This is an internal error,
 because the stage that threw the exception should be marked as failing."""
 
+      # Don't leave portage query servers behind to keep the chroot busy.
+      portage_utilities.ShutdownPortageqServers(self._run.options.buildroot)
+
     return success
 
 
@@ -915,6 +920,9 @@ def _RunBuildStagesWrapper(options, build_config):
   # to the start of the script (e.g. in or after _PostParseCheck).
   options.Freeze()
 
+  if options.cidb_creds:
+    cidb.ConnectCIDB(options.cidb_creds)
+
   with parallel.Manager() as manager:
     builder_run = cbuildbot_run.BuilderRun(options, build_config, manager)
     if metadata_dump_dict:
@@ -1300,6 +1308,9 @@ def _CreateParser():
   group.add_remote_option('--archive-base', type='gs_path',
                           help=('Base GS URL (gs://<bucket_name>/<path>) to '
                                 'upload archive artifacts to'))
+  group.add_option('--cidb-creds', type='path', default=None,
+                   help=('Path to the credentials of the CIDB instance to '
+                         'record this build in.'))
   group.add_remote_option(
       '--cq-gerrit-query', dest='cq_gerrit_override', default=None,
       help=('If given, this gerrit query will be used to find what patches to '
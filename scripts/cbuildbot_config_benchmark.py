@@ -0,0 +1,51 @@
+# Copyright (c) 2014 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Time how long it takes to import the cbuildbot config."""
+
+import logging
+import sys
+
+from chromite.cbuildbot import constants
+from chromite.lib import commandline
+from chromite.lib import cros_build_lib
+
+
+# Run in a fresh interpreter each time so nothing is cached between runs.
+_IMPORT_SNIPPET = """
+import time
+start = time.time()
+from chromite.cbuildbot import cbuildbot_config
+print time.time() - start
+"""
+
+
+def TimeImport():
+  """Import cbuildbot_config in a new python and return the seconds taken."""
+  result = cros_build_lib.RunCommand(
+      [sys.executable, '-c', _IMPORT_SNIPPET], cwd=constants.SOURCE_ROOT,
+      redirect_stdout=True, debug_level=logging.DEBUG)
+  return float(result.output)
+
+
+def GetParser():
+  """Creates the argparse parser."""
+  parser = commandline.ArgumentParser(description=__doc__)
+  parser.add_argument('-n', '--runs', type=int, default=10,
+                      help='How many times to import the config.')
+  return parser
+
+
+def main(argv):
+  parser = GetParser()
+  options = parser.parse_args(argv)
+  if options.runs < 1:
+    parser.error('--runs must be at least 1')
+
+  times = sorted(TimeImport() for _ in xrange(options.runs))
+  print 'runs: %d' % len(times)
+  print 'min:  %.3fs' % times[0]
+  print 'med:  %.3fs' % times[len(times) / 2]
+  print 'max:  %.3fs' % times[-1]
+  return 0
@@ -20,18 +20,52 @@ from chromite.lib import commandline
 from chromite.lib import stats
 
 
-def GetOptions(my_commands):
-  """Returns the argparse to use for Cros."""
+def _FindSubCommand(argv, my_commands):
+  """Returns the name of the subcommand given in |argv| (if any).
+
+  The subcommand is the first positional argument, so skip over the global
+  options (and their values) in front of it.
+  """
+  # pylint: disable=W0212
+  global_options = GetOptions({})._option_string_actions
+  args = iter(argv)
+  for arg in args:
+    if arg == '--':
+      arg = next(args, None)
+    elif arg.startswith('-'):
+      # Skip the values of options like --cache-dir.
+      action = global_options.get(arg)
+      if action is not None and action.nargs is None:
+        next(args, None)
+      continue
+    return arg if arg in my_commands else None
+  return None
+
+
+def GetOptions(my_commands, subcommand=None):
+  """Returns the argparse to use for Cros.
+
+  Args:
+    my_commands: The index of available commands (see
+      commands.GetCommandIndex).
+    subcommand: The name of the command being run.  Only this command gets
+      imported & has its options set up; the rest are just listed.
+  """
   parser = commandline.ArgumentParser(caching=True)
-  if not commands:
+  if not my_commands:
     return parser
 
   subparsers = parser.add_subparsers(title='cros commands')
-  for cmd_name, class_def in sorted(my_commands.iteritems(), key=lambda x:x[0]):
+  for cmd_name, cmd_info in sorted(my_commands.iteritems(), key=lambda x:x[0]):
+    if cmd_name != subcommand:
+      subparsers.add_parser(cmd_name, help=cmd_info['help'])
+      continue
+
+    class_def = commands.GetCommand(cmd_name)
     epilog = getattr(class_def, 'EPILOG', None)
     sub_parser = subparsers.add_parser(
-        cmd_name, description=class_def.__doc__, epilog=epilog,
-        caching=class_def.use_caching_options,
+        cmd_name, help=cmd_info['help'], description=class_def.__doc__,
+        epilog=epilog, caching=class_def.use_caching_options,
         formatter_class=commandline.argparse.RawDescriptionHelpFormatter)
     class_def.AddParser(sub_parser)
 
@@ -44,7 +78,8 @@ def _RunSubCommand(subcommand):
 
 
 def main(argv):
-  parser = GetOptions(commands.ListCommands())
+  my_commands = commands.GetCommandIndex()
+  parser = GetOptions(my_commands, _FindSubCommand(argv, my_commands))
   # Cros currently does nothing without a subcmd. Print help if no args are
   # specified.
   if not argv:
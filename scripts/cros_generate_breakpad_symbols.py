@@ -21,8 +21,13 @@ import ctypes
 import logging
 import multiprocessing
 import os
+import shutil
+import struct
 import tempfile
+import time
 
+from chromite.cbuildbot import constants
+from chromite.lib import cache
 from chromite.lib import commandline
 from chromite.lib import cros_build_lib
 from chromite.lib import osutils
@@ -33,6 +38,195 @@ from chromite.lib import signals
 SymbolHeader = collections.namedtuple('SymbolHeader',
                                       ('cpu', 'id', 'name', 'os',))
 
+# Where the symbol cache lives, relative to the common cache dir.
+SYMBOL_CACHE_DIR = 'breakpad_symbols'
+
+# Cached symbols that haven't been used in this long (in seconds) are pruned.
+SYMBOL_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# ELF constants needed to find the build-id note.
+_ELF_MAGIC = '\x7fELF'
+_ELFCLASS64 = 2
+_ELFDATA2MSB = 2
+_SHT_NOTE = 7
+_NT_GNU_BUILD_ID = 3
+
+
+def ReadBuildId(elf_file):
+  """Read the GNU build-id note out of an ELF (or split debug) file.
+
+  Args:
+    elf_file: The ELF file to read.
+
+  Returns:
+    The build-id as a hex string, or None if the file is not a readable ELF
+    or has no build-id.
+  """
+  try:
+    with open(elf_file, 'rb') as f:
+      ident = f.read(16)
+      if len(ident) != 16 or ident[:4] != _ELF_MAGIC:
+        return None
+      endian = '>' if ord(ident[5]) == _ELFDATA2MSB else '<'
+      if ord(ident[4]) == _ELFCLASS64:
+        # e_shoff, e_shentsize, e_shnum from the ELF64 header.
+        f.seek(0x28)
+        shoff, = struct.unpack(endian + 'Q', f.read(8))
+        f.seek(0x3a)
+        shentsize, shnum = struct.unpack(endian + 'HH', f.read(4))
+        # sh_type, sh_offset, sh_size within a section header.
+        sh_fmt = (endian + 'I', 0x4, endian + 'QQ', 0x18)
+      else:
+        f.seek(0x20)
+        shoff, = struct.unpack(endian + 'I', f.read(4))
+        f.seek(0x2e)
+        shentsize, shnum = struct.unpack(endian + 'HH', f.read(4))
+        sh_fmt = (endian + 'I', 0x4, endian + 'II', 0x10)
+
+      for i in xrange(shnum):
+        f.seek(shoff + i * shentsize + sh_fmt[1])
+        sh_type, = struct.unpack(sh_fmt[0], f.read(4))
+        if sh_type != _SHT_NOTE:
+          continue
+        f.seek(shoff + i * shentsize + sh_fmt[3])
+        offset, size = struct.unpack(sh_fmt[2],
+                                     f.read(struct.calcsize(sh_fmt[2])))
+        f.seek(offset)
+        notes = f.read(size)
+        # Walk the notes: namesz, descsz, type, then 4-byte aligned name/desc.
+        pos = 0
+        while pos + 12 <= len(notes):
+          namesz, descsz, ntype = struct.unpack(endian + 'III',
+                                                notes[pos:pos + 12])
+          pos += 12
+          name = notes[pos:pos + namesz]
+          pos += (namesz + 3) & ~3
+          desc = notes[pos:pos + descsz]
+          pos += (descsz + 3) & ~3
+          if ntype == _NT_GNU_BUILD_ID and name.rstrip('\0') == 'GNU':
+            return desc.encode('hex')
+  except (IOError, struct.error):
+    pass
+  return None
+
+
+class SymbolCache(object):
+  """Cache of generated symbol files keyed by ELF build-id and name.
+
+  Most binaries don't change between consecutive builds of a board, so
+  rather than running dump_syms on them again, we reuse the .sym file that
+  was generated the last time we saw the same build-id.  The MODULE line of
+  a .sym file names the ELF it was generated from, so identical ELFs that
+  are installed under different names (e.g. hardlinks) are cached apart.
+  Only symbols dumped the normal way are cached, and symbols dumped without
+  a debug file are kept apart from the full ones.  The hit/miss counters are
+  shared with the background processes doing the work.
+  """
+
+  _SYM_FILE = 'symbols.sym'
+  _ELAPSED_FILE = 'elapsed'
+
+  def __init__(self, cache_dir):
+    self._cache_dir = cache_dir
+    self._cache = cache.DiskCache(cache_dir)
+    self.hits = multiprocessing.Value('i')
+    self.misses = multiprocessing.Value('i')
+    # Time it took to generate the symbols we got from the cache instead.
+    self.time_saved = multiprocessing.Value('d')
+
+  @staticmethod
+  def _Key(build_id, elf_file, strip_cfi, debug):
+    mode = ('debug' if debug else 'nodebug') + ('-nocfi' if strip_cfi else '')
+    return (build_id, mode, os.path.basename(elf_file))
+
+  def Restore(self, build_id, elf_file, strip_cfi, debug, breakpad_dir):
+    """Install the cached symbols for |build_id| into |breakpad_dir|.
+
+    Args:
+      build_id: The build-id of the ELF we want symbols for.
+      elf_file: The ELF we want symbols for.
+      strip_cfi: Whether we want symbols without CFI data.
+      debug: Whether we want symbols dumped with a debug file.
+      breakpad_dir: The dir to store the output symbol file in.
+
+    Returns:
+      The path of the installed symbol file, or None on a cache miss.
+    """
+    key = self._Key(build_id, elf_file, strip_cfi, debug)
+    with self._cache.Lookup(key) as ref:
+      if not ref.Exists(lock=True):
+        with self.misses.get_lock():
+          self.misses.value += 1
+        return None
+
+      cached_sym = os.path.join(ref.path, self._SYM_FILE)
+      header = ReadSymsHeader(cached_sym)
+      sym_file = os.path.join(breakpad_dir, header.name, header.id,
+                              header.name + '.sym')
+      osutils.SafeMakedirs(os.path.dirname(sym_file))
+      shutil.copyfile(cached_sym, sym_file)
+      os.chmod(sym_file, 0o644)
+      elapsed = float(osutils.ReadFile(os.path.join(ref.path,
+                                                    self._ELAPSED_FILE)))
+      # Note the use, so that Prune() keeps the entry around.
+      os.utime(ref.path, None)
+
+    with self.hits.get_lock():
+      self.hits.value += 1
+    with self.time_saved.get_lock():
+      self.time_saved.value += elapsed
+    return sym_file
+
+  def Insert(self, build_id, elf_file, strip_cfi, debug, sym_file, elapsed):
+    """Store |sym_file| as the symbols for |build_id|.
+
+    Args:
+      build_id: The build-id of the ELF the symbols were generated for.
+      elf_file: The ELF the symbols were generated for.
+      strip_cfi: Whether the symbols were generated without CFI data.
+      debug: Whether the symbols were generated with a debug file.
+      sym_file: The generated symbol file.
+      elapsed: How long (in seconds) it took to generate |sym_file|.
+    """
+    key = self._Key(build_id, elf_file, strip_cfi, debug)
+    with self._cache.Lookup(key) as ref:
+      with osutils.TempDir(base_dir=self._cache.staging_dir) as tempdir:
+        entry = os.path.join(tempdir, 'entry')
+        os.mkdir(entry)
+        shutil.copyfile(sym_file, os.path.join(entry, self._SYM_FILE))
+        osutils.WriteFile(os.path.join(entry, self._ELAPSED_FILE),
+                          '%f' % elapsed)
+        ref.SetDefault(entry)
+
+  def Prune(self, max_age=SYMBOL_CACHE_MAX_AGE):
+    """Remove the symbols that haven't been used in |max_age| seconds."""
+    cutoff = time.time() - max_age
+    pruned = 0
+    for name in os.listdir(self._cache_dir):
+      path = os.path.join(self._cache_dir, name)
+      if path == self._cache.staging_dir or not os.path.isdir(path):
+        continue
+      if os.path.getmtime(path) >= cutoff:
+        continue
+      # The entry is stored under its name joined from the parts of its key,
+      # so a key of just that name refers to (and locks) the same entry.
+      with self._cache.Lookup((name,)) as ref:
+        ref.Remove(ref.key)
+      pruned += 1
+    if pruned:
+      cros_build_lib.Info('symbol cache: pruned %i unused entries', pruned)
+
+  def Report(self):
+    """Log how well the cache did."""
+    total = self.hits.value + self.misses.value
+    if not total:
+      return
+    cros_build_lib.Info(
+        'symbol cache: %i hits, %i misses (%.1f%% hit rate); '
+        'saved about %.1f seconds of dump_syms time',
+        self.hits.value, self.misses.value, 100.0 * self.hits.value / total,
+        self.time_saved.value)
+
 
 def ReadSymsHeader(sym_file):
   """Parse the header of the symbol file
@@ -61,7 +255,8 @@ def ReadSymsHeader(sym_file):
 
 
 def GenerateBreakpadSymbol(elf_file, debug_file=None, breakpad_dir=None,
-                           board=None, strip_cfi=False, num_errors=None):
+                           board=None, strip_cfi=False, num_errors=None,
+                           symbol_cache=None):
   """Generate the symbols for |elf_file| using |debug_file|
 
   Args:
@@ -71,6 +266,7 @@ def GenerateBreakpadSymbol(elf_file, debug_file=None, breakpad_dir=None,
     board: If |breakpad_dir| is not specified, use |board| to find it
     strip_cfi: Do not generate CFI data
     num_errors: An object to update with the error count (needs a .value member)
+    symbol_cache: A SymbolCache to reuse previously generated symbols from
 
   Returns:
     The number of errors that were encountered.
@@ -80,6 +276,18 @@ def GenerateBreakpadSymbol(elf_file, debug_file=None, breakpad_dir=None,
   if num_errors is None:
     num_errors = ctypes.c_int()
 
+  build_id = None
+  if symbol_cache is not None:
+    build_id = ReadBuildId(elf_file)
+    if build_id is not None:
+      sym_file = symbol_cache.Restore(build_id, elf_file, strip_cfi,
+                                      bool(debug_file), breakpad_dir)
+      if sym_file is not None:
+        cros_build_lib.Info('Reused cached symbols for %s (build-id %s)',
+                            elf_file, build_id)
+        return num_errors.value
+  start_time = time.time()
+
   cmd_base = ['dump_syms']
   if strip_cfi:
     cmd_base += ['-c']
@@ -101,6 +309,10 @@ def GenerateBreakpadSymbol(elf_file, debug_file=None, breakpad_dir=None,
       cros_build_lib.Warning('dump_syms crashed with %s; %s',
                              signals.StrSignal(-ret), msg)
 
+  # Only cache symbols dumped the normal way: the fallbacks below lose data
+  # that a later run (or a fixed dump_syms) might be able to get.
+  clean_dump = True
+
   osutils.SafeMakedirs(breakpad_dir)
   with tempfile.NamedTemporaryFile(dir=breakpad_dir, bufsize=0) as temp:
     if debug_file:
@@ -109,6 +321,7 @@ def GenerateBreakpadSymbol(elf_file, debug_file=None, breakpad_dir=None,
       result = _DumpIt(cmd_args)
 
       if result.returncode:
+        clean_dump = False
         # Sometimes dump_syms can crash because there's too much info.
         # Try dumping and stripping the extended stuff out.  At least
         # this way we'll get the extended symbols.  http://crbug.com/266064
@@ -150,13 +363,18 @@ def GenerateBreakpadSymbol(elf_file, debug_file=None, breakpad_dir=None,
     os.chmod(sym_file, 0o644)
     temp.delete = False
 
+  if build_id is not None and clean_dump:
+    symbol_cache.Insert(build_id, elf_file, strip_cfi, bool(debug_file),
+                        sym_file, time.time() - start_time)
+
   return num_errors.value
 
 
 def GenerateBreakpadSymbols(board, breakpad_dir=None, strip_cfi=False,
                             generate_count=None, sysroot=None,
                             num_processes=None, clean_breakpad=False,
-                            exclude_dirs=(), file_list=None):
+                            exclude_dirs=(), file_list=None,
+                            symbol_cache_dir=None):
   """Generate symbols for this board.
 
   If |file_list| is None, symbols are generated for all executables, otherwise
@@ -179,6 +397,8 @@ def GenerateBreakpadSymbols(board, breakpad_dir=None, strip_cfi=False,
     file_list: Only generate symbols for files in this list. Each file must be a
       full path (including |sysroot| prefix).
       TODO(build): Support paths w/o |sysroot|.
+    symbol_cache_dir: If set, reuse symbols generated by earlier runs for
+      ELFs with the same build-id from this dir, and store new ones there.
 
   Returns:
     The number of errors that were encountered.
@@ -262,11 +482,16 @@ def GenerateBreakpadSymbols(board, breakpad_dir=None, strip_cfi=False,
       cros_build_lib.Error('Failed to find requested files: %s',
                            files_not_found)
 
+  symbol_cache = None
+  if symbol_cache_dir is not None:
+    symbol_cache = SymbolCache(symbol_cache_dir)
+
   # Now start generating symbols for the discovered elfs.
   with parallel.BackgroundTaskRunner(GenerateBreakpadSymbol,
                                      breakpad_dir=breakpad_dir, board=board,
                                      strip_cfi=strip_cfi,
                                      num_errors=bg_errors,
+                                     symbol_cache=symbol_cache,
                                      processes=num_processes) as queue:
     for _, elf_file, debug_file in sorted(targets, reverse=True):
       if generate_count == 0:
@@ -278,6 +503,10 @@ def GenerateBreakpadSymbols(board, breakpad_dir=None, strip_cfi=False,
         if generate_count == 0:
           break
 
+  if symbol_cache is not None:
+    symbol_cache.Prune()
+    symbol_cache.Report()
+
   return bg_errors.value
 
 
@@ -293,7 +522,7 @@ def FindBreakpadDir(board):
 
 
 def main(argv):
-  parser = commandline.ArgumentParser(description=__doc__)
+  parser = commandline.ArgumentParser(description=__doc__, caching=True)
 
   parser.add_argument('--board', default=None,
                       help='board to generate symbols for')
@@ -311,6 +540,10 @@ def main(argv):
                       help='limit number of parallel jobs')
   parser.add_argument('--strip_cfi', action='store_true', default=False,
                       help='do not generate CFI data (pass -c to dump_syms)')
+  parser.add_argument('--nosymbol-cache', dest='symbol_cache',
+                      action='store_false', default=True,
+                      help='do not reuse symbols of unchanged ELFs (by '
+                           'build-id) from previous runs')
   parser.add_argument('file_list', nargs='*', default=None,
                       help='generate symbols for only these files '
                            '(e.g. /build/$BOARD/usr/bin/foo)')
@@ -321,13 +554,19 @@ def main(argv):
   if opts.board is None:
     cros_build_lib.Die('--board is required')
 
+  symbol_cache_dir = None
+  if opts.symbol_cache:
+    symbol_cache_dir = os.path.join(opts.cache_dir, constants.COMMON_CACHE,
+                                    SYMBOL_CACHE_DIR)
+
   ret = GenerateBreakpadSymbols(opts.board, breakpad_dir=opts.breakpad_root,
                                 strip_cfi=opts.strip_cfi,
                                 generate_count=opts.generate_count,
                                 num_processes=opts.jobs,
                                 clean_breakpad=opts.clean,
                                 exclude_dirs=opts.exclude_dir,
-                                file_list=opts.file_list)
+                                file_list=opts.file_list,
+                                symbol_cache_dir=symbol_cache_dir)
   if ret:
     cros_build_lib.Error('encountered %i problem(s)', ret)
     # Since exit(status) gets masked, clamp it to 1 so we don't inadvertently
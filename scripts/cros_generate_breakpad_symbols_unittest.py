@@ -9,7 +9,9 @@ import ctypes
 import logging
 import os
 import StringIO
+import struct
 import sys
+import time
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                 '..', '..'))
@@ -334,6 +336,147 @@ class GenerateSymbolTest(cros_test_lib.MockTempDirTestCase):
     self.assertEqual(ret, 1)
     self.assertEqual(num_errors.value, 1)
 
+  def _DumpSymsCount(self):
+    """Number of times dump_syms was run"""
+    return len([x for x in self.rc_mock.call_args_list
+                if 'dump_syms' in x[0][0]])
+
+  def _GetSymbolCache(self):
+    """Return a SymbolCache in the tempdir"""
+    # The cache won't create its dirs as root; we don't care here.
+    self.PatchObject(osutils, 'SafeMakedirsNonRoot',
+                     side_effect=osutils.SafeMakedirs)
+    return cros_generate_breakpad_symbols.SymbolCache(
+        os.path.join(self.tempdir, 'cache'))
+
+  def testSymbolCache(self):
+    """Symbols for a known build-id are reused instead of regenerated"""
+    self.PatchObject(cros_generate_breakpad_symbols, 'ReadBuildId',
+                     return_value='0123abcd')
+    symbol_cache = self._GetSymbolCache()
+
+    ret = cros_generate_breakpad_symbols.GenerateBreakpadSymbol(
+        self.elf_file, breakpad_dir=self.breakpad_dir,
+        symbol_cache=symbol_cache)
+    self.assertEqual(ret, 0)
+    self.assertEqual(self._DumpSymsCount(), 1)
+    self.assertEqual(symbol_cache.misses.value, 1)
+
+    osutils.RmDir(self.breakpad_dir)
+    ret = cros_generate_breakpad_symbols.GenerateBreakpadSymbol(
+        self.elf_file, breakpad_dir=self.breakpad_dir,
+        symbol_cache=symbol_cache)
+    self.assertEqual(ret, 0)
+    self.assertEqual(self._DumpSymsCount(), 1)
+    self.assertExists(self.sym_file)
+    self.assertEqual(symbol_cache.hits.value, 1)
+
+    # Symbols without CFI are different, so they are cached separately.
+    ret = cros_generate_breakpad_symbols.GenerateBreakpadSymbol(
+        self.elf_file, breakpad_dir=self.breakpad_dir, strip_cfi=True,
+        symbol_cache=symbol_cache)
+    self.assertEqual(self._DumpSymsCount(), 2)
+    self.assertEqual(symbol_cache.misses.value, 2)
+
+  def testSymbolCacheLinks(self):
+    """Identical ELFs installed under different names are cached apart"""
+    self.PatchObject(cros_generate_breakpad_symbols, 'ReadBuildId',
+                     return_value='0123abcd')
+    symbol_cache = self._GetSymbolCache()
+    link_file = os.path.join(self.tempdir, 'link')
+    os.link(self.elf_file, link_file)
+    self.rc_mock.AddCmdResult(['dump_syms', link_file],
+                              output='MODULE OS CPU ID link')
+
+    for _ in range(2):
+      for elf_file in (self.elf_file, link_file):
+        cros_generate_breakpad_symbols.GenerateBreakpadSymbol(
+            elf_file, breakpad_dir=self.breakpad_dir,
+            symbol_cache=symbol_cache)
+    self.assertEqual(self._DumpSymsCount(), 2)
+    self.assertEqual(symbol_cache.misses.value, 2)
+    self.assertEqual(symbol_cache.hits.value, 2)
+
+    link_sym_file = os.path.join(self.breakpad_dir, 'link/ID/link.sym')
+    self.assertExists(self.sym_file)
+    self.assertExists(link_sym_file)
+    self.assertEqual(
+        cros_generate_breakpad_symbols.ReadSymsHeader(link_sym_file).name,
+        'link')
+
+  def testSymbolCacheNoBuildId(self):
+    """ELFs without a build-id are always regenerated"""
+    self.PatchObject(cros_generate_breakpad_symbols, 'ReadBuildId',
+                     return_value=None)
+    symbol_cache = self._GetSymbolCache()
+    for _ in range(2):
+      cros_generate_breakpad_symbols.GenerateBreakpadSymbol(
+          self.elf_file, breakpad_dir=self.breakpad_dir,
+          symbol_cache=symbol_cache)
+    self.assertEqual(self._DumpSymsCount(), 2)
+    self.assertEqual(symbol_cache.hits.value + symbol_cache.misses.value, 0)
+
+  def testSymbolCacheDebugFile(self):
+    """Symbols dumped without the debug file are not reused with it"""
+    self.PatchObject(cros_generate_breakpad_symbols, 'ReadBuildId',
+                     return_value='0123abcd')
+    symbol_cache = self._GetSymbolCache()
+
+    for debug_file in (None, self.debug_file, None, self.debug_file):
+      cros_generate_breakpad_symbols.GenerateBreakpadSymbol(
+          self.elf_file, debug_file, breakpad_dir=self.breakpad_dir,
+          symbol_cache=symbol_cache)
+    self.assertEqual(self._DumpSymsCount(), 2)
+    self.assertEqual(symbol_cache.misses.value, 2)
+    self.assertEqual(symbol_cache.hits.value, 2)
+
+  def testSymbolCacheFallback(self):
+    """Symbols from the fallback dumps are not cached"""
+    self.PatchObject(cros_generate_breakpad_symbols, 'ReadBuildId',
+                     return_value='0123abcd')
+    symbol_cache = self._GetSymbolCache()
+    self.rc_mock.AddCmdResult(['dump_syms', self.elf_file, self.debug_dir],
+                              returncode=1)
+
+    for _ in range(2):
+      cros_generate_breakpad_symbols.GenerateBreakpadSymbol(
+          self.elf_file, self.debug_file, breakpad_dir=self.breakpad_dir,
+          symbol_cache=symbol_cache)
+    self.assertEqual(self._DumpSymsCount(), 4)
+    self.assertEqual(symbol_cache.misses.value, 2)
+    self.assertEqual(symbol_cache.hits.value, 0)
+
+  def testSymbolCachePrune(self):
+    """Symbols that haven't been used in a while are pruned"""
+    build_id_mock = self.PatchObject(cros_generate_breakpad_symbols,
+                                     'ReadBuildId')
+    symbol_cache = self._GetSymbolCache()
+    for build_id in ('old', 'new'):
+      build_id_mock.return_value = build_id
+      cros_generate_breakpad_symbols.GenerateBreakpadSymbol(
+          self.elf_file, breakpad_dir=self.breakpad_dir,
+          symbol_cache=symbol_cache)
+
+    # Using the old symbols again should keep them around too.
+    cache_dir = os.path.join(self.tempdir, 'cache')
+    entries = [x for x in os.listdir(cache_dir)
+               if os.path.isdir(os.path.join(cache_dir, x)) and x != 'staging']
+    self.assertEqual(len(entries), 2)
+    old_time = time.time() - 2 * 24 * 60 * 60
+    for entry in entries:
+      os.utime(os.path.join(cache_dir, entry), (old_time, old_time))
+    build_id_mock.return_value = 'old'
+    cros_generate_breakpad_symbols.GenerateBreakpadSymbol(
+        self.elf_file, breakpad_dir=self.breakpad_dir,
+        symbol_cache=symbol_cache)
+    self.assertEqual(symbol_cache.hits.value, 1)
+
+    symbol_cache.Prune(max_age=24 * 60 * 60)
+    remaining = [x for x in entries
+                 if os.path.exists(os.path.join(cache_dir, x))]
+    self.assertEqual(len(remaining), 1)
+    self.assertTrue(remaining[0].startswith('old+'))
+
 
 class UtilsTestDir(cros_test_lib.TempDirTestCase):
   """Tests ReadSymsHeader."""
@@ -349,6 +492,41 @@ class UtilsTestDir(cros_test_lib.TempDirTestCase):
     self.assertEquals(result.os, 'Linux')
 
 
+class ReadBuildIdTest(cros_test_lib.TempDirTestCase):
+  """Tests ReadBuildId."""
+
+  @staticmethod
+  def _FakeElf64(notes):
+    """Return a minimal little endian ELF64 image with one SHT_NOTE section."""
+    shoff = 0x40
+    data_off = shoff + 0x40
+    header = '\x7fELF' + '\x02\x01\x01' + '\0' * 9
+    header += struct.pack('<HHIQQQIHHHHHH', 2, 62, 1, 0, 0, shoff, 0, 0x40,
+                          0, 0, 0x40, 1, 0)
+    section = struct.pack('<IIQQQQIIQQ', 0, 7, 0, 0, data_off, len(notes), 0,
+                          0, 4, 0)
+    return header + section + notes
+
+  def testBuildId(self):
+    """Find the GNU build-id note among other notes"""
+    other = struct.pack('<III', 4, 4, 1) + 'GNU\0' + 'abcd'
+    build_id = struct.pack('<III', 4, 3, 3) + 'GNU\0' + '\x12\x34\x56\0'
+    elf = os.path.join(self.tempdir, 'elf')
+    osutils.WriteFile(elf, self._FakeElf64(other + build_id))
+    self.assertEqual(cros_generate_breakpad_symbols.ReadBuildId(elf),
+                     '123456')
+
+  def testNoBuildId(self):
+    """Non-ELFs and ELFs without a build-id have no build-id"""
+    elf = os.path.join(self.tempdir, 'elf')
+    osutils.WriteFile(elf, self._FakeElf64(''))
+    self.assertEqual(cros_generate_breakpad_symbols.ReadBuildId(elf), None)
+    osutils.WriteFile(elf, 'not an elf')
+    self.assertEqual(cros_generate_breakpad_symbols.ReadBuildId(elf), None)
+    self.assertEqual(cros_generate_breakpad_symbols.ReadBuildId(
+        os.path.join(self.tempdir, 'missing')), None)
+
+
 class UtilsTest(cros_test_lib.TestCase):
   """Tests ReadSymsHeader."""
 
@@ -7,6 +7,7 @@
 
 import filecmp
 import fnmatch
+import functools
 import os
 import parallel_emerge
 import portage # pylint: disable=F0401
@@ -19,6 +20,7 @@ from chromite.lib import commandline
 from chromite.lib import cros_build_lib
 from chromite.lib import osutils
 from chromite.lib import operation
+from chromite.lib import parallel
 from chromite.lib import upgrade_table as utable
 from chromite.scripts import merge_package_status as mps
 
@@ -115,6 +117,10 @@ class Upgrader(object):
   PORTAGEQ_CMD = 'portageq'
   BOARD_CMDS = set([EQUERY_CMD, EMERGE_CMD, PORTAGEQ_CMD])
 
+  # Max number of boards to analyze at once in status report mode.  Each
+  # board builds its own portage dependency graph, so this is memory bound.
+  MAX_CONCURRENT_BOARDS = 8
+
   __slots__ = ['_amend',        # Boolean to use --amend with upgrade commit
                '_args',         # Commandline arguments (all portage targets)
                '_curr_arch',    # Architecture for current board run
@@ -143,6 +149,8 @@ class Upgrader(object):
                '_upgrade_cnt',  # Num pkg upgrades in this run (all boards)
                '_upgrade_deep', # Boolean indicating upgrade_deep requested
                '_upstream',     # Path to upstream portage repo
+               '_upstream_cache', # Dict of _FindUpstreamCPV results
+               '_upstream_index', # Set of category/package_name upstream
                '_unstable_ok',  # Boolean to allow unstable upstream also
                '_verbose',      # Boolean
                ]
@@ -170,6 +178,8 @@ class Upgrader(object):
     self._porttree = None
     self._emptydir = None
     self._deps_graph = None
+    self._upstream_cache = {}
+    self._upstream_index = None
 
     # Pre-compiled regexps for speed.
     self._missing_eclass_re = re.compile(r'(\S+\.eclass) could not be '
@@ -225,6 +235,28 @@ class Upgrader(object):
         if line:
           self._stable_repo_categories.add(line)
 
+  def _LoadUpstreamIndex(self):
+    """Load every category/package_name in |self._upstream| into set.
+
+    If |self._upstream| has no profiles/categories file the index is left
+    as None, and nothing is ruled out without asking equery.
+    """
+    self._upstream_index = None
+    cat_file_path = os.path.join(self._upstream, self.CATEGORIES_FILE)
+    if not os.path.exists(cat_file_path):
+      return
+
+    upstream_index = set()
+    with open(cat_file_path, 'r') as f:
+      for line in f:
+        cat = line.strip()
+        cat_dir = os.path.join(self._upstream, cat)
+        if cat and os.path.isdir(cat_dir):
+          for pn in os.listdir(cat_dir):
+            upstream_index.add('%s/%s' % (cat, pn))
+
+    self._upstream_index = upstream_index
+
   def _WriteStableRepoCategories(self):
     """Write |self._stable_repo_categories| to profiles/categories."""
 
@@ -436,8 +468,23 @@ class Upgrader(object):
     By default, only ebuilds stable on that arch will be accepted.  To
     accept unstable ebuilds, set |unstable_ok| to True.
 
+    Results are memoized in |self._upstream_cache|, so boards that share an
+    arch only ask equery once per package.  If |self._upstream_index| is
+    loaded, packages that are not in the upstream tree at all are ruled
+    out without asking equery.
+
     Returns upstream cpv, if found.
     """
+    cache_key = (self._curr_arch, unstable_ok, pkg)
+    if self._upstream_cache is not None and cache_key in self._upstream_cache:
+      return self._upstream_cache[cache_key]
+
+    if self._upstream_index is not None:
+      catpkg = Upgrader._GetCatPkgFromCpv(pkg) or pkg
+      if (re.match(r'^[\w+.-]+/[\w+.-]+$', catpkg) and
+          catpkg not in self._upstream_index):
+        return None
+
     envvars = self._GenPortageEnvvars(self._curr_arch, unstable_ok,
                                       portdir=self._upstream,
                                       portage_configroot=self._emptydir)
@@ -448,12 +495,15 @@ class Upgrader(object):
         equery, extra_env=envvars, print_cmd=self._verbose,
         error_code_ok=True, redirect_stdout=True, combine_stdout_stderr=True)
 
+    upstream_cpv = None
     if cmd_result.returncode == 0:
       ebuild_path = cmd_result.output.strip()
       (_overlay, cat, _pn, pv) = self._SplitEBuildPath(ebuild_path)
-      return os.path.join(cat, pv)
-    else:
-      return None
+      upstream_cpv = os.path.join(cat, pv)
+
+    if self._upstream_cache is not None:
+      self._upstream_cache[cache_key] = upstream_cpv
+    return upstream_cpv
 
   def _GetBoardCmd(self, cmd):
     """Return the board-specific version of |cmd|, if applicable."""
@@ -1696,6 +1746,11 @@ class Upgrader(object):
     Currently just lists all package dependencies in pre-order along with
     potential upgrades.
     """
+    self._AnalyzeBoard(board)
+    self._MergeCurrTable()
+
+  def _AnalyzeBoard(self, board):
+    """Does the work of RunBoard, leaving the results in |self._curr_table|."""
     # Preserve status report for entire stable repo (output of 'git status -s').
     self._SaveStatusOnStableRepo()
     # Read contents of profiles/categories for later checks
@@ -1755,7 +1810,8 @@ class Upgrader(object):
     finally:
       self._DropAnyStashedChanges()
 
-    # Merge tables together after each run.
+  def _MergeCurrTable(self):
+    """Merge |self._curr_table| into |self._master_table|."""
     self._master_cnt += 1
     self._master_archs.add(self._curr_arch)
     if self._master_table:
@@ -1765,6 +1821,54 @@ class Upgrader(object):
       self._master_table = self._curr_table
       self._master_table._arch = None
 
+  def _RunBoardsConcurrently(self, boards):
+    """Run the upgrader for all |boards| at once, in separate processes.
+
+    Only safe in status report mode with nothing staged in |self._stable_repo|,
+    as nothing is written anywhere.  Results from |self._FindUpstreamCPV| are
+    shared across the processes, and the board tables are merged in the order
+    of |boards| afterwards, exactly as a serial run would merge them.
+    """
+    def _RunBoard(board):
+      oper.Notice('Running with board %s.' % board)
+      self._AnalyzeBoard(board)
+      return (self._curr_arch, self._curr_table)
+
+    steps = [functools.partial(_RunBoard, board) for board in boards]
+    with parallel.Manager() as manager:
+      self._upstream_cache = manager.dict(self._upstream_cache)
+      try:
+        results = parallel.RunParallelSteps(
+            steps, max_parallel=self.MAX_CONCURRENT_BOARDS, return_values=True)
+      except parallel.BackgroundFailure as ex:
+        raise RuntimeError('Failed to run boards %s:\n%s' %
+                           (' '.join(boards), ex))
+      finally:
+        self._upstream_cache = dict(self._upstream_cache.items())
+
+    for arch, table in results:
+      self._curr_arch = arch
+      self._curr_table = table
+      self._MergeCurrTable()
+
+  def RunBoards(self, boards):
+    """Run the upgrader for each of |boards|, in order.
+
+    In status report mode boards are analyzed concurrently, unless there are
+    changes staged in |self._stable_repo| that RunBoard would have to stash.
+    """
+    self._LoadUpstreamIndex()
+
+    if len(boards) > 1 and not self._IsInUpgradeMode():
+      self._SaveStatusOnStableRepo()
+      if not self._AnyChangesStaged():
+        self._RunBoardsConcurrently(boards)
+        return
+
+    for board in boards:
+      oper.Notice('Running with board %s.' % board)
+      self.RunBoard(board)
+
   def WriteTableFiles(self, csv=None):
     """Write |self._master_table| to |csv| file, if requested."""
 
@@ -1959,10 +2063,7 @@ def main(argv):
   passed = True
   try:
     upgrader.PrepareToRun()
-
-    for board in boards:
-      oper.Notice('Running with board %s.' % board)
-      upgrader.RunBoard(board)
+    upgrader.RunBoards(boards)
   except RuntimeError as ex:
     passed = False
     oper.Error(str(ex))
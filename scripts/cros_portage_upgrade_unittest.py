@@ -2040,7 +2040,20 @@ class RunBoardTest(CpuTestBase):
 
     # Verify
     with self.OutputCapturer():
-      cpu.Upgrader.RunBoard(mocked_upgrader, board)
+      cpu.Upgrader._AnalyzeBoard(mocked_upgrader, board)
+    self.mox.VerifyAll()
+
+  def testRunBoard(self):
+    mocked_upgrader = self._MockUpgrader(cmdargs=['dev-libs/A'])
+    board = 'runboard_testboard'
+
+    # Replay script
+    mocked_upgrader._AnalyzeBoard(board)
+    mocked_upgrader._MergeCurrTable()
+    self.mox.ReplayAll()
+
+    # Verify
+    cpu.Upgrader.RunBoard(mocked_upgrader, board)
     self.mox.VerifyAll()
 
   def testRunBoard1(self):
@@ -2102,11 +2115,205 @@ class RunBoardTest(CpuTestBase):
     # Verify
     with self.OutputCapturer():
       self.assertRaises(RuntimeError,
-                        cpu.Upgrader.RunBoard,
+                        cpu.Upgrader._AnalyzeBoard,
                         mocked_upgrader, board)
     self.mox.VerifyAll()
 
 
+class RunBoardsTest(CpuTestBase):
+  """Test Upgrader.RunBoards and the upstream index it loads."""
+
+  def _TestRunBoards(self, boards, upgrade=False, staged_changes=False,
+                     concurrent=False):
+    """Test Upgrader.RunBoards."""
+    cmdargs = ['dev-libs/A']
+    if upgrade:
+      cmdargs = ['--upgrade'] + cmdargs
+    mocked_upgrader = self._MockUpgrader(cmdargs=cmdargs)
+
+    # Replay script
+    mocked_upgrader._LoadUpstreamIndex()
+    if len(boards) > 1:
+      upgrade_mode = cpu.Upgrader._IsInUpgradeMode(mocked_upgrader)
+      mocked_upgrader._IsInUpgradeMode().AndReturn(upgrade_mode)
+      if not upgrade_mode:
+        mocked_upgrader._SaveStatusOnStableRepo()
+        mocked_upgrader._AnyChangesStaged().AndReturn(staged_changes)
+
+    if concurrent:
+      mocked_upgrader._RunBoardsConcurrently(boards)
+    else:
+      for board in boards:
+        mocked_upgrader.RunBoard(board)
+    self.mox.ReplayAll()
+
+    # Verify
+    with self.OutputCapturer():
+      cpu.Upgrader.RunBoards(mocked_upgrader, boards)
+    self.mox.VerifyAll()
+
+  def testRunBoardsOneBoard(self):
+    self._TestRunBoards(['board1'])
+
+  def testRunBoardsStatusMode(self):
+    self._TestRunBoards(['board1', 'board2'], concurrent=True)
+
+  def testRunBoardsStatusModeStaged(self):
+    self._TestRunBoards(['board1', 'board2'], staged_changes=True)
+
+  def testRunBoardsUpgradeMode(self):
+    self._TestRunBoards(['board1', 'board2'], upgrade=True)
+
+  def testRunBoardsConcurrently(self):
+    """Board tables come back from the children and merge in board order."""
+    boards = ['board1', 'board2', 'board3']
+    archs = {'board1': 'x86', 'board2': 'arm', 'board3': 'amd64'}
+    mocked_upgrader = self._MockUpgrader(cmdargs=['dev-libs/A'],
+                                         _upstream_cache={'dev-libs/A': None})
+
+    def _AnalyzeBoard(board):
+      """Stand in for Upgrader._AnalyzeBoard, run in a child process."""
+      mocked_upgrader._curr_arch = archs[board]
+      mocked_upgrader._curr_table = utable.UpgradeTable(archs[board],
+                                                        name=board)
+      curr_table = mocked_upgrader._curr_table
+      curr_table.AppendRow({
+          curr_table.COL_PACKAGE: 'dev-libs/A',
+          curr_table.COL_SLOT: '0',
+          curr_table.COL_OVERLAY: 'overlay-%s' % board,
+          curr_table.COL_CURRENT_VER: '1',
+          curr_table.COL_STABLE_UPSTREAM_VER: '2',
+          curr_table.COL_LATEST_UPSTREAM_VER: '2',
+          curr_table.COL_STATE: utable.UpgradeTable.STATE_NEEDS_UPGRADE,
+          curr_table.COL_DEPENDS_ON: '',
+          curr_table.COL_USED_BY: '',
+          curr_table.COL_TARGET: 'virtual/target-os',
+      })
+      mocked_upgrader._upstream_cache['%s/B' % board] = archs[board]
+
+    merged = []
+    def _MergeCurrTable():
+      """Note each table as it is merged, then really merge it."""
+      curr_table = mocked_upgrader._curr_table
+      merged.append((curr_table.GetName(), curr_table.GetArch()))
+      cpu.Upgrader._MergeCurrTable(mocked_upgrader)
+
+    mocked_upgrader._AnalyzeBoard = _AnalyzeBoard
+    mocked_upgrader._MergeCurrTable = _MergeCurrTable
+    self.mox.ReplayAll()
+
+    # Verify
+    with self.OutputCapturer():
+      cpu.Upgrader._RunBoardsConcurrently(mocked_upgrader, boards)
+    self.mox.VerifyAll()
+
+    self.assertEquals(mocked_upgrader._upstream_cache,
+                      {'dev-libs/A': None, 'board1/B': 'x86',
+                       'board2/B': 'arm', 'board3/B': 'amd64'})
+    self.assertEquals(type(mocked_upgrader._upstream_cache), dict)
+    self.assertEquals(merged, [(board, archs[board]) for board in boards])
+    self.assertEquals(mocked_upgrader._master_cnt, 3)
+    self.assertEquals(mocked_upgrader._master_archs,
+                      set(['x86', 'arm', 'amd64']))
+
+    master_table = mocked_upgrader._master_table
+    self.assertEquals(master_table.GetArch(), None)
+    self.assertEquals(master_table.GetNumRows(), 1)
+    row = master_table.GetRowByIndex(0)
+    for arch in archs.values():
+      col = utable.UpgradeTable.GetColumnName(
+          utable.UpgradeTable.COL_CURRENT_VER, arch)
+      self.assertEquals(row[col], '1')
+    self.assertEquals(row[utable.UpgradeTable.COL_OVERLAY],
+                      'overlay-board1 AND overlay-board2 AND overlay-board3')
+
+  @osutils.TempDirDecorator
+  def testLoadUpstreamIndex(self):
+    osutils.WriteFile(os.path.join(self.tempdir, 'profiles', 'categories'),
+                      'dev-libs\nsys-apps\nmissing-cat\n', makedirs=True)
+    for catpkg in ('dev-libs/A', 'dev-libs/B', 'sys-apps/C'):
+      osutils.SafeMakedirs(os.path.join(self.tempdir, catpkg))
+    mocked_upgrader = self._MockUpgrader(_upstream=self.tempdir)
+    self.mox.ReplayAll()
+
+    # Verify
+    cpu.Upgrader._LoadUpstreamIndex(mocked_upgrader)
+    self.mox.VerifyAll()
+    self.assertEquals(mocked_upgrader._upstream_index,
+                      set(['dev-libs/A', 'dev-libs/B', 'sys-apps/C']))
+
+  @osutils.TempDirDecorator
+  def testLoadUpstreamIndexNoCategories(self):
+    mocked_upgrader = self._MockUpgrader(_upstream=self.tempdir,
+                                         _upstream_index=set(['dev-libs/A']))
+    self.mox.ReplayAll()
+
+    # Verify
+    cpu.Upgrader._LoadUpstreamIndex(mocked_upgrader)
+    self.mox.VerifyAll()
+    self.assertEquals(mocked_upgrader._upstream_index, None)
+
+
+class FindUpstreamCPVTest(CpuTestBase):
+  """Test Upgrader._FindUpstreamCPV memoization and upstream index."""
+
+  def _SetUpEquery(self, mocked_upgrader, pkg, ebuild_path, cat, pv):
+    """Expect one equery run for |pkg| that finds |ebuild_path|."""
+    envvars = {'ARCH': DEFAULT_ARCH}
+    mocked_upgrader._GenPortageEnvvars(
+        DEFAULT_ARCH, False, portdir='/upstream',
+        portage_configroot='empty-dir').AndReturn(envvars)
+    cros_build_lib.RunCommand(
+        ['equery', 'which', pkg], extra_env=envvars, print_cmd=False,
+        error_code_ok=True, redirect_stdout=True, combine_stdout_stderr=True,
+        ).AndReturn(RunCommandResult(returncode=0, output=ebuild_path))
+    mocked_upgrader._SplitEBuildPath(ebuild_path).AndReturn(
+        ('/upstream', cat, None, pv))
+
+  def testFindUpstreamCPVCached(self):
+    mocked_upgrader = self._MockUpgrader(_upstream='/upstream',
+                                         _emptydir='empty-dir',
+                                         _upstream_cache={})
+    self.mox.StubOutWithMock(cros_build_lib, 'RunCommand')
+
+    # Replay script
+    self._SetUpEquery(mocked_upgrader, 'dev-libs/A',
+                      '/upstream/dev-libs/A/A-2.ebuild', 'dev-libs', 'A-2')
+    self.mox.ReplayAll()
+
+    # Verify
+    for _ in xrange(2):
+      result = cpu.Upgrader._FindUpstreamCPV(mocked_upgrader, 'dev-libs/A')
+      self.assertEquals(result, 'dev-libs/A-2')
+    self.mox.VerifyAll()
+
+    # Results are cached by arch, unstable_ok and package.
+    key = (DEFAULT_ARCH, False, 'dev-libs/A')
+    self.assertEquals(mocked_upgrader._upstream_cache,
+                      {key: 'dev-libs/A-2'})
+
+  def testFindUpstreamCPVNotIndexed(self):
+    mocked_upgrader = self._MockUpgrader(_upstream='/upstream',
+                                         _emptydir='empty-dir',
+                                         _upstream_cache={},
+                                         _upstream_index=set(['dev-libs/A']))
+    self.mox.StubOutWithMock(cros_build_lib, 'RunCommand')
+
+    # Replay script
+    self._SetUpEquery(mocked_upgrader, 'dev-libs/A-2',
+                      '/upstream/dev-libs/A/A-2.ebuild', 'dev-libs', 'A-2')
+    self.mox.ReplayAll()
+
+    # Verify
+    result = cpu.Upgrader._FindUpstreamCPV(mocked_upgrader, 'dev-libs/A-2')
+    self.assertEquals(result, 'dev-libs/A-2')
+    result = cpu.Upgrader._FindUpstreamCPV(mocked_upgrader, 'dev-libs/B')
+    self.assertEquals(result, None)
+    result = cpu.Upgrader._FindUpstreamCPV(mocked_upgrader, 'dev-libs/B-1')
+    self.assertEquals(result, None)
+    self.mox.VerifyAll()
+
+
 class GiveEmergeResultsTest(CpuTestBase):
   """Test Upgrader._GiveEmergeResults"""
 
@@ -3550,14 +3757,14 @@ class MainTest(CpuTestBase):
     self.mox.StubOutWithMock(cpu.Upgrader, 'PreRunChecks')
     self.mox.StubOutWithMock(cpu, '_BoardIsSetUp')
     self.mox.StubOutWithMock(cpu.Upgrader, 'PrepareToRun')
-    self.mox.StubOutWithMock(cpu.Upgrader, 'RunBoard')
+    self.mox.StubOutWithMock(cpu.Upgrader, 'RunBoards')
     self.mox.StubOutWithMock(cpu.Upgrader, 'RunCompleted')
     self.mox.StubOutWithMock(cpu.Upgrader, 'WriteTableFiles')
 
     cpu.Upgrader.PreRunChecks()
     cpu._BoardIsSetUp('any-board').AndReturn(True)
     cpu.Upgrader.PrepareToRun()
-    cpu.Upgrader.RunBoard('any-board')
+    cpu.Upgrader.RunBoards(['any-board'])
     cpu.Upgrader.RunCompleted()
     cpu.Upgrader.WriteTableFiles(csv='/dev/null')
     self.mox.ReplayAll()
@@ -3590,7 +3797,7 @@ class MainTest(CpuTestBase):
     self.mox.StubOutWithMock(cpu.Upgrader, 'PreRunChecks')
     self.mox.StubOutWithMock(cpu, '_BoardIsSetUp')
     self.mox.StubOutWithMock(cpu.Upgrader, 'PrepareToRun')
-    self.mox.StubOutWithMock(cpu.Upgrader, 'RunBoard')
+    self.mox.StubOutWithMock(cpu.Upgrader, 'RunBoards')
     self.mox.StubOutWithMock(cpu.Upgrader, 'RunCompleted')
     self.mox.StubOutWithMock(cpu.Upgrader, 'WriteTableFiles')
 
@@ -3598,8 +3805,7 @@ class MainTest(CpuTestBase):
     cpu._BoardIsSetUp('board1').AndReturn(True)
     cpu._BoardIsSetUp('board2').AndReturn(True)
     cpu.Upgrader.PrepareToRun()
-    cpu.Upgrader.RunBoard('board1')
-    cpu.Upgrader.RunBoard('board2')
+    cpu.Upgrader.RunBoards(['board1', 'board2'])
     cpu.Upgrader.RunCompleted()
     cpu.Upgrader.WriteTableFiles(csv=None)
     self.mox.ReplayAll()
@@ -3615,7 +3821,7 @@ class MainTest(CpuTestBase):
     self.mox.StubOutWithMock(cpu.Upgrader, 'CheckBoardList')
     self.mox.StubOutWithMock(cpu, '_BoardIsSetUp')
     self.mox.StubOutWithMock(cpu.Upgrader, 'PrepareToRun')
-    self.mox.StubOutWithMock(cpu.Upgrader, 'RunBoard')
+    self.mox.StubOutWithMock(cpu.Upgrader, 'RunBoards')
     self.mox.StubOutWithMock(cpu.Upgrader, 'RunCompleted')
     self.mox.StubOutWithMock(cpu.Upgrader, 'WriteTableFiles')
 
@@ -3623,7 +3829,7 @@ class MainTest(CpuTestBase):
     cpu.Upgrader.CheckBoardList(['any-board'])
     cpu._BoardIsSetUp('any-board').AndReturn(True)
     cpu.Upgrader.PrepareToRun()
-    cpu.Upgrader.RunBoard('any-board')
+    cpu.Upgrader.RunBoards(['any-board'])
     cpu.Upgrader.RunCompleted()
     cpu.Upgrader.WriteTableFiles(csv=None)
     self.mox.ReplayAll()
@@ -3639,7 +3845,7 @@ class MainTest(CpuTestBase):
     self.mox.StubOutWithMock(cpu.Upgrader, 'CheckBoardList')
     self.mox.StubOutWithMock(cpu, '_BoardIsSetUp')
     self.mox.StubOutWithMock(cpu.Upgrader, 'PrepareToRun')
-    self.mox.StubOutWithMock(cpu.Upgrader, 'RunBoard')
+    self.mox.StubOutWithMock(cpu.Upgrader, 'RunBoards')
     self.mox.StubOutWithMock(cpu.Upgrader, 'RunCompleted')
     self.mox.StubOutWithMock(cpu.Upgrader, 'WriteTableFiles')
 
@@ -3648,8 +3854,7 @@ class MainTest(CpuTestBase):
     cpu._BoardIsSetUp('board1').AndReturn(True)
     cpu._BoardIsSetUp('board2').AndReturn(True)
     cpu.Upgrader.PrepareToRun()
-    cpu.Upgrader.RunBoard('board1')
-    cpu.Upgrader.RunBoard('board2')
+    cpu.Upgrader.RunBoards(['board1', 'board2'])
     cpu.Upgrader.RunCompleted()
     cpu.Upgrader.WriteTableFiles(csv='/dev/null')
     self.mox.ReplayAll()
@@ -3666,7 +3871,7 @@ class MainTest(CpuTestBase):
     self.mox.StubOutWithMock(cpu.Upgrader, 'CheckBoardList')
     self.mox.StubOutWithMock(cpu, '_BoardIsSetUp')
     self.mox.StubOutWithMock(cpu.Upgrader, 'PrepareToRun')
-    self.mox.StubOutWithMock(cpu.Upgrader, 'RunBoard')
+    self.mox.StubOutWithMock(cpu.Upgrader, 'RunBoards')
     self.mox.StubOutWithMock(cpu.Upgrader, 'RunCompleted')
     self.mox.StubOutWithMock(cpu.Upgrader, 'WriteTableFiles')
 
@@ -3675,9 +3880,7 @@ class MainTest(CpuTestBase):
     cpu._BoardIsSetUp('board1').AndReturn(True)
     cpu._BoardIsSetUp('board2').AndReturn(True)
     cpu.Upgrader.PrepareToRun()
-    cpu.Upgrader.RunBoard(cpu.Upgrader.HOST_BOARD)
-    cpu.Upgrader.RunBoard('board1')
-    cpu.Upgrader.RunBoard('board2')
+    cpu.Upgrader.RunBoards([cpu.Upgrader.HOST_BOARD, 'board1', 'board2'])
     cpu.Upgrader.RunCompleted()
     cpu.Upgrader.WriteTableFiles(csv='/dev/null')
     self.mox.ReplayAll()
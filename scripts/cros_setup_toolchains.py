@@ -7,9 +7,11 @@
 """
 
 import copy
+import errno
 import glob
 import json
 import os
+import shutil
 
 from chromite.cbuildbot import constants
 from chromite.lib import commandline
@@ -152,6 +154,8 @@ class Crossdev(object):
         cros_build_lib.RunCommand(cmd, print_cmd=False, redirect_stdout=True)
       else:
         cros_build_lib.RunCommand(cmd)
+      # Crossdev (re)generates ebuilds and may merge packages.
+      PackageVersions.Invalidate()
 
       configured_targets.append(target)
 
@@ -215,6 +219,47 @@ def IsPackageDisabled(target, package):
   return GetDesiredPackageVersions(target, package) == [PACKAGE_NONE]
 
 
+class PackageVersions(object):
+  """Snapshot of the installed and best visible versions of packages.
+
+  Matching an atom against the vartree/porttree without portage's caches
+  rescans them every time, and we look up every (target, package) pair
+  several times over.  Instead, we scan the installed packages in one pass,
+  and remember the best visible ebuild of every atom we look up.  Call
+  Invalidate() whenever packages get (un)merged or crossdev runs.
+  """
+
+  _installed = None
+  _visible = {}
+
+  @classmethod
+  def Invalidate(cls):
+    """Forget everything; the next lookup rescans portage."""
+    cls._installed = None
+    cls._visible = {}
+
+  @classmethod
+  def GetInstalled(cls, atom):
+    """Returns the list of installed CPVs of |atom| (e.g. sys-devel/gcc)."""
+    if cls._installed is None:
+      cls._installed = {}
+      # pylint: disable=E1101
+      vardb = portage.db['/']['vartree'].dbapi
+      for cpv in vardb.cpv_all(use_cache=0):
+        cp = portage.versions.cpv_getkey(cpv)
+        cls._installed.setdefault(cp, []).append(cpv)
+    return cls._installed.get(atom, [])
+
+  @classmethod
+  def GetBestVisible(cls, atom):
+    """Returns the best visible CPV of |atom| in the porttree (or '')."""
+    if atom not in cls._visible:
+      # pylint: disable=E1101
+      portdb = portage.db['/']['porttree'].dbapi
+      cls._visible[atom] = portage.best(portdb.match(atom, use_cache=0))
+    return cls._visible[atom]
+
+
 def GetInstalledPackageVersions(atom):
   """Extracts the list of current versions of a target, package pair.
 
@@ -225,7 +270,7 @@ def GetInstalledPackageVersions(atom):
   """
   versions = []
   # pylint: disable=E1101
-  for pkg in portage.db['/']['vartree'].dbapi.match(atom, use_cache=0):
+  for pkg in PackageVersions.GetInstalled(atom):
     version = portage.versions.cpv_getversion(pkg)
     versions.append(version)
   return versions
@@ -240,9 +285,10 @@ def GetStablePackageVersion(atom, installed):
 
   returns a string containing the latest version.
   """
-  pkgtype = 'vartree' if installed else 'porttree'
-  # pylint: disable=E1101
-  cpv = portage.best(portage.db['/'][pkgtype].dbapi.match(atom, use_cache=0))
+  if installed:
+    cpv = portage.best(PackageVersions.GetInstalled(atom))
+  else:
+    cpv = PackageVersions.GetBestVisible(atom)
   return portage.versions.cpv_getversion(cpv) if cpv else None
 
 
@@ -411,6 +457,7 @@ def UpdateTargets(targets, usepkg):
 
   cmd.extend(packages)
   cros_build_lib.RunCommand(cmd)
+  PackageVersions.Invalidate()
   return True
 
 
@@ -441,6 +488,7 @@ def CleanTargets(targets):
     cmd = [EMERGE_CMD, '--unmerge']
     cmd.extend(packages)
     cros_build_lib.RunCommand(cmd)
+    PackageVersions.Invalidate()
   else:
     print 'Nothing to clean!'
 
@@ -704,8 +752,19 @@ def _GetFilesForTarget(target, root='/'):
   return paths, elfs
 
 
+def _LinkOrCopy(src, dst):
+  """Hardlink |src| to |dst|, or copy it if we can't (e.g. across mounts)"""
+  try:
+    os.link(src, dst)
+  except OSError as e:
+    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+      raise
+    shutil.copy2(src, dst)
+
+
 def _BuildInitialPackageRoot(output_dir, paths, elfs, ldpaths,
-                             path_rewrite_func=lambda x:x, root='/'):
+                             path_rewrite_func=lambda x:x, root='/',
+                             elf_cache=None):
   """Link in all packable files and their runtime dependencies
 
   This also wraps up executable ELFs with helper scripts.
@@ -717,6 +776,7 @@ def _BuildInitialPackageRoot(output_dir, paths, elfs, ldpaths,
     ldpaths: A dict of static ldpath information
     path_rewrite_func: User callback to rewrite paths in output_dir
     root: The root path to pull all packages/files from
+    elf_cache: The lddtree.ELFCache to read ELF info through
   """
   # Link in all the files.
   sym_paths = []
@@ -740,7 +800,7 @@ def _BuildInitialPackageRoot(output_dir, paths, elfs, ldpaths,
           os.symlink(tgt, dst)
           continue
 
-    os.link(src, dst)
+    _LinkOrCopy(src, dst)
 
   # Now see if any of the symlinks need to be wrapped.
   for sym, tgt in sym_paths:
@@ -754,8 +814,9 @@ def _BuildInitialPackageRoot(output_dir, paths, elfs, ldpaths,
   libdir = os.path.join(output_dir, 'lib')
   osutils.SafeMakedirs(libdir)
   donelibs = set()
+  parsed_elfs = lddtree.ParseELFs(elfs, root, ldpaths, elf_cache=elf_cache)
   for elf in elfs:
-    e = lddtree.ParseELF(elf, root, ldpaths)
+    e = parsed_elfs[elf]
     interp = e['interp']
     if interp:
       # Generate a wrapper if it is executable.
@@ -781,7 +842,7 @@ def _BuildInitialPackageRoot(output_dir, paths, elfs, ldpaths,
       dst = os.path.join(libdir, os.path.basename(path))
       src = ReadlinkRoot(src, root)
 
-      os.link(root + src, dst)
+      _LinkOrCopy(root + src, dst)
 
 
 def _EnvdGetVar(envd, var):
@@ -869,7 +930,8 @@ def _ProcessDistroCleanups(target, output_dir):
   osutils.RmDir(os.path.join(output_dir, 'etc'))
 
 
-def CreatePackagableRoot(target, output_dir, ldpaths, root='/'):
+def CreatePackagableRoot(target, output_dir, ldpaths, root='/',
+                         elf_cache=None):
   """Setup a tree from the packages for the specified target
 
   This populates a path with all the files from toolchain packages so that
@@ -880,6 +942,7 @@ def CreatePackagableRoot(target, output_dir, ldpaths, root='/'):
     output_dir: The output directory to place all the files
     ldpaths: A dict of static ldpath information
     root: The root path to pull all packages/files from
+    elf_cache: The lddtree.ELFCache to read ELF info through
   """
   # Find all the files owned by the packages for this target.
   paths, elfs = _GetFilesForTarget(target, root=root)
@@ -890,7 +953,8 @@ def CreatePackagableRoot(target, output_dir, ldpaths, root='/'):
     """Move /usr/bin to /bin so people can just use that toplevel dir"""
     return path[4:] if path.startswith('/usr/bin/') else path
   _BuildInitialPackageRoot(output_dir, paths, elfs, ldpaths,
-                           path_rewrite_func=MoveUsrBinToBin, root=root)
+                           path_rewrite_func=MoveUsrBinToBin, root=root,
+                           elf_cache=elf_cache)
 
   # The packages, when part of the normal distro, have helper scripts
   # that setup paths and such.  Since we are making this standalone, we
@@ -920,10 +984,14 @@ def CreatePackages(targets_wanted, output_dir, root='/'):
     # because we hardlink in all the files (to avoid overhead of reading/writing
     # the copies multiple times).  But tar gets angry if a file's hardlink count
     # changes from when it starts reading a file to when it finishes.
-    with parallel.BackgroundTaskRunner(CreatePackagableRoot) as queue:
-      for target in targets:
-        output_target_dir = os.path.join(tempdir, target)
-        queue.put([target, output_target_dir, ldpaths, root])
+    with parallel.Manager() as manager:
+      # The targets share most of their libraries (libc, libstdc++, gmp, ...),
+      # so let all the processes share what they read out of the ELFs.
+      elf_cache = lddtree.ELFCache(elfs=manager.dict())
+      with parallel.BackgroundTaskRunner(CreatePackagableRoot) as queue:
+        for target in targets:
+          output_target_dir = os.path.join(tempdir, target)
+          queue.put([target, output_target_dir, ldpaths, root, elf_cache])
 
     # Build the tarball.
     with parallel.BackgroundTaskRunner(cros_build_lib.CreateTarball) as queue:
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# Copyright (c) 2014 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for cros_setup_toolchains.py"""
+
+import errno
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', '..'))
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from chromite.lib import parallel_unittest
+from chromite.scripts import cros_setup_toolchains
+from chromite.scripts import lddtree
+
+# TODO(build): Finish test wrapper (http://crosbug.com/37517).
+# Until then, this has to be after the chromite imports.
+import mock
+
+
+class PackageVersionsTest(cros_test_lib.MockTestCase):
+  """Tests for the PackageVersions snapshot"""
+
+  def setUp(self):
+    self.installed = ['sys-devel/gcc-4.8.2', 'sys-devel/binutils-2.22',
+                      'cross-armv7a-cros-linux-gnueabi/gcc-4.8.2']
+    self.visible = {
+        'sys-devel/gcc': ['sys-devel/gcc-4.8.2', 'sys-devel/gcc-4.9.1'],
+        'sys-devel/binutils': ['sys-devel/binutils-2.22'],
+    }
+    self.vardb = mock.Mock()
+    self.vardb.cpv_all.side_effect = lambda **_kwargs: list(self.installed)
+    self.portdb = mock.Mock()
+    self.portdb.match.side_effect = (
+        lambda atom, **_kwargs: self.visible.get(atom, []))
+
+    portage = mock.Mock()
+    portage.db = {'/': {'vartree': mock.Mock(dbapi=self.vardb),
+                        'porttree': mock.Mock(dbapi=self.portdb)}}
+    portage.best.side_effect = lambda cpvs: max(cpvs) if cpvs else ''
+    portage.versions.cpv_getkey.side_effect = lambda x: x.rsplit('-', 1)[0]
+    portage.versions.cpv_getversion.side_effect = lambda x: x.rsplit('-', 1)[1]
+    self.PatchObject(cros_setup_toolchains, 'portage', new=portage,
+                     create=True)
+
+    cros_setup_toolchains.PackageVersions.Invalidate()
+    self.addCleanup(cros_setup_toolchains.PackageVersions.Invalidate)
+
+  def testSnapshot(self):
+    """Portage should only be scanned once for many lookups"""
+    for _ in xrange(3):
+      self.assertEqual(
+          cros_setup_toolchains.GetInstalledPackageVersions('sys-devel/gcc'),
+          ['4.8.2'])
+      self.assertEqual(
+          cros_setup_toolchains.GetInstalledPackageVersions('sys-devel/gdb'),
+          [])
+      self.assertEqual(cros_setup_toolchains.GetStablePackageVersion(
+          'sys-devel/binutils', True), '2.22')
+      self.assertEqual(cros_setup_toolchains.GetStablePackageVersion(
+          'sys-devel/gcc', False), '4.9.1')
+      self.assertEqual(cros_setup_toolchains.GetStablePackageVersion(
+          'sys-devel/gdb', False), None)
+    self.assertEqual(self.vardb.cpv_all.call_count, 1)
+    self.assertEqual(sorted(x[0][0] for x in self.portdb.match.call_args_list),
+                     ['sys-devel/gcc', 'sys-devel/gdb'])
+
+  def testInvalidate(self):
+    """Lookups after Invalidate() should see the new state of portage"""
+    self.assertEqual(
+        cros_setup_toolchains.GetStablePackageVersion('sys-devel/gcc', True),
+        '4.8.2')
+    self.installed = ['sys-devel/gcc-4.9.1']
+    self.assertEqual(
+        cros_setup_toolchains.GetStablePackageVersion('sys-devel/gcc', True),
+        '4.8.2')
+    cros_setup_toolchains.PackageVersions.Invalidate()
+    self.assertEqual(
+        cros_setup_toolchains.GetStablePackageVersion('sys-devel/gcc', True),
+        '4.9.1')
+    self.assertEqual(self.vardb.cpv_all.call_count, 2)
+
+  def testUpdateTargets(self):
+    """Installing packages should invalidate the snapshot"""
+    self.PatchObject(cros_setup_toolchains, 'RemovePackageMask')
+    self.PatchObject(cros_setup_toolchains, 'GetTargetPackages',
+                     return_value=['gcc'])
+    self.PatchObject(cros_setup_toolchains, 'GetPortagePackage',
+                     return_value='sys-devel/gcc')
+    self.PatchObject(cros_setup_toolchains, 'GetDesiredPackageVersions',
+                     return_value=[cros_setup_toolchains.PACKAGE_STABLE])
+    self.PatchObject(cros_setup_toolchains.osutils, 'SafeUnlink')
+
+    def _Emerge(cmd, **_kwargs):
+      """Pretend to install the packages in |cmd|"""
+      self.assertEqual(cmd[-1], 'sys-devel/gcc')
+      self.installed = ['sys-devel/gcc-4.9.1']
+    run_mock = self.PatchObject(cros_build_lib, 'RunCommand',
+                                side_effect=_Emerge)
+
+    self.assertTrue(cros_setup_toolchains.UpdateTargets(['host'], False))
+    self.assertEqual(run_mock.call_count, 1)
+    self.assertEqual(
+        cros_setup_toolchains.GetInstalledPackageVersions('sys-devel/gcc'),
+        ['4.9.1'])
+    # With the update done, there should be nothing left to do.
+    self.assertFalse(cros_setup_toolchains.UpdateTargets(['host'], False))
+    self.assertEqual(run_mock.call_count, 1)
+
+
+# pylint: disable=W0212
+class CreatePackagesTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for CreatePackages"""
+
+  def setUp(self):
+    self.StartPatcher(parallel_unittest.ParallelMock())
+    self.PatchObject(cros_setup_toolchains, 'ExpandTargets',
+                     return_value={'armv7a': {}, 'x86_64': {}})
+    self.PatchObject(lddtree, 'LoadLdpaths', return_value={})
+    self.files_mock = self.PatchObject(
+        cros_setup_toolchains, '_GetFilesForTarget',
+        side_effect=lambda target, root: (set(['/bin/' + target]),
+                                          set(['/bin/' + target])))
+    self.cache_sizes = []
+    def _Build(_output_dir, _paths, elfs, _ldpaths, **kwargs):
+      """Note what the cache held, then add our ELFs to it"""
+      elf_cache = kwargs['elf_cache']
+      self.assertTrue(isinstance(elf_cache, lddtree.ELFCache))
+      self.cache_sizes.append(len(elf_cache._elfs))
+      for elf in elfs:
+        elf_cache._elfs[elf] = None
+    self.build_mock = self.PatchObject(cros_setup_toolchains,
+                                       '_BuildInitialPackageRoot',
+                                       side_effect=_Build)
+    self.PatchObject(cros_setup_toolchains, '_ProcessDistroCleanups')
+    self.tar_mock = self.PatchObject(cros_build_lib, 'CreateTarball')
+
+  def testSharedELFCache(self):
+    """Each target should be parsed in its own task through a shared cache"""
+    cros_setup_toolchains.CreatePackages(['all'], self.tempdir)
+
+    self.assertEqual(sorted(x[0][0] for x in self.files_mock.call_args_list),
+                     ['armv7a', 'x86_64'])
+    self.assertEqual(self.build_mock.call_count, 2)
+    # The second target should see what the first one put in the cache.
+    self.assertEqual(self.cache_sizes, [0, 1])
+    self.assertEqual(sorted(x[0][0] for x in self.tar_mock.call_args_list),
+                     [os.path.join(self.tempdir, 'armv7a.tar.xz'),
+                      os.path.join(self.tempdir, 'x86_64.tar.xz')])
+
+
+class LinkOrCopyTest(cros_test_lib.TempDirTestCase):
+  """Tests for _LinkOrCopy"""
+
+  def testCopyAcrossMounts(self):
+    """Files we can't hardlink should be copied"""
+    src = os.path.join(self.tempdir, 'src')
+    dst = os.path.join(self.tempdir, 'dst')
+    osutils.WriteFile(src, 'data')
+    with mock.patch.object(os, 'link',
+                           side_effect=OSError(errno.EXDEV, 'EXDEV')):
+      cros_setup_toolchains._LinkOrCopy(src, dst)
+    self.assertEqual(osutils.ReadFile(dst), 'data')
+    self.assertNotEqual(os.stat(src).st_ino, os.stat(dst).st_ino)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -30,7 +30,7 @@ class RunScriptTest(cros_test_lib.MockTempDirTestCase):
   def testStatsUpload(self, upload_count=1, return_value=0):
     """Test stats uploading."""
     return_value = cros.main(['chrome-sdk', '--board', 'lumpy'])
-    self.assertEquals(stats.StatsUploader._Upload.call_count, upload_count)
+    self.assertEquals(stats.StatsUploader._UploadBatch.call_count, upload_count)
     self.assertEquals(return_value, return_value)
 
   def testStatsUploadError(self):
@@ -40,5 +40,29 @@ class RunScriptTest(cros_test_lib.MockTempDirTestCase):
       self.testStatsUpload(upload_count=0)
 
 
+class FindSubCommandTest(cros_test_lib.TestCase):
+  """Test finding the subcommand to set up."""
+
+  COMMANDS = {'build': {}, 'shell': {}}
+
+  def _Find(self, argv):
+    return cros._FindSubCommand(argv, self.COMMANDS)
+
+  def testFirstPositional(self):
+    """Only the first positional argument names the subcommand."""
+    self.assertEqual(self._Find(['build', 'shell']), 'build')
+    self.assertEqual(self._Find(['shell', '--board', 'build']), 'shell')
+    self.assertEqual(self._Find(['lint', 'build']), None)
+    self.assertEqual(self._Find([]), None)
+
+  def testGlobalOptions(self):
+    """Values of global options should not be taken for the subcommand."""
+    self.assertEqual(self._Find(['--cache-dir', 'build', 'shell']), 'shell')
+    self.assertEqual(self._Find(['--debug', 'build']), 'build')
+    self.assertEqual(self._Find(['--cache-dir=build', 'shell']), 'shell')
+    self.assertEqual(self._Find(['--log-level', 'debug']), None)
+    self.assertEqual(self._Find(['--', 'build']), 'build')
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
@@ -155,7 +155,7 @@ class MainTest(cros_test_lib.MockLoggingTestCase):
     """The stats upload path."""
     deploy_chrome.main(['--board=lumpy', '--staging-only',
                         '--build-dir=/tmp/abc'])
-    self.assertEquals(stats.StatsUploader._Upload.call_count, call_count)
+    self.assertEquals(stats.StatsUploader._UploadBatch.call_count, call_count)
 
   def testStatsUploadError(self):
     """Don't upload stats if we fail to create it."""
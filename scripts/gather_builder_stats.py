@@ -16,6 +16,7 @@ import sys
 from chromite.cbuildbot import cbuildbot_config
 from chromite.cbuildbot import metadata_lib
 from chromite.cbuildbot import constants
+from chromite.lib import cidb
 from chromite.lib import commandline
 from chromite.lib import cros_build_lib
 from chromite.lib import gdata_lib
@@ -564,11 +565,13 @@ class StatsManager(object):
   # Whether to grab a count of what data has been written to sheets before.
   # This is needed if you are writing data to the Google Sheets spreadsheet.
   GET_SHEETS_VERSION = True
+  # Whether Gather reads metadata.json files out of Google Storage.
+  FETCH_METADATA = True
 
   def __init__(self, config_target, ss_key=None,
                no_sheets_version_filter=False):
     self.builds = []
-    self.gs_ctx = gs.GSContext()
+    self.gs_ctx = gs.GSContext() if self.FETCH_METADATA else None
     self.config_target = config_target
     self.ss_key = ss_key
     self.no_sheets_version_filter = no_sheets_version_filter
@@ -877,7 +880,7 @@ class CLStats(StatsManager):
     self.reasons = {}
     self.blames = {}
     self.summary = {}
-    self.pre_cq_stats = PreCQStats()
+    self.pre_cq_stats = PreCQStats() if self.FETCH_METADATA else None
 
   def GatherFailureReasons(self, creds):
     """Gather the reasons why our builds failed and the blamed bugs or CLs.
@@ -1358,6 +1361,185 @@ class CLStats(StatsManager):
     self.summary = super_summary
     return super_summary
 
+class CIDBCLStats(CLStats):
+  """Manager for CL action stats computed by CIDB.
+
+  Rather than reading every metadata.json in the date range and going over
+  the CL actions in them here, the summary is put together out of a handful
+  of SQL aggregations over the builds, stages and CL actions in CIDB.  The
+  stats based on the failure reasons in the CQ spreadsheet are left out, and
+  nothing is uploaded to the spreadsheet.
+  """
+  # The build configs of each bot type whose CL actions are summarized.
+  BOT_TYPE_CONFIGS = {CQ: [CQ_MASTER], PRE_CQ: [PRE_CQ_GROUP]}
+  SUMMARY_SPREADSHEET_COLUMNS = {}
+  FETCH_METADATA = False
+
+  def __init__(self, db, **kwargs):
+    """Initialize.
+
+    Args:
+      db: The CIDBConnection to query.
+      kwargs: See StatsManager.
+    """
+    super(CIDBCLStats, self).__init__(None, **kwargs)
+    self.db = db
+    self.start_time = None
+
+  #pylint: disable-msg=W0613
+  def Gather(self, start_date, sort_by_build_number=True,
+             starting_build_number=0, creds=None):
+    """Limit the summary to what happened since |start_date|.
+
+    Nothing needs fetching up front; the other arguments are ignored.
+    """
+    self.start_time = datetime.datetime.combine(start_date, datetime.time())
+
+  def _ByBotType(self, counts):
+    """Convert {(build_config, key): count} to {bot_type: {key: count}}."""
+    by_bot_type = dict((bot_type, {}) for bot_type in self.BOT_TYPE_CONFIGS)
+    for bot_type, configs in self.BOT_TYPE_CONFIGS.iteritems():
+      for (config, key), count in counts.iteritems():
+        if config in configs:
+          d = by_bot_type[bot_type]
+          d[key] = d.get(key, 0) + count
+    return by_bot_type
+
+  def Summarize(self):
+    """Process, print, and return a summary of cl action statistics.
+
+    As a side effect, save summary to self.summary.
+
+    Returns:
+      A dictionary summarizing the statistics.
+    """
+    configs = sum(self.BOT_TYPE_CONFIGS.values(), [])
+    bot_types = dict((config, bot_type)
+                     for bot_type, x in self.BOT_TYPE_CONFIGS.iteritems()
+                     for config in x)
+    kwargs = {'build_configs': configs, 'start_time': self.start_time}
+
+    runs = self._ByBotType(self.db.GetBuildStatusCounts(**kwargs))
+    actions = self._ByBotType(self.db.GetCLActionCounts(**kwargs))
+    unique_cls, unique_patches = self.db.GetUniqueChangeCounts(**kwargs)
+    good_rejections = self.db.GetRejections(falsely_rejected=True, **kwargs)
+    bad_rejections = self.db.GetRejections(falsely_rejected=False, **kwargs)
+    patch_handle_times = self.db.GetPatchHandlingTimes(**kwargs)
+
+    def _Count(action):
+      return sum(x.get(action, 0) for x in actions.itervalues())
+    passed = constants.FINAL_STATUS_PASSED
+
+    # good_patch_rejection_count maps the bot type (CQ or PRE_CQ) to the number
+    #   of times that bot has falsely rejected good patches.
+    good_patch_count = _Count(constants.CL_ACTION_SUBMITTED)
+    good_patch_rejection_count = collections.defaultdict(int)
+    rejections_per_patch = collections.defaultdict(int)
+    for r in good_rejections:
+      good_patch_rejection_count[bot_types[r['build_config']]] += 1
+      rejections_per_patch[(r['change_number'], r['change_source'],
+                            r['patch_number'])] += 1
+    false_rejection_rate = self.FalseRejectionRate(good_patch_count,
+                                                   good_patch_rejection_count)
+
+    # This list counts how many times each good patch was rejected.
+    rejection_counts = [0] * (good_patch_count - len(rejections_per_patch))
+    rejection_counts += rejections_per_patch.values()
+
+    # Break down the frequency of how many times each patch is rejected.
+    good_patch_rejection_breakdown = []
+    if rejection_counts:
+      for x in range(max(rejection_counts) + 1):
+        good_patch_rejection_breakdown.append((x, rejection_counts.count(x)))
+
+    # Patches that were rejected, then a later patch of the CL was submitted
+    # are good candidates for bad CLs.
+    bad_cl_candidates = {}
+    for r in bad_rejections:
+      change = metadata_lib.GerritChangeTuple(
+          r['change_number'],
+          r['change_source'] == cidb.CHANGE_SOURCE_INTERNAL)
+      candidates = bad_cl_candidates.setdefault(bot_types[r['build_config']],
+                                                [])
+      if change not in candidates:
+        candidates.append(change)
+
+    summary = {'total_runs'            : sum(sum(x.values())
+                                             for x in runs.itervalues()),
+               'passed_runs'           : sum(x.get(passed, 0)
+                                             for x in runs.itervalues()),
+               'total_cl_actions'      : sum(sum(x.values())
+                                             for x in actions.itervalues()),
+               'unique_cls'            : unique_cls,
+               'unique_patches'        : unique_patches,
+               'submitted_patches'     : good_patch_count,
+               'rejections'            :
+                   _Count(constants.CL_ACTION_KICKED_OUT),
+               'submit_fails'          :
+                   _Count(constants.CL_ACTION_SUBMIT_FAILED),
+               'good_patch_rejections' : sum(rejection_counts),
+               'mean_good_patch_rejections' :
+                   numpy.mean(rejection_counts),
+               'good_patch_rejection_breakdown' :
+                   good_patch_rejection_breakdown,
+               'good_patch_rejection_count' :
+                   dict(good_patch_rejection_count),
+               'false_rejection_rate' :
+                   false_rejection_rate,
+               'median_handling_time' : numpy.median(patch_handle_times),
+               self.PATCH_HANDLING_TIME_SUMMARY_KEY : patch_handle_times,
+               'bad_cl_candidates' : bad_cl_candidates,
+               'correctly_rejected_by_stage' : self._ByBotType(
+                   self.db.GetRejectionStageFailureCounts(
+                       falsely_rejected=False, **kwargs)),
+               'incorrectly_rejected_by_stage' : self._ByBotType(
+                   self.db.GetRejectionStageFailureCounts(
+                       falsely_rejected=True, **kwargs)),
+               'stage_failures' : self._ByBotType(
+                   self.db.GetStageFailureCounts(**kwargs)),
+               }
+
+    logging.info('%d of %d runs passed.', summary['passed_runs'],
+                 summary['total_runs'])
+    logging.info('      Total CL actions: %d.', summary['total_cl_actions'])
+    logging.info('    Unique CLs touched: %d.', summary['unique_cls'])
+    logging.info('Unique patches touched: %d.', summary['unique_patches'])
+    logging.info('   Total CLs submitted: %d.', summary['submitted_patches'])
+    logging.info('      Total rejections: %d.', summary['rejections'])
+    logging.info(' Total submit failures: %d.', summary['submit_fails'])
+    logging.info(' Good patches rejected: %d.', len(rejections_per_patch))
+    logging.info(' False rejection rate for CQ: %.1f%%',
+                 summary['false_rejection_rate'].get(CQ, 0))
+    logging.info(' False rejection rate for Pre-CQ: %.1f%%',
+                 summary['false_rejection_rate'].get(PRE_CQ, 0))
+    logging.info(' Combined false rejection rate: %.1f%%',
+                 summary['false_rejection_rate']['combined'])
+    if patch_handle_times:
+      logging.info('     Median good patch')
+      logging.info('         handling time: %.2f hours',
+                   summary['median_handling_time']/3600.0)
+
+    for bot_type, patches in summary['bad_cl_candidates'].items():
+      logging.info('%d bad patch candidates were rejected by the %s',
+                   len(patches), bot_type)
+
+    for bot_type in (CQ, PRE_CQ):
+      logging.info('Stages from the %s that failed:', bot_type)
+      self._PrintCounts(summary['stage_failures'][bot_type],
+                        '  %(cnt)d failures in %(reason)s')
+
+    logging.info('Stages from the Pre-CQ that caught real failures:')
+    fmt = '  %(cnt)d broken patches were caught by %(reason)s'
+    self._PrintCounts(summary['correctly_rejected_by_stage'][PRE_CQ], fmt)
+
+    logging.info('Stages from the Pre-CQ that failed but succeeded on retry')
+    fmt = '  %(cnt)d good patches failed incorrectly in %(reason)s'
+    self._PrintCounts(summary['incorrectly_rejected_by_stage'][PRE_CQ], fmt)
+
+    self.summary = summary
+    return summary
+
+
 # TODO(mtennant): Add token file support.  See upload_package_status.py.
 def _PrepareCreds(email, password=None):
   """Return a gdata_lib.Creds object from given credentials.
@@ -1388,11 +1570,15 @@ def _CheckOptions(options):
     cros_build_lib.Error('You must specify --email with --save.')
     return False
 
-  # The --cl-actions option requires --email.
-  if options.cl_actions and not options.email:
+  # The --cl-actions option requires --email, unless the stats come from CIDB.
+  if options.cl_actions and not (options.email or options.cidb_creds):
     cros_build_lib.Error('You must specify --email with --cl-actions.')
     return False
 
+  if options.cidb_creds and not options.cl_actions:
+    cros_build_lib.Error('--cidb-creds only works with --cl-actions.')
+    return False
+
   return True
 
 
@@ -1432,6 +1618,11 @@ def GetParser():
                       help='Save results to DB, if applicable.')
   parser.add_argument('--email', action='store', type=str, default=None,
                       help='Specify email for Google Sheets account to use.')
+  parser.add_argument('--cidb-creds', action='store', type='path',
+                      default=None,
+                      help='Compute the stats with queries against the CIDB '
+                           'instance with these credentials, rather than by '
+                           'reading metadata.json files.')
 
   mode = parser.add_argument_group('Advanced (use at own risk)')
   mode.add_argument('--no-upload', action='store_false', default=True,
@@ -1483,7 +1674,9 @@ def main(argv):
             ss_key=options.ss_key or CQ_SS_KEY,
             no_sheets_version_filter=options.no_sheets_version_filter))
 
-  if options.cl_actions:
+  if options.cl_actions and options.cidb_creds:
+    stats_managers.append(CIDBCLStats(cidb.CIDBConnection(options.cidb_creds)))
+  elif options.cl_actions:
     # CL stats manager uses the CQ spreadsheet to fetch failure reasons
     stats_managers.append(
         CLStats(
@@ -1540,6 +1733,10 @@ def main(argv):
 
     cros_build_lib.Info('Finished with %s.\n\n', stats_mgr.config_target)
 
+  if options.save and options.carbon:
+    # Make sure everything queued up for Carbon has gone out before exiting.
+    graphite.Flush()
+
 
 # Background: This function logs the number of tryjob runs, both internal
 # and external, to Graphite.  It gets the data from git logs.  It was in
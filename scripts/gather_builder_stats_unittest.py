@@ -14,6 +14,7 @@ import sys
 import unittest
 
 sys.path.insert(0, os.path.abspath('%s/../..' % os.path.dirname(__file__)))
+from chromite.lib import cidb
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
 from chromite.scripts import gather_builder_stats
@@ -200,6 +201,61 @@ class TestCLActionLogic(unittest.TestCase):
       self.maxDiff = None
       self.assertEqual(summary, expected)
 
+  def testCIDBCLStatsSetup(self):
+    """CIDB stats should need neither Google Storage nor the spreadsheet."""
+    with mock.patch.object(gather_builder_stats.gs, 'GSContext',
+                           side_effect=AssertionError('GSContext created')):
+      cl_stats = gather_builder_stats.CIDBCLStats(mock.Mock())
+    self.assertEqual(cl_stats.gs_ctx, None)
+    self.assertFalse(cl_stats.UPLOAD_ROW_PER_BUILD or
+                     cl_stats.SUMMARY_SPREADSHEET_COLUMNS)
+
+  def testCIDBCLStatsSummary(self):
+    """The SQL summary should count CL actions the way CIDB records them."""
+    db = cidb.CIDBConnection(connect_url='sqlite://')
+    db.ApplySchemaMigrations()
+    for builddata in (self._getTestBuildData(cq=True) +
+                      self._getTestBuildData(cq=False)):
+      build_id = db.InsertBuild(
+          builder_name='', waterfall='', build_number=builddata.build_number,
+          build_config=builddata.metadata_dict['bot-config'],
+          bot_hostname='', start_time=0)
+      db.FinishBuild(build_id, builddata.status)
+      db.InsertCLActions(build_id, builddata.metadata_dict['cl_actions'])
+
+    with mock.patch.object(gather_builder_stats.gs, 'GSContext',
+                           side_effect=AssertionError('GSContext created')):
+      cl_stats = gather_builder_stats.CIDBCLStats(db)
+      cl_stats.Gather(datetime.date(1970, 1, 1))
+      summary = cl_stats.Summarize()
+
+    # This differs from the summary computed from metadata on purpose: CIDB
+    # doesn't keep the list of patches each build tested, so a patch counts
+    # as tested by every build that picked it up.  That makes the rejections
+    # of c4p2 (and of c1p1 by Pre-CQ build 6) count as well.
+    expected = {
+        'total_runs': 11,
+        'passed_runs': 3,
+        'unique_patches': 7,
+        'total_cl_actions': 28,
+        'good_patch_rejection_breakdown': [(0, 2), (1, 0), (2, 1), (3, 1)],
+        'good_patch_rejection_count': {CQ: 2, PRE_CQ: 3},
+        'good_patch_rejections': 5,
+        'mean_good_patch_rejections': 1.25,
+        'false_rejection_rate': {CQ: 100./3, PRE_CQ: 300./7,
+                                 'combined': 500./9},
+        'submitted_patches': 4,
+        'submit_fails': 0,
+        'unique_cls': 4,
+        'rejections': 10,
+        'correctly_rejected_by_stage': {CQ: {}, PRE_CQ: {}},
+        'incorrectly_rejected_by_stage': {CQ: {}, PRE_CQ: {}},
+        'stage_failures': {CQ: {}, PRE_CQ: {}},
+    }
+    self.maxDiff = None
+    self.assertEqual(dict((k, summary[k]) for k in expected), expected)
+    self.assertEqual(len(summary['patch_handling_time']), 4)
+
   def testProcessBlameString(self):
     """Tests that bug and CL links are correctly parsed."""
     blame = ('some words then crbug.com/1234, then other junk and '
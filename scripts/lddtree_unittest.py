@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# Copyright (c) 2014 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for lddtree.py"""
+
+import cPickle as pickle
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', '..'))
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from chromite.lib import parallel
+from chromite.scripts import lddtree
+
+
+# The compat info of all our fake ELFs.
+COMPAT = ('ELFOSABI_SYSV', 64, True, 'EM_X86_64')
+
+
+def _FakeReadELFInfo(path):
+  """Stand in for lddtree._ReadELFInfo that notes each read in a log
+
+  The fake ELFs hold the repr() of the fields that differ from the defaults.
+  """
+  log = os.path.join(os.path.dirname(path), 'reads.log')
+  with open(log, 'a') as f:
+    f.write(path + '\n')
+  info = {
+      'compat': COMPAT,
+      'interp': None,
+      'rpath': None,
+      'runpath': None,
+      'needed': [],
+  }
+  info.update(eval(osutils.ReadFile(path)))
+  return info
+
+
+class ELFTestCase(cros_test_lib.MockTempDirTestCase):
+  """Base class for tests that use fake ELFs"""
+
+  def setUp(self):
+    self.PatchObject(lddtree, '_ReadELFInfo', side_effect=_FakeReadELFInfo)
+
+  def WriteELF(self, path, **kwargs):
+    """Create a fake ELF at |path| (relative to tempdir)"""
+    path = os.path.join(self.tempdir, path)
+    osutils.SafeMakedirs(os.path.dirname(path))
+    osutils.WriteFile(path, repr(kwargs))
+    return path
+
+  def Reads(self, path=''):
+    """Return the paths read in the dir |path| (relative to tempdir)"""
+    log = os.path.join(self.tempdir, path, 'reads.log')
+    return osutils.ReadFile(log).splitlines() if os.path.exists(log) else []
+
+
+class ELFCacheTest(ELFTestCase):
+  """Tests for the ELFCache"""
+
+  def setUp(self):
+    self.elf = self.WriteELF('libfoo.so')
+    self.cache_file = os.path.join(self.tempdir, 'cache')
+
+  def testRead(self):
+    """ELFs should only be read again once they change"""
+    elf_cache = lddtree.ELFCache()
+    self.assertEqual(elf_cache.Read(self.elf)['needed'], [])
+    self.assertEqual(elf_cache.Read(self.elf)['needed'], [])
+    self.assertEqual(self.Reads(), [self.elf])
+
+    self.WriteELF('libfoo.so', needed=['libc.so.6'])
+    self.assertEqual(elf_cache.Read(self.elf)['needed'], ['libc.so.6'])
+    self.assertEqual(self.Reads(), [self.elf, self.elf])
+
+  def testListDir(self):
+    """Dir listings should be refreshed once the dir changes"""
+    elf_cache = lddtree.ELFCache()
+    self.assertEqual(elf_cache.ListDir(self.tempdir), set(['libfoo.so']))
+
+    self.PatchObject(os, 'listdir', side_effect=AssertionError('listed'))
+    self.assertEqual(elf_cache.ListDir(self.tempdir), set(['libfoo.so']))
+    self.assertEqual(elf_cache.ListDir(os.path.join(self.tempdir, 'nope')),
+                     set())
+
+    self.PatchObject(os, 'listdir', return_value=['libfoo.so', 'libbar.so'])
+    st = os.stat(self.tempdir)
+    os.utime(self.tempdir, (st.st_atime, st.st_mtime + 10))
+    self.assertEqual(elf_cache.ListDir(self.tempdir),
+                     set(['libfoo.so', 'libbar.so']))
+
+  def testSaveLoad(self):
+    """Saved entries should be reused by later caches"""
+    elf_cache = lddtree.ELFCache(path=self.cache_file)
+    elf_cache.Read(self.elf)
+    elf_cache.Save()
+
+    elf_cache = lddtree.ELFCache(path=self.cache_file)
+    elf_cache.Read(self.elf)
+    self.assertEqual(self.Reads(), [self.elf])
+
+    # Changed ELFs should still be read again.
+    self.WriteELF('libfoo.so', needed=['libc.so.6'])
+    self.assertEqual(elf_cache.Read(self.elf)['needed'], ['libc.so.6'])
+    self.assertEqual(self.Reads(), [self.elf, self.elf])
+
+  def testSaveUnchanged(self):
+    """Caches that read nothing new shouldn't be written out"""
+    elf_cache = lddtree.ELFCache(path=self.cache_file)
+    elf_cache.Save()
+    self.assertFalse(os.path.exists(self.cache_file))
+
+  def testLoadOtherVersion(self):
+    """Caches saved by other versions should be ignored"""
+    elf_cache = lddtree.ELFCache(path=self.cache_file)
+    elf_cache.Read(self.elf)
+    elf_cache.Save()
+    with open(self.cache_file, 'rb') as f:
+      _, elfs = pickle.load(f)
+    with open(self.cache_file, 'wb') as f:
+      pickle.dump((lddtree.ELFCache.VERSION + 1, elfs), f)
+
+    lddtree.ELFCache(path=self.cache_file).Read(self.elf)
+    self.assertEqual(self.Reads(), [self.elf, self.elf])
+
+  def testLoadCorrupt(self):
+    """Corrupt caches should be ignored"""
+    osutils.WriteFile(self.cache_file, 'junk')
+    lddtree.ELFCache(path=self.cache_file).Read(self.elf)
+    self.assertEqual(self.Reads(), [self.elf])
+
+  def testSharedStorage(self):
+    """Processes sharing a manager dict should read each ELF only once"""
+    def _Read(elf_cache):
+      elf_cache.Read(self.elf)
+
+    with parallel.Manager() as manager:
+      elf_cache = lddtree.ELFCache(elfs=manager.dict())
+      for _ in xrange(2):
+        with parallel.BackgroundTaskRunner(_Read) as queue:
+          queue.put([elf_cache])
+      self.assertEqual(self.Reads(), [self.elf])
+      self.assertEqual(elf_cache.Read(self.elf)['needed'], [])
+    self.assertEqual(self.Reads(), [self.elf])
+
+
+class ParseELFTest(ELFTestCase):
+  """Tests for finding the libs in ParseELF"""
+
+  def setUp(self):
+    self.ldpaths = {
+        'conf': [os.path.join(self.tempdir, 'lib')],
+        'env': [],
+        'interp': [],
+    }
+
+  def _ParseELF(self, **kwargs):
+    """Parse a fake ELF with the dynamic tags |kwargs|"""
+    path = self.WriteELF('bin/prog', **kwargs)
+    return lddtree.ParseELF(path, ldpaths=self.ldpaths,
+                            elf_cache=lddtree.ELFCache())
+
+  def testFindLib(self):
+    """Libs should be found in the ldpaths"""
+    lib = self.WriteELF('lib/libfoo.so')
+    self.WriteELF('other/libbar.so')
+    ret = self._ParseELF(needed=['libfoo.so', 'libbar.so'])
+    self.assertEqual(ret['libs']['libfoo.so']['path'], lib)
+    self.assertEqual(ret['libs']['libbar.so']['path'], None)
+
+  def testFindLibSubdir(self):
+    """Needed entries with a / in them should be found in subdirs"""
+    lib = self.WriteELF('lib/sub/libfoo.so')
+    ret = self._ParseELF(needed=['sub/libfoo.so'])
+    self.assertEqual(ret['libs']['sub/libfoo.so']['path'], lib)
+
+  def testFindLibIncompatible(self):
+    """Libs for other machines should be skipped"""
+    self.ldpaths['env'] = [os.path.join(self.tempdir, 'lib32')]
+    self.WriteELF('lib32/libfoo.so', compat=COMPAT[:-1] + ('EM_386',))
+    lib = self.WriteELF('lib/libfoo.so')
+    ret = self._ParseELF(needed=['libfoo.so'])
+    self.assertEqual(ret['libs']['libfoo.so']['path'], lib)
+
+  def testRpath(self):
+    """Libs should be found via RPATH"""
+    lib = self.WriteELF('rpath/libfoo.so')
+    ret = self._ParseELF(needed=['libfoo.so'],
+                         rpath=os.path.join(self.tempdir, 'rpath'))
+    self.assertEqual(ret['rpath'], [os.path.join(self.tempdir, 'rpath')])
+    self.assertEqual(ret['libs']['libfoo.so']['path'], lib)
+
+  def testRunpathHidesRpath(self):
+    """RPATH should be ignored when RUNPATH is set"""
+    self.WriteELF('rpath/libfoo.so')
+    ret = self._ParseELF(needed=['libfoo.so'],
+                         rpath=os.path.join(self.tempdir, 'rpath'),
+                         runpath=os.path.join(self.tempdir, 'runpath'))
+    self.assertEqual(ret['rpath'], [])
+    self.assertEqual(ret['runpath'], [os.path.join(self.tempdir, 'runpath')])
+    self.assertEqual(ret['libs']['libfoo.so']['path'], None)
+
+  def testEmptyRunpath(self):
+    """An empty RUNPATH should not hide RPATH"""
+    lib = self.WriteELF('rpath/libfoo.so')
+    ret = self._ParseELF(needed=['libfoo.so'],
+                         rpath=os.path.join(self.tempdir, 'rpath'),
+                         runpath='')
+    self.assertEqual(ret['rpath'], [os.path.join(self.tempdir, 'rpath')])
+    self.assertEqual(ret['runpath'], [])
+    self.assertEqual(ret['libs']['libfoo.so']['path'], lib)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -214,6 +214,7 @@ def FinalizeTable(csv_table):
     if len(matching_rows) > 1:
       for mr in matching_rows:
         mr[COL_PACKAGE] += ':' + mr[COL_SLOT]
+      csv_table.InvalidateIndex()
 
     # Split target column into cros_target and host_target columns
     target_str = row.get(COL_TARGET, None)
@@ -12,6 +12,7 @@ import tempfile
 
 from chromite.lib import cros_test_lib
 from chromite.lib import table
+from chromite.lib import upgrade_table as utable
 from chromite.scripts import merge_package_status as mps
 
 # pylint: disable=W0212,R0904
@@ -205,6 +206,42 @@ class MergeTest(cros_test_lib.OutputTestCase, cros_test_lib.TempDirTestCase):
     os.unlink(path1)
     os.unlink(path2)
 
+  def _CreateBoardTable(self, arch, num_packages, offset):
+    """Return a table like cros_portage_upgrade writes for one board."""
+    col_ver = utable.UpgradeTable.GetColumnName(
+        utable.UpgradeTable.COL_CURRENT_VER, arch)
+    col_deps = utable.UpgradeTable.GetColumnName(
+        utable.UpgradeTable.COL_DEPENDS_ON, arch)
+    rows = []
+    for i in xrange(offset, offset + num_packages):
+      rows.append({mps.COL_PACKAGE: 'cat-%d/pkg-%d' % (i % 50, i),
+                   mps.COL_SLOT: str(i % 3),
+                   mps.COL_OVERLAY: 'portage',
+                   col_ver: '1.%d' % i,
+                   col_deps: 'cat-0/pkg-%d cat-1/pkg-%d' % (i + 1, i + 2),
+                   mps.COL_TARGET: 'virtual/target-os'})
+    cols = [mps.COL_PACKAGE, mps.COL_SLOT, mps.COL_OVERLAY, col_ver, col_deps,
+            mps.COL_TARGET]
+    mytable = self._CreateTableWithRows(cols, rows)
+    mytable.SetName(arch)
+    return mytable
+
+  def testMergeLargeTables(self):
+    """Merge per-board tables of realistic size."""
+    num_packages = 3000
+    tables = [self._CreateBoardTable('x86', num_packages, 0),
+              self._CreateBoardTable('amd64', num_packages, 500),
+              self._CreateBoardTable('arm', num_packages, 1000)]
+
+    with self.OutputCapturer():
+      csv_table = mps.MergeTables(tables)
+
+    self.assertEquals(num_packages + 1000, len(csv_table))
+    row = csv_table.GetRowsByValue({mps.COL_PACKAGE: 'cat-0/pkg-1500',
+                                    mps.COL_SLOT: '0'})[0]
+    self.assertEquals('1.1500', row['Current arm Version'])
+    self.assertEquals('1.1500', row['Current x86 Version'])
+
   def testFinalizeTable(self):
     self.assertEquals(3, self._table.GetNumRows())
     self.assertEquals(len(self.COLUMNS), self._table.GetNumColumns())
@@ -0,0 +1,288 @@
+# Copyright (c) 2014 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Answer portage database queries for a sysroot over a local socket.
+
+Every portageq/equery run has to initialize portage & load its databases,
+which often takes seconds.  This server loads them once and keeps them around
+so repeated queries are cheap.  It speaks newline delimited json: clients send
+  {"cmd": "best_visible", "args": ["ebuild", "chromeos-base/chromeos-chrome"]}
+and get back {"result": ...} or {"error": "..."}.
+
+See portage_utilities.Portageq for the client side.  The server shuts itself
+down once it has been idle for a while, or when asked to (see
+portage_utilities.ShutdownPortageqServers).
+"""
+
+import errno
+import glob
+import json
+import logging
+import os
+import socket
+import SocketServer
+import stat
+
+from chromite.cbuildbot import portage_utilities
+from chromite.lib import commandline
+from chromite.lib import cros_build_lib
+
+
+# How long (in seconds) to stay around without any queries.
+IDLE_TIMEOUT = 10 * 60
+
+# The files (relative to the sysroot) that change whenever packages are
+# (un)merged.
+_VDB_PATHS = ('var/cache/edb/counter', 'var/db/pkg')
+
+# The portage config files (relative to the sysroot), and how deep to look
+# into each of them for changes.
+_CONFIG_PATHS = (('etc/make.conf*', 0), ('etc/portage', 3))
+
+# Where overlays keep the PORTAGE_BINHOST settings make.conf sources.
+_BINHOST_CONF_DIR = 'chromeos/binhost'
+
+# Which portage tree to look in for each package type.
+_PKG_TYPE_TREES = {
+    'ebuild': 'porttree',
+    'binary': 'bintree',
+    'installed': 'vartree',
+}
+
+
+def _GetMtimes(path, depth=0):
+  """Return the mtimes of |path| & of whatever is up to |depth| levels below it
+
+  Hidden files (like .git dirs) are skipped.
+  """
+  try:
+    st = os.stat(path)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    return [(path, None)]
+  mtimes = [(path, st.st_mtime)]
+  if depth and stat.S_ISDIR(st.st_mode):
+    for name in sorted(os.listdir(path)):
+      if not name.startswith('.'):
+        mtimes += _GetMtimes(os.path.join(path, name), depth - 1)
+  return mtimes
+
+
+class PortageDB(object):
+  """The portage databases for a sysroot, reloaded when they might be stale"""
+
+  def __init__(self, sysroot):
+    self.sysroot = sysroot
+    self.root = os.path.join(sysroot, '')
+    self._trees = None
+    self._stamp = None
+    self._overlays = []
+    self._profiles = []
+
+  def _GetStamp(self):
+    """Return a stamp of everything the answers to queries depend on
+
+    It changes whenever packages are (un)merged, the portage config or
+    profiles change, or ebuilds are added to or removed from the overlays
+    (e.g. when uprevving).
+    """
+    stamp = []
+    for path in _VDB_PATHS:
+      stamp += _GetMtimes(os.path.join(self.root, path))
+    for pattern, depth in _CONFIG_PATHS:
+      for path in sorted(glob.glob(os.path.join(self.root, pattern))):
+        stamp += _GetMtimes(path, depth)
+    for overlay in self._overlays:
+      # Adding or removing an ebuild updates the mtime of its package dir.
+      stamp += _GetMtimes(overlay, 2)
+      stamp += _GetMtimes(os.path.join(overlay, _BINHOST_CONF_DIR), 2)
+    for profile in self._profiles:
+      stamp += _GetMtimes(profile, 1)
+    return stamp
+
+  def _Load(self):
+    """(Re)load the portage databases for the sysroot"""
+    # pylint: disable=F0401
+    import portage
+    logging.info('loading portage databases for %s', self.sysroot)
+    trees = portage.create_trees(config_root=self.root, target_root=self.root)
+    self._trees = trees[self.root]
+    settings = self._trees['vartree'].settings
+    self._overlays = ([settings['PORTDIR']] +
+                      settings.get('PORTDIR_OVERLAY', '').split())
+    self._profiles = list(settings.profiles)
+
+  def GetTree(self, name):
+    """Return the portage tree |name|, loading things first if need be"""
+    stamp = self._GetStamp()
+    if self._trees is None or stamp != self._stamp:
+      self._Load()
+      # What to watch depends on the config we just loaded.
+      stamp = self._GetStamp()
+      self._stamp = stamp
+    return self._trees[name]
+
+  def BestVisible(self, pkg_type, atom):
+    """Return the best visible CPV of |pkg_type| for |atom| (or '')"""
+    # pylint: disable=F0401
+    import portage
+    dbapi = self.GetTree(_PKG_TYPE_TREES[pkg_type]).dbapi
+    return portage.best(dbapi.match(atom))
+
+  def EnvVar(self, *args):
+    """Return the values of the portage config variables named in |args|"""
+    settings = self.GetTree('vartree').settings
+    return [settings.get(x, '') for x in args]
+
+  def Match(self, atom):
+    """Return the installed CPVs that match |atom|"""
+    return self.GetTree('vartree').dbapi.match(atom)
+
+  def Contents(self, cpv):
+    """Return the sorted list of files installed by |cpv|"""
+    # pylint: disable=F0401
+    import portage
+    vartree = self.GetTree('vartree')
+    if not vartree.dbapi.cpv_exists(cpv):
+      raise ValueError('%s is not installed' % cpv)
+    category, pf = portage.catsplit(cpv)
+    dblink = portage.dblink(category, pf, self.root, vartree.settings,
+                            treetype='vartree', vartree=vartree)
+    return sorted(dblink.getcontents())
+
+
+class _QueryHandler(SocketServer.StreamRequestHandler):
+  """Answer every query sent over the connection"""
+
+  def handle(self):
+    db = self.server.db
+    queries = {
+        'best_visible': db.BestVisible,
+        'envvar': db.EnvVar,
+        'match': db.Match,
+        'contents': db.Contents,
+        'shutdown': self.server.Shutdown,
+    }
+    for line in self.rfile:
+      try:
+        query = json.loads(line)
+        reply = {'result': queries[query['cmd']](*query['args'])}
+      except Exception as e:
+        logging.warning('query %r failed: %s', line.strip(), e)
+        reply = {'error': '%s: %s' % (type(e).__name__, e)}
+      self.wfile.write(json.dumps(reply) + '\n')
+      self.wfile.flush()
+
+
+class PortageqServer(SocketServer.UnixStreamServer):
+  """Serve queries for one sysroot, one at a time (portage isn't threadsafe)"""
+
+  timeout = IDLE_TIMEOUT
+
+  def __init__(self, socket_path, db):
+    self.socket_path = socket_path
+    self.db = db
+    self.idle = False
+    SocketServer.UnixStreamServer.__init__(self, socket_path, _QueryHandler)
+
+  def server_bind(self):
+    # Only take over the socket if the server that owned it went away.
+    try:
+      SocketServer.UnixStreamServer.server_bind(self)
+    except socket.error as e:
+      if e.errno != errno.EADDRINUSE or _IsServing(self.socket_path):
+        raise
+      os.unlink(self.socket_path)
+      SocketServer.UnixStreamServer.server_bind(self)
+
+  def handle_timeout(self):
+    self.idle = True
+
+  def Shutdown(self):
+    """Exit once the current request has been answered"""
+    self.idle = True
+
+  def Serve(self):
+    """Answer queries until we've been idle for a while"""
+    try:
+      while not self.idle:
+        self.handle_request()
+    finally:
+      self.server_close()
+      os.unlink(self.socket_path)
+
+
+def _IsServing(socket_path):
+  """Whether a server is answering on |socket_path|"""
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+    return True
+  except socket.error:
+    return False
+  finally:
+    sock.close()
+
+
+def _Daemonize():
+  """Detach from our parent so it can exit while we keep serving"""
+  # pylint: disable=W0212
+  if os.fork():
+    os._exit(0)
+  os.setsid()
+  if os.fork():
+    os._exit(0)
+  # Don't keep the directory we were started from busy.
+  os.chdir('/')
+  null = os.open(os.devnull, os.O_RDWR)
+  for fd in (0, 1, 2):
+    os.dup2(null, fd)
+  os.close(null)
+
+
+def GetParser():
+  """Return a command line parser"""
+  parser = commandline.ArgumentParser(description=__doc__)
+  parser.add_argument('--board', default=None,
+                      help='board whose sysroot to answer queries for '
+                           '(default: the sdk)')
+  parser.add_argument('--daemon', action='store_true', default=False,
+                      help='run in the background')
+  return parser
+
+
+def main(argv):
+  opts = GetParser().parse_args(argv)
+  opts.Freeze()
+
+  if not cros_build_lib.IsInsideChroot():
+    cros_build_lib.Die('%s must be run inside the chroot' % __file__)
+
+  sysroot = cros_build_lib.GetSysroot(board=opts.board)
+  if opts.board:
+    # Do what the portageq-<board> wrappers do.
+    os.environ['ROOT'] = sysroot
+    os.environ['PORTAGE_CONFIGROOT'] = sysroot
+    os.environ['SYSROOT'] = sysroot
+
+  socket_path = portage_utilities.GetPortageqSocketPath(opts.board)
+  if _IsServing(socket_path):
+    logging.info('a server is already running on %s', socket_path)
+    return 0
+
+  # Bind before going into the background so that once we return, clients
+  # can connect right away (their queries wait while portage loads).
+  try:
+    server = PortageqServer(socket_path, PortageDB(sysroot))
+  except socket.error as e:
+    if e.errno == errno.EADDRINUSE and _IsServing(socket_path):
+      # Someone else started one at the same time as us.
+      return 0
+    raise
+
+  if opts.daemon:
+    _Daemonize()
+  server.Serve()
+  return 0
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# Copyright (c) 2014 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for portageq_server.py"""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', '..'))
+from chromite.cbuildbot import portage_utilities
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from chromite.scripts import portageq_server
+
+# TODO(build): Finish test wrapper (http://crosbug.com/37517).
+# Until then, this has to be after the chromite imports.
+import mock
+
+
+class FakePortageDB(portageq_server.PortageDB):
+  """Answer queries without portage"""
+
+  def BestVisible(self, pkg_type, atom):
+    return '%s-1.0' % atom if pkg_type == 'ebuild' else ''
+
+  def EnvVar(self, *args):
+    return ['%s-value' % x for x in args]
+
+  def Match(self, atom):
+    return ['%s-1.0' % atom, '%s-2.0' % atom]
+
+  def Contents(self, cpv):
+    raise ValueError('%s is not installed' % cpv)
+
+
+class PortageqServerTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for the portageq server & client"""
+
+  def setUp(self):
+    self.socket_path = os.path.join(self.tempdir, 'portageq-foo.sock')
+    self.PatchObject(portage_utilities.Portageq, '_GetSocketPath',
+                     return_value=self.socket_path)
+    self.rc_mock = self.PatchObject(cros_build_lib, 'RunCommand',
+                                    side_effect=self._RunCommand)
+    self.portageq = portage_utilities.Portageq(board='foo')
+    self.server = None
+    self.thread = None
+
+  def tearDown(self):
+    if self.server:
+      self.server.idle = True
+      self._Query()
+      self.thread.join()
+
+  def _Query(self):
+    """Poke the server (so it notices it has to exit)"""
+    try:
+      self.portageq.EnvVar('FOO')
+    except Exception:
+      pass
+
+  def _RunCommand(self, cmd, **_kwargs):
+    """Start the server, or pretend to be portageq"""
+    if cmd[0].endswith('portageq_server'):
+      self.assertEqual(cmd[1:], ['--daemon', '--board', 'foo'])
+      self._StartServer()
+      return cros_build_lib.CommandResult(cmd=cmd, returncode=0)
+    return cros_build_lib.CommandResult(cmd=cmd, output='portageq output\n',
+                                        returncode=0)
+
+  def _StartServer(self, timeout=portageq_server.IDLE_TIMEOUT):
+    self.server = portageq_server.PortageqServer(
+        self.socket_path, FakePortageDB('/build/foo'))
+    self.server.timeout = timeout
+    self.thread = threading.Thread(target=self.server.Serve)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def testQueries(self):
+    """Queries should be answered by the server"""
+    self._StartServer()
+    self.assertEqual(self.portageq.BestVisible('cat/pkg'), 'cat/pkg-1.0')
+    self.assertEqual(self.portageq.BestVisible('cat/pkg', pkg_type='binary'),
+                     '')
+    self.assertEqual(self.portageq.EnvVar('ARCH'), 'ARCH-value')
+    self.assertEqual(self.portageq.Match('cat/pkg'),
+                     ['cat/pkg-1.0', 'cat/pkg-2.0'])
+    self.assertEqual(self.rc_mock.call_count, 0)
+
+  def testStartServer(self):
+    """The server should be started on first use & then reused"""
+    self.assertEqual(self.portageq.EnvVar('ARCH'), 'ARCH-value')
+    self.assertEqual(self.portageq.EnvVar('ARCH'), 'ARCH-value')
+    self.assertEqual(self.rc_mock.call_count, 1)
+
+  def testQueryError(self):
+    """Queries the server can't answer should go to portageq"""
+    self._StartServer()
+    self.assertEqual(self.portageq.Contents('cat/pkg-1.0'),
+                     ['portageq output'])
+    self.rc_mock.assert_called_once_with(
+        ['portageq-foo', 'contents', '/build/foo', 'cat/pkg-1.0'],
+        cwd=self.portageq.buildroot, enter_chroot=True,
+        debug_level=mock.ANY, capture_output=True)
+    # The server should still be used for later queries.
+    self.assertEqual(self.portageq.EnvVar('ARCH'), 'ARCH-value')
+    self.assertEqual(self.rc_mock.call_count, 1)
+
+  def testNoServer(self):
+    """Fall back to portageq when the server can't be started"""
+    def _RunCommand(cmd, **kwargs):
+      if cmd[0].endswith('portageq_server'):
+        raise cros_build_lib.RunCommandError('failed', None)
+      return self._RunCommand(cmd, **kwargs)
+    self.rc_mock.side_effect = _RunCommand
+    self.assertEqual(self.portageq.EnvVar('ARCH', error_code_ok=True),
+                     'portageq output')
+    self.assertEqual(self.portageq.Match('cat/pkg'), ['portageq', 'output'])
+    # We should only try to start the server once.
+    self.assertEqual(self.rc_mock.call_count, 3)
+
+  def testIdleTimeout(self):
+    """The server should clean up after itself once idle"""
+    self._StartServer(timeout=0.01)
+    self.thread.join(10)
+    self.assertFalse(self.thread.is_alive())
+    self.assertFalse(os.path.exists(self.socket_path))
+    self.server = None
+    self.thread = None
+
+  def testShutdown(self):
+    """The server should exit when asked to"""
+    self._StartServer()
+    self.PatchObject(portage_utilities, '_PORTAGEQ_SOCKET',
+                     new=os.path.join(self.tempdir, 'portageq-%s.sock'))
+    self.PatchObject(cros_build_lib, 'IsInsideChroot', return_value=True)
+    portage_utilities.ShutdownPortageqServers()
+    self.thread.join(10)
+    self.assertFalse(self.thread.is_alive())
+    self.assertFalse(os.path.exists(self.socket_path))
+    self.server = None
+    self.thread = None
+    # Nothing to do when no servers are running.
+    portage_utilities.ShutdownPortageqServers()
+
+  def testStaleSocket(self):
+    """A socket left behind by a dead server should be taken over"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(self.socket_path)
+    sock.close()
+    self._StartServer()
+    self.assertEqual(self.portageq.EnvVar('ARCH'), 'ARCH-value')
+
+  def testSocketInUse(self):
+    """We should not take over the socket of a live server"""
+    self._StartServer()
+    self.assertRaises(socket.error, portageq_server.PortageqServer,
+                      self.socket_path, FakePortageDB('/build/foo'))
+    self.assertEqual(self.portageq.EnvVar('ARCH'), 'ARCH-value')
+
+
+class PortageDBTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for PortageDB"""
+
+  def setUp(self):
+    self.overlay = os.path.join(self.tempdir, 'overlay')
+    self.profile = os.path.join(self.overlay, 'profiles', 'base')
+    osutils.SafeMakedirs(os.path.join(self.overlay, 'cat', 'pkg'))
+    osutils.SafeMakedirs(self.profile)
+    osutils.SafeMakedirs(os.path.join(self.overlay, '.git'))
+    self.db = portageq_server.PortageDB(self.tempdir)
+    self.load_mock = self.PatchObject(self.db, '_Load', side_effect=self._Load)
+    self.tree = self.db.GetTree('vartree')
+
+  def _Load(self):
+    """Pretend to load the portage databases"""
+    # pylint: disable=W0212
+    self.db._trees = {'vartree': object()}
+    self.db._overlays = [self.overlay]
+    self.db._profiles = [self.profile]
+
+  def _Touch(self, path, mtime):
+    """Set the mtime of |path| to something that will look new"""
+    path = os.path.join(self.tempdir, path)
+    if not os.path.exists(path):
+      osutils.Touch(path, makedirs=True)
+    os.utime(path, (time.time() + mtime,) * 2)
+
+  def _AssertReloads(self, reloads):
+    """Check whether a query reloaded the databases"""
+    count = self.load_mock.call_count
+    tree = self.db.GetTree('vartree')
+    self.assertEqual(self.load_mock.call_count, count + reloads)
+    self.assertEqual(tree is self.tree, not reloads)
+    self.tree = tree
+
+  def testNoChanges(self):
+    """The databases should be reused when nothing changed"""
+    self._AssertReloads(0)
+    self.assertEqual(self.load_mock.call_count, 1)
+
+  def testMerges(self):
+    """The databases should be reloaded when packages are merged"""
+    self._Touch('var/cache/edb/counter', 10)
+    self._AssertReloads(1)
+    self._Touch('var/db/pkg', 20)
+    self._AssertReloads(1)
+
+  def testConfig(self):
+    """The databases should be reloaded when the portage config changes"""
+    self._Touch('etc/make.conf.board_setup', 10)
+    self._AssertReloads(1)
+    self._Touch('etc/portage/package.keywords/cros', 20)
+    self._AssertReloads(1)
+    self._Touch('overlay/profiles/base/make.defaults', 30)
+    self._AssertReloads(1)
+    self._Touch('overlay/chromeos/binhost/target/BINHOST.conf', 40)
+    self._AssertReloads(1)
+
+  def testUprev(self):
+    """The databases should be reloaded when ebuilds come and go"""
+    osutils.Touch(os.path.join(self.overlay, 'cat', 'pkg', 'pkg-2.ebuild'))
+    self._Touch('overlay/cat/pkg', 10)
+    self._AssertReloads(1)
+    # Git activity in the overlay doesn't matter though.
+    self._Touch('overlay/.git/index', 20)
+    self._AssertReloads(0)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
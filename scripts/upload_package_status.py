@@ -119,8 +119,8 @@ class Uploader(object):
               row_delta[col] = new_val
 
         if row_delta:
-          self._scomm.UpdateRowCellByCell(ss_row.ss_row_num,
-                                          gdata_lib.PrepRowForSS(row_delta))
+          self._scomm.QueueRowUpdate(ss_row.ss_row_num,
+                                     gdata_lib.PrepRowForSS(row_delta))
           rows_updated += 1
           oper.Info('C %-30s: %s' % (csv_package, ', '.join(changed)))
         else:
@@ -135,6 +135,12 @@ class Uploader(object):
             row_descr_list.append('%s="%s"' % (col, new_row[col]))
         oper.Info('A %-30s: %s' % (csv_package, ', '.join(row_descr_list)))
 
+    # Write all the changed cells in one go, before any rows get deleted
+    # (which would change the row numbers).
+    if rows_updated:
+      oper.Notice('Writing changes to %d rows.' % rows_updated)
+    self._scomm.FlushCellUpdates()
+
     return (rows_unchanged, rows_updated, rows_inserted)
 
   def _DeleteOldRows(self):
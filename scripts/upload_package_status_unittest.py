@@ -12,6 +12,7 @@ import mox
 
 from chromite.lib import cros_test_lib
 from chromite.lib import gdata_lib
+from chromite.lib import gdata_lib_unittest
 from chromite.lib import osutils
 from chromite.lib import table as tablelib
 from chromite.scripts import merge_package_status as mps
@@ -290,7 +291,7 @@ class UploaderTest(cros_test_lib.MoxOutputTestCase):
     g_col_set1 = set(row1_reverse_delta.keys())
     g_row1 = gdata_lib.PrepRowForSS(self.SS_ROW1)
     row1_verifier = lambda rdelta : RowVerifier(rdelta, g_col_set1, g_row1)
-    mocked_uploader._scomm.UpdateRowCellByCell(3, mox.Func(row1_verifier))
+    mocked_uploader._scomm.QueueRowUpdate(3, mox.Func(row1_verifier))
 
     # Third Row.
     # Pretend third row does already exist in online spreadsheet, and
@@ -309,7 +310,10 @@ class UploaderTest(cros_test_lib.MoxOutputTestCase):
     g_col_set2 = set(row2_reverse_delta.keys())
     g_row2 = gdata_lib.PrepRowForSS(self.SS_ROW2)
     row2_verifier = lambda rdelta : RowVerifier(rdelta, g_col_set2, g_row2)
-    mocked_uploader._scomm.UpdateRowCellByCell(4, mox.Func(row2_verifier))
+    mocked_uploader._scomm.QueueRowUpdate(4, mox.Func(row2_verifier))
+
+    # All changes get written together at the end.
+    mocked_uploader._scomm.FlushCellUpdates()
 
     self.mox.ReplayAll()
 
@@ -318,6 +322,45 @@ class UploaderTest(cros_test_lib.MoxOutputTestCase):
       ups.Uploader._UploadChangedRows(mocked_uploader)
     self.mox.VerifyAll()
 
+  def testUploadChangedRowsBatched(self):
+    """Changed rows should be written to the spreadsheet in one batch."""
+    cells = {}
+    for colIx, col in enumerate(self.COLS, start=1):
+      cells[(1, colIx)] = col
+    ss_rows = []
+    for rowIx, row in enumerate((self.SS_ROW1, self.SS_ROW2), start=2):
+      ss_row = gdata_lib.PrepRowForSS(row)
+      ss_row[self.SS_COL_VER] = 'old'
+      ss_rows.append(gdata_lib.SpreadsheetRow('OrigRow%d' % rowIx, rowIx,
+                                              ss_row))
+      for colIx, col in enumerate(self.COLS, start=1):
+        cells[(rowIx, colIx)] = ss_row[gdata_lib.PrepColNameForSS(col)]
+    service = gdata_lib_unittest.FakeSpreadsheetsService(cells)
+
+    scomm = gdata_lib.SpreadsheetComm()
+    scomm.gd_client = service
+    scomm.ss_key = 'TheSSKey'
+    scomm.ws_key = 'TheWSKey'
+
+    table = self._CreateTableWithRows(self.COLS, [self.ROW1, self.ROW2])
+    uploader = ups.Uploader(None, table)
+    uploader._scomm = scomm
+    uploader._ss_row_cache = dict((r[self.SS_COL_PKG], r) for r in ss_rows)
+
+    with self.OutputCapturer():
+      result = uploader._UploadChangedRows()
+    self.assertEquals((0, 2, 0), result)
+
+    ver_ix = self.COLS.index(self.COL_VER) + 1
+    self.assertEquals(gdata_lib.PrepValForSS(self.ROW1[self.COL_VER]),
+                      service.cells[(2, ver_ix)])
+    self.assertEquals(gdata_lib.PrepValForSS(self.ROW2[self.COL_VER]),
+                      service.cells[(3, ver_ix)])
+    # One request to look up the columns, then one to fetch & one to write
+    # the changed cells.
+    self.assertEquals(['GetCellsFeed', 'GetCellsFeed', 'ExecuteBatch'],
+                      [req for req, _ in service.requests])
+
   def testDeleteOldRows(self):
     mocked_uploader = self._MockUploader()
 
@@ -11,6 +11,7 @@ for those executables involved).
 
 from __future__ import print_function
 
+import cStringIO
 import ctypes
 import datetime
 import errno
@@ -30,6 +31,7 @@ except ImportError:
 import random
 import signal
 import socket
+import tarfile
 import textwrap
 import tempfile
 import time
@@ -41,6 +43,7 @@ from chromite.lib import cache
 from chromite.lib import commandline
 from chromite.lib import cros_build_lib
 from chromite.lib import gs
+from chromite.lib import locking
 from chromite.lib import osutils
 from chromite.lib import parallel
 from chromite.lib import retry_util
@@ -94,16 +97,46 @@ DEDUPE_NOTIFY_TIMEOUT = 20
 OFFICIAL_DEDUPE_NAMESPACE = 'chromium-os-upload-symbols'
 STAGING_DEDUPE_NAMESPACE = '%s-staging' % OFFICIAL_DEDUPE_NAMESPACE
 
+# Where the local dedupe index lives (relative to the common cache dir).
+DEDUPE_INDEX_DIR = 'upload_symbols'
+
+# How much of a symbol file to read at a time when hashing it.
+HASH_CHUNK_SIZE = 1024 * 1024
+
 
 # How long to wait (in seconds) for a single upload to complete.  This has
 # to allow for symbols that are up to CRASH_SERVER_FILE_LIMIT in size.
 UPLOAD_TIMEOUT = 30 * 60
 
 
-# Sleep for 200ms in between uploads to avoid DoS'ing symbol server.
+# Sleep for 200ms in between uploads to avoid DoS'ing symbol server.  With
+# the rate controller, this is how often we start uploads to begin with.
 DEFAULT_SLEEP_DELAY = 0.2
 
 
+# The most uploads we'll run at once.  We start with one at a time (the server
+# has DoS protection -- see http://crbug.com/209442 & http://crbug.com/212496)
+# and only ramp up while the server keeps up.  See UploadRateController.
+DEFAULT_MAX_CONCURRENCY = 8
+
+# How much the upload rate & concurrency grow after each successful upload,
+# and how much they shrink by when the server pushes back on us.
+RATE_INCREASE = 0.5
+RATE_BACKOFF = 0.5
+
+# The most we'll speed up the rate of starting uploads (relative to the
+# initial rate), and the most we'll slow it down.
+MAX_RATE_FACTOR = DEFAULT_MAX_CONCURRENCY
+MIN_RATE_FACTOR = 1.0 / 8
+
+# Every this many bytes of a symbol file costs one more token to upload, so
+# big files use up more of the rate budget than small ones.
+RATE_BYTES_PER_TOKEN = 10 * 1024 * 1024
+
+# How long to wait (in seconds) before checking again for a free upload slot.
+RATE_POLL_INTERVAL = 0.05
+
+
 # Number of seconds to wait before retrying an upload.  The delay will double
 # for each subsequent retry of the same symbol file.
 INITIAL_RETRY_DELAY = 1
@@ -140,6 +173,204 @@ ERROR_ADJUST_FAIL = 1.0
 ERROR_ADJUST_PASS = -0.5
 
 
+# The tarballs each process has open for reading members out of.  Keyed by
+# pid as the file offsets can't be shared with the processes we fork.
+_OPEN_TARBALLS = {}
+
+
+class TarballMember(str):
+  """A symbol file inside of a tarball that we read without unpacking it
+
+  This acts like the path the file would have if the tarball were unpacked
+  in place, so it can be logged & written to the failed list like any other
+  symbol file.  The header & digest are gathered while scanning the tarball
+  so we never have to seek backwards in it (which is slow when compressed).
+  """
+
+  # pylint: disable=W0231
+  def __new__(cls, tarball, tarinfo, *_args, **_kwargs):
+    return str.__new__(cls, os.path.join(tarball, tarinfo.name))
+
+  def __init__(self, tarball, tarinfo, header=None, digest=None):
+    self.tarball = tarball
+    self.tarinfo = tarinfo
+    self.header = header
+    self.digest = digest
+
+  def __getnewargs__(self):
+    return (self.tarball, self.tarinfo, self.header, self.digest)
+
+  @property
+  def size(self):
+    return self.tarinfo.size
+
+  def Open(self):
+    """Return a file object for reading this member"""
+    key = (os.getpid(), self.tarball)
+    tar = _OPEN_TARBALLS.get(key)
+    if tar is None:
+      tar = _OPEN_TARBALLS[key] = tarfile.open(self.tarball, 'r:*')
+    return tar.extractfile(self.tarinfo)
+
+
+def _CloseTarballs():
+  """Close the tarballs this process opened via TarballMember.Open"""
+  pid = os.getpid()
+  for key in [x for x in _OPEN_TARBALLS if x[0] == pid]:
+    _OPEN_TARBALLS.pop(key).close()
+
+
+def _GetSymbolSize(sym_file):
+  """Return the size of |sym_file| (a path or TarballMember)"""
+  if isinstance(sym_file, TarballMember):
+    return sym_file.size
+  return os.path.getsize(sym_file)
+
+
+def _OpenSymbol(sym_file):
+  """Return a file object for |sym_file| (a path or TarballMember)"""
+  if isinstance(sym_file, TarballMember):
+    return sym_file.Open()
+  return open(sym_file, 'rb')
+
+
+def _HashFile(f, digest):
+  """Update |digest| with the rest of the contents of |f|
+
+  Returns:
+    The hex digest.
+  """
+  for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ''):
+    digest.update(chunk)
+  return digest.hexdigest()
+
+
+class UploadRateController(object):
+  """Decide when to start uploads, and how many to run at once
+
+  Uploads are paced with a token bucket: tokens refill at |rate| per second,
+  and each upload costs one token plus one per RATE_BYTES_PER_TOKEN bytes.
+  On top of that, the number of uploads in flight is limited.  Both the rate
+  and the concurrency limit follow AIMD: they grow a little with every upload
+  that goes through, and are cut sharply when the server pushes back (HTTP
+  429/5xx, timeouts, dropped connections).
+
+  The state lives in shared memory so that all the upload processes forked
+  off after this is created work off the same budget.
+  """
+
+  # Offsets into the shared state.
+  _LIMIT, _ACTIVE, _TOKENS, _LAST, _RATE = range(5)
+
+  def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, rate=None):
+    """Initialize
+
+    Args:
+      max_concurrency: The most uploads to ever run at once.
+      rate: How many tokens to start uploads with per second.  If None, only
+        the concurrency is limited.
+    """
+    self.max_concurrency = max_concurrency
+    self.initial_rate = rate
+    self._lock = multiprocessing.Lock()
+    self._state = multiprocessing.RawArray(ctypes.c_double, 5)
+    self._state[self._LIMIT] = 1
+    self._state[self._TOKENS] = 1
+    self._state[self._LAST] = time.time()
+    self._state[self._RATE] = rate or 0
+
+  @property
+  def limit(self):
+    """The number of uploads we currently allow at once"""
+    return int(self._state[self._LIMIT])
+
+  @property
+  def rate(self):
+    """The rate at which uploads are currently started (tokens per second)"""
+    return self._state[self._RATE] or None
+
+  def _Refill(self, now):
+    """Add the tokens that accumulated since the last refill"""
+    state = self._state
+    if state[self._RATE]:
+      elapsed = max(0, now - state[self._LAST])
+      burst = max(1, state[self._LIMIT])
+      state[self._TOKENS] = min(burst, state[self._TOKENS] +
+                                elapsed * state[self._RATE])
+    state[self._LAST] = now
+
+  def Acquire(self, size=0):
+    """Wait for our turn to upload a file of |size| bytes"""
+    cost = 1 + size // RATE_BYTES_PER_TOKEN
+    state = self._state
+    while True:
+      with self._lock:
+        self._Refill(time.time())
+        # Don't let a big file wait forever for more tokens than can ever
+        # accumulate.
+        needed = min(cost, max(1, state[self._LIMIT]))
+        if state[self._ACTIVE] < int(state[self._LIMIT]):
+          if not state[self._RATE]:
+            state[self._ACTIVE] += 1
+            return
+          if state[self._TOKENS] >= needed:
+            state[self._TOKENS] -= cost
+            state[self._ACTIVE] += 1
+            return
+          delay = (needed - state[self._TOKENS]) / state[self._RATE]
+        else:
+          delay = RATE_POLL_INTERVAL
+      # Don't spin on float rounding when we're a hair short of a token.
+      time.sleep(min(max(delay, RATE_POLL_INTERVAL / 10), RATE_POLL_INTERVAL))
+
+  def Release(self, success=True, throttled=False):
+    """Note that an upload finished
+
+    Args:
+      success: Whether the upload went through.
+      throttled: Whether the server pushed back on the upload.
+    """
+    state = self._state
+    with self._lock:
+      state[self._ACTIVE] = max(0, state[self._ACTIVE] - 1)
+      if throttled:
+        state[self._LIMIT] = max(1, state[self._LIMIT] * RATE_BACKOFF)
+        if state[self._RATE]:
+          state[self._RATE] = max(self.initial_rate * MIN_RATE_FACTOR,
+                                  state[self._RATE] * RATE_BACKOFF)
+          # Start refilling from empty so we pause for a bit.
+          state[self._TOKENS] = min(0, state[self._TOKENS])
+      elif success:
+        # Grow by about one upload for each round of |limit| uploads.
+        state[self._LIMIT] = min(self.max_concurrency, state[self._LIMIT] +
+                                 RATE_INCREASE * 2 / state[self._LIMIT])
+        if state[self._RATE]:
+          state[self._RATE] = min(self.initial_rate * MAX_RATE_FACTOR,
+                                  state[self._RATE] + RATE_INCREASE)
+
+
+def _IsThrottled(e):
+  """Whether the upload error |e| means the server is struggling"""
+  if isinstance(e, urllib2.HTTPError):
+    return e.code == 429 or e.code >= 500
+  return isinstance(e, (urllib2.URLError, httplib.HTTPException,
+                        socket.error))
+
+
+def _RateControlledSymUpload(rate_control, upload_url, sym_item):
+  """Run SymUpload once the |rate_control| lets us"""
+  rate_control.Acquire(_GetSymbolSize(sym_item.sym_file))
+  success = throttled = False
+  try:
+    SymUpload(upload_url, sym_item)
+    success = True
+  except Exception as e:
+    throttled = _IsThrottled(e)
+    raise
+  finally:
+    rate_control.Release(success=success, throttled=throttled)
+
+
 def SymUpload(upload_url, sym_item):
   """Upload a symbol file to a HTTP server
 
@@ -163,6 +394,14 @@ def SymUpload(upload_url, sym_item):
   sym_header = sym_item.sym_header
   sym_file = sym_item.sym_file
 
+  if isinstance(sym_file, TarballMember):
+    # Stream the symbols straight out of the tarball.
+    sym_param = poster.encode.MultipartParam(
+        'symbol_file', filename=os.path.basename(sym_file),
+        filesize=sym_file.size, fileobj=sym_file.Open())
+  else:
+    sym_param = poster.encode.MultipartParam.from_file('symbol_file', sym_file)
+
   fields = (
       ('code_file', sym_header.name),
       ('debug_file', sym_header.name),
@@ -178,7 +417,7 @@ def SymUpload(upload_url, sym_item):
       ('product', 'ChromeOS'),
       ('os', sym_header.os),
       ('cpu', sym_header.cpu),
-      poster.encode.MultipartParam.from_file('symbol_file', sym_file),
+      sym_param,
   )
 
   data, headers = poster.encode.multipart_encode(fields)
@@ -252,7 +491,8 @@ def _UpdateCounter(counter, adj):
 
 def UploadSymbol(upload_url, sym_item, file_limit=DEFAULT_FILE_LIMIT,
                  sleep=0, num_errors=None, watermark_errors=None,
-                 failed_queue=None, passed_queue=None):
+                 failed_queue=None, passed_queue=None, dedupe_index=None,
+                 rate_control=None):
   """Upload |sym_item| to |upload_url|
 
   Args:
@@ -264,6 +504,8 @@ def UploadSymbol(upload_url, sym_item, file_limit=DEFAULT_FILE_LIMIT,
     watermark_errors: An object to track current error behavior (needs a .value)
     failed_queue: When a symbol fails, add it to this queue
     passed_queue: When a symbol passes, add it to this queue
+    dedupe_index: When a symbol passes, record it in this DedupeIndex
+    rate_control: An UploadRateController to pace each upload attempt with
 
   Returns:
     The number of errors that were encountered.
@@ -293,19 +535,23 @@ def UploadSymbol(upload_url, sym_item, file_limit=DEFAULT_FILE_LIMIT,
       # is unnecessary for 32bit x86 targets where the frame pointer is used (as
       # all of ours have) and it accounts for over half the size of the symbols
       # uploaded.
-      file_size = os.path.getsize(sym_file)
+      file_size = _GetSymbolSize(sym_file)
       if file_size > file_limit:
         cros_build_lib.Warning('stripping CFI from %s due to size %s > %s',
                                sym_file, file_size, file_limit)
-        temp_sym_file.writelines([x for x in open(sym_file, 'rb').readlines()
-                                  if not x.startswith('STACK CFI')])
+        f = _OpenSymbol(sym_file)
+        try:
+          temp_sym_file.writelines([x for x in f
+                                    if not x.startswith('STACK CFI')])
+        finally:
+          f.close()
 
         upload_item = FakeItem(sym_file=temp_sym_file.name,
                                  sym_header=sym_item.sym_header)
 
     # Hopefully the crash server will let it through.  But it probably won't.
     # Not sure what the best answer is in this case.
-    file_size = os.path.getsize(upload_item.sym_file)
+    file_size = _GetSymbolSize(upload_item.sym_file)
     if file_size > CRASH_SERVER_FILE_LIMIT:
       cros_build_lib.PrintBuildbotStepWarnings()
       cros_build_lib.Warning('upload file %s is awfully large, risking '
@@ -313,11 +559,15 @@ def UploadSymbol(upload_url, sym_item, file_limit=DEFAULT_FILE_LIMIT,
                              sym_file, file_size, CRASH_SERVER_FILE_LIMIT)
 
     # Upload the symbol file.
+    if rate_control is None:
+      upload = SymUpload
+    else:
+      upload = functools.partial(_RateControlledSymUpload, rate_control)
     success = False
     try:
       cros_build_lib.TimedCommand(
           retry_util.RetryException,
-          (urllib2.HTTPError, urllib2.URLError), MAX_RETRIES, SymUpload,
+          (urllib2.HTTPError, urllib2.URLError), MAX_RETRIES, upload,
           upload_url, upload_item, sleep=INITIAL_RETRY_DELAY,
           timed_log_msg='upload of %10i bytes took %%s: %s' %
                         (file_size, os.path.basename(sym_file)))
@@ -325,6 +575,12 @@ def UploadSymbol(upload_url, sym_item, file_limit=DEFAULT_FILE_LIMIT,
 
       if passed_queue:
         passed_queue.put(sym_item)
+      if dedupe_index is not None:
+        try:
+          dedupe_index.Add(sym_item)
+        except EnvironmentError:
+          cros_build_lib.Warning('could not record %s in the dedupe index',
+                                 os.path.basename(sym_file), exc_info=True)
     except urllib2.HTTPError as e:
       cros_build_lib.Warning('could not upload: %s: HTTP %s: %s',
                              os.path.basename(sym_file), e.code, e.reason)
@@ -348,18 +604,95 @@ FakeItem = cros_build_lib.Collection(
     'FakeItem', sym_file=None, sym_header=None, content=lambda x: '')
 
 
+class SymbolFile(object):
+  """A sym_file along with its parsed header & content digest"""
+
+  def __init__(self, sym_file):
+    if isinstance(sym_file, TarballMember):
+      self.sym_header = sym_file.header
+      self._content_digest = sym_file.digest
+    else:
+      self.sym_header = cros_generate_breakpad_symbols.ReadSymsHeader(sym_file)
+      self._content_digest = None
+    self.sym_file = sym_file
+
+  @property
+  def content_digest(self):
+    """The hash of the whole symbol file"""
+    if self._content_digest is None:
+      f = _OpenSymbol(self.sym_file)
+      try:
+        self._content_digest = _HashFile(f, hashlib.sha1())
+      finally:
+        f.close()
+    return self._content_digest
+
+
 # TODO(build): Delete this if check. http://crbug.com/341152
 if isolateserver:
-  class SymbolItem(isolateserver.BufferItem):
-    """Turn a sym_file into an isolateserver.Item"""
+  class SymbolItem(SymbolFile, isolateserver.BufferItem):
+    """Turn a sym_file into an isolateserver.Item
+
+    The item digest is the header; see content_digest for the whole file.
+    """
 
     ALGO = hashlib.sha1
 
     def __init__(self, sym_file):
-      sym_header = cros_generate_breakpad_symbols.ReadSymsHeader(sym_file)
-      super(SymbolItem, self).__init__(str(sym_header), self.ALGO)
-      self.sym_header = sym_header
-      self.sym_file = sym_file
+      SymbolFile.__init__(self, sym_file)
+      isolateserver.BufferItem.__init__(self, str(self.sym_header), self.ALGO)
+
+
+class DedupeIndex(object):
+  """Local record of the symbols we've already uploaded
+
+  Unlike the swarming service, this needs no server: every symbol that gets
+  uploaded is appended as a "<module name> <build id> <digest>" line, and
+  later runs skip anything listed.  Appends are done under a file lock, so the
+  index may be shared by multiple processes (or bots on shared storage).
+  Keep one index per upload server.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._entries = None
+
+  def _GetLock(self):
+    return locking.FileLock('%s.lock' % self.path, verbose=False)
+
+  @staticmethod
+  def Key(sym_item):
+    """Return the index entry for |sym_item| (a SymbolFile)"""
+    sym_header = sym_item.sym_header
+    return (sym_header.name, sym_header.id, sym_item.content_digest)
+
+  def _Load(self):
+    """Read the index the first time it's needed"""
+    if self._entries is None:
+      self._entries = set()
+      if os.path.exists(self.path):
+        with self._GetLock().read_lock():
+          for line in osutils.ReadFile(self.path).splitlines():
+            entry = tuple(line.split())
+            if len(entry) == 3:
+              self._entries.add(entry)
+    return self._entries
+
+  def __contains__(self, sym_item):
+    return self.Key(sym_item) in self._Load()
+
+  def __len__(self):
+    return len(self._Load())
+
+  def Add(self, sym_item):
+    """Record |sym_item| as being uploaded"""
+    entry = self.Key(sym_item)
+    osutils.SafeMakedirs(os.path.dirname(self.path))
+    with self._GetLock().write_lock():
+      with open(self.path, 'a') as f:
+        f.write('%s\n' % ' '.join(entry))
+    if self._entries is not None:
+      self._entries.add(entry)
 
 
 def SymbolDeduplicatorNotify(dedupe_namespace, dedupe_queue):
@@ -401,10 +734,11 @@ def SymbolDeduplicatorNotify(dedupe_namespace, dedupe_queue):
       continue
 
 
-def SymbolDeduplicator(storage, sym_paths):
+def SymbolDeduplicator(storage, sym_paths, dedupe_index=None):
   """Filter out symbol files that we've already uploaded
 
-  Using the swarming service, ask it to tell us which symbol files we've already
+  Anything recorded in the local |dedupe_index| is dropped first.  Then using
+  the swarming service, ask it to tell us which symbol files we've already
   uploaded in previous runs and/or by other bots.  If the query fails for any
   reason, we'll just upload all symbols.  This is fine as the symbol server will
   do the right thing and this phase is purely an optimization.
@@ -413,8 +747,9 @@ def SymbolDeduplicator(storage, sym_paths):
   storage object.  Saves us from having to recreate one all the time.
 
   Args:
-    storage: An isolateserver.StorageApi object
+    storage: An isolateserver.StorageApi object (may be None)
     sym_paths: List of symbol files to check against the dedupe server
+    dedupe_index: A DedupeIndex of symbols we uploaded before
 
   Returns:
     List of symbol files that have not been uploaded before
@@ -422,8 +757,15 @@ def SymbolDeduplicator(storage, sym_paths):
   if not sym_paths:
     return sym_paths
 
-  items = [SymbolItem(x) for x in sym_paths]
+  # The swarming service needs isolateserver items, but the local index can
+  # get by without that module.
   if storage:
+    items = [SymbolItem(x) for x in sym_paths]
+  else:
+    items = [SymbolFile(x) for x in sym_paths]
+  if dedupe_index is not None:
+    items = [x for x in items if x not in dedupe_index]
+  if storage and items:
     try:
       with timeout_util.Timeout(DEDUPE_TIMEOUT):
         items = storage.contains(items)
@@ -448,6 +790,35 @@ def IsTarball(path):
   return parts[-1] in ('tbz2', 'tbz', 'tgz', 'txz')
 
 
+def TarballSymbolFinder(tarball, tar):
+  """Locate symbol files in the opened |tar| without unpacking it
+
+  The tarball is read in one pass: the header & digest of each symbol file
+  are computed as we go, and the members are read again later on (in order)
+  only when they actually need uploading.
+
+  Args:
+    tarball: The path to the tarball.
+    tar: The tarfile.TarFile object for |tarball|.
+
+  Returns:
+    Yield a TarballMember for every file that ends in ".sym".
+  """
+  for tarinfo in tar:
+    if not tarinfo.isfile() or not tarinfo.name.endswith('.sym'):
+      continue
+
+    f = tar.extractfile(tarinfo)
+    try:
+      first_line = f.readline()
+      digest = _HashFile(f, hashlib.sha1(first_line))
+    finally:
+      f.close()
+    sym_header = cros_generate_breakpad_symbols.ReadSymsHeader(
+        cStringIO.StringIO(first_line))
+    yield TarballMember(tarball, tarinfo, header=sym_header, digest=digest)
+
+
 def SymbolFinder(tempdir, paths):
   """Locate symbol files in |paths|
 
@@ -455,7 +826,8 @@ def SymbolFinder(tempdir, paths):
     tempdir: Path to use for temporary files (caller will clean up).
     paths: A list of input paths to walk. Files are returned w/out any checks.
       Dirs are searched for files that end in ".sym". Urls are fetched and then
-      processed. Tarballs are unpacked and walked.
+      processed. Tarballs are read in place (or unpacked and walked when the
+      tarfile module can't handle them).
 
   Returns:
     Yield every viable sym file.
@@ -493,10 +865,18 @@ def SymbolFinder(tempdir, paths):
 
     elif IsTarball(p):
       cros_build_lib.Info('processing files inside %s', p)
-      tardir = tempfile.mkdtemp(dir=tempdir)
-      cache.Untar(os.path.realpath(p), tardir)
-      for p in SymbolFinder(tardir, [tardir]):
-        yield p
+      try:
+        tar = tarfile.open(p, 'r:*')
+      except tarfile.ReadError:
+        # Python can't read all the formats tar can (like xz), so unpack those.
+        tardir = tempfile.mkdtemp(dir=tempdir)
+        cache.Untar(os.path.realpath(p), tardir)
+        for p in SymbolFinder(tardir, [tardir]):
+          yield p
+      else:
+        with tar:
+          for p in TarballSymbolFinder(p, tar):
+            yield p
 
     else:
       yield p
@@ -533,7 +913,8 @@ def WriteQueueToFile(listing, queue, relpath=None):
 def UploadSymbols(board=None, official=False, breakpad_dir=None,
                   file_limit=DEFAULT_FILE_LIMIT, sleep=DEFAULT_SLEEP_DELAY,
                   upload_limit=None, sym_paths=None, failed_list=None,
-                  root=None, retry=True, dedupe_namespace=None):
+                  root=None, retry=True, dedupe_namespace=None,
+                  dedupe_index=None, max_concurrency=DEFAULT_MAX_CONCURRENCY):
   """Upload all the generated symbols for |board| to the crash server
 
   You can use in a few ways:
@@ -546,7 +927,8 @@ def UploadSymbols(board=None, official=False, breakpad_dir=None,
     official: Use the official symbol server rather than the staging one
     breakpad_dir: The full path to the breakpad directory where symbols live
     file_limit: The max file size of a symbol file before we try to strip it
-    sleep: How long to sleep in between uploads
+    sleep: How long to sleep in between uploads to begin with; the rate is
+      adjusted as we go based on how the server copes
     upload_limit: If set, only upload this many symbols (meant for testing)
     sym_paths: Specific symbol files (or dirs of sym files) to upload,
       otherwise search |breakpad_dir|
@@ -555,12 +937,16 @@ def UploadSymbols(board=None, official=False, breakpad_dir=None,
     root: The tree to prefix to |breakpad_dir| (if |breakpad_dir| is not set)
     retry: Whether we should retry failures.
     dedupe_namespace: The isolateserver namespace to dedupe uploaded symbols.
+    dedupe_index: Path to a local index file used to dedupe uploaded symbols.
+      This works with or without |dedupe_namespace|.
+    max_concurrency: The most symbols to upload at once.
 
   Returns:
     The number of errors that were encountered.
   """
   # TODO(build): Delete this assert.
-  assert isolateserver, 'Missing isolateserver import http://crbug.com/341152'
+  assert isolateserver or not dedupe_namespace, \
+      'Missing isolateserver import http://crbug.com/341152'
 
   if official:
     upload_url = OFFICIAL_UPLOAD_URL
@@ -603,13 +989,22 @@ def UploadSymbols(board=None, official=False, breakpad_dir=None,
   storage_notify_proc = multiprocessing.Process(
       target=SymbolDeduplicatorNotify, args=(dedupe_namespace, dedupe_queue))
 
+  if dedupe_index:
+    dedupe_index = DedupeIndex(dedupe_index)
+    cros_build_lib.Info('using %i symbols recorded in dedupe index %s',
+                        len(dedupe_index), dedupe_index.path)
+
   bg_errors = multiprocessing.Value('i')
   watermark_errors = multiprocessing.Value('f')
   failed_queue = multiprocessing.Queue()
+  # Pace the uploads as a whole rather than having each one sleep.
+  rate_control = UploadRateController(
+      max_concurrency=max_concurrency, rate=1.0 / sleep if sleep else None)
   uploader = functools.partial(
-      UploadSymbol, upload_url, file_limit=file_limit, sleep=sleep,
+      UploadSymbol, upload_url, file_limit=file_limit,
       num_errors=bg_errors, watermark_errors=watermark_errors,
-      failed_queue=failed_queue, passed_queue=dedupe_queue)
+      failed_queue=failed_queue, passed_queue=dedupe_queue,
+      dedupe_index=dedupe_index, rate_control=rate_control)
 
   start_time = datetime.datetime.now()
   Counters = cros_build_lib.Collection(
@@ -621,7 +1016,7 @@ def UploadSymbols(board=None, official=False, breakpad_dir=None,
       return
 
     missing_count = 0
-    for item in SymbolDeduplicator(storage_query, files):
+    for item in SymbolDeduplicator(storage_query, files, dedupe_index):
       missing_count += 1
 
       if counters.upload_limit == 0:
@@ -641,11 +1036,14 @@ def UploadSymbols(board=None, official=False, breakpad_dir=None,
       # For the first run, we collect the symbols that failed.  If the
       # overall failure rate was low, we'll retry them on the second run.
       for retry in (retry, False):
-        # We need to limit ourselves to one upload at a time to avoid the server
-        # kicking in DoS protection.  See these bugs for more details:
+        # The rate controller starts us off with one upload at a time to avoid
+        # the server kicking in DoS protection, and only runs more at once as
+        # long as the server keeps up.  See these bugs for more details:
         # http://crbug.com/209442
         # http://crbug.com/212496
-        with parallel.BackgroundTaskRunner(uploader, processes=1) as queue:
+        with parallel.BackgroundTaskRunner(
+            uploader, processes=max_concurrency,
+            onexit=_CloseTarballs) as queue:
           dedupe_list = []
           for sym_file in SymbolFinder(tempdir, sym_paths):
             dedupe_list.append(sym_file)
@@ -695,6 +1093,7 @@ def UploadSymbols(board=None, official=False, breakpad_dir=None,
     WriteQueueToFile(failed_list, failed_queue, breakpad_dir)
 
   finally:
+    _CloseTarballs()
     cros_build_lib.Info('finished uploading; joining background process')
     if dedupe_queue:
       dedupe_queue.put(None)
@@ -756,10 +1155,7 @@ def UploadSymbols(board=None, official=False, breakpad_dir=None,
 
 
 def main(argv):
-  # TODO(build): Delete this assert.
-  assert isolateserver, 'Missing isolateserver import http://crbug.com/341152'
-
-  parser = commandline.ArgumentParser(description=__doc__)
+  parser = commandline.ArgumentParser(description=__doc__, caching=True)
 
   parser.add_argument('sym_paths', type='path_or_uri', nargs='*', default=None,
                       help='symbol file or directory or URL or tarball')
@@ -779,7 +1175,16 @@ def main(argv):
   parser.add_argument('--failed-list', type='path',
                       help='where to save a list of failed symbols')
   parser.add_argument('--dedupe', action='store_true', default=False,
-                      help='use the swarming service to avoid re-uploading')
+                      help='use the swarming service & a local index to '
+                           'avoid re-uploading')
+  parser.add_argument('--dedupe-index', type='path', default=None,
+                      help='local index of uploaded symbols to avoid '
+                           're-uploading (may be on shared storage); '
+                           'works without --dedupe')
+  parser.add_argument('--max-concurrency', type=int,
+                      default=DEFAULT_MAX_CONCURRENCY,
+                      help='most symbols to upload at once (default: '
+                           '%(default)s)')
   parser.add_argument('--testing', action='store_true', default=False,
                       help='run in testing mode')
   parser.add_argument('--yes', action='store_true', default=False,
@@ -807,11 +1212,17 @@ def main(argv):
     SymUpload = TestingSymUpload
 
   dedupe_namespace = None
+  dedupe_index = opts.dedupe_index
   if opts.dedupe:
+    # TODO(build): Delete this assert.
+    assert isolateserver, 'Missing isolateserver import http://crbug.com/341152'
     if opts.official_build and not opts.testing:
       dedupe_namespace = OFFICIAL_DEDUPE_NAMESPACE
     else:
       dedupe_namespace = STAGING_DEDUPE_NAMESPACE
+    if dedupe_index is None:
+      dedupe_index = os.path.join(opts.cache_dir, constants.COMMON_CACHE,
+                                  DEDUPE_INDEX_DIR, dedupe_namespace)
 
   if not opts.yes:
     prolog = '\n'.join(textwrap.wrap(textwrap.dedent("""
@@ -836,7 +1247,9 @@ def main(argv):
                        file_limit=opts.strip_cfi, sleep=DEFAULT_SLEEP_DELAY,
                        upload_limit=opts.upload_limit, sym_paths=opts.sym_paths,
                        failed_list=opts.failed_list,
-                       dedupe_namespace=dedupe_namespace)
+                       dedupe_namespace=dedupe_namespace,
+                       dedupe_index=dedupe_index,
+                       max_concurrency=opts.max_concurrency)
   if ret:
     cros_build_lib.Error('encountered %i problem(s)', ret)
     # Since exit(status) gets masked, clamp it to 1 so we don't inadvertently
@@ -7,11 +7,16 @@
 
 from __future__ import print_function
 
+import BaseHTTPServer
 import ctypes
+import hashlib
 import logging
 import multiprocessing
 import os
+import pickle
+import SocketServer
 import sys
+import threading
 import time
 import urllib2
 
@@ -150,7 +155,38 @@ class UploadSymbolsTest(cros_test_lib.MockTempDirTestCase):
     cros_build_lib.CreateTarball(
         'syms.tar.gz', self.tempdir, compression=cros_build_lib.COMP_GZIP,
         inputs=('foo', 'bar', 'some'))
+
+    def _Uploader(*args, **_kwargs):
+      """Read the symbol out of the tarball like SymUpload does"""
+      args[1].sym_file.Open().read()
+      return 0
+    self.upload_mock.side_effect = _Uploader
+
     self._testUpload([tarball], sym_paths=self.sym_paths)
+    # pylint: disable=W0212
+    self.assertEqual(upload_symbols._OPEN_TARBALLS, {})
+
+  def testUploadDedupeIndex(self):
+    """Verify symbols in the local dedupe index are skipped on later runs"""
+    index = os.path.join(self.tempdir, 'index')
+    # The header is mocked, so make sure each file has a unique digest.
+    for sym_path in self.sym_paths:
+      osutils.WriteFile(os.path.join(self.tempdir, sym_path), sym_path)
+
+    def _Uploader(*args, **kwargs):
+      """Record the uploaded symbol in the index"""
+      kwargs['dedupe_index'].Add(args[1])
+      return 0
+    self.upload_mock.side_effect = _Uploader
+
+    for expected_count in (3, 0):
+      self.upload_mock.reset_mock()
+      with parallel_unittest.ParallelMock():
+        ret = upload_symbols.UploadSymbols('', breakpad_dir=self.tempdir,
+                                           sleep=0, retry=False,
+                                           dedupe_index=index)
+        self.assertEqual(ret, 0)
+        self.assertEqual(self.upload_mock.call_count, expected_count)
 
   def testUploadRemoteTarball(self):
     """Test uploading symbols contains in a remote tarball"""
@@ -254,6 +290,63 @@ class SymbolDeduplicatorTest(cros_test_lib.MockTestCase):
     self.assertEqual(self.header_mock.call_count, len(sym_paths))
     self.assertEqual(len(ret), len(sym_paths))
 
+  def testDedupeIndex(self):
+    """Symbols in the local index should not reach the dedupe server"""
+    self.storage_mock.contains.side_effect = lambda items: items
+    index = mock.MagicMock()
+    index.__contains__.side_effect = lambda item: item.sym_file == '/b'
+    ret = upload_symbols.SymbolDeduplicator(self.storage_mock, ['/a', '/b'],
+                                            dedupe_index=index)
+    self.assertEqual([x.sym_file for x in ret], ['/a'])
+    items = self.storage_mock.contains.call_args[0][0]
+    self.assertEqual([x.sym_file for x in items], ['/a'])
+
+  def testDedupeIndexNoStorage(self):
+    """The local index should work without the dedupe server"""
+    index = mock.MagicMock()
+    index.__contains__.side_effect = lambda item: item.sym_file == '/b'
+    ret = upload_symbols.SymbolDeduplicator(None, ['/a', '/b'],
+                                            dedupe_index=index)
+    self.assertEqual([x.sym_file for x in ret], ['/a'])
+    self.assertFalse(isinstance(ret[0], isolateserver.Item))
+
+  def testDedupeIndexAll(self):
+    """Do not talk to the dedupe server when the index has everything"""
+    index = mock.MagicMock()
+    index.__contains__.return_value = True
+    ret = upload_symbols.SymbolDeduplicator(self.storage_mock, ['/a', '/b'],
+                                            dedupe_index=index)
+    self.assertEqual(ret, [])
+    self.assertEqual(self.storage_mock.contains.call_count, 0)
+
+
+class DedupeIndexTest(cros_test_lib.TempDirTestCase):
+  """Tests for DedupeIndex"""
+
+  def setUp(self):
+    self.index_path = os.path.join(self.tempdir, 'some', 'dir', 'index')
+    self.sym_file = os.path.join(self.tempdir, 'foo.sym')
+    osutils.WriteFile(self.sym_file, 'MODULE Linux arm 123-456 blkid\n')
+
+  def testAddAndLoad(self):
+    """Entries should persist between instances"""
+    item = upload_symbols.SymbolFile(self.sym_file)
+    index = upload_symbols.DedupeIndex(self.index_path)
+    self.assertFalse(item in index)
+    index.Add(item)
+    self.assertTrue(item in index)
+
+    index = upload_symbols.DedupeIndex(self.index_path)
+    self.assertEqual(len(index), 1)
+    self.assertTrue(item in index)
+
+  def testContentChange(self):
+    """A symbol with the same header but new content is not deduped"""
+    index = upload_symbols.DedupeIndex(self.index_path)
+    index.Add(upload_symbols.SymbolFile(self.sym_file))
+    osutils.WriteFile(self.sym_file, 'PUBLIC 1471 0 main\n', mode='a')
+    self.assertFalse(upload_symbols.SymbolFile(self.sym_file) in index)
+
 
 class UploadSymbolTest(cros_test_lib.MockTempDirTestCase):
   """Tests for UploadSymbol()"""
@@ -272,6 +365,15 @@ class UploadSymbolTest(cros_test_lib.MockTempDirTestCase):
     self.upload_mock.assert_called_with(self.url, self.sym_item)
     self.assertEqual(self.upload_mock.call_count, 1)
 
+  def testUploadSymbolDedupeIndex(self):
+    """Verify passed symbols are recorded in the dedupe index"""
+    osutils.Touch(self.sym_file)
+    index = mock.MagicMock()
+    ret = upload_symbols.UploadSymbol(self.url, self.sym_item,
+                                      dedupe_index=index)
+    self.assertEqual(ret, 0)
+    index.Add.assert_called_once_with(self.sym_item)
+
   def testUploadSymbolErrorCountExceeded(self):
     """Verify that when the error count gets too high, we stop uploading"""
     errors = ctypes.c_int(10000)
@@ -334,6 +436,162 @@ class UploadSymbolTest(cros_test_lib.MockTempDirTestCase):
     self.assertEqual(warn_mock.call_count, 1)
 
 
+class UploadRateControllerTest(cros_test_lib.MockTestCase):
+  """Tests for UploadRateController"""
+
+  def setUp(self):
+    self.now = 1000.0
+    def _Sleep(secs):
+      self.now += secs
+    self.PatchObject(time, 'time', side_effect=lambda: self.now)
+    self.PatchObject(time, 'sleep', side_effect=_Sleep)
+
+  def testConcurrencyAIMD(self):
+    """Concurrency should grow slowly on success & halve on throttling"""
+    rc = upload_symbols.UploadRateController(max_concurrency=4)
+    self.assertEqual(rc.limit, 1)
+    self.assertEqual(rc.rate, None)
+    for _ in xrange(20):
+      rc.Acquire()
+      rc.Release()
+    self.assertEqual(rc.limit, 4)
+    rc.Release(success=False, throttled=True)
+    self.assertEqual(rc.limit, 2)
+    rc.Release(success=False, throttled=True)
+    rc.Release(success=False, throttled=True)
+    self.assertEqual(rc.limit, 1)
+    # Plain failures (e.g. bad requests) don't change anything.
+    rc.Release(success=False)
+    self.assertEqual(rc.limit, 1)
+
+  def testConcurrencyLimit(self):
+    """Acquire should wait for a slot to free up"""
+    rc = upload_symbols.UploadRateController(max_concurrency=4)
+    rc.Acquire()
+    # Free up the slot once we've waited a little while.
+    def _Sleep(_secs):
+      rc.Release()
+    time.sleep.side_effect = _Sleep
+    rc.Acquire()
+    self.assertEqual(time.sleep.call_count, 1)
+
+  def testTokenBucket(self):
+    """Uploads should start at the specified rate, and speed up over time"""
+    rc = upload_symbols.UploadRateController(max_concurrency=1, rate=2)
+    start = self.now
+    rc.Acquire()
+    self.assertEqual(self.now, start)
+    rc.Release()
+    self.assertTrue(rc.rate > 2)
+    rc.Acquire()
+    self.assertTrue(0 < self.now - start < 0.5)
+
+  def testTokenBucketThrottled(self):
+    """Throttling should slow the rate down & pause uploads"""
+    rc = upload_symbols.UploadRateController(max_concurrency=1, rate=2)
+    rc.Acquire()
+    rc.Release(success=False, throttled=True)
+    self.assertEqual(rc.rate, 1)
+    for _ in xrange(10):
+      rc.Release(success=False, throttled=True)
+    self.assertEqual(rc.rate, 2 * upload_symbols.MIN_RATE_FACTOR)
+    start = self.now
+    rc.Acquire()
+    self.assertTrue(self.now - start >= 1 / rc.rate)
+
+  def testBigFiles(self):
+    """Big files should use up more of the rate than small ones"""
+    rc = upload_symbols.UploadRateController(max_concurrency=1, rate=1)
+    rc.Acquire(size=3 * upload_symbols.RATE_BYTES_PER_TOKEN)
+    rc.Release(success=False)
+    start = self.now
+    rc.Acquire()
+    self.assertTrue(self.now - start >= 4)
+
+
+class _ThrottlingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Reject uploads w/HTTP 429 when too many are in flight at once."""
+
+  def do_POST(self):
+    server = self.server
+    self.rfile.read(int(self.headers['Content-Length']))
+    with server.lock:
+      server.active += 1
+      server.max_active = max(server.max_active, server.active)
+      throttled = server.active > server.max_concurrency
+    try:
+      time.sleep(0.02)
+      if throttled:
+        server.throttled += 1
+        self.send_response(429)
+      else:
+        server.uploads += 1
+        self.send_response(200)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+    finally:
+      with server.lock:
+        server.active -= 1
+
+  def log_message(self, *_args):
+    pass
+
+
+class _ThrottlingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """A local stand-in for a crash server with DoS protection."""
+
+  daemon_threads = True
+
+  def __init__(self, max_concurrency):
+    BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                       _ThrottlingHandler)
+    self.lock = threading.Lock()
+    self.max_concurrency = max_concurrency
+    self.active = 0
+    self.max_active = 0
+    self.uploads = 0
+    self.throttled = 0
+
+  @property
+  def url(self):
+    return 'http://localhost:%i/upload' % self.server_address[1]
+
+
+class UploadSymbolsThrottlingTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for UploadSymbols() against a server that throttles us"""
+
+  def setUp(self):
+    self.server = _ThrottlingServer(max_concurrency=2)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    self.sym_paths = []
+    for i in xrange(30):
+      sym_file = os.path.join(self.tempdir, '%i.sym' % i)
+      osutils.WriteFile(sym_file, 'MODULE Linux arm %i blkid\n' % i)
+      self.sym_paths.append(sym_file)
+
+    def SymUpload(upload_url, sym_item):
+      urllib2.urlopen(upload_url, osutils.ReadFile(sym_item.sym_file)).read()
+    self.PatchObject(upload_symbols, 'SymUpload', side_effect=SymUpload)
+    self.PatchObject(upload_symbols, 'STAGING_UPLOAD_URL', self.server.url)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testAdaptiveConcurrency(self):
+    """All symbols should make it up even though the server pushes back"""
+    # Start off fast enough that the server will throttle us.
+    ret = upload_symbols.UploadSymbols(sym_paths=self.sym_paths, sleep=0.001,
+                                       max_concurrency=4)
+    self.assertEqual(ret, 0)
+    # Every file got uploaded exactly once (plus throttled retries).
+    self.assertEqual(self.server.uploads, len(self.sym_paths))
+    self.assertTrue(self.server.max_active > 1)
+
+
 class SymUploadTest(cros_test_lib.MockTempDirTestCase):
   """Tests for SymUpload()"""
 
@@ -373,6 +631,87 @@ PUBLIC 1471 0 main"""
     self.assertTrue(self.SYM_CONTENTS in data)
 
 
+class SymbolFinderTest(cros_test_lib.TempDirTestCase):
+  """Tests for SymbolFinder()"""
+
+  # pylint: disable=W0212
+
+  SYM_CONTENTS = 'MODULE Linux arm 123-456 blkid\nPUBLIC 1471 0 main\n'
+
+  def testTarballMembers(self):
+    """Symbols in tarballs should be read w/out unpacking them"""
+    srcdir = os.path.join(self.tempdir, 'src')
+    osutils.WriteFile(os.path.join(srcdir, 'a', 'foo.sym'), self.SYM_CONTENTS,
+                      makedirs=True)
+    osutils.WriteFile(os.path.join(srcdir, 'a', 'ignored'), '')
+    tarball = os.path.join(self.tempdir, 'syms.tar.bz2')
+    cros_build_lib.CreateTarball(tarball, srcdir,
+                                 compression=cros_build_lib.COMP_BZIP2,
+                                 inputs=('a',))
+    workdir = os.path.join(self.tempdir, 'work')
+    osutils.SafeMakedirs(workdir)
+
+    syms = list(upload_symbols.SymbolFinder(workdir, [tarball]))
+    self.assertEqual(syms, [os.path.join(tarball, 'a', 'foo.sym')])
+    self.assertEqual(os.listdir(workdir), [])
+
+    sym = syms[0]
+    self.assertEqual(sym.header.name, 'blkid')
+    self.assertEqual(sym.size, len(self.SYM_CONTENTS))
+    item = upload_symbols.SymbolItem(sym)
+    self.assertEqual(item.sym_header.id, '123-456')
+    self.assertEqual(item.content_digest,
+                     hashlib.sha1(self.SYM_CONTENTS).hexdigest())
+
+    # Make sure the member survives being passed to the uploader processes.
+    sym = pickle.loads(pickle.dumps(sym, pickle.HIGHEST_PROTOCOL))
+    self.assertEqual(sym.Open().read(), self.SYM_CONTENTS)
+
+    # The tarball stays open for later members until we're done uploading.
+    key = (os.getpid(), tarball)
+    tar = upload_symbols._OPEN_TARBALLS[key]
+    upload_symbols._CloseTarballs()
+    self.assertFalse(key in upload_symbols._OPEN_TARBALLS)
+    self.assertTrue(tar.closed)
+
+
+class MainTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for main()"""
+
+  def setUp(self):
+    self.upload_mock = self.PatchObject(upload_symbols, 'UploadSymbols',
+                                        return_value=0)
+    self.sym_file = os.path.join(self.tempdir, 'foo.sym')
+    self.cache_dir = os.path.join(self.tempdir, 'cache')
+
+  def _Main(self, *args):
+    """Run main() on our symbol file w/the extra |args|"""
+    argv = ['--yes', '--cache-dir', self.cache_dir, self.sym_file] + list(args)
+    self.assertEqual(upload_symbols.main(argv), 0)
+    self.assertEqual(self.upload_mock.call_count, 1)
+    return self.upload_mock.call_args[1]
+
+  def testDedupeIndexOnly(self):
+    """--dedupe-index should not turn on the swarming service"""
+    index = os.path.join(self.tempdir, 'index')
+    kwargs = self._Main('--dedupe-index', index)
+    self.assertEqual(kwargs['dedupe_namespace'], None)
+    self.assertEqual(kwargs['dedupe_index'], index)
+
+  def testDedupe(self):
+    """--dedupe should use the swarming service & a default local index"""
+    kwargs = self._Main('--dedupe')
+    self.assertEqual(kwargs['dedupe_namespace'],
+                     upload_symbols.STAGING_DEDUPE_NAMESPACE)
+    self.assertTrue(kwargs['dedupe_index'].startswith(self.cache_dir))
+
+  def testNoDedupe(self):
+    """Nothing should be deduped by default"""
+    kwargs = self._Main()
+    self.assertEqual(kwargs['dedupe_namespace'], None)
+    self.assertEqual(kwargs['dedupe_index'], None)
+
+
 class UtilTest(cros_test_lib.TempDirTestCase):
   """Various tests for utility funcs."""
 
@@ -17,10 +17,15 @@ from __future__ import print_function
 
 import glob
 import errno
+import mmap
 import optparse
 import os
 import shutil
 import sys
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
 
 from elftools.elf.elffile import ELFFile
 from elftools.common import exceptions
@@ -214,6 +219,22 @@ def LoadLdpaths(root='/'):
   return ldpaths
 
 
+def _GetCompatInfo(elf):
+  """Return the aspects of |elf| (an ELFFile) that CompatibleELFs checks"""
+  return (elf.header['e_ident']['EI_OSABI'], elf.elfclass, elf.little_endian,
+          elf.header['e_machine'])
+
+
+def _CompatibleInfo(info1, info2):
+  """See if two ELFs are compatible given their _GetCompatInfo()"""
+  osabis = frozenset([info1[0], info2[0]])
+  compat_sets = (
+    frozenset('ELFOSABI_%s' % x for x in ('NONE', 'SYSV', 'GNU', 'LINUX',)),
+  )
+  return ((len(osabis) == 1 or any(osabis.issubset(x) for x in compat_sets)) and
+    info1[1:] == info2[1:])
+
+
 def CompatibleELFs(elf1, elf2):
   """See if two ELFs are compatible
 
@@ -226,38 +247,181 @@ def CompatibleELFs(elf1, elf2):
   Returns:
     True if compatible, False otherwise
   """
-  osabis = frozenset([e.header['e_ident']['EI_OSABI'] for e in (elf1, elf2)])
-  compat_sets = (
-    frozenset('ELFOSABI_%s' % x for x in ('NONE', 'SYSV', 'GNU', 'LINUX',)),
-  )
-  return ((len(osabis) == 1 or any(osabis.issubset(x) for x in compat_sets)) and
-    elf1.elfclass == elf2.elfclass and
-    elf1.little_endian == elf2.little_endian and
-    elf1.header['e_machine'] == elf2.header['e_machine'])
+  return _CompatibleInfo(_GetCompatInfo(elf1), _GetCompatInfo(elf2))
+
+
+def _ReadELFInfo(path):
+  """Read the bits of the ELF at |path| that we need to walk its deps
+
+  Returns:
+    a dict with the compat info, the (raw) interp, rpath & runpath (or None
+    if unset), and the list of needed libs
+  """
+  with open(path, 'rb') as f:
+    # Parse out of a mapping rather than via lots of small reads & seeks.
+    try:
+      stream = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError):
+      # Empty files can't be mapped; let ELFFile reject it.
+      stream = f
+
+    try:
+      elf = ELFFile(stream)
+      info = {
+        'compat': _GetCompatInfo(elf),
+        'interp': None,
+        'rpath': None,
+        'runpath': None,
+        'needed': [],
+      }
+      seen_dynamic = False
+      for segment in elf.iter_segments():
+        if segment.header.p_type == 'PT_INTERP':
+          if info['interp'] is None:
+            info['interp'] = bstr(segment.get_interp_name())
+        elif segment.header.p_type == 'PT_DYNAMIC' and not seen_dynamic:
+          # XXX: We assume there is only one PT_DYNAMIC.  This is
+          # probably fine since the runtime ldso does the same.
+          seen_dynamic = True
+          for t in segment.iter_tags():
+            if t.entry.d_tag == 'DT_RPATH':
+              info['rpath'] = bstr(t.rpath)
+            elif t.entry.d_tag == 'DT_RUNPATH':
+              info['runpath'] = bstr(t.runpath)
+            elif t.entry.d_tag == 'DT_NEEDED':
+              info['needed'].append(bstr(t.needed))
+      del elf
+    finally:
+      if stream is not f:
+        stream.close()
+
+  return info
+
+
+class ELFCache(object):
+  """Remember what we've read out of ELFs, and what libs each dir holds
+
+  Reading ELFs is the slow part of walking dependency trees, and most ELFs
+  share the same libraries.  Entries are keyed by path and checked against
+  the inode, mtime & size of the file, so changed files get read again.
+  Directory listings are checked against the dir's mtime, and let us skip
+  looking for libs in dirs that don't have them.
+
+  If given a |path|, the ELF entries are loaded from there, and Save() writes
+  them back so later runs can reuse them.  If given |elfs|, the ELF entries
+  are kept in it rather than a private dict; e.g. pass a multiprocessing
+  manager dict to share them between processes.
+  """
+
+  VERSION = 1
+
+  def __init__(self, path=None, elfs=None):
+    self.path = path
+    self._elfs = {} if elfs is None else elfs
+    self._dirs = {}
+    self._dirty = False
+    if path:
+      self.Load()
+
+  def Load(self):
+    """Load the ELF entries saved in our path (if any)"""
+    try:
+      with open(self.path, 'rb') as f:
+        version, elfs = pickle.load(f)
+      if version == self.VERSION:
+        self._elfs.update(elfs)
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        warn('%s: unable to load cache: %s' % (self.path, e))
+    except Exception as e:
+      warn('%s: ignoring corrupt cache: %s' % (self.path, e))
+
+  def Save(self):
+    """Save the ELF entries to our path (if anything changed)"""
+    if not self.path or not self._dirty:
+      return
+    tmp = '%s.tmp.%i' % (self.path, os.getpid())
+    with open(tmp, 'wb') as f:
+      pickle.dump((self.VERSION, dict(self._elfs)), f,
+                  pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, self.path)
+    self._dirty = False
+
+  def ListDir(self, path):
+    """Return the set of names in the dir |path| (empty if it's missing)"""
+    try:
+      mtime = os.stat(path).st_mtime
+    except OSError:
+      return frozenset()
+    entry = self._dirs.get(path)
+    if entry is None or entry[0] != mtime:
+      try:
+        entry = (mtime, frozenset(os.listdir(path)))
+      except OSError:
+        return frozenset()
+      self._dirs[path] = entry
+    return entry[1]
+
+  def Read(self, path):
+    """Return the _ReadELFInfo() for |path|, reading it only if need be"""
+    st = os.stat(path)
+    stamp = (st.st_ino, st.st_mtime, st.st_size)
+    entry = self._elfs.get(path)
+    if entry is None or entry[0] != stamp:
+      entry = (stamp, _ReadELFInfo(path))
+      self._elfs[path] = entry
+      self._dirty = True
+    return entry[1]
+
+
+# The cache used by default by everything in this process.
+_ELF_CACHE = ELFCache()
 
 
-def FindLib(elf, lib, ldpaths):
+def GetELFCache():
+  """Return the process-wide ELFCache"""
+  return _ELF_CACHE
+
+
+def _FindLib(info, lib, ldpaths, elf_cache):
+  """Like FindLib(), but for an ELF we have the _ReadELFInfo() of"""
+  for ldpath in ldpaths:
+    path = os.path.join(ldpath, lib)
+    # Plain names can be checked against the (cached) dir listing, but names
+    # with a / in them live in subdirs, so look them up directly.
+    if os.path.sep in lib:
+      if not os.path.exists(path):
+        continue
+    elif lib not in elf_cache.ListDir(ldpath):
+      continue
+    try:
+      libinfo = elf_cache.Read(path)
+    except (IOError, OSError):
+      # Broken symlinks and such.
+      continue
+    if _CompatibleInfo(info['compat'], libinfo['compat']):
+      return path
+  return None
+
+
+def FindLib(elf, lib, ldpaths, elf_cache=None):
   """Try to locate a |lib| that is compatible to |elf| in the given |ldpaths|
 
   Args:
     elf: the elf which the library should be compatible with (ELF wise)
     lib: the library (basename) to search for
     ldpaths: a list of paths to search
+    elf_cache: the ELFCache to use (defaults to the process-wide one)
   Returns:
     the full path to the desired library
   """
-  for ldpath in ldpaths:
-    path = os.path.join(ldpath, lib)
-    if os.path.exists(path):
-      with open(path, 'rb') as f:
-        libelf = ELFFile(f)
-        if CompatibleELFs(elf, libelf):
-          return path
-  return None
+  if elf_cache is None:
+    elf_cache = _ELF_CACHE
+  return _FindLib({'compat': _GetCompatInfo(elf)}, lib, ldpaths, elf_cache)
 
 
 def ParseELF(path, root='/', ldpaths={'conf':[], 'env':[], 'interp':[]},
-             _first=True, _all_libs={}):
+             _first=True, _all_libs={}, cache=None, elf_cache=None):
   """Parse the ELF dependency tree of the specified file
 
   Args:
@@ -266,6 +430,10 @@ def ParseELF(path, root='/', ldpaths={'conf':[], 'env':[], 'interp':[]},
           only as |path| and |ldpaths| are expected to be prefixed already
     ldpaths: dict containing library paths to search; should have the keys:
              conf, env, interp
+    cache: dict to remember parsed libraries in; pass the same one to many
+           calls so that libraries they share are only looked up & parsed once
+    elf_cache: the ELFCache to read ELFs through (defaults to the
+               process-wide one)
     _first: Recursive use only; is this the first ELF ?
     _all_libs: Recursive use only; dict of all libs we've seen
   Returns:
@@ -285,6 +453,8 @@ def ParseELF(path, root='/', ldpaths={'conf':[], 'env':[], 'interp':[]},
       },
     }
   """
+  if elf_cache is None:
+    elf_cache = _ELF_CACHE
   if _first:
     _all_libs = {}
     ldpaths = ldpaths.copy()
@@ -297,80 +467,104 @@ def ParseELF(path, root='/', ldpaths={'conf':[], 'env':[], 'interp':[]},
     'libs': _all_libs,
   }
 
-  with open(path, 'rb') as f:
-    elf = ELFFile(f)
+  # Where a library finds its own deps depends on the paths we search.
+  cache_key = None
+  if cache is not None and not _first:
+    cache_key = (path, root,
+                 tuple((k, tuple(v)) for k, v in sorted(ldpaths.items())))
 
-    # If this is the first ELF, extract the interpreter.
-    if _first:
-      for segment in elf.iter_segments():
-        if segment.header.p_type != 'PT_INTERP':
-          continue
+  if cache_key is not None and cache_key in cache:
+    rpaths, runpaths, libs, found = cache[cache_key]
+  else:
+    info = elf_cache.Read(path)
 
-        interp = bstr(segment.get_interp_name())
-        ret['interp'] = normpath(root + interp)
-        ret['libs'][os.path.basename(interp)] = {
-          'path': ret['interp'],
-          'needed': [],
-        }
-        # XXX: Should read it and scan for /lib paths.
-        ldpaths['interp'] = [
-          normpath(root + os.path.dirname(interp)),
-          normpath(root + '/usr' + os.path.dirname(interp)),
-        ]
-        break
-
-    # Parse the ELF's dynamic tags.
-    libs = []
+    # If this is the first ELF, extract the interpreter.
+    if _first and info['interp'] is not None:
+      interp = info['interp']
+      ret['interp'] = normpath(root + interp)
+      ret['libs'][os.path.basename(interp)] = {
+        'path': ret['interp'],
+        'needed': [],
+      }
+      # XXX: Should read it and scan for /lib paths.
+      ldpaths['interp'] = [
+        normpath(root + os.path.dirname(interp)),
+        normpath(root + '/usr' + os.path.dirname(interp)),
+      ]
+
+    # Process the ELF's dynamic tags.
+    libs = info['needed']
     rpaths = []
     runpaths = []
-    for segment in elf.iter_segments():
-      if segment.header.p_type != 'PT_DYNAMIC':
-        continue
-
-      for t in segment.iter_tags():
-        if t.entry.d_tag == 'DT_RPATH':
-          rpaths = ParseLdPaths(bstr(t.rpath), root=root, path=path)
-        elif t.entry.d_tag == 'DT_RUNPATH':
-          runpaths = ParseLdPaths(bstr(t.runpath), root=root, path=path)
-        elif t.entry.d_tag == 'DT_NEEDED':
-          libs.append(bstr(t.needed))
-      if runpaths:
-        # If both RPATH and RUNPATH are set, only the latter is used.
-        rpaths = []
-
-      # XXX: We assume there is only one PT_DYNAMIC.  This is
-      # probably fine since the runtime ldso does the same.
-      break
+    if info['rpath'] is not None:
+      rpaths = ParseLdPaths(info['rpath'], root=root, path=path)
+    if info['runpath']:
+      # An empty RUNPATH doesn't give us any paths, so it can't hide RPATH.
+      runpaths = ParseLdPaths(info['runpath'], root=root, path=path)
+    if runpaths:
+      # If both RPATH and RUNPATH are set, only the latter is used.
+      rpaths = []
     if _first:
       # Propagate the rpaths used by the main ELF since those will be
       # used at runtime to locate things.
       ldpaths['rpath'] = rpaths
       ldpaths['runpath'] = runpaths
-    ret['rpath'] = rpaths
-    ret['runpath'] = runpaths
-    ret['needed'] = libs
 
-    # Search for the libs this ELF uses.
+    # Search for the libs this ELF uses.  If we're caching the result,
+    # we need all of them, not just the ones this tree hasn't seen yet.
+    found = {}
     all_ldpaths = None
     for lib in libs:
-      if lib in _all_libs:
+      if lib in _all_libs and cache_key is None:
         continue
       if all_ldpaths is None:
         all_ldpaths = rpaths + ldpaths['rpath'] + ldpaths['env'] + runpaths + ldpaths['runpath'] + ldpaths['conf'] + ldpaths['interp']
-      fullpath = FindLib(elf, lib, all_ldpaths)
-      _all_libs[lib] = {
-        'path': fullpath,
-        'needed': [],
-      }
-      if fullpath:
-        lret = ParseELF(fullpath, root, ldpaths, False, _all_libs)
-        _all_libs[lib]['needed'] = lret['needed']
-
-    del elf
+      found[lib] = _FindLib(info, lib, all_ldpaths, elf_cache)
+
+    if cache_key is not None:
+      cache[cache_key] = (rpaths, runpaths, libs, found)
+
+  ret['rpath'] = rpaths
+  ret['runpath'] = runpaths
+  ret['needed'] = libs
+
+  for lib in libs:
+    if lib in _all_libs:
+      continue
+    fullpath = found[lib]
+    _all_libs[lib] = {
+      'path': fullpath,
+      'needed': [],
+    }
+    if fullpath:
+      lret = ParseELF(fullpath, root, ldpaths, False, _all_libs, cache=cache,
+                      elf_cache=elf_cache)
+      _all_libs[lib]['needed'] = lret['needed']
 
   return ret
 
 
+def ParseELFs(paths, root='/', ldpaths={'conf':[], 'env':[], 'interp':[]},
+              elf_cache=None):
+  """Parse the ELF dependency trees of all the specified files in one pass
+
+  This is like calling ParseELF() on each of |paths|, but the libraries they
+  share are only looked up & parsed once.
+
+  Args:
+    paths: The ELFs to scan
+    root: See ParseELF()
+    ldpaths: See ParseELF()
+    elf_cache: See ParseELF()
+  Returns:
+    a dict mapping each of |paths| to its ParseELF() result
+  """
+  cache = {}
+  return dict((path, ParseELF(path, root, ldpaths, cache=cache,
+                              elf_cache=elf_cache))
+              for path in paths)
+
+
 def _NormalizePath(option, _opt, value, parser):
   setattr(parser.values, option.dest, normpath(value))
 
@@ -558,6 +752,9 @@ they need will be placed into /foo/lib/ only.""")
   parser.add_option('--skip-non-elfs',
     action='store_true', default=False,
     help='Skip plain (non-ELF) files instead of warning')
+  parser.add_option('--cache',
+    default=None, type='string',
+    help='Remember parsed ELFs in this file to speed up later runs')
   parser.add_option('-V', '--version',
     action='callback', callback=_ShowVersion,
     help='Show version information')
@@ -608,6 +805,10 @@ they need will be placed into /foo/lib/ only.""")
     print('ldpaths[conf] =', ldpaths['conf'])
     print('ldpaths[env]  =', ldpaths['env'])
 
+  # The ELFs will share most of their libraries, so only look at them once.
+  elf_cache = ELFCache(path=options.cache) if options.cache else GetELFCache()
+  tree_cache = {}
+
   # Process all the files specified.
   ret = 0
   for path in paths:
@@ -621,7 +822,8 @@ they need will be placed into /foo/lib/ only.""")
     for p in glob.iglob(path):
       matched = True
       try:
-        elf = ParseELF(p, options.root, ldpaths)
+        elf = ParseELF(p, options.root, ldpaths, cache=tree_cache,
+                       elf_cache=elf_cache)
       except exceptions.ELFError as e:
         if options.skip_non_elfs:
           continue
@@ -640,7 +842,7 @@ they need will be placed into /foo/lib/ only.""")
         ret = 1
         warn('%s: %s' % (p, e))
         continue
-      except IOError as e:
+      except (IOError, OSError) as e:
         ret = 1
         warn('%s: %s' % (p, e))
         continue
@@ -654,6 +856,7 @@ they need will be placed into /foo/lib/ only.""")
       ret = 1
       warn('%s: did not match any paths' % (path,))
 
+  elf_cache.Save()
   return ret
 
 